@@ -0,0 +1,45 @@
+import time
+
+import numpy as np
+
+from horch.detection.anchor import find_priors_kmeans, iou_wh
+
+
+def random_sizes(n, k=9, seed=0):
+    centers = np.random.RandomState(k).uniform(0.02, 0.8, size=(k, 2))
+    rng = np.random.RandomState(seed)
+    return centers[rng.randint(k, size=n)] * rng.lognormal(0, 0.2, size=(n, 2))
+
+
+def bench_find_priors(sizes=(100000, 1000000), k=9):
+    print("%10s %10s %10s %10s" % ("boxes", "method", "time(ms)", "mean IoU"))
+    for n in sizes:
+        boxes = random_sizes(n, k)
+        for method in ['lloyd', 'minibatch']:
+            np.random.seed(0)
+            start = time.perf_counter()
+            priors = find_priors_kmeans(boxes.astype(np.float32), k, verbose=False, method=method).numpy()
+            elapsed = (time.perf_counter() - start) * 1000
+            print("%10d %10s %10.1f %10.4f" % (n, method, elapsed, iou_wh(boxes, priors).max(axis=1).mean()))
+
+
+def bench_find_priors_stream(n=10000000, chunk_size=100000, k=9):
+    def chunks():
+        for i in range(n // chunk_size):
+            yield random_sizes(chunk_size, k, seed=i)
+
+    start = time.perf_counter()
+    for _ in chunks():
+        pass
+    t_data = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    priors = find_priors_kmeans(chunks(), k, verbose=False, method='minibatch', seed=0).numpy()
+    elapsed = (time.perf_counter() - start) * 1000
+    print("streamed %d boxes: %.1f ms (%.1f ms generating them), mean IoU %.4f" % (
+        n, elapsed, t_data, iou_wh(random_sizes(100000, k, seed=123), priors).max(axis=1).mean()))
+
+
+if __name__ == '__main__':
+    bench_find_priors()
+    bench_find_priors_stream()
@@ -0,0 +1,32 @@
+import torch
+
+from horch import _C as _native
+from horch._fallback import _C as _fallback
+
+from benchmark.nms import random_boxes, timeit
+
+
+def bench_backends():
+    boxes = {n: random_boxes(n) for n in (1000, 5000)}
+    scores = {n: torch.rand(n) for n in boxes}
+    input = torch.randn(2, 256, 50, 50)
+    rois = torch.cat([torch.randint(2, (512, 1)).float(), random_boxes(512).clamp(0, 1)], dim=1)
+    cases = [
+        ("nms N=%d" % n, lambda C, n=n: C.nms(boxes[n], scores[n], 0.5))
+        for n in boxes
+    ] + [
+        ("soft_nms N=%d" % n, lambda C, n=n: C.soft_nms(boxes[n], scores[n].clone(), 0.5, 100, 0.01))
+        for n in boxes
+    ] + [
+        ("iou_mn 100x20000", lambda C, b1=random_boxes(100), b2=random_boxes(20000): C.iou_mn_forward(b1, b2)),
+        ("roi_align 512x7x7", lambda C: C.roi_align_forward(input, rois, 50.0, 50.0, 7, 7, 2)),
+    ]
+    print("%-20s %12s %12s %8s" % ("op", "native(ms)", "torch(ms)", "ratio"))
+    for name, f in cases:
+        t_native = timeit(lambda: f(_native))
+        t_fallback = timeit(lambda: f(_fallback))
+        print("%-20s %12.3f %12.3f %7.1fx" % (name, t_native, t_fallback, t_fallback / t_native))
+
+
+if __name__ == '__main__':
+    bench_backends()
@@ -0,0 +1,116 @@
+import numpy as np
+
+from horch.detection import BBox
+from horch.detection.eval import mAP, compute_map
+import time
+
+from horch.train.metrics import CocoAveragePrecision, StreamingCOCOEvaluator
+
+from benchmark.nms import timeit
+
+
+def random_dataset(num_images, num_classes=20, gts_per_image=7, dts_per_image=100, seed=0):
+    rng = np.random.RandomState(seed)
+    m = num_images * gts_per_image
+    n = num_images * dts_per_image
+    lt = rng.uniform(0, 400, size=(m, 2))
+    gt_boxes = np.concatenate([lt, lt + rng.uniform(10, 200, size=(m, 2))], axis=1)
+    gt_image_ids = np.repeat(np.arange(num_images), gts_per_image)
+    gt_category_ids = rng.randint(0, num_classes, size=m)
+    lt = rng.uniform(0, 400, size=(n, 2))
+    dt_boxes = np.concatenate([lt, lt + rng.uniform(10, 200, size=(n, 2))], axis=1)
+    dt_boxes[:m] = gt_boxes + rng.normal(0, 5, size=gt_boxes.shape)
+    dt_scores = rng.uniform(size=n)
+    dt_image_ids = np.repeat(np.arange(num_images), dts_per_image)
+    dt_category_ids = rng.randint(0, num_classes, size=n)
+    dt_category_ids[:m] = gt_category_ids
+    return (dt_boxes, dt_scores, dt_image_ids, dt_category_ids,
+            gt_boxes, gt_image_ids, gt_category_ids)
+
+
+def bench_map(sizes=(500, 5000)):
+    print("%8s %14s %14s" % ("images", "BBox(ms)", "arrays(ms)"))
+    for num_images in sizes:
+        data = random_dataset(num_images)
+        dt_boxes, dt_scores, dt_image_ids, dt_category_ids, gt_boxes, gt_image_ids, gt_category_ids = data
+        detections = [BBox(i, c, list(b), s) for b, s, i, c in
+                      zip(dt_boxes, dt_scores, dt_image_ids, dt_category_ids)]
+        ground_truths = [BBox(i, c, list(b)) for b, i, c in
+                         zip(gt_boxes, gt_image_ids, gt_category_ids)]
+        t_bbox = timeit(lambda: mAP(detections, ground_truths, 0.5), repeat=3)
+        t_arrays = timeit(lambda: compute_map(*data, 0.5), repeat=3)
+        print("%8d %14.1f %14.1f" % (num_images, t_bbox, t_arrays))
+
+
+def bench_coco_ap(sizes=(500, 2000), batch_size=32):
+    print("%8s %14s" % ("images", "CocoAP(ms)"))
+    for num_images in sizes:
+        dt_boxes, dt_scores, dt_image_ids, dt_category_ids, gt_boxes, gt_image_ids, gt_category_ids = \
+            random_dataset(num_images, dts_per_image=20)
+        dt_boxes[:, 2:] -= dt_boxes[:, :2]
+        gt_boxes[:, 2:] -= gt_boxes[:, :2]
+        image_dets = [[] for _ in range(num_images)]
+        image_gts = [[] for _ in range(num_images)]
+        for b, s, i, c in zip(dt_boxes.tolist(), dt_scores.tolist(), dt_image_ids.tolist(), dt_category_ids.tolist()):
+            image_dets[i].append({'bbox': b, 'score': s, 'category_id': c})
+        for b, i, c in zip(gt_boxes.tolist(), gt_image_ids.tolist(), gt_category_ids.tolist()):
+            image_gts[i].append({'bbox': b, 'image_id': i, 'category_id': c})
+
+        def run():
+            metric = CocoAveragePrecision()
+            metric.reset()
+            for start in range(0, num_images, batch_size):
+                metric.update(metric.output_transform({
+                    'target': [image_gts[start:start + batch_size]],
+                    'preds': image_dets[start:start + batch_size],
+                    'batch_size': len(image_gts[start:start + batch_size]),
+                }))
+            return metric.compute()
+
+        print("%8d %14.1f" % (num_images, timeit(run, repeat=3)))
+
+
+def random_coco_dataset(num_images, width=640, height=480):
+    dt_boxes, dt_scores, dt_image_ids, dt_category_ids, gt_boxes, gt_image_ids, gt_category_ids = \
+        random_dataset(num_images, num_classes=80)
+    dt_boxes[:, 2:] -= dt_boxes[:, :2]
+    gt_boxes[:, 2:] -= gt_boxes[:, :2]
+    dt_boxes /= [width, height, width, height]
+    annotations = {
+        'images': [{'id': i, 'width': width, 'height': height} for i in range(num_images)],
+        'annotations': [{'id': j, 'image_id': i, 'category_id': c, 'bbox': b, 'area': b[2] * b[3], 'iscrowd': 0}
+                        for j, (b, i, c) in enumerate(zip(gt_boxes.tolist(), gt_image_ids.tolist(),
+                                                          gt_category_ids.tolist()))],
+        'categories': [{'id': c} for c in range(80)],
+    }
+    image_dets = [[] for _ in range(num_images)]
+    image_gts = [[] for _ in range(num_images)]
+    for b, s, i, c in zip(dt_boxes.tolist(), dt_scores.tolist(), dt_image_ids.tolist(), dt_category_ids.tolist()):
+        image_dets[i].append({'bbox': b, 'score': s, 'category_id': c})
+    for ann in annotations['annotations']:
+        image_gts[ann['image_id']].append(ann)
+    return annotations, image_gts, image_dets
+
+
+def bench_streaming_coco(sizes=(1000, 5000), num_workers=(0, 2, 4), batch_size=32):
+    print("%8s %8s %12s %12s" % ("images", "workers", "update(ms)", "compute(ms)"))
+    for num_images in sizes:
+        annotations, image_gts, image_dets = random_coco_dataset(num_images)
+        for n in num_workers:
+            metric = StreamingCOCOEvaluator(annotations, num_workers=n)
+            metric.reset()
+            start_time = time.perf_counter()
+            for start in range(0, num_images, batch_size):
+                metric.update({'target': [image_gts[start:start + batch_size]],
+                               'preds': image_dets[start:start + batch_size]})
+            t_update = (time.perf_counter() - start_time) * 1000
+            start_time = time.perf_counter()
+            metric.compute()
+            t_compute = (time.perf_counter() - start_time) * 1000
+            print("%8d %8d %12.1f %12.1f" % (num_images, n, t_update, t_compute))
+
+
+if __name__ == '__main__':
+    bench_map()
+    bench_coco_ap()
+    bench_streaming_coco()
@@ -0,0 +1,65 @@
+import random
+
+import torch
+
+from horch.detection import get_locations
+from horch.models.detection.fcos import FCOSTransform, get_mlvl_centers, centerness
+
+from benchmark.nms import timeit
+
+
+def fcos_targets_loop(mlvl_centers, thresholds, anns):
+    # The former assignment, looping over annotations and levels.
+    loc_targets, cls_targets, ctn_targets = [], [], []
+    for centers in mlvl_centers:
+        lx, ly = centers.size()[:2]
+        loc_targets.append(torch.zeros(lx, ly, 4))
+        cls_targets.append(torch.zeros(lx, ly, dtype=torch.long))
+        ctn_targets.append(torch.zeros(lx, ly))
+    for ann in anns:
+        l, t, w, h = ann['bbox']
+        r, b = l + w, t + h
+        for centers, (lo, hi), loc_t, cls_t, ctn_t in zip(
+                mlvl_centers, thresholds, loc_targets, cls_targets, ctn_targets):
+            cx, cy = centers[..., 0], centers[..., 1]
+            mask = (l < cx) & (cx < r) & (t < cy) & (cy < b)
+            ts = torch.stack([cx - l, cy - t, r - cx, b - cy], dim=-1)
+            max_t = ts.max(dim=-1)[0]
+            mask &= (max_t >= lo) & (max_t < hi)
+            if not mask.any():
+                continue
+            loc_t[mask] = ts[mask]
+            cls_t[mask] = ann['category_id']
+            ctn_t[mask] = centerness(loc_t[mask])
+    loc_t = torch.cat([t.view(-1, 4) for t in loc_targets], dim=0)
+    cls_t = torch.cat([t.view(-1) for t in cls_targets], dim=0)
+    ctn_t = torch.cat([t.view(-1) for t in ctn_targets], dim=0)
+    return loc_t, cls_t, ctn_t
+
+
+def random_anns(size, n):
+    anns = []
+    for _ in range(n):
+        w, h = random.uniform(4, size[0] * 0.5), random.uniform(4, size[1] * 0.5)
+        l, t = random.uniform(0, size[0] - w), random.uniform(0, size[1] - h)
+        anns.append({'bbox': [l, t, w, h], 'category_id': random.randint(1, 80)})
+    return anns
+
+
+def bench_fcos_transform(sizes=((512, 512), (800, 800)), num_gts=(5, 20, 50, 100)):
+    strides = [8, 16, 32, 64, 128]
+    print("%12s %6s %10s %14s %8s" % ("size", "G", "loop(ms)", "vectorized(ms)", "speedup"))
+    for size in sizes:
+        mlvl_centers = get_mlvl_centers(get_locations(size, strides), strides)
+        transform = FCOSTransform(mlvl_centers)
+        img = torch.zeros(3, size[1], size[0])
+        for g in num_gts:
+            random.seed(0)
+            anns = random_anns(size, g)
+            t1 = timeit(lambda: fcos_targets_loop(mlvl_centers, transform.thresholds, anns), 5)
+            t2 = timeit(lambda: transform(img, anns), 5)
+            print("%12s %6d %10.1f %14.1f %8.1f" % ("%dx%d" % size, g, t1, t2, t1 / t2))
+
+
+if __name__ == '__main__':
+    bench_fcos_transform()
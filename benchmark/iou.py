@@ -0,0 +1,71 @@
+import torch
+
+from horch import _C
+from horch.detection.iou import iou_mn_reduce, iou_b11
+from horch.nn.loss import iou_loss
+
+from benchmark.nms import random_boxes, timeit
+
+
+def bench_iou_mn(sizes=((20, 50000), (100, 100000), (1000, 1000)), threads=(1, None)):
+    num_threads = torch.get_num_threads()
+    print("%-8s %12s %12s %12s" % ("threads", "M x N", "forward(ms)", "backward(ms)"))
+    for t in threads:
+        torch.set_num_threads(t or num_threads)
+        for m, n in sizes:
+            boxes1 = random_boxes(m)
+            boxes2 = random_boxes(n)
+            ious = _C.iou_mn_forward(boxes1, boxes2)
+            dious = torch.randn_like(ious)
+            t_forward = timeit(lambda: _C.iou_mn_forward(boxes1, boxes2))
+            t_backward = timeit(lambda: _C.iou_mn_backward(dious, boxes1, boxes2, ious))
+            print("%-8d %12s %12.3f %12.3f" % (
+                torch.get_num_threads(), "%dx%d" % (m, n), t_forward, t_backward))
+    torch.set_num_threads(num_threads)
+
+
+def bench_iou_mn_reduce(sizes=((20, 50000), (100, 100000), (500, 200000)), threshold=0.4):
+    print("%12s %10s %10s %12s %12s" % ("M x N", "dense(ms)", "reduce(ms)", "dense(MB)", "reduce(MB)"))
+    for m, n in sizes:
+        boxes1 = random_boxes(m)
+        boxes2 = random_boxes(n)
+
+        def dense():
+            ious = _C.iou_mn_forward(boxes1, boxes2)
+            return ious.max(dim=0), ious.max(dim=1)[1], (ious >= threshold).sum(dim=0)
+
+        t_dense = timeit(dense, repeat=3)
+        t_reduce = timeit(lambda: iou_mn_reduce(boxes1, boxes2, threshold), repeat=3)
+        mb_dense = m * n * boxes1.element_size() / 2 ** 20
+        mb_reduce = n * (boxes1.element_size() + 16) / 2 ** 20
+        print("%12s %10.3f %10.3f %12.1f %12.1f" % (
+            "%dx%d" % (m, n), t_dense, t_reduce, mb_dense, mb_reduce))
+
+
+def composed_iou_loss(prediction, ground_truth):
+    boxes_p = torch.cat([-prediction[..., :2], prediction[..., 2:]], dim=-1)
+    boxes_t = torch.cat([-ground_truth[..., :2], ground_truth[..., 2:]], dim=-1)
+    return -torch.log(iou_b11(boxes_p, boxes_t)).sum()
+
+
+def bench_iou_loss(sizes=(1000, 10000, 100000)):
+    print("%-8s %8s %14s %14s" % ("kind", "N", "composed(ms)", "fused(ms)"))
+    for n in sizes:
+        prediction = torch.rand(n, 4) + 0.1
+        ground_truth = torch.rand(n, 4) + 0.1
+
+        def run(f):
+            x = prediction.clone().requires_grad_()
+            f(x).backward()
+
+        t_composed = timeit(lambda: run(lambda x: composed_iou_loss(x, ground_truth)))
+        for kind in ['iou', 'giou', 'diou', 'ciou']:
+            t_fused = timeit(lambda: run(lambda x: iou_loss(x, ground_truth, 'sum', kind)))
+            print("%-8s %8d %14s %14.3f" % (
+                kind, n, "%.3f" % t_composed if kind == 'iou' else "-", t_fused))
+
+
+if __name__ == '__main__':
+    bench_iou_mn()
+    bench_iou_mn_reduce()
+    bench_iou_loss()
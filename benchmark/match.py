@@ -0,0 +1,43 @@
+import torch
+
+from horch.detection import BBox, generate_mlvl_anchors, calc_anchor_sizes
+from horch.detection.one import flatten, match_anchors_batch, pad_gts
+from horch.detection.two import match_anchors
+
+from benchmark.nms import timeit
+
+
+def random_anns(n):
+    boxes = torch.rand(n, 4)
+    boxes[:, 2:] = boxes[:, 2:] * 0.3 + 0.02
+    boxes[:, :2] *= 1 - boxes[:, 2:]
+    return [{'bbox': box, 'category_id': i % 20 + 1} for i, box in enumerate(boxes.tolist())]
+
+
+def bench_match_anchors(batch_sizes=(8, 32), num_gts=(5, 20, 50), size=(512, 512)):
+    strides = [8, 16, 32, 64, 128]
+    anchor_sizes = [calc_anchor_sizes(s, (0.5, 1, 2), (1, 2 ** (1 / 3), 2 ** (2 / 3))) for s in (32, 64, 128, 256, 512)]
+    a_xywh = flatten(generate_mlvl_anchors(size, strides, anchor_sizes))
+    a_ltrb = BBox.convert(a_xywh, BBox.XYWH, BBox.LTRB)
+    print("%d anchors" % len(a_xywh))
+    print("%6s %6s %14s %14s %8s" % ("B", "G", "per-image(ms)", "batched(ms)", "speedup"))
+    for b in batch_sizes:
+        for g in num_gts:
+            torch.manual_seed(0)
+            image_gts = [random_anns(g) for _ in range(b)]
+
+            def loop():
+                for anns in image_gts:
+                    match_anchors(anns, a_xywh, a_ltrb, 0.5, 0.4)
+
+            def batched():
+                gt_boxes, gt_labels, gt_mask = pad_gts(image_gts)
+                match_anchors_batch(gt_boxes, gt_labels, gt_mask, a_xywh, a_ltrb, 0.5, 0.4)
+
+            t1 = timeit(loop, 3)
+            t2 = timeit(batched, 3)
+            print("%6d %6d %14.1f %14.1f %8.1f" % (b, g, t1, t2, t1 / t2))
+
+
+if __name__ == '__main__':
+    bench_match_anchors()
@@ -0,0 +1,87 @@
+import time
+
+import torch
+
+from horch.detection import BBox
+from horch.detection.eval import compute_map
+from horch.detection.nms import soft_nms_cpu, softer_nms_cpu
+from horch.detection.postprocess import batched_detections
+
+
+def random_boxes(n):
+    boxes = torch.rand(n, 4)
+    boxes[:, 2:] = boxes[:, 2:] * 0.2 + 0.01
+    return BBox.convert(boxes, BBox.XYWH, BBox.LTRB, inplace=True)
+
+
+def timeit(f, repeat=5):
+    f()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        f()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def bench_soft_nms(sizes=(1000, 5000, 10000, 20000), topk=100):
+    print("%-12s %8s %12s %12s %8s" % ("op", "N", "linear(ms)", "heap(ms)", "speedup"))
+    for n in sizes:
+        boxes = random_boxes(n)
+        scores = torch.rand(n)
+        vars = torch.rand(n, 4) * 0.1 + 0.01
+        for name, f in [
+            ("soft_nms", lambda algorithm: soft_nms_cpu(
+                boxes, scores.clone(), 0.5, topk, 0.01, algorithm=algorithm)),
+            ("softer_nms", lambda algorithm: softer_nms_cpu(
+                boxes.clone(), scores.clone(), vars, 0.5, topk, algorithm=algorithm)),
+        ]:
+            t_linear = timeit(lambda: f('linear'))
+            t_heap = timeit(lambda: f('heap'))
+            print("%-12s %8d %12.3f %12.3f %7.1fx" % (name, n, t_linear, t_heap, t_linear / t_heap))
+
+
+def noisy_detections(batch_size, num_gts=10, dts_per_gt=20, num_classes=5, noise=0.15):
+    # Every ground truth is detected many times with jittered boxes scored by their IoU with it,
+    # like the dense predictions before nms.
+    gt_boxes = random_boxes(batch_size * num_gts) * 0.8 + 0.1
+    gt_labels = torch.randint(num_classes, (batch_size * num_gts,))
+    gt_images = torch.arange(batch_size).repeat_interleave(num_gts)
+
+    n = batch_size * num_gts * dts_per_gt
+    boxes = gt_boxes.repeat_interleave(dts_per_gt, dim=0)
+    wh = (boxes[:, 2:] - boxes[:, :2]).repeat(1, 2)
+    boxes = boxes + torch.randn(n, 4) * noise * wh
+    boxes[:, 2:] = torch.max(boxes[:, 2:], boxes[:, :2] + 1e-3)
+    lt = torch.max(boxes[:, :2], gt_boxes.repeat_interleave(dts_per_gt, dim=0)[:, :2])
+    rb = torch.min(boxes[:, 2:], gt_boxes.repeat_interleave(dts_per_gt, dim=0)[:, 2:])
+    inter = (rb - lt).clamp(min=0).prod(dim=1)
+    areas = (boxes[:, 2:] - boxes[:, :2]).prod(dim=1)
+    gt_areas = wh[:, :2].prod(dim=1)
+    scores = (inter / (areas + gt_areas - inter) + torch.rand(n) * 0.3) / 1.3
+    labels = gt_labels.repeat_interleave(dts_per_gt)
+    batch_idxs = gt_images.repeat_interleave(dts_per_gt)
+    return (boxes, scores, labels, batch_idxs), (gt_boxes, gt_images, gt_labels)
+
+
+def bench_parallel_nms(batch_sizes=(1, 8, 32), nms_methods=('nms', 'soft', 'matrix', 'cluster')):
+    print("%6s %10s %10s %10s %14s" % ("B", "nms", "time(ms)", "mAP@0.5", "mAP@.5:.95"))
+    iou_thresholds = torch.linspace(0.5, 0.95, 10).tolist()
+    for b in batch_sizes:
+        torch.manual_seed(0)
+        (boxes, scores, labels, batch_idxs), (gt_boxes, gt_images, gt_labels) = noisy_detections(b)
+        for nms in nms_methods:
+            def run():
+                return batched_detections(
+                    boxes.clone(), scores.clone(), labels, batch_idxs, b, nms, 0.5, 100, 0.05)
+
+            t = timeit(run, 3)
+            dets = run()
+            maps = compute_map(
+                BBox.convert(dets.boxes, BBox.LTWH, BBox.LTRB).numpy(), dets.scores.numpy(),
+                dets.image_indices.numpy(), dets.labels.numpy() - 1,
+                gt_boxes.numpy(), gt_images.numpy(), gt_labels.numpy(), iou_thresholds)
+            print("%6d %10s %10.2f %10.3f %14.3f" % (b, nms, t, maps[0], maps.mean()))
+
+
+if __name__ == '__main__':
+    bench_soft_nms()
+    bench_parallel_nms()
@@ -0,0 +1,60 @@
+import torch
+
+from horch.detection import generate_mlvl_anchors, calc_anchor_sizes
+from horch.detection.one import flatten, anchor_based_inference, anchor_based_batch_inference
+
+from benchmark.nms import timeit
+
+
+def bench_anchor_based_inference(batch_sizes=(1, 8, 32), nms_methods=('nms', 'multiclass', 'soft'),
+                                 size=(320, 320), num_classes=21):
+    strides = [8, 16, 32, 64, 128]
+    anchor_sizes = [calc_anchor_sizes(s, (0.5, 1, 2)) for s in (32, 64, 128, 256, 512)]
+    anchors = flatten(generate_mlvl_anchors(size, strides, anchor_sizes))
+    print("%d anchors, %d classes" % (len(anchors), num_classes))
+    print("%6s %12s %14s %14s %8s" % ("B", "nms", "per-image(ms)", "batched(ms)", "speedup"))
+    for b in batch_sizes:
+        torch.manual_seed(0)
+        loc_p = torch.randn(b, len(anchors), 4) * 0.1
+        cls_p = torch.randn(b, len(anchors), num_classes) - 5
+        for nms in nms_methods:
+            def loop():
+                for i in range(b):
+                    anchor_based_inference(
+                        loc_p[i], cls_p[i], anchors, 0.05, 0.5, 100, 'sigmoid', nms)
+
+            def batched():
+                anchor_based_batch_inference(
+                    loc_p, cls_p, anchors, 0.05, 0.5, 100, 'sigmoid', nms)
+
+            t1 = timeit(loop, 3)
+            t2 = timeit(batched, 3)
+            print("%6d %12s %14.1f %14.1f %8.2f" % (b, nms, t1, t2, t1 / t2))
+
+
+def bench_fused_inference(nms_methods=('nms', 'multiclass', 'soft'), size=(320, 320), num_classes=21,
+                          conf_strategies=('softmax', 'sigmoid')):
+    # SSD-lite style single image inference on CPU
+    strides = [16, 32, 64, 128, 256]
+    anchor_sizes = [calc_anchor_sizes(s, (0.5, 1, 2)) for s in (32, 64, 128, 192, 256)]
+    anchors = flatten(generate_mlvl_anchors(size, strides, anchor_sizes))
+    print("%d anchors, %d classes" % (len(anchors), num_classes))
+    print("%8s %12s %14s %14s %8s" % ("conf", "nms", "unfused(ms)", "fused(ms)", "speedup"))
+    torch.manual_seed(0)
+    loc_p = torch.randn(1, len(anchors), 4) * 0.1
+    cls_p = torch.randn(1, len(anchors), num_classes) - 4
+    cls_p[..., 0] += 6
+    for conf_strategy in conf_strategies:
+        for nms in nms_methods:
+            def run(fused):
+                return lambda: anchor_based_batch_inference(
+                    loc_p, cls_p, anchors, 0.05, 0.5, 100, conf_strategy, nms, fused=fused)
+
+            t1 = timeit(run(False), 20)
+            t2 = timeit(run(True), 20)
+            print("%8s %12s %14.2f %14.2f %8.2f" % (conf_strategy, nms, t1, t2, t1 / t2))
+
+
+if __name__ == '__main__':
+    bench_anchor_based_inference()
+    bench_fused_inference()
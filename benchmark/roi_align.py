@@ -0,0 +1,64 @@
+import torch
+
+from horch import _C
+from horch.nn.roi_align import MultiScaleRoIAlign
+
+from benchmark.nms import random_boxes, timeit
+
+
+def random_rois(n, batch_size):
+    return torch.cat([torch.randint(batch_size, (n, 1)).float(), random_boxes(n).clamp(0, 1)], dim=1)
+
+
+def bench_roi_align(num_rois=(512, 1000, 2000), output_sizes=(7, 14), threads=None):
+    threads = threads or sorted({1, torch.get_num_threads()})
+    batch_size, channels, height, width = 2, 256, 50, 68
+    input = torch.randn(batch_size, channels, height, width)
+    ps_input = torch.randn(batch_size, 10 * 7 * 7, height, width)
+    print("%-12s %6s %6s %8s %12s %12s" % ("op", "RoIs", "size", "threads", "forward(ms)", "backward(ms)"))
+    for n in num_rois:
+        rois = random_rois(n, batch_size)
+        for size in output_sizes:
+            cases = [
+                ("roi_align", size,
+                 lambda: _C.roi_align_forward(input, rois, height, width, size, size, 2),
+                 lambda g: _C.roi_align_backward(
+                     g, rois, height, width, size, size, batch_size, channels, height, width, 2)),
+            ]
+            if size == 7:
+                cases.append(
+                    ("psroi_align", size,
+                     lambda: _C.psroi_align_forward(ps_input, rois, height, width, 10, 7, 7, 2),
+                     lambda g: _C.psroi_align_backward(
+                         g, rois, height, width, 10, 7, 7, batch_size, ps_input.size(1), height, width, 2)))
+            for name, size, forward, backward in cases:
+                grad = torch.randn_like(forward())
+                for t in threads:
+                    torch.set_num_threads(t)
+                    print("%-12s %6d %6d %8d %12.2f %12.2f" % (
+                        name, n, size, t, timeit(forward, 3), timeit(lambda: backward(grad), 3)))
+    torch.set_num_threads(threads[-1])
+
+
+def bench_multi_scale_roi_align(num_rois=(512, 2000), size=(800, 1088), levels=(2, 3, 4, 5, 6)):
+    h, w = size
+    ps = [torch.randn(1, 256, h // 2 ** l, w // 2 ** l, requires_grad=True) for l in levels]
+    print("%-16s %6s %12s %12s" % ("pooling", "RoIs", "forward(ms)", "+backward(ms)"))
+    for n in num_rois:
+        rois = random_rois(n, 1)
+        for name, all_levels in [("all levels", True), ("assigned level", False)]:
+            pool = MultiScaleRoIAlign(7, levels, all_levels=all_levels)
+
+            def forward():
+                with torch.no_grad():
+                    pool(ps, rois)
+
+            def backward():
+                sum(p.sum() for p in pool(ps, rois)).backward()
+
+            print("%-16s %6d %12.2f %12.2f" % (name, n, timeit(forward, 3), timeit(backward, 3)))
+
+
+if __name__ == '__main__':
+    bench_roi_align()
+    bench_multi_scale_roi_align()
@@ -0,0 +1,70 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from horch import _C, _numpy
+
+from benchmark.nms import random_boxes
+
+
+def run_threaded(f, num_threads, num_calls):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(num_threads) as pool:
+        list(pool.map(lambda _: f(), range(num_calls)))
+    return (time.perf_counter() - start) * 1000
+
+
+def main_thread_progress(f):
+    # Iterations of a Python loop in the main thread while `f` runs in another thread, relative
+    # to the loop alone. Close to 0 if `f` holds the GIL, even with a single cpu.
+    start = time.perf_counter()
+    n = 0
+    while time.perf_counter() - start < 0.05:
+        n += 1
+    rate = n / 0.05
+    thread = threading.Thread(target=f)
+    start = time.perf_counter()
+    thread.start()
+    n = 0
+    while thread.is_alive():
+        n += 1
+    return n / (rate * (time.perf_counter() - start))
+
+
+def bench_threads(thread_counts=(1, 2, 4, 8), num_calls=16):
+    # Intra-op parallelism of the kernels would hide the scaling over Python threads
+    torch.set_num_threads(1)
+    boxes = random_boxes(5000)
+    scores = torch.rand(5000)
+    boxes1, boxes2 = random_boxes(100), random_boxes(20000)
+    np_boxes1, np_boxes2 = boxes1.numpy().astype(np.float64), random_boxes(2000).numpy().astype(np.float64)
+    anchors = torch.cat([torch.rand(20000, 2), torch.rand(20000, 2) * 0.2 + 0.01], dim=1)
+    loc_p = torch.randn(20000, 4) * 0.1
+    cls_p = torch.randn(20000, 21) - 4
+    cls_p[:, 0] += 6
+    cases = [
+        ("nms N=5000", lambda: _C.nms(boxes, scores, 0.5)),
+        ("soft_nms N=5000", lambda: _C.soft_nms(boxes, scores.clone(), 0.5, 100, 0.01)),
+        ("softer_nms N=5000", lambda: _C.softer_nms(
+            boxes.clone(), scores.clone(), torch.full((5000, 4), 0.05), 0.5, 100, 0.01, 0.01)),
+        ("iou_mn 100x20000", lambda: _C.iou_mn_forward(boxes1, boxes2)),
+        ("decode_and_nms A=20000", lambda: _C.decode_and_nms(
+            loc_p, cls_p, anchors, 'softmax', 0.05, 'nms', 0.5, 100, 0.01, 0)),
+        ("_numpy.iou_mn 100x2000", lambda: _numpy.iou_mn(np_boxes1, np_boxes2)),
+        ("_numpy.iou_mm N=2000", lambda: _numpy.iou_mm(np_boxes2)),
+    ]
+    print("%d calls of every op, %d cpus" % (num_calls, torch.multiprocessing.cpu_count()))
+    print("%-24s" % "op" + "".join("%12s" % ("%d thr(ms)" % n) for n in thread_counts) +
+          "%9s %10s" % ("speedup", "main thr"))
+    for name, f in cases:
+        f()
+        ts = [run_threaded(f, n, num_calls) for n in thread_counts]
+        print("%-24s" % name + "".join("%12.1f" % t for t in ts) +
+              "%8.1fx %9.0f%%" % (ts[0] / min(ts), main_thread_progress(f) * 100))
+
+
+if __name__ == '__main__':
+    bench_threads()
@@ -0,0 +1,29 @@
+r"""
+Selects the implementation of the detection ops.
+
+``HORCH_BACKEND`` can be ``native`` (the compiled ``horch._C`` and ``horch._numpy``
+extensions), ``torch`` (the pure PyTorch and NumPy fallbacks in ``horch._fallback``)
+or ``auto`` (default), which uses the extensions if they are built and falls back
+otherwise.
+"""
+import os
+import warnings
+
+BACKENDS = ['auto', 'native', 'torch']
+
+BACKEND = os.environ.get('HORCH_BACKEND', 'auto')
+if BACKEND not in BACKENDS:
+    raise ValueError("HORCH_BACKEND must be one of %s, got %s" % (BACKENDS, BACKEND))
+
+if BACKEND == 'torch':
+    from horch._fallback import _C, _numpy
+else:
+    try:
+        from horch import _C, _numpy
+        BACKEND = 'native'
+    except ImportError:
+        if BACKEND == 'native':
+            raise
+        warnings.warn("horch extensions are not built, falling back to the pure PyTorch implementation.")
+        from horch._fallback import _C, _numpy
+        BACKEND = 'torch'
@@ -0,0 +1,415 @@
+r"""
+Pure PyTorch implementations of the ops in the ``horch._C`` extension, with the
+same signatures and semantics. They are used when the extension is not built or
+``HORCH_BACKEND=torch`` is set, see ``horch._backend``.
+"""
+import math
+
+import torch
+import torch.nn.functional as F
+
+# The ops are plain PyTorch ops and run on tensors of any device.
+with_cuda = True
+
+
+def _iou_mn(boxes1, boxes2):
+    x1, y1, x2, y2 = boxes1.t()[:, :, None]
+    u1, v1, u2, v2 = boxes2.t()[:, None, :]
+    w = (torch.min(x2, u2) - torch.max(x1, u1)).clamp(min=0)
+    h = (torch.min(y2, v2) - torch.max(y1, v1)).clamp(min=0)
+    inter = w * h
+    return inter / ((x2 - x1) * (y2 - y1) + (u2 - u1) * (v2 - v1) - inter)
+
+
+# Rows of the suppression mask computed at once, which bounds the memory of nms to
+# O(chunk size * N) instead of O(N^2).
+_NMS_CHUNK_SIZE = 1024
+
+
+def _greedy_nms(boxes, threshold, groups=None):
+    r"""
+    Greedy nms of score-sorted boxes, only between boxes of the same group if `groups`
+    is provided. Returns the bool mask of kept boxes.
+
+    The bool suppression mask is computed in chunks of rows. The boxes of a chunk are
+    final once the kept boxes of the previous chunks have suppressed them, and are
+    resolved inside the chunk as in Cluster-NMS: all start kept and a box stays kept if
+    no kept box before it suppresses it, until nothing changes.
+    """
+    n = boxes.size(0)
+    keep = torch.zeros(n, dtype=torch.bool, device=boxes.device)
+    removed = torch.zeros_like(keep)
+    for start in range(0, n, _NMS_CHUNK_SIZE):
+        end = min(start + _NMS_CHUNK_SIZE, n)
+        # mask[i, j] tells whether box start + i suppresses box start + j if it is kept
+        mask = _iou_mn(boxes[start:end], boxes[start:]) >= threshold
+        if groups is not None:
+            mask &= groups[start:end, None] == groups[None, start:]
+        mask.triu_(1)
+        candidates = ~removed[start:end]
+        inner = mask[:, :end - start]
+        chunk_keep = candidates
+        while True:
+            new_keep = candidates & ~(inner & chunk_keep[:, None]).any(dim=0)
+            if torch.equal(new_keep, chunk_keep):
+                break
+            chunk_keep = new_keep
+        keep[start:end] = chunk_keep
+        removed[end:] |= mask[chunk_keep, end - start:].any(dim=0)
+    return keep
+
+
+def nms(dets, scores, threshold):
+    if dets.numel() == 0:
+        return dets.new_empty(0, dtype=torch.long)
+    order = scores.sort(0, descending=True)[1]
+    return order[_greedy_nms(dets[order], threshold)]
+
+
+def batched_nms(dets, scores, idxs, threshold):
+    if dets.numel() == 0:
+        return dets.new_empty(0, dtype=torch.long)
+    idxs = idxs.long()
+    order = scores.sort(0, descending=True)[1]
+    keep = order[_greedy_nms(dets[order], threshold, idxs[order])]
+    # Group by idxs, keeping the score order inside every group
+    n = len(keep)
+    keys = idxs[keep] * n + torch.arange(n, device=keep.device)
+    return keep[keys.argsort()]
+
+
+def _soft_ious(dets, areas, i):
+    lt = torch.max(dets[i, :2], dets[:, :2])
+    rb = torch.min(dets[i, 2:], dets[:, 2:])
+    wh = (rb - lt + 0.01).clamp(min=0)
+    inter = wh[:, 0] * wh[:, 1]
+    return inter / (areas[i] + areas - inter)
+
+
+def _select(scores, suppressed):
+    # The last box with the max non-negative score, like the native kernels.
+    masked = scores.masked_fill(suppressed, -1)
+    i = len(masked) - 1 - int(masked.flip(0).argmax())
+    if masked[i] < 0:
+        return -1
+    return i
+
+
+def soft_nms(dets, scores, iou_threshold, topk, min_score):
+    if dets.numel() == 0:
+        return torch.empty(0, dtype=torch.long)
+    areas = (dets[:, 2] - dets[:, 0] + 0.01) * (dets[:, 3] - dets[:, 1] + 0.01)
+    suppressed = torch.zeros(len(dets), dtype=torch.bool, device=dets.device)
+    indices = []
+    for _ in range(topk):
+        i = _select(scores, suppressed)
+        if i == -1:
+            break
+        indices.append(i)
+        suppressed[i] = True
+
+        ious = _soft_ious(dets, areas, i)
+        decay = (ious >= iou_threshold) & ~suppressed
+        scores[decay] *= 1 - ious[decay]
+        suppressed |= decay & (scores < min_score)
+    return torch.tensor(indices, dtype=torch.long)
+
+
+def softer_nms(dets, scores, vars, iou_threshold, topk, sigma, min_score):
+    if dets.numel() == 0:
+        return torch.empty(0, dtype=torch.long)
+    areas = (dets[:, 2] - dets[:, 0] + 0.01) * (dets[:, 3] - dets[:, 1] + 0.01)
+    suppressed = torch.zeros(len(dets), dtype=torch.bool, device=dets.device)
+    indices = []
+    for _ in range(topk):
+        i = _select(scores, suppressed)
+        if i == -1:
+            break
+        indices.append(i)
+        suppressed[i] = True
+
+        ious = _soft_ious(dets, areas, i)
+        active = ~suppressed
+        decay = (ious >= iou_threshold) & active
+        scores[decay] *= 1 - ious[decay]
+        suppressed |= decay & (scores < min_score)
+
+        vote = (ious > 0) & active
+        p = torch.exp(-(1 - ious[vote]) ** 2 / sigma)[:, None] / vars[vote]
+        dets[i] = (dets[i] / vars[i] + (p * dets[vote]).sum(dim=0)) / (1 / vars[i] + p.sum(dim=0))
+    return torch.tensor(indices, dtype=torch.long)
+
+
+# The heap variants give the same result as the linear ones.
+soft_nms_heap = soft_nms
+softer_nms_heap = softer_nms
+
+
+def decode_and_nms(loc_p, cls_p, anchors, conf_strategy, conf_threshold, nms_method,
+                   iou_threshold, topk, min_score, max_per_class):
+    assert conf_strategy in ['softmax', 'sigmoid'], "conf_strategy must be softmax or sigmoid"
+    assert nms_method in ['nms', 'multiclass', 'soft'], "nms_method must be one of nms, multiclass and soft"
+    cls_p = cls_p.to(loc_p.dtype)
+    anchors = anchors.to(loc_p.dtype)
+    if conf_strategy == 'softmax':
+        probs = torch.softmax(cls_p, dim=1)[:, 1:]
+    else:
+        probs = torch.sigmoid(cls_p[:, 1:])
+    if nms_method == 'multiclass':
+        indices, labels = torch.nonzero(probs > conf_threshold).t()
+        scores = probs[indices, labels]
+    else:
+        scores, labels = probs.max(dim=1)
+        if conf_threshold > 0:
+            indices = torch.nonzero(scores > conf_threshold).squeeze(1)
+            scores, labels = scores[indices], labels[indices]
+        else:
+            indices = torch.arange(len(scores), device=scores.device)
+
+    t, a = loc_p[indices], anchors[indices]
+    wh = t[:, 2:].exp() * a[:, 2:]
+    lt = t[:, :2] * a[:, 2:] + a[:, :2] - wh / 2
+    boxes = torch.cat([lt, wh + lt], dim=1)
+
+    if nms_method == 'soft':
+        keep = soft_nms(boxes, scores, iou_threshold, min(topk, len(boxes)), min_score)
+    elif nms_method == 'multiclass':
+        keep = batched_nms(boxes, scores, labels, iou_threshold)
+        if max_per_class > 0:
+            kept_labels = labels[keep]
+            counts = torch.bincount(kept_labels)
+            starts = torch.cumsum(counts, dim=0) - counts
+            ranks = torch.arange(len(keep), device=keep.device) - starts[kept_labels]
+            keep = keep[ranks < max_per_class]
+        keep = keep[scores[keep].argsort(descending=True)]
+    else:
+        keep = nms(boxes, scores, iou_threshold)
+    if topk > 0:
+        keep = keep[:topk]
+    return boxes[keep], scores[keep], labels[keep]
+
+
+def iou_mn_forward(boxes1, boxes2):
+    return _iou_mn(boxes1, boxes2)
+
+
+def iou_mn_backward(dious, boxes1, boxes2, ious):
+    with torch.enable_grad():
+        boxes1 = boxes1.detach().requires_grad_()
+        boxes2 = boxes2.detach().requires_grad_()
+        ious = _iou_mn(boxes1, boxes2)
+        return torch.autograd.grad(ious, (boxes1, boxes2), dious)
+
+
+def iou_mn_reduce(boxes1, boxes2, threshold, tile_size):
+    m, n = boxes1.size(0), boxes2.size(0)
+    max_ious = boxes2.new_zeros(n)
+    indices = boxes2.new_zeros(n, dtype=torch.long)
+    gt_indices = boxes1.new_zeros(m, dtype=torch.long)
+    counts = boxes2.new_zeros(n, dtype=torch.long)
+    if m == 0 or n == 0:
+        return max_ious, indices, gt_indices, counts
+
+    gt_max_ious = boxes1.new_full((m,), -1)
+    for start in range(0, n, tile_size):
+        end = min(start + tile_size, n)
+        ious = _iou_mn(boxes1, boxes2[start:end])
+        max_ious[start:end], indices[start:end] = ious.max(dim=0)
+        counts[start:end] = (ious >= threshold).sum(dim=0)
+        tile_max_ious, tile_indices = ious.max(dim=1)
+        better = tile_max_ious > gt_max_ious
+        gt_max_ious = torch.where(better, tile_max_ious, gt_max_ious)
+        gt_indices = torch.where(better, tile_indices + start, gt_indices)
+    return max_ious, indices, gt_indices, counts
+
+
+IOU, GIOU, DIOU, CIOU = range(4)
+
+
+def _iou_b11(boxes1, boxes2, kind):
+    eps = 1e-7
+    w1 = boxes1[:, 2] - boxes1[:, 0]
+    h1 = boxes1[:, 3] - boxes1[:, 1]
+    w2 = boxes2[:, 2] - boxes2[:, 0]
+    h2 = boxes2[:, 3] - boxes2[:, 1]
+    lt = torch.max(boxes1[:, :2], boxes2[:, :2])
+    rb = torch.min(boxes1[:, 2:], boxes2[:, 2:])
+    wh = (rb - lt).clamp(min=0)
+    inter = wh[:, 0] * wh[:, 1]
+    union = w1 * h1 + w2 * h2 - inter + eps
+    iou = inter / union
+    if kind == IOU:
+        return iou
+
+    cwh = torch.max(boxes1[:, 2:], boxes2[:, 2:]) - torch.min(boxes1[:, :2], boxes2[:, :2])
+    if kind == GIOU:
+        c = cwh[:, 0] * cwh[:, 1] + eps
+        return iou - (c - union) / c
+
+    d = boxes1[:, :2] + boxes1[:, 2:] - boxes2[:, :2] - boxes2[:, 2:]
+    rho2 = (d ** 2).sum(dim=1) / 4
+    c2 = (cwh ** 2).sum(dim=1) + eps
+    diou = iou - rho2 / c2
+    if kind == DIOU:
+        return diou
+
+    v = (4 / math.pi ** 2) * (torch.atan(w2 / h2) - torch.atan(w1 / h1)) ** 2
+    with torch.no_grad():
+        alpha = v / (1 - iou + v + eps)
+    return diou - alpha * v
+
+
+def iou_b11_forward(boxes1, boxes2, kind):
+    return _iou_b11(boxes1, boxes2, kind)
+
+
+def iou_b11_backward(dious, boxes1, boxes2, kind):
+    with torch.enable_grad():
+        boxes1 = boxes1.detach().requires_grad_()
+        boxes2 = boxes2.detach().requires_grad_()
+        ious = _iou_b11(boxes1, boxes2, kind)
+        return torch.autograd.grad(ious, (boxes1, boxes2), dious)
+
+
+def _sampling_grid(input, rois, scale_h, scale_w, pooled_height, pooled_width, grid_h, grid_w):
+    r"""
+    Sampling points of rois sharing the same sampling grid size, normalized for
+    `grid_sample`, as xs of shape `(R, PW * GW)` and ys of shape `(R, PH * GH)`, and
+    the mask of samples inside the input of shape `(R, PH * GH, PW * GW)`.
+    """
+    height, width = input.shape[2:]
+
+    start_w = rois[:, 1] * scale_w
+    start_h = rois[:, 2] * scale_h
+    # Force malformed RoIs to be 1x1
+    roi_width = (rois[:, 3] * scale_w - start_w).clamp(min=1)
+    roi_height = (rois[:, 4] * scale_h - start_h).clamp(min=1)
+    bin_w = roi_width / pooled_width
+    bin_h = roi_height / pooled_height
+
+    # Sampling points in pixel coordinates, (R, PW * GW) and (R, PH * GH)
+    offset_w = (torch.arange(pooled_width, dtype=rois.dtype, device=rois.device)[:, None] +
+                (torch.arange(grid_w, dtype=rois.dtype, device=rois.device) + 0.5) / grid_w).view(-1)
+    offset_h = (torch.arange(pooled_height, dtype=rois.dtype, device=rois.device)[:, None] +
+                (torch.arange(grid_h, dtype=rois.dtype, device=rois.device) + 0.5) / grid_h).view(-1)
+    xs = start_w[:, None] + bin_w[:, None] * offset_w
+    ys = start_h[:, None] + bin_h[:, None] * offset_h
+
+    # Samples outside of [-1, size] are zero, others are clamped to the border.
+    valid = ((ys >= -1) & (ys <= height))[:, :, None] & ((xs >= -1) & (xs <= width))[:, None, :]
+
+    # Pixel centers are at integers, which is `align_corners=True`.
+    xs = (xs / max(width - 1, 1) * 2 - 1).to(input.dtype)
+    ys = (ys / max(height - 1, 1) * 2 - 1).to(input.dtype)
+    return xs, ys, valid
+
+
+def _roi_align(input, rois, scale_h, scale_w, pooled_height, pooled_width, grid_h, grid_w):
+    r"""
+    RoIAlign of rois sharing the same sampling grid size, by bilinear sampling with
+    `grid_sample` once for every image.
+    """
+    channels = input.size(1)
+    num_rois = rois.size(0)
+    xs, ys, valid = _sampling_grid(
+        input, rois, scale_h, scale_w, pooled_height, pooled_width, grid_h, grid_w)
+    grid = torch.stack([
+        xs[:, None, :].expand(-1, ys.size(1), -1),
+        ys[:, :, None].expand(-1, -1, xs.size(1)),
+    ], dim=-1)
+
+    output = input.new_zeros(num_rois, channels, ys.size(1), xs.size(1))
+    batch_indices = rois[:, 0].long()
+    for b in torch.unique(batch_indices).tolist():
+        inds = torch.nonzero(batch_indices == b).squeeze(1)
+        g = grid[inds].view(1, -1, xs.size(1), 2)
+        samples = F.grid_sample(
+            input[b:b + 1], g, mode='bilinear', padding_mode='border', align_corners=True)
+        output[inds] = samples.view(channels, len(inds), ys.size(1), xs.size(1)).transpose(0, 1)
+    output = output * valid[:, None].to(input.dtype)
+    output = output.view(num_rois, channels, pooled_height, grid_h, pooled_width, grid_w)
+    return output.mean(dim=(3, 5))
+
+
+def _psroi_align(input, rois, scale_h, scale_w, out_channels, pooled_height, pooled_width,
+                 grid_h, grid_w):
+    r"""
+    PSRoIAlign of rois sharing the same sampling grid size. Bin (ph, pw) of output
+    channel c reads input channel (c * PH + ph) * PW + pw, so the bins are the batch
+    of `grid_sample` and sample only their own channels, once for every image.
+    """
+    height, width = input.shape[2:]
+    num_rois = rois.size(0)
+    num_bins = pooled_height * pooled_width
+    xs, ys, valid = _sampling_grid(
+        input, rois, scale_h, scale_w, pooled_height, pooled_width, grid_h, grid_w)
+    # (PH, PW, R, GH, GW)
+    shape = (pooled_height, pooled_width, num_rois, grid_h, grid_w)
+    grid = torch.stack([
+        xs.view(num_rois, pooled_width, grid_w).transpose(0, 1)[None, :, :, None, :].expand(shape),
+        ys.view(num_rois, pooled_height, grid_h).transpose(0, 1)[:, None, :, :, None].expand(shape),
+    ], dim=-1).view(num_bins, num_rois, grid_h, grid_w, 2)
+
+    output = input.new_zeros(num_rois, out_channels, pooled_height, grid_h, pooled_width, grid_w)
+    batch_indices = rois[:, 0].long()
+    for b in torch.unique(batch_indices).tolist():
+        inds = torch.nonzero(batch_indices == b).squeeze(1)
+        features = input[b].view(out_channels, num_bins, height, width).transpose(0, 1)
+        g = grid[:, inds].reshape(num_bins, -1, grid_w, 2)
+        samples = F.grid_sample(
+            features, g, mode='bilinear', padding_mode='border', align_corners=True)
+        output[inds] = samples.view(pooled_height, pooled_width, out_channels, len(inds), grid_h, grid_w) \
+            .permute(3, 2, 0, 4, 1, 5)
+    output = output * valid.view(num_rois, 1, pooled_height, grid_h, pooled_width, grid_w).to(input.dtype)
+    return output.mean(dim=(3, 5))
+
+
+def _by_grid_size(pool, input, rois, scale_h, scale_w, channels, pooled_height, pooled_width,
+                  sampling_ratio, *args):
+    num_rois = rois.size(0)
+    if num_rois == 0:
+        return input.new_zeros(0, channels, pooled_height, pooled_width)
+    if sampling_ratio > 0:
+        return pool(input, rois, scale_h, scale_w, *args, pooled_height, pooled_width,
+                    sampling_ratio, sampling_ratio)
+
+    # Adaptive sampling grids, computed separately for every distinct grid size
+    roi_width = (rois[:, 3] * scale_w - rois[:, 1] * scale_w).clamp(min=1)
+    roi_height = (rois[:, 4] * scale_h - rois[:, 2] * scale_h).clamp(min=1)
+    grid_sizes = torch.stack([
+        torch.ceil(roi_height / pooled_height), torch.ceil(roi_width / pooled_width)], dim=1).long()
+    output = input.new_zeros(num_rois, channels, pooled_height, pooled_width)
+    for grid_h, grid_w in torch.unique(grid_sizes, dim=0).tolist():
+        inds = torch.nonzero((grid_sizes[:, 0] == grid_h) & (grid_sizes[:, 1] == grid_w)).squeeze(1)
+        output[inds] = pool(input, rois[inds], scale_h, scale_w, *args, pooled_height, pooled_width,
+                            grid_h, grid_w)
+    return output
+
+
+def roi_align_forward(input, rois, scale_h, scale_w, pooled_height, pooled_width, sampling_ratio):
+    return _by_grid_size(_roi_align, input, rois, scale_h, scale_w, input.size(1),
+                         pooled_height, pooled_width, sampling_ratio)
+
+
+def roi_align_backward(grad, rois, scale_h, scale_w, pooled_height, pooled_width,
+                       batch_size, channels, height, width, sampling_ratio):
+    with torch.enable_grad():
+        input = grad.new_zeros(batch_size, channels, height, width, requires_grad=True)
+        output = roi_align_forward(
+            input, rois, scale_h, scale_w, pooled_height, pooled_width, sampling_ratio)
+        return torch.autograd.grad(output, input, grad)[0]
+
+
+def psroi_align_forward(input, rois, scale_h, scale_w, out_channels, pooled_height, pooled_width,
+                        sampling_ratio):
+    return _by_grid_size(_psroi_align, input, rois, scale_h, scale_w, out_channels,
+                         pooled_height, pooled_width, sampling_ratio, out_channels)
+
+
+def psroi_align_backward(grad, rois, scale_h, scale_w, out_channels, pooled_height, pooled_width,
+                         batch_size, channels, height, width, sampling_ratio):
+    with torch.enable_grad():
+        input = grad.new_zeros(batch_size, channels, height, width, requires_grad=True)
+        output = psroi_align_forward(
+            input, rois, scale_h, scale_w, out_channels, pooled_height, pooled_width, sampling_ratio)
+        return torch.autograd.grad(output, input, grad)[0]
@@ -0,0 +1,26 @@
+r"""
+Pure NumPy implementations of the ops in the ``horch._numpy`` extension.
+"""
+import numpy as np
+
+
+def iou_mn(boxes1, boxes2):
+    boxes1 = np.asarray(boxes1)
+    boxes2 = np.asarray(boxes2)
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    lt = np.maximum(boxes1[:, None, :2], boxes2[None, :, :2])
+    rb = np.minimum(boxes1[:, None, 2:], boxes2[None, :, 2:])
+    wh = np.maximum(rb - lt, 0)
+    inter = wh[..., 0] * wh[..., 1]
+    return inter / (area1[:, None] + area2[None, :] - inter)
+
+
+def iou_mm(boxes):
+    ious = iou_mn(boxes, boxes)
+    np.fill_diagonal(ious, 1)
+    return ious
+
+
+def iou_11(box1, box2):
+    return iou_mn(np.asarray(box1)[None], np.asarray(box2)[None])[0, 0]
@@ -0,0 +1,34 @@
+#pragma once
+
+#include "cpu/vision.h"
+
+#ifdef WITH_CUDA
+#include "cuda/vision.h"
+#endif
+
+// Interface for Python
+at::Tensor iou_b11_forward(const at::Tensor &boxes1, const at::Tensor &boxes2,
+                           const int kind) {
+    if (boxes1.type().is_cuda()) {
+#ifdef WITH_CUDA
+        return iou_b11_forward_cuda(boxes1, boxes2, kind);
+#else
+        AT_ERROR("Not compiled with GPU support");
+#endif
+    }
+    return iou_b11_forward_cpu(boxes1, boxes2, kind);
+};
+
+std::tuple<at::Tensor, at::Tensor> iou_b11_backward(const at::Tensor &dout,
+                                                    const at::Tensor &boxes1,
+                                                    const at::Tensor &boxes2,
+                                                    const int kind) {
+    if (dout.type().is_cuda()) {
+#ifdef WITH_CUDA
+        return iou_b11_backward_cuda(dout, boxes1, boxes2, kind);
+#else
+        AT_ERROR("Not compiled with GPU support");
+#endif
+    }
+    return iou_b11_backward_cpu(dout, boxes1, boxes2, kind);
+};
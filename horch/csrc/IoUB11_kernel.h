@@ -0,0 +1,208 @@
+#pragma once
+
+// Per-pair forward and backward of IoU and its generalized variants, shared by
+// the CPU and CUDA implementations of iou_b11.
+
+#include <cmath>
+
+#ifdef __CUDACC__
+#define HOST_DEVICE __host__ __device__
+#else
+#define HOST_DEVICE
+#endif
+
+enum IoUKind { IOU = 0, GIOU = 1, DIOU = 2, CIOU = 3 };
+
+template <typename T> HOST_DEVICE inline T iou_b11_max(const T a, const T b) {
+    return a > b ? a : b;
+}
+
+template <typename T> HOST_DEVICE inline T iou_b11_min(const T a, const T b) {
+    return a < b ? a : b;
+}
+
+template <typename T>
+HOST_DEVICE inline T iou_b11_forward_single(const T *a, const T *b,
+                                            const int kind) {
+    const T eps = static_cast<T>(1e-7);
+
+    T aw = a[2] - a[0];
+    T ah = a[3] - a[1];
+    T bw = b[2] - b[0];
+    T bh = b[3] - b[1];
+
+    T iw = iou_b11_max(static_cast<T>(0.0),
+                       iou_b11_min(a[2], b[2]) - iou_b11_max(a[0], b[0]));
+    T ih = iou_b11_max(static_cast<T>(0.0),
+                       iou_b11_min(a[3], b[3]) - iou_b11_max(a[1], b[1]));
+    T inter = iw * ih;
+    T uni = aw * ah + bw * bh - inter + eps;
+    T iou = inter / uni;
+    if (kind == IOU) {
+        return iou;
+    }
+
+    T cw = iou_b11_max(a[2], b[2]) - iou_b11_min(a[0], b[0]);
+    T ch = iou_b11_max(a[3], b[3]) - iou_b11_min(a[1], b[1]);
+    if (kind == GIOU) {
+        T c = cw * ch + eps;
+        return iou - (c - uni) / c;
+    }
+
+    T dx = a[0] + a[2] - b[0] - b[2];
+    T dy = a[1] + a[3] - b[1] - b[3];
+    T rho2 = (dx * dx + dy * dy) / 4;
+    T c2 = cw * cw + ch * ch + eps;
+    T diou = iou - rho2 / c2;
+    if (kind == DIOU) {
+        return diou;
+    }
+
+    const T k = static_cast<T>(4.0 / (M_PI * M_PI));
+    T d = atan(bw / bh) - atan(aw / ah);
+    T v = k * d * d;
+    T alpha = v / (1 - iou + v + eps);
+    return diou - alpha * v;
+}
+
+// Accumulates the gradients of iou_b11_forward_single into da and db. As
+// usual for CIoU, the trade-off parameter alpha is treated as a constant.
+template <typename T>
+HOST_DEVICE inline void iou_b11_backward_single(const T *a, const T *b,
+                                                const int kind, const T dout,
+                                                T *da, T *db) {
+    const T eps = static_cast<T>(1e-7);
+
+    T aw = a[2] - a[0];
+    T ah = a[3] - a[1];
+    T bw = b[2] - b[0];
+    T bh = b[3] - b[1];
+
+    T iw = iou_b11_max(static_cast<T>(0.0),
+                       iou_b11_min(a[2], b[2]) - iou_b11_max(a[0], b[0]));
+    T ih = iou_b11_max(static_cast<T>(0.0),
+                       iou_b11_min(a[3], b[3]) - iou_b11_max(a[1], b[1]));
+    T inter = iw * ih;
+    T uni = aw * ah + bw * bh - inter + eps;
+    T iou = inter / uni;
+
+    // Gradients w.r.t. the intersection, the union, the enclosing box width
+    // and height, and the squared center distance.
+    T dinter = dout / uni;
+    T duni = -dout * iou / uni;
+    T dcw = 0, dch = 0, drho2 = 0;
+
+    T cw = iou_b11_max(a[2], b[2]) - iou_b11_min(a[0], b[0]);
+    T ch = iou_b11_max(a[3], b[3]) - iou_b11_min(a[1], b[1]);
+    T dx = a[0] + a[2] - b[0] - b[2];
+    T dy = a[1] + a[3] - b[1] - b[3];
+
+    if (kind == GIOU) {
+        // iou - (c - uni) / c = iou - 1 + uni / c
+        T c = cw * ch + eps;
+        duni += dout / c;
+        T dc = -dout * (uni / c) / c;
+        dcw += dc * ch;
+        dch += dc * cw;
+    } else if (kind == DIOU || kind == CIOU) {
+        T rho2 = (dx * dx + dy * dy) / 4;
+        T c2 = cw * cw + ch * ch + eps;
+        drho2 = -dout / c2;
+        T dc2 = dout * (rho2 / c2) / c2;
+        dcw += dc2 * 2 * cw;
+        dch += dc2 * 2 * ch;
+    }
+
+    if (kind == CIOU) {
+        const T k = static_cast<T>(4.0 / (M_PI * M_PI));
+        T d = atan(bw / bh) - atan(aw / ah);
+        T v = k * d * d;
+        T alpha = v / (1 - iou + v + eps);
+        T dd = -dout * alpha * 2 * k * d;
+        T asq = aw * aw + ah * ah;
+        T bsq = bw * bw + bh * bh;
+        T daw = -dd * ah / asq;
+        T dah = dd * aw / asq;
+        T dbw = dd * bh / bsq;
+        T dbh = -dd * bw / bsq;
+        da[0] -= daw;
+        da[2] += daw;
+        da[1] -= dah;
+        da[3] += dah;
+        db[0] -= dbw;
+        db[2] += dbw;
+        db[1] -= dbh;
+        db[3] += dbh;
+    }
+
+    // uni = area_a + area_b - inter
+    dinter -= duni;
+    da[0] -= duni * ah;
+    da[2] += duni * ah;
+    da[1] -= duni * aw;
+    da[3] += duni * aw;
+    db[0] -= duni * bh;
+    db[2] += duni * bh;
+    db[1] -= duni * bw;
+    db[3] += duni * bw;
+
+    // inter = iw * ih, iw = min(x2) - max(x1), ih = min(y2) - max(y1)
+    if (iw > 0 && ih > 0) {
+        T diw = dinter * ih;
+        T dih = dinter * iw;
+        if (a[0] >= b[0]) {
+            da[0] -= diw;
+        } else {
+            db[0] -= diw;
+        }
+        if (a[1] >= b[1]) {
+            da[1] -= dih;
+        } else {
+            db[1] -= dih;
+        }
+        if (a[2] <= b[2]) {
+            da[2] += diw;
+        } else {
+            db[2] += diw;
+        }
+        if (a[3] <= b[3]) {
+            da[3] += dih;
+        } else {
+            db[3] += dih;
+        }
+    }
+
+    // cw = max(x2) - min(x1), ch = max(y2) - min(y1)
+    if (a[0] <= b[0]) {
+        da[0] -= dcw;
+    } else {
+        db[0] -= dcw;
+    }
+    if (a[1] <= b[1]) {
+        da[1] -= dch;
+    } else {
+        db[1] -= dch;
+    }
+    if (a[2] >= b[2]) {
+        da[2] += dcw;
+    } else {
+        db[2] += dcw;
+    }
+    if (a[3] >= b[3]) {
+        da[3] += dch;
+    } else {
+        db[3] += dch;
+    }
+
+    // rho2 = (dx^2 + dy^2) / 4, dx = a_x1 + a_x2 - b_x1 - b_x2
+    T ddx = drho2 * dx / 2;
+    T ddy = drho2 * dy / 2;
+    da[0] += ddx;
+    da[2] += ddx;
+    db[0] -= ddx;
+    db[2] -= ddx;
+    da[1] += ddy;
+    da[3] += ddy;
+    db[1] -= ddy;
+    db[3] -= ddy;
+}
@@ -30,4 +30,10 @@ std::tuple<at::Tensor, at::Tensor> iou_mn_backward(const at::Tensor &dout,
 #endif
     }
     return iou_mn_backward_cpu(dout, boxes1, boxes2, ious);
-};
\ No newline at end of file
+};
+
+std::tuple<at::Tensor, at::Tensor, at::Tensor, at::Tensor>
+iou_mn_reduce(const at::Tensor &boxes1, const at::Tensor &boxes2,
+              const float threshold, const int64_t tile_size) {
+    return iou_mn_reduce_cpu(boxes1, boxes2, threshold, tile_size);
+}
@@ -0,0 +1,86 @@
+#include "IoUB11_kernel.h"
+#include "cpu/vision.h"
+#include <ATen/Parallel.h>
+#include <ATen/TensorUtils.h>
+
+template <typename T>
+void iou_b11_forward_kernel(const T *boxes1, const T *boxes2, const int64_t n,
+                            const int kind, T *ious) {
+    at::parallel_for(0, n, at::internal::GRAIN_SIZE, [&](int64_t begin, int64_t end) {
+        for (auto i = begin; i < end; i++) {
+            ious[i] = iou_b11_forward_single(boxes1 + 4 * i, boxes2 + 4 * i, kind);
+        }
+    });
+}
+
+template <typename T>
+void iou_b11_backward_kernel(T *dboxes1, T *dboxes2, const T *dious,
+                             const T *boxes1, const T *boxes2, const int64_t n,
+                             const int kind) {
+    at::parallel_for(0, n, at::internal::GRAIN_SIZE, [&](int64_t begin, int64_t end) {
+        for (auto i = begin; i < end; i++) {
+            iou_b11_backward_single(boxes1 + 4 * i, boxes2 + 4 * i, kind,
+                                    dious[i], dboxes1 + 4 * i, dboxes2 + 4 * i);
+        }
+    });
+}
+
+at::Tensor iou_b11_forward_cpu(const at::Tensor &boxes1,
+                               const at::Tensor &boxes2, const int kind) {
+    AT_ASSERTM(!boxes1.type().is_cuda(), "boxes1 must be a CPU tensor");
+    AT_ASSERTM(!boxes2.type().is_cuda(), "boxes2 must be a CPU tensor");
+    AT_ASSERTM(boxes1.sizes() == boxes2.sizes(),
+               "boxes1 should have the same size as boxes2");
+    AT_ASSERTM(kind >= IOU && kind <= CIOU, "invalid kind of iou");
+
+    at::TensorArg boxes1_t{boxes1, "boxes1", 1}, boxes2_t{boxes2, "boxes2", 2};
+
+    at::CheckedFrom c = "iou_b11_forward_cpu";
+    at::checkAllSameType(c, {boxes1_t, boxes2_t});
+
+    auto n = boxes1.size(0);
+    auto ious = torch::empty({n}, boxes1.type());
+
+    if (n == 0)
+        return ious;
+
+    AT_DISPATCH_FLOATING_TYPES(boxes1.type(), "iou_b11_forward_cpu", [&] {
+        iou_b11_forward_kernel<scalar_t>(
+            boxes1.contiguous().data<scalar_t>(),
+            boxes2.contiguous().data<scalar_t>(), n, kind,
+            ious.data<scalar_t>());
+    });
+    return ious;
+}
+
+std::tuple<at::Tensor, at::Tensor>
+iou_b11_backward_cpu(const at::Tensor &dious, const at::Tensor &boxes1,
+                     const at::Tensor &boxes2, const int kind) {
+    AT_ASSERTM(!dious.type().is_cuda(), "dious must be a CPU tensor");
+    AT_ASSERTM(!boxes1.type().is_cuda(), "boxes1 must be a CPU tensor");
+    AT_ASSERTM(!boxes2.type().is_cuda(), "boxes2 must be a CPU tensor");
+    AT_ASSERTM(kind >= IOU && kind <= CIOU, "invalid kind of iou");
+
+    at::TensorArg dious_t{dious, "dious", 1}, boxes1_t{boxes1, "boxes1", 2},
+        boxes2_t{boxes2, "boxes2", 3};
+
+    at::CheckedFrom c = "iou_b11_backward_cpu";
+    at::checkAllSameType(c, {dious_t, boxes1_t, boxes2_t});
+
+    auto n = boxes1.size(0);
+    at::Tensor dboxes1 = torch::zeros({n, 4}, boxes1.type());
+    at::Tensor dboxes2 = torch::zeros({n, 4}, boxes2.type());
+
+    if (n == 0) {
+        return std::make_tuple(dboxes1, dboxes2);
+    }
+
+    AT_DISPATCH_FLOATING_TYPES(boxes1.type(), "iou_b11_backward_cpu", [&] {
+        iou_b11_backward_kernel<scalar_t>(
+            dboxes1.data<scalar_t>(), dboxes2.data<scalar_t>(),
+            dious.contiguous().data<scalar_t>(),
+            boxes1.contiguous().data<scalar_t>(),
+            boxes2.contiguous().data<scalar_t>(), n, kind);
+    });
+    return std::make_tuple(dboxes1, dboxes2);
+}
@@ -1,123 +1,159 @@
 #include "cpu/vision.h"
+#include <ATen/Parallel.h>
 #include <ATen/TensorUtils.h>
 
+// Number of rows of boxes1 processed by one task, so that every task handles
+// roughly GRAIN_SIZE box pairs.
+inline int64_t iou_mn_grain_size(const int64_t n) {
+    return std::max<int64_t>(1, at::internal::GRAIN_SIZE / std::max<int64_t>(n, 1));
+}
+
 template <typename T>
-void iou_mn_forward_kernel(const T *boxes1, const T *boxes2, const int m,
-                           const int n, T *ious) {
-
-    for (auto i = 0; i < m; i++) {
-        auto ibox = boxes1 + 4 * i;
-        auto ix1 = ibox[0];
-        auto iy1 = ibox[1];
-        auto ix2 = ibox[2];
-        auto iy2 = ibox[3];
-        auto iw = ix2 - ix1;
-        auto ih = iy2 - iy1;
-        auto iarea = iw * ih;
-        for (auto j = 0; j < n; j++) {
-            auto jbox = boxes2 + 4 * j;
-            auto jx1 = jbox[0];
-            auto jy1 = jbox[1];
-            auto jx2 = jbox[2];
-            auto jy2 = jbox[3];
-            auto jw = jx2 - jx1;
-            auto jh = jy2 - jy1;
-            auto jarea = jw * jh;
-
-            auto xx1 = std::max(ix1, jx1);
-            auto yy1 = std::max(iy1, jy1);
-            auto xx2 = std::min(ix2, jx2);
-            auto yy2 = std::min(iy2, jy2);
-
-            auto w = std::max(static_cast<T>(0.0), xx2 - xx1);
-            auto h = std::max(static_cast<T>(0.0), yy2 - yy1);
-            auto inter = w * h;
-            auto iou = inter / (iarea + jarea - inter);
-            ious[i * n + j] = iou;
+void iou_mn_forward_kernel(const T *boxes1, const T *boxes2, const int64_t m,
+                           const int64_t n, T *ious) {
+
+    // Structure of arrays of boxes2 with precomputed areas, so that the inner
+    // loop is branchless over contiguous arrays and can be vectorized.
+    std::vector<T> x1(n), y1(n), x2(n), y2(n), areas(n);
+    for (int64_t j = 0; j < n; j++) {
+        auto jbox = boxes2 + 4 * j;
+        x1[j] = jbox[0];
+        y1[j] = jbox[1];
+        x2[j] = jbox[2];
+        y2[j] = jbox[3];
+        areas[j] = (jbox[2] - jbox[0]) * (jbox[3] - jbox[1]);
+    }
+    const T *px1 = x1.data(), *py1 = y1.data(), *px2 = x2.data(),
+            *py2 = y2.data(), *pareas = areas.data();
+
+    at::parallel_for(0, m, iou_mn_grain_size(n), [&](int64_t begin, int64_t end) {
+        for (auto i = begin; i < end; i++) {
+            auto ibox = boxes1 + 4 * i;
+            const auto ix1 = ibox[0];
+            const auto iy1 = ibox[1];
+            const auto ix2 = ibox[2];
+            const auto iy2 = ibox[3];
+            const auto iarea = (ix2 - ix1) * (iy2 - iy1);
+            T *out = ious + i * n;
+            for (int64_t j = 0; j < n; j++) {
+                auto w = std::max(static_cast<T>(0.0),
+                                  std::min(ix2, px2[j]) - std::max(ix1, px1[j]));
+                auto h = std::max(static_cast<T>(0.0),
+                                  std::min(iy2, py2[j]) - std::max(iy1, py1[j]));
+                auto inter = w * h;
+                out[j] = inter / (iarea + pareas[j] - inter);
+            }
         }
+    });
+}
+
+// Accumulates the gradients of the IoU between ibox and jbox into dibox and
+// djbox.
+template <typename T>
+inline void iou_mn_backward_pair(const T *ibox, const T *jbox, const T diou,
+                                 T *dibox, T *djbox) {
+    auto ix1 = ibox[0];
+    auto iy1 = ibox[1];
+    auto ix2 = ibox[2];
+    auto iy2 = ibox[3];
+    auto iw = ix2 - ix1;
+    auto ih = iy2 - iy1;
+    auto iarea = iw * ih;
+
+    auto jx1 = jbox[0];
+    auto jy1 = jbox[1];
+    auto jx2 = jbox[2];
+    auto jy2 = jbox[3];
+    auto jw = jx2 - jx1;
+    auto jh = jy2 - jy1;
+    auto jarea = jw * jh;
+
+    auto xx1 = std::max(ix1, jx1);
+    auto yy1 = std::max(iy1, jy1);
+    auto xx2 = std::min(ix2, jx2);
+    auto yy2 = std::min(iy2, jy2);
+
+    auto w = std::max(static_cast<T>(0.0), xx2 - xx1);
+    auto h = std::max(static_cast<T>(0.0), yy2 - yy1);
+    auto inter_area = w * h;
+    auto union_area = iarea + jarea - inter_area;
+
+    auto darea = diou * inter_area / (union_area * union_area);
+
+    dibox[0] += ih * darea;
+    dibox[1] += iw * darea;
+    dibox[2] -= ih * darea;
+    dibox[3] -= iw * darea;
+
+    djbox[0] += jh * darea;
+    djbox[1] += jw * darea;
+    djbox[2] -= jh * darea;
+    djbox[3] -= jw * darea;
+
+    auto dinter = diou * (inter_area + union_area) / (union_area * union_area);
+    auto dw = h * dinter;
+    auto dh = w * dinter;
+
+    if (ix1 >= jx1) {
+        dibox[0] -= dw;
+    } else {
+        djbox[0] -= dw;
+    }
+
+    if (iy1 >= jy1) {
+        dibox[1] -= dh;
+    } else {
+        djbox[1] -= dh;
+    }
+
+    if (ix2 <= jx2) {
+        dibox[2] += dw;
+    } else {
+        djbox[2] += dw;
+    }
+
+    if (iy2 <= jy2) {
+        dibox[3] += dh;
+    } else {
+        djbox[3] += dh;
     }
 }
 
 template <typename T>
 void iou_mn_backward_kernel(T *dboxes1, T *dboxes2, const T *dious,
-                            const T *boxes1, const T *boxes2, const int m,
-                            const int n, const T *ious) {
-
-    for (auto i = 0; i < m; i++) {
-        auto ibox = boxes1 + 4 * i;
-        auto dibox = dboxes1 + 4 * i;
-        auto ix1 = ibox[0];
-        auto iy1 = ibox[1];
-        auto ix2 = ibox[2];
-        auto iy2 = ibox[3];
-        auto iw = ix2 - ix1;
-        auto ih = iy2 - iy1;
-        auto iarea = iw * ih;
-        for (auto j = 0; j < n; j++) {
-            if (ious[i * n + j] == 0)
-                continue;
-            auto jbox = boxes2 + 4 * j;
-            auto djbox = dboxes2 + 4 * j;
-            auto jx1 = jbox[0];
-            auto jy1 = jbox[1];
-            auto jx2 = jbox[2];
-            auto jy2 = jbox[3];
-            auto jw = jx2 - jx1;
-            auto jh = jy2 - jy1;
-            auto jarea = jw * jh;
-
-            auto xx1 = std::max(ix1, jx1);
-            auto yy1 = std::max(iy1, jy1);
-            auto xx2 = std::min(ix2, jx2);
-            auto yy2 = std::min(iy2, jy2);
-
-            auto w = std::max(static_cast<T>(0.0), xx2 - xx1);
-            auto h = std::max(static_cast<T>(0.0), yy2 - yy1);
-            auto inter_area = w * h;
-            auto union_area = iarea + jarea - inter_area;
-
-            auto diou = dious[i * n + j];
-            auto darea = diou * inter_area / (union_area * union_area);
-
-            dibox[0] += ih * darea;
-            dibox[1] += iw * darea;
-            dibox[2] -= ih * darea;
-            dibox[3] -= iw * darea;
-
-            djbox[0] += jh * darea;
-            djbox[1] += jw * darea;
-            djbox[2] -= jh * darea;
-            djbox[3] -= jw * darea;
-
-            auto dinter =
-                diou * (inter_area + union_area) / (union_area * union_area);
-            auto dw = h * dinter;
-            auto dh = w * dinter;
-
-            if (ix1 >= jx1) {
-                dibox[0] -= dw;
-            } else {
-                djbox[0] -= dw;
-            }
+                            const T *boxes1, const T *boxes2, const int64_t m,
+                            const int64_t n, const T *ious) {
 
-            if (iy1 >= jy1) {
-                dibox[1] -= dh;
-            } else {
-                djbox[1] -= dh;
-            }
+    // Rows of boxes1 are split across threads, so dboxes1 is written without
+    // conflicts. Every thread other than the first accumulates dboxes2 into
+    // its own buffer, which is reduced into dboxes2 afterwards.
+    const int64_t num_threads = at::get_num_threads();
+    std::vector<T> partial(std::max<int64_t>(num_threads - 1, 0) * 4 * n, 0);
 
-            if (ix2 <= jx2) {
-                dibox[2] += dw;
-            } else {
-                djbox[2] += dw;
+    at::parallel_for(0, m, iou_mn_grain_size(n), [&](int64_t begin, int64_t end) {
+        const int64_t tid = at::get_thread_num();
+        T *djboxes = tid == 0 ? dboxes2 : partial.data() + (tid - 1) * 4 * n;
+        for (auto i = begin; i < end; i++) {
+            auto ibox = boxes1 + 4 * i;
+            auto dibox = dboxes1 + 4 * i;
+            for (int64_t j = 0; j < n; j++) {
+                if (ious[i * n + j] == 0)
+                    continue;
+                iou_mn_backward_pair(ibox, boxes2 + 4 * j, dious[i * n + j],
+                                     dibox, djboxes + 4 * j);
             }
+        }
+    });
 
-            if (iy2 <= jy2) {
-                dibox[3] += dh;
-            } else {
-                djbox[3] += dh;
+    if (num_threads > 1) {
+        at::parallel_for(0, 4 * n, at::internal::GRAIN_SIZE, [&](int64_t begin, int64_t end) {
+            for (int64_t t = 0; t < num_threads - 1; t++) {
+                const T *p = partial.data() + t * 4 * n;
+                for (auto k = begin; k < end; k++) {
+                    dboxes2[k] += p[k];
+                }
             }
-        }
+        });
     }
 }
 
@@ -135,7 +171,7 @@ at::Tensor iou_mn_forward_cpu(const at::Tensor &boxes1,
 
     auto m = boxes1.size(0);
     auto n = boxes2.size(0);
-    auto ious = torch::zeros({m, n}, boxes1.type());
+    auto ious = torch::empty({m, n}, boxes1.type());
 
     if (ious.numel() == 0)
         return ious;
@@ -180,4 +216,126 @@ std::tuple<at::Tensor, at::Tensor> iou_mn_backward_cpu(const at::Tensor &dious,
             ious.contiguous().data<scalar_t>());
     });
     return std::make_tuple(dboxes1, dboxes2);
-}
\ No newline at end of file
+}
+template <typename T>
+void iou_mn_reduce_kernel(const T *boxes1, const T *boxes2, const int64_t m,
+                          const int64_t n, const T threshold,
+                          const int64_t tile_size, T *max_ious,
+                          int64_t *indices, int64_t *gt_indices,
+                          int64_t *counts) {
+
+    std::vector<T> x1(n), y1(n), x2(n), y2(n), areas(n);
+    for (int64_t j = 0; j < n; j++) {
+        auto jbox = boxes2 + 4 * j;
+        x1[j] = jbox[0];
+        y1[j] = jbox[1];
+        x2[j] = jbox[2];
+        y2[j] = jbox[3];
+        areas[j] = (jbox[2] - jbox[0]) * (jbox[3] - jbox[1]);
+    }
+
+    // Every tile of boxes2 keeps its own best box2 for each box1, merged in
+    // tile order afterwards so that ties resolve to the first index.
+    const int64_t num_tiles = (n + tile_size - 1) / tile_size;
+    std::vector<T> tile_gt_max(num_tiles * m, -1);
+    std::vector<int64_t> tile_gt_indices(num_tiles * m, 0);
+
+    at::parallel_for(0, num_tiles, 1, [&](int64_t tile_begin, int64_t tile_end) {
+        std::vector<T> tile_ious(tile_size);
+        T *pious = tile_ious.data();
+        for (auto tile = tile_begin; tile < tile_end; tile++) {
+            const int64_t begin = tile * tile_size;
+            const int64_t size = std::min(tile_size, n - begin);
+            const T *px1 = x1.data() + begin, *py1 = y1.data() + begin,
+                    *px2 = x2.data() + begin, *py2 = y2.data() + begin,
+                    *pareas = areas.data() + begin;
+            T *pmax = max_ious + begin;
+            int64_t *pindices = indices + begin;
+            int64_t *pcounts = counts + begin;
+            for (int64_t j = 0; j < size; j++) {
+                pmax[j] = -1;
+                pindices[j] = 0;
+                pcounts[j] = 0;
+            }
+
+            for (int64_t i = 0; i < m; i++) {
+                auto ibox = boxes1 + 4 * i;
+                const auto ix1 = ibox[0];
+                const auto iy1 = ibox[1];
+                const auto ix2 = ibox[2];
+                const auto iy2 = ibox[3];
+                const auto iarea = (ix2 - ix1) * (iy2 - iy1);
+                for (int64_t j = 0; j < size; j++) {
+                    auto w = std::max(static_cast<T>(0.0),
+                                      std::min(ix2, px2[j]) - std::max(ix1, px1[j]));
+                    auto h = std::max(static_cast<T>(0.0),
+                                      std::min(iy2, py2[j]) - std::max(iy1, py1[j]));
+                    auto inter = w * h;
+                    pious[j] = inter / (iarea + pareas[j] - inter);
+                }
+                T best = -1;
+                int64_t best_j = 0;
+                for (int64_t j = 0; j < size; j++) {
+                    auto iou = pious[j];
+                    if (iou > pmax[j]) {
+                        pmax[j] = iou;
+                        pindices[j] = i;
+                    }
+                    pcounts[j] += iou >= threshold;
+                    if (iou > best) {
+                        best = iou;
+                        best_j = j;
+                    }
+                }
+                tile_gt_max[tile * m + i] = best;
+                tile_gt_indices[tile * m + i] = begin + best_j;
+            }
+        }
+    });
+
+    for (int64_t i = 0; i < m; i++) {
+        T best = -1;
+        int64_t best_j = 0;
+        for (int64_t tile = 0; tile < num_tiles; tile++) {
+            if (tile_gt_max[tile * m + i] > best) {
+                best = tile_gt_max[tile * m + i];
+                best_j = tile_gt_indices[tile * m + i];
+            }
+        }
+        gt_indices[i] = best_j;
+    }
+}
+
+std::tuple<at::Tensor, at::Tensor, at::Tensor, at::Tensor>
+iou_mn_reduce_cpu(const at::Tensor &boxes1, const at::Tensor &boxes2,
+                  const float threshold, const int64_t tile_size) {
+    AT_ASSERTM(!boxes1.type().is_cuda(), "boxes1 must be a CPU tensor");
+    AT_ASSERTM(!boxes2.type().is_cuda(), "boxes2 must be a CPU tensor");
+    AT_ASSERTM(tile_size > 0, "tile_size must be positive");
+
+    at::TensorArg boxes1_t{boxes1, "boxes1", 1}, boxes2_t{boxes2, "boxes2", 2};
+
+    at::CheckedFrom c = "iou_mn_reduce_cpu";
+    at::checkAllSameType(c, {boxes1_t, boxes2_t});
+
+    auto m = boxes1.size(0);
+    auto n = boxes2.size(0);
+    auto max_ious = torch::zeros({n}, boxes1.type());
+    auto indices = torch::zeros({n}, boxes1.options().dtype(at::kLong));
+    auto gt_indices = torch::zeros({m}, boxes1.options().dtype(at::kLong));
+    auto counts = torch::zeros({n}, boxes1.options().dtype(at::kLong));
+
+    if (m == 0 || n == 0) {
+        return std::make_tuple(max_ious, indices, gt_indices, counts);
+    }
+
+    AT_DISPATCH_FLOATING_TYPES(boxes1.type(), "iou_mn_reduce_cpu", [&] {
+        iou_mn_reduce_kernel<scalar_t>(
+            boxes1.contiguous().data<scalar_t>(),
+            boxes2.contiguous().data<scalar_t>(), m, n,
+            static_cast<scalar_t>(threshold), tile_size,
+            max_ious.data<scalar_t>(), indices.data<int64_t>(),
+            gt_indices.data<int64_t>(), counts.data<int64_t>());
+    });
+    return std::make_tuple(max_ious, indices, gt_indices, counts);
+}
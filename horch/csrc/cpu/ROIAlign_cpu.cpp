@@ -1,4 +1,5 @@
 #include <ATen/ATen.h>
+#include <ATen/Parallel.h>
 #include <TH/TH.h>
 
 // implementation taken from Caffe2
@@ -110,39 +111,31 @@ void pre_calc_for_bilinear_interpolate(
   }
 }
 
+// Bilinear interpolation weights of every sample of a RoI, shared by all channels
 template <typename T>
-void ROIAlignForward(
-    const int nthreads,
-    const T* input,
-    const T& scale_h,
-    const T& scale_w,
-    const int channels,
-    const int height,
-    const int width,
-    const int pooled_height,
-    const int pooled_width,
-    const int sampling_ratio,
-    const T* rois,
-    T* output) {
-  int n_rois = nthreads / channels / pooled_width / pooled_height;
-  // (n, c, ph, pw) is an element in the pooled output
-  // can be parallelized using omp
-  // #pragma omp parallel for num_threads(32)
-  for (int n = 0; n < n_rois; n++) {
-    int index_n = n * channels * pooled_width * pooled_height;
-
-    const T* offset_rois = rois + n * 5;
-    int roi_batch_ind = offset_rois[0];
+struct RoIPreCalc {
+  int batch_ind;
+  int roi_bin_grid_h;
+  int roi_bin_grid_w;
+  T count;
+  std::vector<PreCalc<T>> pre_calc;
+
+  void compute(
+      const T* offset_rois,
+      const T& scale_h,
+      const T& scale_w,
+      const int height,
+      const int width,
+      const int pooled_height,
+      const int pooled_width,
+      const int sampling_ratio) {
+    batch_ind = offset_rois[0];
 
     // Do not using rounding; this implementation detail is critical
     T roi_start_w = offset_rois[1] * scale_w;
     T roi_start_h = offset_rois[2] * scale_h;
     T roi_end_w = offset_rois[3] * scale_w;
     T roi_end_h = offset_rois[4] * scale_h;
-    // T roi_start_w = round(offset_rois[0] * spatial_scale);
-    // T roi_start_h = round(offset_rois[1] * spatial_scale);
-    // T roi_end_w = round(offset_rois[2] * spatial_scale);
-    // T roi_end_h = round(offset_rois[3] * spatial_scale);
 
     // Force malformed ROIs to be 1x1
     T roi_width = std::max(roi_end_w - roi_start_w, (T)1.);
@@ -151,18 +144,16 @@ void ROIAlignForward(
     T bin_size_w = static_cast<T>(roi_width) / static_cast<T>(pooled_width);
 
     // We use roi_bin_grid to sample the grid and mimic integral
-    int roi_bin_grid_h = (sampling_ratio > 0)
+    roi_bin_grid_h = (sampling_ratio > 0)
         ? sampling_ratio
         : ceil(roi_height / pooled_height); // e.g., = 2
-    int roi_bin_grid_w =
+    roi_bin_grid_w =
         (sampling_ratio > 0) ? sampling_ratio : ceil(roi_width / pooled_width);
 
     // We do average (integral) pooling inside a bin
-    const T count = roi_bin_grid_h * roi_bin_grid_w; // e.g. = 4
+    count = roi_bin_grid_h * roi_bin_grid_w; // e.g. = 4
 
-    // we want to precalculate indeces and weights shared by all chanels,
-    // this is the key point of optimiation
-    std::vector<PreCalc<T>> pre_calc(
+    pre_calc.resize(
         roi_bin_grid_h * roi_bin_grid_w * pooled_width * pooled_height);
     pre_calc_for_bilinear_interpolate(
         height,
@@ -178,11 +169,46 @@ void ROIAlignForward(
         roi_bin_grid_h,
         roi_bin_grid_w,
         pre_calc);
+  }
+};
 
-      for (int c = 0; c < channels; c++) {
-      int index_n_c = index_n + c * pooled_width * pooled_height;
+template <typename T>
+void ROIAlignForward(
+    const int nthreads,
+    const T* input,
+    const T& scale_h,
+    const T& scale_w,
+    const int channels,
+    const int height,
+    const int width,
+    const int pooled_height,
+    const int pooled_width,
+    const int sampling_ratio,
+    const T* rois,
+    T* output) {
+  int n_rois = nthreads / channels / pooled_width / pooled_height;
+  // (n, c) pairs are split among threads. The weights of a RoI are computed
+  // once in every chunk and shared by the channels of the RoI in the chunk.
+  at::parallel_for(0, (int64_t)n_rois * channels, 1, [=](int64_t begin, int64_t end) {
+    RoIPreCalc<T> roi;
+    int n = -1;
+    for (int64_t i = begin; i < end; i++) {
+      int c = i % channels;
+      if (i / channels != n) {
+        n = i / channels;
+        roi.compute(
+            rois + n * 5, scale_h, scale_w, height, width,
+            pooled_height, pooled_width, sampling_ratio);
+      }
+      // Local copies, as stores to the output could alias the members
+      const int roi_bin_grid_h = roi.roi_bin_grid_h;
+      const int roi_bin_grid_w = roi.roi_bin_grid_w;
+      const T count = roi.count;
+      const PreCalc<T>* pre_calc = roi.pre_calc.data();
+
+      int index_n_c = i * pooled_width * pooled_height;
       const T* offset_input =
-          input + (roi_batch_ind * channels + c) * height * width;
+          input + (roi.batch_ind * channels + c) * height * width;
       int pre_calc_index = 0;
 
       for (int ph = 0; ph < pooled_height; ph++) {
@@ -206,60 +232,8 @@ void ROIAlignForward(
           output[index] = output_val;
         } // for pw
       } // for ph
-    } // for c
-  } // for n
-}
-
-template <typename T>
-void bilinear_interpolate_gradient(
-    const int height, const int width,
-    T y, T x,
-    T& w1, T& w2, T& w3, T& w4,
-    int& x_low, int& x_high, int& y_low, int& y_high,
-    const int index /* index for debug only*/) {
-
-  // deal with cases that inverse elements are out of feature map boundary
-  if (y < -1.0 || y > height || x < -1.0 || x > width) {
-    // empty
-    w1 = w2 = w3 = w4 = 0.;
-    x_low = x_high = y_low = y_high = -1;
-    return;
-  }
-
-  if (y <= 0) y = 0;
-  if (x <= 0) x = 0;
-
-  y_low = (int)y;
-  x_low = (int)x;
-
-  if (y_low >= height - 1) {
-    y_high = y_low = height - 1;
-    y = (T)y_low;
-  } else {
-    y_high = y_low + 1;
-  }
-
-  if (x_low >= width - 1) {
-    x_high = x_low = width - 1;
-    x = (T)x_low;
-  } else {
-    x_high = x_low + 1;
-  }
-
-  T ly = y - y_low;
-  T lx = x - x_low;
-  T hy = 1. - ly, hx = 1. - lx;
-
-  // reference in forward
-  // T v1 = input[y_low * width + x_low];
-  // T v2 = input[y_low * width + x_high];
-  // T v3 = input[y_high * width + x_low];
-  // T v4 = input[y_high * width + x_high];
-  // T val = (w1 * v1 + w2 * v2 + w3 * v3 + w4 * v4);
-
-  w1 = hy * hx, w2 = hy * lx, w3 = ly * hx, w4 = ly * lx;
-
-  return;
+    } // for (n, c)
+  });
 }
 
 template <class T>
@@ -283,71 +257,51 @@ void ROIAlignBackward(
     const T* rois,
     const int n_stride, const int c_stride,
     const int h_stride, const int w_stride) {
-  for (int index = 0; index < nthreads; index++) {
-    // (n, c, ph, pw) is an element in the pooled output
-    int pw = index % pooled_width;
-    int ph = (index / pooled_width) % pooled_height;
-    int c = (index / pooled_width / pooled_height) % channels;
-    int n = index / pooled_width / pooled_height / channels;
-
-    const T* offset_rois = rois + n * 5;
-    int roi_batch_ind  = offset_rois[0];
-
-    // Do not using rounding; this implementation detail is critical
-    T roi_start_w = offset_rois[1] * scale_w;
-    T roi_start_h = offset_rois[2] * scale_h;
-    T roi_end_w = offset_rois[3] * scale_w;
-    T roi_end_h = offset_rois[4] * scale_h;
-
-    // Force malformed ROIs to be 1x1
-    T roi_width = std::max(roi_end_w - roi_start_w, (T)1.);
-    T roi_height = std::max(roi_end_h - roi_start_h, (T)1.);
-    T bin_size_h = static_cast<T>(roi_height) / static_cast<T>(pooled_height);
-    T bin_size_w = static_cast<T>(roi_width) / static_cast<T>(pooled_width);
-
-    T* offset_grad_input = grad_input + ((roi_batch_ind * channels + c) * height * width);
-
-    int output_offset = n*n_stride + c*c_stride;
-    const T* offset_grad_output = grad_output + output_offset;
-    const T grad_output_this_bin = offset_grad_output[ph*h_stride + pw*w_stride];
-
-    // We use roi_bin_grid to sample the grid and mimic integral
-    int roi_bin_grid_h = (sampling_ratio > 0) ? sampling_ratio : ceil(roi_height / pooled_height); // e.g., = 2
-    int roi_bin_grid_w = (sampling_ratio > 0) ? sampling_ratio : ceil(roi_width / pooled_width);
-
-    // We do average (integral) pooling inside a bin
-    const T count = roi_bin_grid_h * roi_bin_grid_w; // e.g. = 4
-
-    for (int iy = 0; iy < roi_bin_grid_h; iy++)
-    {
-      const T y = roi_start_h + ph * bin_size_h + static_cast<T>(iy + .5f) * bin_size_h / static_cast<T>(roi_bin_grid_h); // e.g., 0.5, 1.5
-      for (int ix = 0; ix < roi_bin_grid_w; ix++)
-      {
-        const T x = roi_start_w + pw * bin_size_w + static_cast<T>(ix + .5f) * bin_size_w / static_cast<T>(roi_bin_grid_w);
-
-        T w1, w2, w3, w4;
-        int x_low, x_high, y_low, y_high;
-
-        bilinear_interpolate_gradient(height, width, y, x,
-            w1, w2, w3, w4,
-            x_low, x_high, y_low, y_high,
-            index);
-
-        T g1 = grad_output_this_bin * w1 / count;
-        T g2 = grad_output_this_bin * w2 / count;
-        T g3 = grad_output_this_bin * w3 / count;
-        T g4 = grad_output_this_bin * w4 / count;
-
-        if (x_low >= 0 && x_high >= 0 && y_low >= 0 && y_high >= 0) {
-          // atomic add is not needed for now since it is single threaded
-          add(offset_grad_input + y_low * width + x_low, static_cast<T>(g1));
-          add(offset_grad_input + y_low * width + x_high, static_cast<T>(g2));
-          add(offset_grad_input + y_high * width + x_low, static_cast<T>(g3));
-          add(offset_grad_input + y_high * width + x_high, static_cast<T>(g4));
-        } // if
-      } // ix
-    } // iy
-  } // for
+  int n_rois = nthreads / channels / pooled_width / pooled_height;
+  // Channels are split among threads. A thread is the only one to scatter into
+  // the gradients of its channels, so no atomic add is needed, and every
+  // gradient is accumulated in the same order as by a single thread.
+  at::parallel_for(0, channels, 1, [=](int64_t c_begin, int64_t c_end) {
+    RoIPreCalc<T> roi;
+    for (int n = 0; n < n_rois; n++) {
+      roi.compute(
+          rois + n * 5, scale_h, scale_w, height, width,
+          pooled_height, pooled_width, sampling_ratio);
+      // Local copies, as stores to the gradients could alias the members
+      const int roi_bin_grid_h = roi.roi_bin_grid_h;
+      const int roi_bin_grid_w = roi.roi_bin_grid_w;
+      const T count = roi.count;
+      const PreCalc<T>* pre_calc = roi.pre_calc.data();
+
+      for (int c = c_begin; c < c_end; c++) {
+        T* offset_grad_input = grad_input + ((roi.batch_ind * channels + c) * height * width);
+        const T* offset_grad_output = grad_output + n*n_stride + c*c_stride;
+        int pre_calc_index = 0;
+
+        for (int ph = 0; ph < pooled_height; ph++) {
+          for (int pw = 0; pw < pooled_width; pw++) {
+            const T grad_output_this_bin = offset_grad_output[ph*h_stride + pw*w_stride];
+
+            for (int iy = 0; iy < roi_bin_grid_h; iy++) {
+              for (int ix = 0; ix < roi_bin_grid_w; ix++) {
+                PreCalc<T> pc = pre_calc[pre_calc_index];
+                pre_calc_index += 1;
+
+                // Samples out of the feature map have no weight
+                if (pc.w1 == 0 && pc.w2 == 0 && pc.w3 == 0 && pc.w4 == 0)
+                  continue;
+
+                add(offset_grad_input + pc.pos1, static_cast<T>(grad_output_this_bin * pc.w1 / count));
+                add(offset_grad_input + pc.pos2, static_cast<T>(grad_output_this_bin * pc.w2 / count));
+                add(offset_grad_input + pc.pos3, static_cast<T>(grad_output_this_bin * pc.w3 / count));
+                add(offset_grad_input + pc.pos4, static_cast<T>(grad_output_this_bin * pc.w4 / count));
+              } // ix
+            } // iy
+          } // pw
+        } // ph
+      } // c
+    } // n
+  });
 } // ROIAlignBackward
 
 
@@ -0,0 +1,160 @@
+#include "cpu/vision.h"
+
+// Scores the anchors and decodes the boxes of the candidates in one pass, so
+// that neither the scores nor the boxes of all anchors are materialized, then
+// runs nms on the candidates only.
+template <typename scalar_t>
+std::tuple<at::Tensor, at::Tensor, at::Tensor> decode_and_nms_cpu_kernel(
+    const at::Tensor &loc_p_t, const at::Tensor &cls_p_t,
+    const at::Tensor &anchors_t, const bool softmax, const float conf_threshold,
+    const std::string &nms_method, const float iou_threshold, const int topk,
+    const float min_score, const int max_per_class) {
+    AT_ASSERTM(loc_p_t.size(0) == cls_p_t.size(0) &&
+                   anchors_t.size(0) == cls_p_t.size(0),
+               "loc_p, cls_p and anchors must have the same number of anchors");
+    AT_ASSERTM(cls_p_t.size(1) > 1, "cls_p must have background and classes");
+
+    auto num_anchors = cls_p_t.size(0);
+    auto num_classes = cls_p_t.size(1);
+    auto loc_p = loc_p_t.data<scalar_t>();
+    auto cls_p = cls_p_t.data<scalar_t>();
+    auto anchors = anchors_t.data<scalar_t>();
+    const bool multiclass = nms_method == "multiclass";
+
+    std::vector<scalar_t> boxes, scores;
+    std::vector<int64_t> labels;
+    std::vector<scalar_t> probs(num_classes);
+    for (int64_t a = 0; a < num_anchors; a++) {
+        const scalar_t *logits = cls_p + a * num_classes;
+        auto num_candidates = labels.size();
+        if (multiclass) {
+            if (softmax) {
+                scalar_t m = logits[0];
+                for (int64_t c = 1; c < num_classes; c++)
+                    m = std::max(m, logits[c]);
+                scalar_t sum = 0;
+                for (int64_t c = 0; c < num_classes; c++) {
+                    probs[c] = std::exp(logits[c] - m);
+                    sum += probs[c];
+                }
+                for (int64_t c = 1; c < num_classes; c++)
+                    probs[c] /= sum;
+            } else {
+                for (int64_t c = 1; c < num_classes; c++)
+                    probs[c] = 1 / (1 + std::exp(-logits[c]));
+            }
+            for (int64_t c = 1; c < num_classes; c++) {
+                if (probs[c] > conf_threshold) {
+                    scores.push_back(probs[c]);
+                    labels.push_back(c - 1);
+                }
+            }
+        } else {
+            // Both softmax and sigmoid keep the order of the logits
+            int64_t best = 1;
+            for (int64_t c = 2; c < num_classes; c++) {
+                if (logits[c] > logits[best])
+                    best = c;
+            }
+            scalar_t prob;
+            if (softmax) {
+                scalar_t m = logits[0];
+                for (int64_t c = 1; c < num_classes; c++)
+                    m = std::max(m, logits[c]);
+                scalar_t sum = 0;
+                for (int64_t c = 0; c < num_classes; c++)
+                    sum += std::exp(logits[c] - m);
+                prob = std::exp(logits[best] - m) / sum;
+            } else {
+                prob = 1 / (1 + std::exp(-logits[best]));
+            }
+            if (conf_threshold <= 0 || prob > conf_threshold) {
+                scores.push_back(prob);
+                labels.push_back(best - 1);
+            }
+        }
+        if (labels.size() == num_candidates)
+            continue;
+
+        // XYWH targets to LTRB boxes, as target_to_coords and BBox.convert
+        const scalar_t *t = loc_p + a * 4;
+        const scalar_t *anchor = anchors + a * 4;
+        scalar_t x = t[0] * anchor[2] + anchor[0];
+        scalar_t y = t[1] * anchor[3] + anchor[1];
+        scalar_t w = std::exp(t[2]) * anchor[2];
+        scalar_t h = std::exp(t[3]) * anchor[3];
+        scalar_t l = x - w / 2;
+        scalar_t u = y - h / 2;
+        for (auto i = num_candidates; i < labels.size(); i++) {
+            boxes.push_back(l);
+            boxes.push_back(u);
+            boxes.push_back(w + l);
+            boxes.push_back(h + u);
+        }
+    }
+
+    int64_t n = scores.size();
+    at::Tensor boxes_t = at::empty({n, 4}, loc_p_t.options());
+    at::Tensor scores_t = at::empty({n}, loc_p_t.options());
+    at::Tensor labels_t = at::empty({n}, loc_p_t.options().dtype(at::kLong));
+    std::copy(boxes.begin(), boxes.end(), boxes_t.data<scalar_t>());
+    std::copy(scores.begin(), scores.end(), scores_t.data<scalar_t>());
+    std::copy(labels.begin(), labels.end(), labels_t.data<int64_t>());
+
+    at::Tensor keep_t;
+    if (nms_method == "soft") {
+        // Soft nms decays the scores in place
+        keep_t = soft_nms_cpu(boxes_t, scores_t, iou_threshold,
+                              std::min<int64_t>(topk, n), min_score);
+    } else if (multiclass) {
+        keep_t = batched_nms_cpu(boxes_t, scores_t, labels_t, iou_threshold);
+        if (max_per_class > 0) {
+            // Kept boxes are grouped by class and sorted by scores in every class
+            auto keep = keep_t.data<int64_t>();
+            auto kept_labels = labels_t.data<int64_t>();
+            int64_t num_to_keep = 0, rank = 0;
+            for (int64_t i = 0; i < keep_t.size(0); i++) {
+                if (i > 0 && kept_labels[keep[i]] != kept_labels[keep[i - 1]])
+                    rank = 0;
+                if (rank++ < max_per_class)
+                    keep[num_to_keep++] = keep[i];
+            }
+            keep_t = keep_t.slice(0, 0, num_to_keep);
+        }
+        auto order_t =
+            std::get<1>(scores_t.index_select(0, keep_t).sort(0, true));
+        keep_t = keep_t.index_select(0, order_t);
+    } else {
+        keep_t = nms_cpu(boxes_t, scores_t, iou_threshold);
+    }
+    if (topk > 0 && keep_t.size(0) > topk)
+        keep_t = keep_t.slice(0, 0, topk);
+
+    return std::make_tuple(boxes_t.index_select(0, keep_t),
+                           scores_t.index_select(0, keep_t),
+                           labels_t.index_select(0, keep_t));
+}
+
+std::tuple<at::Tensor, at::Tensor, at::Tensor>
+decode_and_nms_cpu(const at::Tensor &loc_p, const at::Tensor &cls_p,
+                   const at::Tensor &anchors, const std::string &conf_strategy,
+                   const float conf_threshold, const std::string &nms_method,
+                   const float iou_threshold, const int topk,
+                   const float min_score, const int max_per_class) {
+    AT_ASSERTM(!loc_p.type().is_cuda(), "loc_p must be a CPU tensor");
+    AT_ASSERTM(conf_strategy == "softmax" || conf_strategy == "sigmoid",
+               "conf_strategy must be softmax or sigmoid");
+    AT_ASSERTM(nms_method == "nms" || nms_method == "multiclass" ||
+                   nms_method == "soft",
+               "nms_method must be one of nms, multiclass and soft");
+
+    std::tuple<at::Tensor, at::Tensor, at::Tensor> result;
+    AT_DISPATCH_FLOATING_TYPES(loc_p.type(), "decode_and_nms_cpu", [&] {
+        result = decode_and_nms_cpu_kernel<scalar_t>(
+            loc_p.contiguous(), cls_p.to(loc_p.dtype()).contiguous(),
+            anchors.to(loc_p.dtype()).contiguous(), conf_strategy == "softmax",
+            conf_threshold, nms_method, iou_threshold, topk, min_score,
+            max_per_class);
+    });
+    return result;
+}
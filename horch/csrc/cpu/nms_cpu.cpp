@@ -1,4 +1,5 @@
 #include <torch/extension.h>
+#include <ATen/Parallel.h>
 
 template <typename scalar_t>
 at::Tensor nms_cpu_kernel(
@@ -78,4 +79,123 @@ at::Tensor nms_cpu(
     result = nms_cpu_kernel<scalar_t>(dets, scores, threshold);
   });
   return result;
-}
\ No newline at end of file
+}
+
+template <typename scalar_t>
+void batched_nms_cpu_group(const scalar_t *x1, const scalar_t *y1,
+                           const scalar_t *x2, const scalar_t *y2,
+                           const scalar_t *areas,
+                           const std::vector<int64_t> &order,
+                           std::vector<int64_t> &keep, const float threshold) {
+  auto ndets = static_cast<int64_t>(order.size());
+  std::vector<uint8_t> suppressed(ndets, 0);
+
+  for (int64_t _i = 0; _i < ndets; _i++) {
+    if (suppressed[_i] == 1)
+      continue;
+    auto i = order[_i];
+    keep.push_back(i);
+    auto ix1 = x1[i];
+    auto iy1 = y1[i];
+    auto ix2 = x2[i];
+    auto iy2 = y2[i];
+    auto iarea = areas[i];
+
+    for (int64_t _j = _i + 1; _j < ndets; _j++) {
+      if (suppressed[_j] == 1)
+        continue;
+      auto j = order[_j];
+      auto xx1 = std::max(ix1, x1[j]);
+      auto yy1 = std::max(iy1, y1[j]);
+      auto xx2 = std::min(ix2, x2[j]);
+      auto yy2 = std::min(iy2, y2[j]);
+
+      auto w = std::max(static_cast<scalar_t>(0), xx2 - xx1);
+      auto h = std::max(static_cast<scalar_t>(0), yy2 - yy1);
+      auto inter = w * h;
+      auto ovr = inter / (iarea + areas[j] - inter);
+      if (ovr >= threshold)
+        suppressed[_j] = 1;
+    }
+  }
+}
+
+template <typename scalar_t>
+at::Tensor batched_nms_cpu_kernel(const at::Tensor &dets,
+                                  const at::Tensor &scores,
+                                  const at::Tensor &idxs,
+                                  const float threshold) {
+  AT_ASSERTM(!dets.type().is_cuda(), "dets must be a CPU tensor");
+  AT_ASSERTM(!scores.type().is_cuda(), "scores must be a CPU tensor");
+  AT_ASSERTM(!idxs.type().is_cuda(), "idxs must be a CPU tensor");
+  AT_ASSERTM(
+      dets.type() == scores.type(), "dets should have the same type as scores");
+
+  if (dets.numel() == 0)
+    return at::empty({0}, dets.options().dtype(at::kLong));
+
+  auto x1_t = dets.select(1, 0).contiguous();
+  auto y1_t = dets.select(1, 1).contiguous();
+  auto x2_t = dets.select(1, 2).contiguous();
+  auto y2_t = dets.select(1, 3).contiguous();
+
+  at::Tensor areas_t = (x2_t - x1_t) * (y2_t - y1_t);
+
+  auto order_t = std::get<1>(scores.sort(0, /* descending=*/true));
+  auto idxs_t = idxs.to(at::kLong).contiguous();
+
+  auto ndets = dets.size(0);
+  auto order = order_t.data<int64_t>();
+  auto group_of = idxs_t.data<int64_t>();
+
+  // Bucket the score-sorted boxes by group, keeping the score order inside
+  // every bucket.
+  int64_t num_groups = 0;
+  for (int64_t i = 0; i < ndets; i++) {
+    AT_ASSERTM(group_of[i] >= 0, "idxs must be non-negative");
+    num_groups = std::max(num_groups, group_of[i] + 1);
+  }
+  std::vector<std::vector<int64_t>> orders(num_groups);
+  for (int64_t _i = 0; _i < ndets; _i++) {
+    auto i = order[_i];
+    orders[group_of[i]].push_back(i);
+  }
+
+  auto x1 = x1_t.data<scalar_t>();
+  auto y1 = y1_t.data<scalar_t>();
+  auto x2 = x2_t.data<scalar_t>();
+  auto y2 = y2_t.data<scalar_t>();
+  auto areas = areas_t.data<scalar_t>();
+
+  std::vector<std::vector<int64_t>> keeps(num_groups);
+  at::parallel_for(0, num_groups, 1, [&](int64_t begin, int64_t end) {
+    for (auto g = begin; g < end; g++) {
+      batched_nms_cpu_group<scalar_t>(x1, y1, x2, y2, areas, orders[g],
+                                      keeps[g], threshold);
+    }
+  });
+
+  int64_t num_to_keep = 0;
+  for (auto &k : keeps)
+    num_to_keep += k.size();
+  at::Tensor keep_t = at::empty({num_to_keep}, dets.options().dtype(at::kLong));
+  auto keep = keep_t.data<int64_t>();
+  for (auto &k : keeps) {
+    std::copy(k.begin(), k.end(), keep);
+    keep += k.size();
+  }
+  return keep_t;
+}
+
+at::Tensor batched_nms_cpu(
+    const at::Tensor& dets,
+    const at::Tensor& scores,
+    const at::Tensor& idxs,
+    const float threshold) {
+  auto result = at::empty({0}, dets.options());
+
+  AT_DISPATCH_FLOATING_TYPES(dets.type(), "batched_nms", [&] {
+    result = batched_nms_cpu_kernel<scalar_t>(dets, scores, idxs, threshold);
+  });
+  return result;
+}
@@ -1,3 +1,4 @@
+#include "cpu/sweep.h"
 #include <torch/extension.h>
 
 template <typename T>
@@ -60,10 +61,63 @@ soft_nms_cpu_main(const T *dets, T *scores, uint8_t *suppressed, const T *areas,
     return indices;
 }
 
+template <typename T>
+std::vector<int64_t>
+soft_nms_heap_cpu_main(const T *dets, T *scores, uint8_t *suppressed,
+                       const T *areas, const int64_t ndets,
+                       const float iou_threshold, const int topk,
+                       const float min_score) {
+    std::vector<int64_t> indices;
+    SweepIndex<T> sweep(dets, ndets);
+    LazyScoreHeap<T> heap(scores, ndets);
+    const auto pad = static_cast<T>(0.01);
+
+    while (static_cast<int64_t>(indices.size()) < topk) {
+        auto i = heap.pop(scores, suppressed);
+        if (i == -1)
+            break;
+        indices.push_back(i);
+        suppressed[i] = 1;
+
+        const T *ibox = dets + 4 * i;
+        auto ix1 = ibox[0];
+        auto iy1 = ibox[1];
+        auto ix2 = ibox[2];
+        auto iy2 = ibox[3];
+
+        auto range = sweep.range(ix1, ix2, pad);
+        for (auto k = range.first; k < range.second; k++) {
+            auto j = sweep.order[k];
+            if (suppressed[j] == 1)
+                continue;
+            const T *jbox = dets + 4 * j;
+
+            auto xx1 = std::max(ix1, jbox[0]);
+            auto yy1 = std::max(iy1, jbox[1]);
+            auto xx2 = std::min(ix2, jbox[2]);
+            auto yy2 = std::min(iy2, jbox[3]);
+
+            auto w = std::max(static_cast<T>(0), xx2 - xx1 + pad);
+            auto h = std::max(static_cast<T>(0), yy2 - yy1 + pad);
+            auto inter = w * h;
+            auto iou = inter / (areas[i] + areas[j] - inter);
+            if (iou >= iou_threshold) {
+                scores[j] *= 1 - iou;
+                if (scores[j] < min_score) {
+                    suppressed[j] = 1;
+                } else {
+                    heap.push(scores[j], j);
+                }
+            }
+        }
+    }
+    return indices;
+}
+
 template <typename scalar_t>
 at::Tensor soft_nms_cpu_kernel(const at::Tensor &dets_t, at::Tensor &scores_t,
                                const float iou_threshold, const int topk,
-                               const float min_score) {
+                               const float min_score, const bool heap) {
     AT_ASSERTM(!dets_t.type().is_cuda(), "dets_t must be a CPU tensor");
     AT_ASSERTM(!scores_t.type().is_cuda(), "scores must be a CPU tensor");
     AT_ASSERTM(dets_t.type() == scores_t.type(),
@@ -86,8 +140,11 @@ at::Tensor soft_nms_cpu_kernel(const at::Tensor &dets_t, at::Tensor &scores_t,
     auto suppressed = suppressed_t.data<uint8_t>();
     auto areas = areas_t.data<scalar_t>();
     auto scores = scores_t.data<scalar_t>();
-    std::vector<int64_t> indices = soft_nms_cpu_main(
-        dets, scores, suppressed, areas, ndets, iou_threshold, topk, min_score);
+    std::vector<int64_t> indices =
+        heap ? soft_nms_heap_cpu_main(dets, scores, suppressed, areas, ndets,
+                                      iou_threshold, topk, min_score)
+             : soft_nms_cpu_main(dets, scores, suppressed, areas, ndets,
+                                 iou_threshold, topk, min_score);
 
     auto n = static_cast<int64_t>(indices.size());
     at::Tensor indices_t =
@@ -106,7 +163,22 @@ at::Tensor soft_nms_cpu(const at::Tensor &dets, at::Tensor &scores,
 
     AT_DISPATCH_FLOATING_TYPES(dets.type(), "soft_nms_cpu", [&] {
         result = soft_nms_cpu_kernel<scalar_t>(dets.contiguous(), scores,
-                                               iou_threshold, topk, min_score);
+                                               iou_threshold, topk, min_score,
+                                               false);
+    });
+    return result;
+}
+
+at::Tensor soft_nms_heap_cpu(const at::Tensor &dets, at::Tensor &scores,
+                             const float iou_threshold, const int topk,
+                             const float min_score) {
+
+    auto result = torch::empty({0}, dets.type());
+
+    AT_DISPATCH_FLOATING_TYPES(dets.type(), "soft_nms_heap_cpu", [&] {
+        result = soft_nms_cpu_kernel<scalar_t>(dets.contiguous(), scores,
+                                               iou_threshold, topk, min_score,
+                                               true);
     });
     return result;
 }
\ No newline at end of file
@@ -1,3 +1,4 @@
+#include "cpu/sweep.h"
 #include <torch/extension.h>
 
 template <typename T>
@@ -96,11 +97,98 @@ softer_nms_cpu_main(T *dets, T *scores, const T *vars, uint8_t *suppressed,
     return indices;
 }
 
+template <typename T>
+std::vector<int64_t>
+softer_nms_heap_cpu_main(T *dets, T *scores, const T *vars,
+                         uint8_t *suppressed, const T *areas,
+                         const int64_t ndets, const float iou_threshold,
+                         const int topk, const float sigma,
+                         const float min_score) {
+    std::vector<int64_t> indices;
+    SweepIndex<T> sweep(dets, ndets);
+    LazyScoreHeap<T> heap(scores, ndets);
+    const auto pad = static_cast<T>(0.01);
+
+    while (static_cast<int64_t>(indices.size()) < topk) {
+        auto i = heap.pop(scores, suppressed);
+        if (i == -1)
+            break;
+        indices.push_back(i);
+        suppressed[i] = 1;
+
+        T *ibox = dets + 4 * i;
+        auto ix1 = ibox[0];
+        auto iy1 = ibox[1];
+        auto ix2 = ibox[2];
+        auto iy2 = ibox[3];
+
+        const T *ivar = vars + 4 * i;
+        auto px1_n = ix1 / ivar[0];
+        auto px1_d = 1 / ivar[0];
+        auto py1_n = iy1 / ivar[1];
+        auto py1_d = 1 / ivar[1];
+        auto px2_n = ix2 / ivar[2];
+        auto px2_d = 1 / ivar[2];
+        auto py2_n = iy2 / ivar[3];
+        auto py2_d = 1 / ivar[3];
+
+        // Boxes outside the sweep range have zero IoU, so they neither decay
+        // nor vote.
+        auto range = sweep.range(ix1, ix2, pad);
+        for (auto k = range.first; k < range.second; k++) {
+            auto j = sweep.order[k];
+            if (suppressed[j] == 1)
+                continue;
+            const T *jbox = dets + 4 * j;
+            auto jx1 = jbox[0];
+            auto jy1 = jbox[1];
+            auto jx2 = jbox[2];
+            auto jy2 = jbox[3];
+
+            auto xx1 = std::max(ix1, jx1);
+            auto yy1 = std::max(iy1, jy1);
+            auto xx2 = std::min(ix2, jx2);
+            auto yy2 = std::min(iy2, jy2);
+
+            auto w = std::max(static_cast<T>(0), xx2 - xx1 + pad);
+            auto h = std::max(static_cast<T>(0), yy2 - yy1 + pad);
+            auto inter = w * h;
+            auto iou = inter / (areas[i] + areas[j] - inter);
+            if (iou >= iou_threshold) {
+                scores[j] *= 1 - iou;
+                if (scores[j] < min_score) {
+                    suppressed[j] = 1;
+                } else {
+                    heap.push(scores[j], j);
+                }
+            }
+            if (iou > 0) {
+                const T *jvar = vars + 4 * j;
+                auto p = exp(-pow(1 - iou, 2) / sigma);
+                px1_n += p * jx1 / jvar[0];
+                px1_d += p / jvar[0];
+                py1_n += p * jy1 / jvar[1];
+                py1_d += p / jvar[1];
+                px2_n += p * jx2 / jvar[2];
+                px2_d += p / jvar[2];
+                py2_n += p * jy2 / jvar[3];
+                py2_d += p / jvar[3];
+            }
+        }
+        ibox[0] = px1_n / px1_d;
+        ibox[1] = py1_n / py1_d;
+        ibox[2] = px2_n / px2_d;
+        ibox[3] = py2_n / py2_d;
+    }
+    return indices;
+}
+
 template <typename scalar_t>
 at::Tensor softer_nms_cpu_kernel(at::Tensor &dets_t, at::Tensor &scores_t,
                                  const at::Tensor &vars_t,
                                  const float iou_threshold, const int topk,
-                                 const float sigma, const float min_score) {
+                                 const float sigma, const float min_score,
+                                 const bool heap) {
     AT_ASSERTM(dets_t.is_contiguous(), "dets_t must be contiguous");
     AT_ASSERTM(!dets_t.type().is_cuda(), "dets_t must be a CPU tensor");
     AT_ASSERTM(!scores_t.type().is_cuda(), "scores_t must be a CPU tensor");
@@ -129,8 +217,12 @@ at::Tensor softer_nms_cpu_kernel(at::Tensor &dets_t, at::Tensor &scores_t,
     auto suppressed = suppressed_t.data<uint8_t>();
     auto areas = areas_t.data<scalar_t>();
     std::vector<int64_t> indices =
-        softer_nms_cpu_main(dets, scores, vars, suppressed, areas, ndets,
-                            iou_threshold, topk, sigma, min_score);
+        heap ? softer_nms_heap_cpu_main(dets, scores, vars, suppressed, areas,
+                                        ndets, iou_threshold, topk, sigma,
+                                        min_score)
+             : softer_nms_cpu_main(dets, scores, vars, suppressed, areas,
+                                   ndets, iou_threshold, topk, sigma,
+                                   min_score);
     auto n = static_cast<int64_t>(indices.size());
     at::Tensor indices_t =
         torch::empty({n}, at::device(at::kCPU).dtype(at::kLong));
@@ -148,7 +240,20 @@ at::Tensor softer_nms_cpu(at::Tensor &dets, at::Tensor &scores,
 
     AT_DISPATCH_FLOATING_TYPES(dets.type(), "softer_nms_cpu", [&] {
         result = softer_nms_cpu_kernel<scalar_t>(
-            dets, scores, vars, iou_threshold, topk, sigma, min_score);
+            dets, scores, vars, iou_threshold, topk, sigma, min_score, false);
+    });
+    return result;
+}
+
+at::Tensor softer_nms_heap_cpu(at::Tensor &dets, at::Tensor &scores,
+                               const at::Tensor &vars,
+                               const float iou_threshold, const int topk,
+                               const float sigma, const float min_score) {
+    auto result = torch::empty({0}, dets.type());
+
+    AT_DISPATCH_FLOATING_TYPES(dets.type(), "softer_nms_heap_cpu", [&] {
+        result = softer_nms_cpu_kernel<scalar_t>(
+            dets, scores, vars, iou_threshold, topk, sigma, min_score, true);
     });
     return result;
 }
\ No newline at end of file
@@ -0,0 +1,64 @@
+#pragma once
+#include <algorithm>
+#include <cstdint>
+#include <numeric>
+#include <queue>
+#include <utility>
+#include <vector>
+
+// Boxes sorted by x1. Boxes that may overlap a query box along the x axis are
+// found by binary search, so spatially disjoint boxes are never visited.
+template <typename T> struct SweepIndex {
+    std::vector<int64_t> order;
+    std::vector<T> x1;
+    T max_w = 0;
+
+    SweepIndex(const T *dets, const int64_t ndets) : order(ndets), x1(ndets) {
+        std::iota(order.begin(), order.end(), 0);
+        std::sort(order.begin(), order.end(), [&](int64_t a, int64_t b) {
+            return dets[4 * a] < dets[4 * b];
+        });
+        for (int64_t k = 0; k < ndets; k++) {
+            auto box = dets + 4 * order[k];
+            x1[k] = box[0];
+            max_w = std::max(max_w, box[2] - box[0]);
+        }
+    }
+
+    // Range [begin, end) of `order` covering all boxes whose x extent, padded
+    // by `pad`, intersects [qx1, qx2].
+    std::pair<int64_t, int64_t> range(T qx1, T qx2, T pad) const {
+        auto begin = std::lower_bound(x1.begin(), x1.end(), qx1 - max_w - pad);
+        auto end = std::upper_bound(begin, x1.end(), qx2 + pad);
+        return std::make_pair(begin - x1.begin(), end - x1.begin());
+    }
+};
+
+// Max-heap of (score, index) with lazy updates: a decayed box is pushed again
+// with its new score, and entries whose score is outdated are skipped on pop.
+// Ties are broken by the larger index, the same as the linear argmax.
+template <typename T> struct LazyScoreHeap {
+    std::priority_queue<std::pair<T, int64_t>> heap;
+
+    LazyScoreHeap(const T *scores, const int64_t ndets) {
+        std::vector<std::pair<T, int64_t>> entries(ndets);
+        for (int64_t j = 0; j < ndets; j++)
+            entries[j] = std::make_pair(scores[j], j);
+        heap = std::priority_queue<std::pair<T, int64_t>>(
+            std::less<std::pair<T, int64_t>>(), std::move(entries));
+    }
+
+    void push(T score, int64_t j) { heap.push(std::make_pair(score, j)); }
+
+    int64_t pop(const T *scores, const uint8_t *suppressed) {
+        while (!heap.empty()) {
+            auto top = heap.top();
+            heap.pop();
+            auto j = top.second;
+            if (suppressed[j] == 1 || top.first != scores[j] || top.first < 0)
+                continue;
+            return j;
+        }
+        return -1;
+    }
+};
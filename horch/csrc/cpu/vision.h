@@ -36,14 +36,44 @@ std::tuple<at::Tensor, at::Tensor> iou_mn_backward_cpu(const at::Tensor &dious,
                                                        const at::Tensor &boxes2,
                                                        const at::Tensor &ious);
 
+at::Tensor iou_b11_forward_cpu(const at::Tensor &boxes1,
+                               const at::Tensor &boxes2, const int kind);
+
+std::tuple<at::Tensor, at::Tensor>
+iou_b11_backward_cpu(const at::Tensor &dious, const at::Tensor &boxes1,
+                     const at::Tensor &boxes2, const int kind);
+
+std::tuple<at::Tensor, at::Tensor, at::Tensor, at::Tensor>
+iou_mn_reduce_cpu(const at::Tensor &boxes1, const at::Tensor &boxes2,
+                  const float threshold, const int64_t tile_size);
+
 at::Tensor nms_cpu(const at::Tensor &dets, const at::Tensor &scores,
                    const float threshold);
 
+at::Tensor batched_nms_cpu(const at::Tensor &dets, const at::Tensor &scores,
+                           const at::Tensor &idxs, const float threshold);
+
 at::Tensor soft_nms_cpu(const at::Tensor &dets, at::Tensor &scores,
                         const float iou_threshold, const int topk,
                         const float score_threshold);
 
+at::Tensor soft_nms_heap_cpu(const at::Tensor &dets, at::Tensor &scores,
+                             const float iou_threshold, const int topk,
+                             const float score_threshold);
+
 at::Tensor softer_nms_cpu(at::Tensor &dets, at::Tensor &scores,
                           const at::Tensor &vars, const float iou_threshold,
                           const int topk, const float sigma,
-                          const float min_score);
\ No newline at end of file
+                          const float min_score);
+
+at::Tensor softer_nms_heap_cpu(at::Tensor &dets, at::Tensor &scores,
+                               const at::Tensor &vars,
+                               const float iou_threshold, const int topk,
+                               const float sigma, const float min_score);
+
+std::tuple<at::Tensor, at::Tensor, at::Tensor>
+decode_and_nms_cpu(const at::Tensor &loc_p, const at::Tensor &cls_p,
+                   const at::Tensor &anchors, const std::string &conf_strategy,
+                   const float conf_threshold, const std::string &nms_method,
+                   const float iou_threshold, const int topk,
+                   const float min_score, const int max_per_class);
@@ -0,0 +1,94 @@
+#include <ATen/ATen.h>
+#include <ATen/cuda/CUDAContext.h>
+
+#include <THC/THC.h>
+
+#include "IoUB11_kernel.h"
+#include "cuda_helpers.h"
+
+#define GET_BLOCKS(block_size, n)                                              \
+    ((static_cast<int>(n) + block_size - 1) / block_size)
+
+template <typename T>
+__global__ void iou_b11_forward(const int nthreads, const T *boxes1,
+                                const T *boxes2, const int kind, T *ious) {
+    CUDA_1D_KERNEL_LOOP(index, nthreads) {
+        ious[index] = iou_b11_forward_single(boxes1 + index * 4,
+                                             boxes2 + index * 4, kind);
+    }
+}
+
+template <typename T>
+__global__ void iou_b11_backward(const int nthreads, T *dboxes1, T *dboxes2,
+                                 const T *dout, const T *boxes1,
+                                 const T *boxes2, const int kind) {
+    CUDA_1D_KERNEL_LOOP(index, nthreads) {
+        iou_b11_backward_single(boxes1 + index * 4, boxes2 + index * 4, kind,
+                                dout[index], dboxes1 + index * 4,
+                                dboxes2 + index * 4);
+    }
+}
+
+at::Tensor iou_b11_forward_cuda(const at::Tensor &boxes1,
+                                const at::Tensor &boxes2, const int kind) {
+    AT_ASSERTM(boxes1.device().is_cuda(), "boxes1 must be a CUDA tensor");
+    AT_ASSERTM(boxes2.device().is_cuda(), "boxes2 must be a CUDA tensor");
+    AT_ASSERTM(boxes1.sizes() == boxes2.sizes(),
+               "boxes1 should have the same size as boxes2");
+
+    auto n = boxes1.size(0);
+
+    at::Tensor ious = at::empty({n}, boxes1.options());
+
+    cudaStream_t stream = at::cuda::getCurrentCUDAStream();
+
+    dim3 grid(min(GET_BLOCKS(512, n), 4096));
+    dim3 block(512);
+
+    if (ious.numel() == 0) {
+        THCudaCheck(cudaGetLastError());
+        return ious;
+    }
+
+    AT_DISPATCH_FLOATING_TYPES(boxes1.type(), "iou_b11_forward_cuda", [&] {
+        iou_b11_forward<scalar_t><<<grid, block, 0, stream>>>(
+            n, boxes1.contiguous().data<scalar_t>(),
+            boxes2.contiguous().data<scalar_t>(), kind,
+            ious.data<scalar_t>());
+    });
+    THCudaCheck(cudaGetLastError());
+    return ious;
+}
+
+std::tuple<at::Tensor, at::Tensor>
+iou_b11_backward_cuda(const at::Tensor &dout, const at::Tensor &boxes1,
+                      const at::Tensor &boxes2, const int kind) {
+    AT_ASSERTM(dout.device().is_cuda(), "dout must be a CUDA tensor");
+    AT_ASSERTM(boxes1.device().is_cuda(), "boxes1 must be a CUDA tensor");
+    AT_ASSERTM(boxes2.device().is_cuda(), "boxes2 must be a CUDA tensor");
+
+    auto n = boxes1.size(0);
+
+    at::Tensor dboxes1 = at::zeros({n, 4}, boxes1.options());
+    at::Tensor dboxes2 = at::zeros({n, 4}, boxes2.options());
+
+    cudaStream_t stream = at::cuda::getCurrentCUDAStream();
+
+    dim3 grid(min(GET_BLOCKS(512, n), 4096));
+    dim3 block(512);
+
+    if (dout.numel() == 0) {
+        THCudaCheck(cudaGetLastError());
+        return std::make_tuple(dboxes1, dboxes2);
+    }
+
+    AT_DISPATCH_FLOATING_TYPES(dout.type(), "iou_b11_backward_cuda", [&] {
+        iou_b11_backward<scalar_t><<<grid, block, 0, stream>>>(
+            n, dboxes1.data<scalar_t>(), dboxes2.data<scalar_t>(),
+            dout.contiguous().data<scalar_t>(),
+            boxes1.contiguous().data<scalar_t>(),
+            boxes2.contiguous().data<scalar_t>(), kind);
+    });
+    THCudaCheck(cudaGetLastError());
+    return std::make_tuple(dboxes1, dboxes2);
+}
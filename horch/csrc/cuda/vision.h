@@ -21,6 +21,13 @@ std::tuple<at::Tensor, at::Tensor>
 iou_mn_backward_cuda(const at::Tensor &dout, const at::Tensor &boxes1,
                      const at::Tensor &boxes2, const at::Tensor &ious);
 
+at::Tensor iou_b11_forward_cuda(const at::Tensor &boxes1,
+                                const at::Tensor &boxes2, const int kind);
+
+std::tuple<at::Tensor, at::Tensor>
+iou_b11_backward_cuda(const at::Tensor &dout, const at::Tensor &boxes1,
+                      const at::Tensor &boxes2, const int kind);
+
 at::Tensor ROIAlign_forward_cuda(const at::Tensor &input,
                                  const at::Tensor &rois,
                                  const float scale_h,
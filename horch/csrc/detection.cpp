@@ -1,17 +1,34 @@
+#include "IoUB11.h"
 #include "IoUMN.h"
 #include "PSROIAlign.h"
 #include "ROIAlign.h"
 #include "nms.h"
 #include <torch/extension.h>
 
+// The ops only touch tensors, so the GIL is released while they run and they
+// can be called from several Python threads concurrently.
+using release_gil = py::call_guard<py::gil_scoped_release>;
+
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
-    m.def("nms", &nms, "nms");
-    m.def("soft_nms", &soft_nms, "soft_nms");
-    m.def("softer_nms", &softer_nms, "softer_nms");
-    m.def("iou_mn_forward", &iou_mn_forward, "iou_mn_forward");
-    m.def("iou_mn_backward", &iou_mn_backward, "iou_mn_backward");
-    m.def("psroi_align_forward", &PSROIAlign_forward, "PSROIAlign_forward");
-    m.def("psroi_align_backward", &PSROIAlign_backward, "PSROIAlign_backward");
-    m.def("roi_align_forward", &ROIAlign_forward, "ROIAlign_forward");
-    m.def("roi_align_backward", &ROIAlign_backward, "ROIAlign_backward");
+#ifdef WITH_CUDA
+    m.attr("with_cuda") = true;
+#else
+    m.attr("with_cuda") = false;
+#endif
+    m.def("nms", &nms, "nms", release_gil());
+    m.def("batched_nms", &batched_nms, "batched_nms", release_gil());
+    m.def("soft_nms", &soft_nms, "soft_nms", release_gil());
+    m.def("softer_nms", &softer_nms, "softer_nms", release_gil());
+    m.def("soft_nms_heap", &soft_nms_heap, "soft_nms_heap", release_gil());
+    m.def("softer_nms_heap", &softer_nms_heap, "softer_nms_heap", release_gil());
+    m.def("decode_and_nms", &decode_and_nms, "decode_and_nms", release_gil());
+    m.def("iou_mn_forward", &iou_mn_forward, "iou_mn_forward", release_gil());
+    m.def("iou_mn_backward", &iou_mn_backward, "iou_mn_backward", release_gil());
+    m.def("iou_mn_reduce", &iou_mn_reduce, "iou_mn_reduce", release_gil());
+    m.def("iou_b11_forward", &iou_b11_forward, "iou_b11_forward", release_gil());
+    m.def("iou_b11_backward", &iou_b11_backward, "iou_b11_backward", release_gil());
+    m.def("psroi_align_forward", &PSROIAlign_forward, "PSROIAlign_forward", release_gil());
+    m.def("psroi_align_backward", &PSROIAlign_backward, "PSROIAlign_backward", release_gil());
+    m.def("roi_align_forward", &ROIAlign_forward, "ROIAlign_forward", release_gil());
+    m.def("roi_align_backward", &ROIAlign_backward, "ROIAlign_backward", release_gil());
 }
\ No newline at end of file
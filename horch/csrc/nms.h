@@ -24,6 +24,29 @@ at::Tensor nms(const at::Tensor &dets, const at::Tensor &scores,
     return result;
 }
 
+at::Tensor batched_nms(const at::Tensor &dets, const at::Tensor &scores,
+                       const at::Tensor &idxs, const float threshold) {
+    if (dets.device().is_cuda()) {
+#ifdef WITH_CUDA
+        if (dets.numel() == 0) {
+            return at::empty({0}, dets.options().dtype(at::kLong));
+        }
+        // Offset boxes of different groups so that they never overlap, then
+        // run a single nms and regroup the kept indices.
+        auto offsets = idxs.to(dets.options()) * (dets.max() + 1);
+        auto b = at::cat({dets + offsets.unsqueeze(1), scores.unsqueeze(1)}, 1);
+        auto keep = nms_cuda(b, threshold);
+        auto rank = at::arange(keep.size(0), keep.options());
+        auto key = idxs.to(at::kLong).index_select(0, keep) * keep.size(0) + rank;
+        return keep.index_select(0, std::get<1>(key.sort(0)));
+#else
+        AT_ERROR("Not compiled with GPU support");
+#endif
+    }
+
+    return batched_nms_cpu(dets, scores, idxs, threshold);
+}
+
 at::Tensor soft_nms(const at::Tensor &dets, at::Tensor &scores,
                     const float iou_threshold, const int topk,
                     const float score_threshold) {
@@ -36,4 +59,33 @@ at::Tensor softer_nms(at::Tensor &dets, at::Tensor &scores,
                       const float min_score) {
     return softer_nms_cpu(dets, scores, vars, iou_threshold, topk, sigma,
                           min_score);
-}
\ No newline at end of file
+}
+
+at::Tensor soft_nms_heap(const at::Tensor &dets, at::Tensor &scores,
+                         const float iou_threshold, const int topk,
+                         const float score_threshold) {
+    return soft_nms_heap_cpu(dets, scores, iou_threshold, topk,
+                             score_threshold);
+}
+
+at::Tensor softer_nms_heap(at::Tensor &dets, at::Tensor &scores,
+                           const at::Tensor &vars, const float iou_threshold,
+                           const int topk, const float sigma,
+                           const float min_score) {
+    return softer_nms_heap_cpu(dets, scores, vars, iou_threshold, topk, sigma,
+                               min_score);
+}
+
+std::tuple<at::Tensor, at::Tensor, at::Tensor>
+decode_and_nms(const at::Tensor &loc_p, const at::Tensor &cls_p,
+               const at::Tensor &anchors, const std::string &conf_strategy,
+               const float conf_threshold, const std::string &nms_method,
+               const float iou_threshold, const int topk, const float min_score,
+               const int max_per_class) {
+    if (loc_p.device().is_cuda()) {
+        AT_ERROR("decode_and_nms is only implemented on CPU");
+    }
+    return decode_and_nms_cpu(loc_p, cls_p, anchors, conf_strategy,
+                              conf_threshold, nms_method, iou_threshold, topk,
+                              min_score, max_per_class);
+}
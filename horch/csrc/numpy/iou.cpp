@@ -170,7 +170,12 @@ py::array_t<T>
 Py_iou_mm(py::array_t<T, py::array::c_style | py::array::forcecast> boxes) {
     int64_t n = boxes.shape(0);
     auto out = py::array_t<T>({n, n});
-    iou_mm(boxes.data(), n, out.mutable_data());
+    const T *data = boxes.data();
+    T *out_data = out.mutable_data();
+    {
+        py::gil_scoped_release release;
+        iou_mm(data, n, out_data);
+    }
     return out;
 }
 
@@ -181,7 +186,13 @@ Py_iou_mn(py::array_t<T, py::array::c_style | py::array::forcecast> boxes1,
     int64_t m = boxes1.shape(0);
     int64_t n = boxes2.shape(0);
     auto out = py::array_t<T>({m, n});
-    iou_mn(boxes1.data(), m, boxes2.data(), n, out.mutable_data());
+    const T *data1 = boxes1.data();
+    const T *data2 = boxes2.data();
+    T *out_data = out.mutable_data();
+    {
+        py::gil_scoped_release release;
+        iou_mn(data1, m, data2, n, out_data);
+    }
     return out;
 }
 
@@ -14,8 +14,11 @@ from horch.transforms.detection.functional import to_absolute_coords
 from horch.detection.bbox import BBox
 from horch.detection.iou import iou_11, iou_b11, iou_1m, iou_mn
 from horch.detection.anchor import find_priors_kmeans, find_priors_coco
-from horch.detection.nms import nms, soft_nms_cpu, softer_nms_cpu
+from horch.detection.anchor_cache import anchor_grid, MlvlAnchors, MlvlPriors, MlvlCenters
+from horch.detection.nms import nms, batched_nms, multiclass_nms, soft_nms_cpu, softer_nms_cpu, decode_and_nms, \
+    matrix_nms, cluster_nms
 from horch.detection.eval import mAP
+from horch.detection.detections import Detections
 
 __all__ = [
     "BBox", "nms", "soft_nms_cpu", "misc_target_collate",
@@ -23,7 +26,8 @@ __all__ = [
     "get_locations", "calc_anchor_sizes", "generate_anchors",
     "generate_mlvl_anchors", "generate_anchors_with_priors",
     "find_priors_kmeans", "mAP", "find_priors_coco", "softer_nms_cpu",
-    "misc_collate"
+    "misc_collate", "batched_nms", "multiclass_nms", "decode_and_nms", "matrix_nms", "cluster_nms",
+    "MlvlAnchors", "MlvlPriors", "MlvlCenters", "Detections",
 ]
 
 
@@ -61,16 +65,11 @@ def calc_anchor_sizes(size, aspect_ratios, scales=(1,), dtype=torch.float32):
 def generate_mlvl_anchors(input_size, strides, anchor_sizes):
     width, height = input_size
     locations = get_locations(input_size, strides)
+    scale = torch.tensor([width, height], dtype=torch.float)
     anchors_of_level = []
     for (lx, ly), sizes in zip(locations, anchor_sizes):
-        anchors = torch.zeros(lx, ly, len(sizes), 4)
-        anchors[:, :, :, 0] = (torch.arange(
-            lx, dtype=torch.float).view(lx, 1, 1).expand(lx, ly, len(sizes)) + 0.5) / lx
-        anchors[:, :, :, 1] = (torch.arange(
-            ly, dtype=torch.float).view(1, ly, 1).expand(lx, ly, len(sizes)) + 0.5) / ly
-        anchors[:, :, :, 2] = sizes[:, 0] / width
-        anchors[:, :, :, 3] = sizes[:, 1] / height
-        anchors_of_level.append(anchors)
+        sizes = torch.as_tensor(sizes, dtype=torch.float) / scale
+        anchors_of_level.append(anchor_grid(lx, ly, sizes))
     return anchors_of_level
 
 
@@ -79,32 +78,21 @@ def generate_anchors(input_size, stride=16, aspect_ratios=(1 / 2, 1 / 1, 2 / 1),
     lx, ly = get_locations(input_size, [stride])[0]
     aspect_ratios = torch.tensor(aspect_ratios)
     scales = aspect_ratios.new_tensor(scales).view(len(scales), -1)
-    num_anchors = len(aspect_ratios) * len(scales)
-    anchors = torch.zeros(lx, ly, num_anchors, 4)
-    anchors[:, :, :, 0] = (torch.arange(
-        lx, dtype=torch.float).view(lx, 1, 1).expand(lx, ly, num_anchors) + 0.5) / lx
-    anchors[:, :, :, 1] = (torch.arange(
-        ly, dtype=torch.float).view(1, ly, 1).expand(lx, ly, num_anchors) + 0.5) / ly
     if scales.size(1) == 2:
         sw = scales[:, [0]]
         sh = scales[:, [1]]
     else:
         sw = sh = scales
-    anchors[:, :, :, 2] = (sw * aspect_ratios).view(-1) / width
-    anchors[:, :, :, 3] = (sh / aspect_ratios).view(-1) / height
-    return anchors
+    sizes = torch.stack([
+        (sw * aspect_ratios).view(-1) / width,
+        (sh / aspect_ratios).view(-1) / height,
+    ], dim=-1)
+    return anchor_grid(lx, ly, sizes)
 
 
 def generate_anchors_with_priors(input_size, stride, priors):
     lx, ly = get_locations(input_size, [stride])[0]
-    num_anchors = len(priors)
-    anchors = torch.zeros(lx, ly, num_anchors, 4)
-    anchors[:, :, :, 0] = (torch.arange(
-        lx, dtype=torch.float).view(lx, 1, 1).expand(lx, ly, num_anchors) + 0.5) / lx
-    anchors[:, :, :, 1] = (torch.arange(
-        ly, dtype=torch.float).view(1, ly, 1).expand(lx, ly, num_anchors) + 0.5) / ly
-    anchors[:, :, :, 2:] = priors
-    return anchors
+    return anchor_grid(lx, ly, priors)
 
 
 def misc_target_collate(batch):
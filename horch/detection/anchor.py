@@ -1,9 +1,14 @@
+import itertools
+
 import numpy as np
 import torch
 
-from horch._numpy import iou_mn, iou_11
+from horch._backend import _numpy
 from horch.detection import BBox
 
+iou_mn = _numpy.iou_mn
+iou_11 = _numpy.iou_11
+
 
 def kmeans(X, k, max_iter=300, tol=1e-6, verbose=True):
     n, d = X.shape
@@ -11,15 +16,12 @@ def kmeans(X, k, max_iter=300, tol=1e-6, verbose=True):
     for i in range(max_iter):
         dist = 1 - iou_mn(X, centers)
         y = np.argmin(dist, axis=1)
-        loss = 0
-        for ki in range(k):
-            kx = X[y == ki]
-            if kx.size != 0:
-                center = np.mean(kx, axis=0)
-                iou = iou_11(center, centers[ki])
-                loss += 1 - iou
-                centers[ki] = center
-        loss /= k
+        counts = np.bincount(y, minlength=k)
+        nonempty = counts != 0
+        sums = np.stack([np.bincount(y, weights=X[:, j], minlength=k) for j in range(d)], axis=1)
+        new_centers = sums[nonempty] / counts[nonempty, None]
+        loss = np.sum(1 - _iou_paired(new_centers, centers[nonempty])) / k
+        centers[nonempty] = new_centers
         if verbose:
             print("Iter %d: %.6f" % (i, loss))
         if loss < tol:
@@ -27,6 +29,149 @@ def kmeans(X, k, max_iter=300, tol=1e-6, verbose=True):
     return y, centers
 
 
+def _iou_paired(boxes1, boxes2):
+    lt = np.maximum(boxes1[:, :2], boxes2[:, :2])
+    rb = np.minimum(boxes1[:, 2:], boxes2[:, 2:])
+    wh = np.maximum(rb - lt, 0)
+    inter = wh[:, 0] * wh[:, 1]
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    return inter / (area1 + area2 - inter)
+
+
+def iou_wh(sizes, centers):
+    r"""
+    IoU between boxes of `sizes` (..., n, 2) and `centers` (..., k, 2) of [width, height]
+    aligned at the same center, (..., n, k).
+    """
+    w1, h1 = sizes[..., :, None, 0], sizes[..., :, None, 1]
+    w2, h2 = centers[..., None, :, 0], centers[..., None, :, 1]
+    inter = np.minimum(w1, w2) * np.minimum(h1, h2)
+    return inter / (w1 * h1 + w2 * h2 - inter)
+
+
+def kmeans_pp_init(sizes, k, n_init=1, rng=np.random):
+    r"""
+    k-means++ seeding under the distance 1 - IoU, for `n_init` restarts at once.
+
+    Returns:
+        centers: (n_init, k, 2)
+    """
+    n = len(sizes)
+    centers = np.empty((n_init, k, 2), dtype=np.float64)
+    centers[:, 0] = sizes[rng.randint(n, size=n_init)]
+    dist = 1 - iou_wh(sizes, centers[:, :1])[..., 0]
+    for i in range(1, k):
+        p = np.maximum(dist, 0) ** 2
+        cum = np.cumsum(p, axis=1)
+        u = rng.uniform(size=n_init) * cum[:, -1]
+        idx = np.minimum([np.searchsorted(c, x, side='right') for c, x in zip(cum, u)], n - 1)
+        centers[:, i] = sizes[idx]
+        dist = np.minimum(dist, 1 - iou_wh(sizes, centers[:, i:i + 1])[..., 0])
+    return centers
+
+
+def _iter_batches(sizes, batch_size, max_iter, rng):
+    # Random minibatches of an array, or the chunks of a stream regrouped to `batch_size`.
+    if isinstance(sizes, np.ndarray) or torch.is_tensor(sizes):
+        sizes = np.asarray(sizes, dtype=np.float64)
+        for _ in range(max_iter):
+            yield sizes[rng.randint(len(sizes), size=min(batch_size, len(sizes)))]
+        return
+    buffer, n = [], 0
+    for chunk in sizes:
+        chunk = np.asarray(chunk, dtype=np.float64).reshape(-1, 2)
+        buffer.append(chunk)
+        n += len(chunk)
+        while n >= batch_size:
+            batch = np.concatenate(buffer)
+            yield batch[:batch_size]
+            buffer, n = [batch[batch_size:]], n - batch_size
+    if n:
+        yield np.concatenate(buffer)
+
+
+def kmeans_minibatch(sizes, k, batch_size=4096, max_iter=100, n_init=4, init_size=None, tol=1e-4,
+                     seed=None, verbose=True):
+    r"""
+    Mini-batch k-means of box sizes under the distance 1 - IoU, with k-means++
+    seeding. `n_init` restarts are run together on the same minibatches, and the
+    one with the highest mean IoU on the seeding sample is returned.
+
+    Parameters
+    ----------
+    sizes : ``numpy.ndarray`` or iterable
+        Box sizes of [width, height], or an iterable (e.g. a generator) of chunks
+        of them, which is consumed in one pass or until convergence.
+    k : ``int``
+        Number of clusters.
+    batch_size : ``int``
+        Number of boxes of every minibatch.
+    max_iter : ``int``
+        Maximum number of minibatches for array input.
+    n_init : ``int``
+        Number of restarts.
+    init_size : ``int``
+        Number of boxes to seed with, taken from the first minibatches of a
+        stream. Default: 3 * batch_size
+    tol : ``float``
+        Stop when no center moves more than `tol` (relative) in a minibatch.
+    seed : ``int``
+        Random seed.
+    verbose: ``bool``
+        Whether to print info.
+
+    Returns
+    -------
+    centers : ``numpy.ndarray``
+        (k, 2) box sizes of the centers.
+    """
+    rng = np.random.RandomState(seed)
+    init_size = init_size or 3 * batch_size
+    batches = _iter_batches(sizes, batch_size, max_iter, rng)
+
+    # The seeding sample is also the first minibatches of a stream
+    pending = []
+    if isinstance(sizes, np.ndarray) or torch.is_tensor(sizes):
+        sizes = np.asarray(sizes, dtype=np.float64)
+        sample = sizes[rng.choice(len(sizes), size=min(init_size, len(sizes)), replace=False)]
+    else:
+        n = 0
+        for batch in batches:
+            pending.append(batch)
+            n += len(batch)
+            if n >= init_size:
+                break
+        sample = np.concatenate(pending)
+    if len(sample) < k:
+        raise ValueError("Need at least k=%d boxes, got %d" % (k, len(sample)))
+
+    centers = kmeans_pp_init(sample, k, n_init, rng)
+    counts = np.zeros((n_init, k))
+    restarts = np.arange(n_init)[:, None] * k
+    for i, batch in enumerate(itertools.chain(pending, batches)):
+        y = np.argmax(iou_wh(batch, centers), axis=-1)
+        labels = (restarts + y).ravel()
+        batch_counts = np.bincount(labels, minlength=n_init * k).reshape(n_init, k)
+        sums = np.zeros((n_init * k, 2))
+        np.add.at(sums, labels, np.tile(batch, (n_init, 1)))
+        counts += batch_counts
+        # Per center learning rate of 1 / count
+        nonempty = batch_counts > 0
+        delta = np.zeros_like(centers)
+        delta[nonempty] = (sums.reshape(n_init, k, 2)[nonempty] - batch_counts[nonempty, None] * centers[nonempty]) \
+            / counts[nonempty, None]
+        centers += delta
+        shift = np.abs(delta / centers).max()
+        if verbose:
+            print("Iter %d: %.6f" % (i, shift))
+        if shift < tol:
+            break
+
+    mean_ious = iou_wh(sample, centers).max(axis=-1).mean(axis=-1)
+    return centers[np.argmax(mean_ious)]
+
+
 def find_centers_kmeans(bboxes, k, max_iter=100, verbose=True):
     r"""
     Find bounding box centers by kmeans.
@@ -48,21 +193,32 @@ def find_centers_kmeans(bboxes, k, max_iter=100, verbose=True):
     return centers
 
 
-def find_priors_kmeans(sizes, k, max_iter=100, verbose=True):
+def find_priors_kmeans(sizes, k, max_iter=100, verbose=True, method='lloyd', **kwargs):
     r"""
     Find bounding box centers by kmeans.
 
     Parameters
     ----------
     sizes : ``numpy.ndarray``
-        Bounding boxes of normalized [width, height].
+        Bounding boxes of normalized [width, height]. For `method='minibatch'`, it
+        could also be an iterable of chunks of them.
     k : ``int``
         Number of clusters (priors).
     max_iter : ``int``
         Maximum numer of iterations. Default: 100
     verbose: ``bool``
         Whether to print info.
+    method : ``str``
+        `lloyd` for kmeans with random initialization on all boxes, or `minibatch`
+        for mini-batch kmeans with k-means++ seeding, see `kmeans_minibatch`.
+    kwargs :
+        Other arguments of `kmeans_minibatch`.
     """
+    if method == 'minibatch':
+        priors = kmeans_minibatch(sizes, k, max_iter=max_iter, verbose=verbose, **kwargs)
+        return torch.from_numpy(priors).float()
+    elif method != 'lloyd':
+        raise ValueError("method must be 'lloyd' or 'minibatch', got %s" % method)
     bboxes = np.concatenate([np.full_like(sizes, 0.5), sizes], axis=-1)
     bboxes = BBox.convert(bboxes, BBox.XYWH, BBox.LTRB, inplace=True)
     centers = find_centers_kmeans(bboxes, k, max_iter, verbose)
@@ -72,24 +228,22 @@ def find_priors_kmeans(sizes, k, max_iter=100, verbose=True):
     return torch.from_numpy(priors).float()
 
 
-def find_priors_coco(ds, k=3, max_iter=100, verbose=True):
+def _coco_sizes(annotations, chunk_size=65536):
+    # Normalized box sizes of COCO style annotations in chunks.
+    image_sizes = {img['id']: (img['width'], img['height']) for img in annotations['images']}
+    anns = annotations['annotations']
+    for start in range(0, len(anns), chunk_size):
+        chunk = anns[start:start + chunk_size]
+        sizes = np.array([ann['bbox'][2:] for ann in chunk], dtype=np.float64).reshape(-1, 2)
+        sizes /= np.array([image_sizes[ann['image_id']] for ann in chunk], dtype=np.float64).reshape(-1, 2)
+        yield sizes
+
+
+def find_priors_coco(ds, k=3, max_iter=100, verbose=True, method='lloyd', **kwargs):
     assert hasattr(ds, "to_coco"), "ds must have `to_coco()` method"
-    from hpycocotools.coco import COCO
-    coco = COCO(ds.to_coco(), verbose=False)
-    bboxes = []
-    for img_id, anns in coco.imgToAnns.items():
-        img = coco.loadImgs(img_id)[0]
-        height = img['height']
-        width = img['width']
-        for ann in anns:
-            l, t, w, h = ann['bbox']
-            l /= width
-            t /= height
-            w /= width
-            h /= height
-            bboxes.append([l, t, w, h])
-    bboxes = np.array(bboxes, dtype=np.float32)
-    sizes = bboxes[:, 2:]
-    priors = find_priors_kmeans(sizes, k=k, max_iter=max_iter, verbose=verbose)
+    sizes = _coco_sizes(ds.to_coco())
+    if method != 'minibatch':
+        sizes = np.concatenate(list(sizes)).astype(np.float32)
+    priors = find_priors_kmeans(sizes, k=k, max_iter=max_iter, verbose=verbose, method=method, **kwargs)
     priors = torch.stack(sorted(priors, key=lambda x: x[0] * x[1]))
-    return priors
\ No newline at end of file
+    return priors
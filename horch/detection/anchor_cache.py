@@ -0,0 +1,310 @@
+from collections import OrderedDict
+
+import torch
+
+from horch.detection.bbox import BBox
+
+__all__ = [
+    "LRUCache", "get_cache", "clear_cache", "set_cache_size", "image_size",
+    "MlvlAnchors", "MlvlPriors", "MlvlCenters", "is_grid",
+]
+
+DEFAULT_CACHE_SIZE = 32
+
+
+class LRUCache:
+    r"""
+    Least-recently-used mapping with a bounded number of entries.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of entries kept. The least recently used one is evicted first.
+    """
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, create):
+        r"""
+        Return the value of `key`, calling `create()` to build and insert it on a miss.
+        """
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            value = create()
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return value
+        self.hits += 1
+        self._data.move_to_end(key)
+        return value
+
+    def resize(self, maxsize):
+        self.maxsize = maxsize
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+_cache = LRUCache()
+
+
+def get_cache():
+    return _cache
+
+
+def clear_cache():
+    _cache.clear()
+
+
+def set_cache_size(maxsize):
+    _cache.resize(maxsize)
+
+
+def image_size(img):
+    r"""
+    (width, height) of a PIL image or a tensor of shape `(..., H, W)`.
+    """
+    if torch.is_tensor(img):
+        return img.size(-1), img.size(-2)
+    return tuple(img.size)
+
+
+def _key_of(x):
+    if torch.is_tensor(x):
+        return _key_of(x.tolist())
+    if isinstance(x, (list, tuple)):
+        return tuple(_key_of(e) for e in x)
+    return x
+
+
+def _locations(size, strides):
+    # Imported lazily: `horch.detection` itself builds anchors with `anchor_grid`.
+    from horch.detection import get_locations
+    return get_locations(size, strides)
+
+
+def _grid(lx, ly, dtype, device):
+    # Cell indices in (lx, ly) row-major order, the layout of the head predictions.
+    xs = torch.arange(lx, dtype=dtype, device=device)
+    ys = torch.arange(ly, dtype=dtype, device=device)
+    return xs.view(lx, 1).expand(lx, ly), ys.view(1, ly).expand(lx, ly)
+
+
+def anchor_grid(lx, ly, sizes, dtype=torch.float32, device='cpu'):
+    r"""
+    Anchors of shape `(lx, ly, #sizes, 4)` in normalized XYWH format.
+
+    Parameters
+    ----------
+    lx, ly : int
+        Number of locations along width and height.
+    sizes : torch.Tensor
+        Normalized anchor sizes of shape `(#sizes, 2)`.
+    """
+    sizes = torch.as_tensor(sizes, dtype=dtype, device=device).view(-1, 2)
+    a = sizes.size(0)
+    xs, ys = _grid(lx, ly, dtype, device)
+    cx = xs.add(0.5).div_(lx)
+    cy = ys.add(0.5).div_(ly)
+    centers = torch.stack((cx, cy), dim=-1)[:, :, None, :].expand(lx, ly, a, 2)
+    return torch.cat((centers, sizes.expand(lx, ly, a, 2)), dim=-1)
+
+
+class _Grid:
+    kind = None
+
+    def _lookup(self, name, size, dtype, device, build):
+        size = tuple(int(s) for s in size)
+        device = torch.device(device)
+        key = (self.kind, name, self.key, size, dtype, str(device))
+        return _cache.get(key, lambda: build(size, dtype, device))
+
+    def __repr__(self):
+        return "%s%r" % (type(self).__name__, self.key)
+
+
+def is_grid(x):
+    return isinstance(x, _Grid)
+
+
+class _AnchorGrid(_Grid):
+
+    def locations(self, size):
+        return _locations(size, self.strides)
+
+    def __call__(self, size, dtype=torch.float32, device='cpu', format=BBox.XYWH):
+        r"""
+        Flattened anchors of shape `(#anchors, 4)` for inputs of `size`, ordered like the
+        concatenated head predictions.
+
+        Parameters
+        ----------
+        size : tuple of int
+            (width, height) of the input.
+        dtype : torch.dtype
+        device : torch.device or str
+        format : str
+            `BBox.XYWH` or `BBox.LTRB`.
+        """
+        if format == BBox.XYWH:
+            return self._lookup(BBox.XYWH, size, dtype, device, self._build)
+        if format == BBox.LTRB:
+            return self._lookup(
+                BBox.LTRB, size, dtype, device,
+                lambda *args: BBox.convert(self(*args), BBox.XYWH, BBox.LTRB))
+        raise ValueError("Unsupported format: %s" % format)
+
+    def mlvl(self, size, dtype=torch.float32, device='cpu'):
+        r"""
+        Views of the cached XYWH anchors per level, each of shape `(lx, ly, #anchors, 4)`.
+        """
+        anchors = self(size, dtype, device)
+        mlvl_anchors = []
+        start = 0
+        for (lx, ly), a in zip(self.locations(size), self.num_anchors):
+            n = lx * ly * a
+            mlvl_anchors.append(anchors[start:start + n].view(lx, ly, a, 4))
+            start += n
+        return mlvl_anchors
+
+    def grid_sizes(self, size, dtype=torch.float32, device='cpu'):
+        r"""
+        (lx, ly) of the level of every flattened anchor, of shape `(#anchors, 2)`.
+        """
+        def build(size, dtype, device):
+            locations = self.locations(size)
+            lxly = torch.tensor(locations, dtype=dtype, device=device)
+            counts = torch.tensor(
+                [lx * ly * a for (lx, ly), a in zip(locations, self.num_anchors)], device=device)
+            return lxly.repeat_interleave(counts, dim=0)
+        return self._lookup('grid_sizes', size, dtype, device, build)
+
+
+class MlvlAnchors(_AnchorGrid):
+    r"""
+    Multi-level anchors with absolute sizes, looked up by input size.
+    Equivalent to `flatten(generate_mlvl_anchors(size, strides, anchor_sizes))`.
+
+    Parameters
+    ----------
+    strides : Sequence[int]
+        Stride of every level.
+    anchor_sizes : Sequence[torch.Tensor]
+        Anchor sizes (width, height) in pixels of every level, each of shape `(#anchors, 2)`.
+    """
+    kind = 'anchors'
+
+    def __init__(self, strides, anchor_sizes):
+        assert len(strides) == len(anchor_sizes)
+        self.strides = tuple(strides)
+        self.anchor_sizes = [torch.as_tensor(s, dtype=torch.float32).view(-1, 2) for s in anchor_sizes]
+        self.num_anchors = [len(s) for s in self.anchor_sizes]
+        self.key = (self.strides, _key_of(self.anchor_sizes))
+
+    def _build(self, size, dtype, device):
+        width, height = size
+        scale = torch.tensor([width, height], dtype=dtype, device=device)
+        anchors = [
+            anchor_grid(lx, ly, sizes.to(dtype=dtype, device=device) / scale, dtype, device).view(-1, 4)
+            for (lx, ly), sizes in zip(self.locations(size), self.anchor_sizes)
+        ]
+        return torch.cat(anchors, dim=0)
+
+
+class MlvlPriors(_AnchorGrid):
+    r"""
+    Multi-level anchors with sizes relative to the input, looked up by input size.
+    Equivalent to the flattened `generate_anchors_with_priors(size, stride, priors)` of every level.
+
+    Parameters
+    ----------
+    strides : Sequence[int]
+        Stride of every level.
+    priors : Sequence[torch.Tensor] or torch.Tensor
+        Normalized anchor sizes of every level, of shape `(#levels, #anchors, 2)`.
+    """
+    kind = 'priors'
+
+    def __init__(self, strides, priors):
+        assert len(strides) == len(priors)
+        self.strides = tuple(strides)
+        self.priors = [torch.as_tensor(p, dtype=torch.float32).view(-1, 2) for p in priors]
+        self.num_anchors = [len(p) for p in self.priors]
+        self.key = (self.strides, _key_of(self.priors))
+
+    def _build(self, size, dtype, device):
+        anchors = [
+            anchor_grid(lx, ly, priors, dtype, device).view(-1, 4)
+            for (lx, ly), priors in zip(self.locations(size), self.priors)
+        ]
+        return torch.cat(anchors, dim=0)
+
+
+class MlvlCenters(_Grid):
+    r"""
+    Centers of the locations of every level, looked up by input size.
+
+    Parameters
+    ----------
+    strides : Sequence[int]
+        Stride of every level.
+    unit : str
+        `pixel` for centers `i * stride + stride // 2` in input coordinates (FCOS), or
+        `grid` for centers `i + 0.5` in the coordinates of the level (FoveaBox).
+    """
+    kind = 'centers'
+
+    def __init__(self, strides, unit='pixel'):
+        assert unit in ['pixel', 'grid'], "unit must be pixel or grid"
+        self.strides = tuple(strides)
+        self.unit = unit
+        self.key = (self.strides, unit)
+
+    def locations(self, size):
+        return _locations(size, self.strides)
+
+    def _build(self, size, dtype, device):
+        mlvl_centers = []
+        for (lx, ly), stride in zip(self.locations(size), self.strides):
+            xs, ys = _grid(lx, ly, dtype, device)
+            if self.unit == 'pixel':
+                centers = torch.stack((xs * stride + stride // 2, ys * stride + stride // 2), dim=-1)
+            else:
+                centers = torch.stack((xs + 0.5, ys + 0.5), dim=-1)
+            mlvl_centers.append(centers.reshape(-1, 2))
+        return torch.cat(mlvl_centers, dim=0)
+
+    def __call__(self, size, dtype=torch.float32, device='cpu'):
+        r"""
+        Flattened centers of shape `(#locations, 2)` for inputs of `size`.
+        """
+        return self._lookup('flat', size, dtype, device, self._build)
+
+    def mlvl(self, size, dtype=torch.float32, device='cpu'):
+        r"""
+        Views of the cached centers per level, each of shape `(lx, ly, 2)`.
+        """
+        centers = self(size, dtype, device)
+        mlvl_centers = []
+        start = 0
+        for lx, ly in self.locations(size):
+            mlvl_centers.append(centers[start:start + lx * ly].view(lx, ly, 2))
+            start += lx * ly
+        return mlvl_centers
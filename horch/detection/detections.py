@@ -0,0 +1,174 @@
+import numpy as np
+
+import torch
+
+__all__ = ["Detections", "as_detections"]
+
+
+class Detections:
+    r"""
+    Detections of a batch of images in columns. The detections of image `i` are
+    rows `offsets[i]:offsets[i + 1]` of every column.
+
+    Indexing with an int gives the COCO style dicts of one image, so a `Detections`
+    can be used like the list of lists of dicts it replaces. Indexing with a slice
+    gives the `Detections` of those images.
+
+    Parameters
+    ----------
+    boxes : torch.Tensor
+        Boxes in LTWH format of shape `(n, 4)`.
+    scores : torch.Tensor
+        Scores of shape `(n,)`.
+    labels : torch.Tensor
+        Category ids of shape `(n,)`.
+    offsets : torch.Tensor
+        Start of the detections of every image and the total number, of shape `(#images + 1,)`.
+    image_ids : torch.Tensor
+        Image ids of shape `(n,)`. Default: -1
+    masks : Sequence[np.ndarray]
+        Optional binary masks inside the boxes of every detection, as `segmentation`.
+    """
+
+    def __init__(self, boxes, scores, labels, offsets, image_ids=None, masks=None):
+        self.boxes = boxes
+        self.scores = scores
+        self.labels = labels
+        self.offsets = offsets
+        if image_ids is None:
+            image_ids = labels.new_full((len(labels),), -1)
+        self.image_ids = image_ids
+        self.masks = masks
+
+    @classmethod
+    def single(cls, boxes, scores, labels, indices=None, masks=None):
+        r"""
+        Detections of one image, optionally the rows of `indices` only.
+        """
+        if indices is not None:
+            indices = torch.as_tensor(indices, dtype=torch.long)
+            boxes, scores, labels = boxes[indices], scores[indices], labels[indices]
+        offsets = torch.tensor([0, len(scores)])
+        return cls(boxes.cpu(), scores.cpu(), labels.cpu(), offsets, masks=masks)
+
+    @classmethod
+    def empty(cls, num_images=1):
+        return cls(torch.zeros(0, 4), torch.zeros(0), torch.zeros(0, dtype=torch.long),
+                   torch.zeros(num_images + 1, dtype=torch.long))
+
+    @classmethod
+    def cat(cls, dets):
+        r"""
+        Concatenate the images of a sequence of `Detections`.
+        """
+        dets = list(dets)
+        if not dets:
+            return cls.empty(0)
+        counts = torch.cat([d.counts for d in dets])
+        offsets = torch.cat([counts.new_zeros(1), counts.cumsum(0)])
+        masks = None
+        if any(d.masks is not None for d in dets):
+            masks = [m for d in dets for m in (d.masks if d.masks is not None else [None] * len(d.scores))]
+        return cls(
+            torch.cat([d.boxes for d in dets]), torch.cat([d.scores for d in dets]),
+            torch.cat([d.labels for d in dets]), offsets,
+            torch.cat([d.image_ids for d in dets]), masks)
+
+    @classmethod
+    def from_dicts(cls, image_dets):
+        r"""
+        Detections from COCO style dicts of every image.
+        """
+        if isinstance(image_dets, Detections):
+            return image_dets
+        counts = [len(dets) for dets in image_dets]
+        dets = [d for ds in image_dets for d in ds]
+        offsets = torch.tensor([0] + counts).cumsum(0)
+        # float64 keeps the values of the dicts exactly
+        boxes = torch.tensor([d['bbox'] for d in dets], dtype=torch.float64).view(-1, 4)
+        scores = torch.tensor([d['score'] for d in dets], dtype=torch.float64)
+        labels = torch.tensor([d['category_id'] for d in dets], dtype=torch.long)
+        image_ids = torch.tensor([d.get('image_id', -1) for d in dets], dtype=torch.long)
+        masks = None
+        if any('segmentation' in d for d in dets):
+            masks = [d.get('segmentation') for d in dets]
+        return cls(boxes, scores, labels, offsets, image_ids, masks)
+
+    @property
+    def counts(self):
+        return self.offsets[1:] - self.offsets[:-1]
+
+    @property
+    def image_indices(self):
+        r"""
+        Index of the image in the batch of every detection.
+        """
+        return torch.arange(len(self)).repeat_interleave(self.counts)
+
+    def with_image_ids(self, image_ids):
+        r"""
+        Copy with the image id of every image set.
+        """
+        image_ids = torch.as_tensor(image_ids, dtype=torch.long).repeat_interleave(self.counts)
+        return Detections(self.boxes, self.scores, self.labels, self.offsets, image_ids, self.masks)
+
+    def numpy(self):
+        r"""
+        Boxes in LTWH format and scores as float64 arrays, image ids and category ids as int64 arrays.
+        """
+        return (self.boxes.numpy().astype(np.float64), self.scores.numpy().astype(np.float64),
+                self.image_ids.numpy(), self.labels.numpy())
+
+    def to_coco_dicts(self):
+        r"""
+        COCO style dicts of every image.
+        """
+        boxes = self.boxes.tolist()
+        scores = self.scores.tolist()
+        labels = self.labels.tolist()
+        image_ids = self.image_ids.tolist()
+        dets = []
+        for i in range(len(scores)):
+            det = {
+                'image_id': image_ids[i],
+                'category_id': labels[i],
+                'bbox': boxes[i],
+                'score': scores[i],
+            }
+            if self.masks is not None and self.masks[i] is not None:
+                det['segmentation'] = self.masks[i]
+            dets.append(det)
+        offsets = self.offsets.tolist()
+        return [dets[s:e] for s, e in zip(offsets[:-1], offsets[1:])]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            assert step == 1, "Only contiguous images can be sliced"
+            stop = max(start, stop)
+            s, e = self.offsets[start].item(), self.offsets[stop].item()
+            masks = self.masks[s:e] if self.masks is not None else None
+            return Detections(
+                self.boxes[s:e], self.scores[s:e], self.labels[s:e],
+                self.offsets[start:stop + 1] - s, self.image_ids[s:e], masks)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("image index out of range")
+        return self[index:index + 1].to_coco_dicts()[0]
+
+    def __iter__(self):
+        return iter(self.to_coco_dicts())
+
+    def __repr__(self):
+        return "Detections(images=%d, detections=%d)" % (len(self), len(self.scores))
+
+
+def as_detections(image_dets):
+    r"""
+    `image_dets` as `Detections`, converting lists of COCO style dicts.
+    """
+    return Detections.from_dicts(image_dets)
@@ -1,69 +1,454 @@
 from typing import List
 
 import numpy as np
-from toolz.curried import groupby
 
+import torch
+
+from horch._backend import _numpy
 from horch.detection.bbox import BBox
-from horch.detection.iou import iou_11
+
+
+def _to_numpy(x):
+    if torch.is_tensor(x):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
 
 
 def mAP(detections: List[BBox], ground_truths: List[BBox], iou_threshold=.5):
     r"""
     Args:
-        detections: sequences of BBox with `confidence`
+        detections: sequences of BBox with `score`
         ground_truths: same size sequences of BBox
         iou_threshold:
     """
-    image_dts = groupby(lambda b: b.image_id, detections)
-    image_gts = groupby(lambda b: b.image_id, ground_truths)
-    image_ids = image_gts.keys()
-    maps = []
-    for i in image_ids:
-        i_dts = image_dts.get(i, [])
-        i_gts = image_gts[i]
-        class_dts = groupby(lambda b: b.category_id, i_dts)
-        class_gts = groupby(lambda b: b.category_id, i_gts)
-        classes = class_gts.keys()
-        aps = []
-        for c in classes:
-            if c not in class_dts:
-                aps.append(0)
-                continue
-            aps.append(AP(class_dts[c], class_gts[c], iou_threshold))
-        maps.append(np.mean(aps))
-    return np.mean(maps)
+    return compute_map(
+        [d.bbox for d in detections], [d.score for d in detections],
+        [d.image_id for d in detections], [d.category_id for d in detections],
+        [g.bbox for g in ground_truths],
+        [g.image_id for g in ground_truths], [g.category_id for g in ground_truths],
+        iou_threshold)
 
 
 def AP(dts: List[BBox], gts: List[BBox], iou_threshold):
-    TP = np.zeros(len(dts), dtype=np.uint8)
-    n_positive = len(gts)
-    seen = np.zeros(n_positive)
-    for i, dt in enumerate(dts):
-        ious = [iou_11(dt.bbox, gt.bbox) for gt in gts]
-        j_max, iou_max = max(enumerate(ious), key=lambda x: x[1])
-        if iou_max > iou_threshold:
-            if not seen[j_max]:
-                TP[i] = 1
-                seen[j_max] = 1
-    FP = 1 - TP
-    acc_fp = np.cumsum(FP)
+    scores = [dt.score for dt in dts]
+    if any(s is None for s in scores):
+        scores = None
+    return compute_ap(
+        [dt.bbox for dt in dts], scores, [gt.bbox for gt in gts], iou_threshold)
+
+
+def compute_map(dt_boxes, dt_scores, dt_image_ids, dt_category_ids,
+                gt_boxes, gt_image_ids, gt_category_ids, iou_threshold=.5):
+    r"""
+    Array version of `mAP`: the AP of every class is averaged over the classes of
+    every image and then over the images with ground truths.
+
+    Args:
+        dt_boxes: (n, 4) detected boxes in LTRB format
+        dt_scores: (n,) confidences of the detections
+        dt_image_ids: (n,) image ids of the detections
+        dt_category_ids: (n,) category ids of the detections
+        gt_boxes: (m, 4) ground truth boxes in LTRB format
+        gt_image_ids: (m,) image ids of the ground truths
+        gt_category_ids: (m,) category ids of the ground truths
+        iou_threshold: a threshold or a sequence of thresholds, in which case
+            the results of all thresholds are returned in an array
+    """
+    dt_boxes, dt_scores, dt_images, dt_categories, gt_boxes, gt_images, gt_categories = _prepare(
+        dt_boxes, dt_scores, dt_image_ids, dt_category_ids, gt_boxes, gt_image_ids, gt_category_ids)
+    if len(gt_boxes) == 0:
+        return np.zeros(len(iou_threshold)) if np.ndim(iou_threshold) else 0
+
+    num_categories = max(dt_categories.max(initial=0), gt_categories.max()) + 1
+    dt_keys = dt_images * num_categories + dt_categories
+    gt_keys = gt_images * num_categories + gt_categories
+    iou_max, j_max = _match_groups(dt_boxes, dt_keys, gt_boxes, gt_keys)
+
+    # Only the groups with ground truths count
+    group_keys, gt_counts = np.unique(gt_keys, return_counts=True)
+    groups = np.searchsorted(group_keys, dt_keys).clip(max=len(group_keys) - 1)
+    valid = group_keys[groups] == dt_keys
+    order = np.lexsort((-dt_scores[valid], groups[valid]))
+    groups = groups[valid][order]
+
+    TP = match_detections(iou_max[valid][order], j_max[valid][order], np.atleast_1d(iou_threshold))
+    aps = _segment_ap(TP, groups, gt_counts)
+
+    _, group_images = np.unique(group_keys // num_categories, return_inverse=True)
+    maps = np.stack([np.bincount(group_images, weights=ap) for ap in aps]) / np.bincount(group_images)
+    maps = maps.mean(axis=1)
+    return maps if np.ndim(iou_threshold) else maps[0]
+
+
+def compute_dataset_map(dt_boxes, dt_scores, dt_image_ids, dt_category_ids,
+                        gt_boxes, gt_image_ids, gt_category_ids, iou_threshold=.5):
+    r"""
+    Dataset level mAP like COCO: the detections of every class are ranked over all
+    images, and the AP of the classes with ground truths are averaged.
+
+    Args:
+        dt_boxes: (n, 4) detected boxes in LTRB format
+        dt_scores: (n,) confidences of the detections
+        dt_image_ids: (n,) image ids of the detections
+        dt_category_ids: (n,) category ids of the detections
+        gt_boxes: (m, 4) ground truth boxes in LTRB format
+        gt_image_ids: (m,) image ids of the ground truths
+        gt_category_ids: (m,) category ids of the ground truths
+        iou_threshold: a threshold or a sequence of thresholds, in which case
+            the results of all thresholds are returned in an array
+    """
+    dt_boxes, dt_scores, dt_images, dt_categories, gt_boxes, gt_images, gt_categories = _prepare(
+        dt_boxes, dt_scores, dt_image_ids, dt_category_ids, gt_boxes, gt_image_ids, gt_category_ids)
+    if len(gt_boxes) == 0:
+        return np.zeros(len(iou_threshold)) if np.ndim(iou_threshold) else 0
+
+    num_categories = max(dt_categories.max(initial=0), gt_categories.max()) + 1
+    iou_max, j_max = _match_groups(
+        dt_boxes, dt_images * num_categories + dt_categories,
+        gt_boxes, gt_images * num_categories + gt_categories)
+
+    # Detections of classes without ground truths are ignored
+    categories, gt_counts = np.unique(gt_categories, return_counts=True)
+    groups = np.searchsorted(categories, dt_categories).clip(max=len(categories) - 1)
+    valid = categories[groups] == dt_categories
+    order = np.lexsort((-dt_scores[valid], groups[valid]))
+    groups = groups[valid][order]
+
+    TP = match_detections(iou_max[valid][order], j_max[valid][order], np.atleast_1d(iou_threshold))
+    maps = _segment_ap(TP, groups, gt_counts).mean(axis=1)
+    return maps if np.ndim(iou_threshold) else maps[0]
+
+
+def _prepare(dt_boxes, dt_scores, dt_image_ids, dt_category_ids, gt_boxes, gt_image_ids, gt_category_ids):
+    # Converts the inputs to arrays and encodes the ids to contiguous integers.
+    n = len(dt_scores)
+    _, images = np.unique(np.concatenate(
+        [_to_numpy(dt_image_ids).reshape(-1), _to_numpy(gt_image_ids).reshape(-1)]), return_inverse=True)
+    _, categories = np.unique(np.concatenate(
+        [_to_numpy(dt_category_ids).reshape(-1), _to_numpy(gt_category_ids).reshape(-1)]), return_inverse=True)
+    return (_to_numpy(dt_boxes).reshape(-1, 4), _to_numpy(dt_scores).reshape(-1),
+            images[:n], categories[:n], _to_numpy(gt_boxes).reshape(-1, 4),
+            images[n:], categories[n:])
+
+
+def _match_groups(dt_boxes, dt_keys, gt_boxes, gt_keys):
+    r"""
+    Max IoU of every detection over the ground truths with the same key, and the
+    index of the ground truth with it, the first one on ties like `argmax`. The
+    IoU is 0 and the index is -1 for detections without ground truths.
+    """
+    gt_order = np.argsort(gt_keys, kind='stable')
+    gt_boxes, gt_keys = gt_boxes[gt_order], gt_keys[gt_order]
+    group_keys, gt_starts, gt_counts = np.unique(gt_keys, return_index=True, return_counts=True)
+    groups = np.searchsorted(group_keys, dt_keys).clip(max=len(group_keys) - 1)
+    counts = np.where(group_keys[groups] == dt_keys, gt_counts[groups], 0)
+
+    n = len(dt_keys)
+    pair_dts = np.repeat(np.arange(n), counts)
+    pair_gts = np.repeat(gt_starts[groups] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    ious = _iou_pairs(dt_boxes[pair_dts], gt_boxes[pair_gts])
+    best = np.lexsort((pair_gts, -ious, pair_dts))
+    first = np.searchsorted(pair_dts[best], np.arange(n))
+    has_gt = counts > 0
+    best = best[first[has_gt]]
+
+    iou_max = np.zeros(n)
+    j_max = np.full(n, -1)
+    iou_max[has_gt] = ious[best]
+    j_max[has_gt] = gt_order[pair_gts[best]]
+    return iou_max, j_max
+
+
+def _segment_ap(TP, segments, n_positive):
+    r"""
+    AP of every segment of ranked detections.
+
+    Args:
+        TP: (t, n) true positives of the detections at t thresholds, in rank order
+            inside every segment
+        segments: (n,) sorted segment indices of the detections
+        n_positive: (s,) number of ground truths of every segment
+    Returns:
+        aps: (t, s)
+    """
+    s = len(n_positive)
+    starts = np.searchsorted(segments, np.arange(s))
+    ranks = np.arange(1, len(segments) + 1) - starts[segments]
+    acc_tp = np.cumsum(TP, axis=1)
+    acc_tp = acc_tp - np.concatenate([np.zeros((len(TP), 1)), acc_tp], axis=1)[:, starts[segments]]
+    precision = acc_tp / ranks
+
+    # Segmented suffix max: precision is in [0, 1], so offsetting every segment
+    # by twice its distance from the last one keeps the maxima inside it.
+    offsets = 2 * (s - 1 - segments)
+    precision = np.maximum.accumulate((precision + offsets)[:, ::-1], axis=1)[:, ::-1] - offsets
+
+    # Recall grows by 1 / n_positive at every true positive, so AP is the sum of
+    # the interpolated precision at the true positives divided by n_positive.
+    weights = TP * precision / n_positive[segments]
+    return np.stack([np.bincount(segments, weights=w, minlength=s) for w in weights])
+
+
+def compute_ap(dt_boxes, dt_scores, gt_boxes, iou_threshold):
+    r"""
+    Array version of `AP` for the detections and ground truths of one class.
+
+    Args:
+        dt_boxes: (n, 4) detected boxes in LTRB format
+        dt_scores: (n,) confidences of the detections, or None if `dt_boxes` is
+            already in descending order of confidence
+        gt_boxes: (m, 4) ground truth boxes in LTRB format
+        iou_threshold:
+    """
+    dt_boxes = _to_numpy(dt_boxes).reshape(-1, 4)
+    gt_boxes = _to_numpy(gt_boxes).reshape(-1, 4)
+    if dt_scores is not None:
+        dt_boxes = dt_boxes[np.argsort(-_to_numpy(dt_scores), kind='stable')]
+    n_positive = len(gt_boxes)
+    if len(dt_boxes) == 0 or n_positive == 0:
+        return 0
+
+    ious = _numpy.iou_mn(dt_boxes.astype(np.float64), gt_boxes.astype(np.float64))
+    j_max = ious.argmax(axis=1)
+    TP = match_detections(ious[np.arange(len(ious)), j_max], j_max, iou_threshold)
     acc_tp = np.cumsum(TP)
+    acc_fp = np.arange(1, len(TP) + 1) - acc_tp
     recall = acc_tp / n_positive
     precision = acc_tp / (acc_fp + acc_tp)
     ap = average_precision(recall, precision)[0]
     return ap
 
 
+def match_detections(iou_max, j_max, iou_threshold):
+    r"""
+    Greedy matching of ranked detections to ground truths. Every detection is
+    assigned to the ground truth it overlaps most, and is a true positive if the
+    IoU exceeds `iou_threshold` and no higher ranked detection took the same
+    ground truth.
+
+    Args:
+        iou_max: (n,) max IoU of the detections in rank order
+        j_max: (n,) indices of the ground truths with the max IoU
+        iou_threshold: a threshold or a (t,) array of thresholds
+    Returns:
+        TP: (n,) or (t, n) uint8 array of true positives
+    """
+    if np.ndim(iou_threshold):
+        return np.stack([match_detections(iou_max, j_max, t) for t in iou_threshold])
+    TP = np.zeros(len(iou_max), dtype=np.uint8)
+    hits = np.flatnonzero(iou_max > iou_threshold)
+    _, first = np.unique(j_max[hits], return_index=True)
+    TP[hits[first]] = 1
+    return TP
+
+
+def _iou_pairs(boxes1, boxes2):
+    lt = np.maximum(boxes1[:, :2], boxes2[:, :2])
+    rb = np.minimum(boxes1[:, 2:], boxes2[:, 2:])
+    wh = np.maximum(rb - lt, 0)
+    inter = wh[:, 0] * wh[:, 1]
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    return inter / (area1 + area2 - inter)
+
+
 def average_precision(recall, precision):
-    mrec = [0, *recall, 1]
-    mpre = [0, *precision, 0]
-    for i in range(len(mpre) - 1, 0, -1):
-        mpre[i - 1] = max(mpre[i - 1], mpre[i])
-    ii = []
-    for i in range(len(mrec) - 1):
-        if mrec[1:][i] != mrec[:-1][i]:
-            ii.append(i + 1)
-    ap = 0
-    for i in ii:
-        ap += np.sum((mrec[i] - mrec[i - 1]) * mpre[i])
+    mrec = np.concatenate([[0], recall, [1]])
+    mpre = np.concatenate([[0], precision, [0]])
+    mpre = np.maximum.accumulate(mpre[::-1])[::-1]
+    ii = np.flatnonzero(mrec[1:] != mrec[:-1]) + 1
+    ap = np.sum((mrec[ii] - mrec[ii - 1]) * mpre[ii])
     return ap, mpre[:-1], mrec[:-1], ii
+
+
+COCO_IOU_THRESHOLDS = np.linspace(.5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True)
+COCO_REC_THRESHOLDS = np.linspace(.0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True)
+COCO_AREA_RANGES = ((0 ** 2, 1e5 ** 2), (0 ** 2, 32 ** 2), (32 ** 2, 96 ** 2), (96 ** 2, 1e5 ** 2))
+COCO_MAX_DETS = (1, 10, 100)
+
+
+def _ranks(groups):
+    # Rank of every element inside its group, for sorted group indices.
+    return np.arange(len(groups)) - np.searchsorted(groups, groups, side='left')
+
+
+def coco_match(dt_boxes, dt_scores, dt_keys, gt_boxes, gt_areas, gt_crowds, gt_keys,
+               iou_thresholds=COCO_IOU_THRESHOLDS, area_ranges=COCO_AREA_RANGES, max_det=COCO_MAX_DETS[-1]):
+    r"""
+    Matching of COCOeval's `evaluateImg` for all (image, category) groups at once.
+    The greedy loop runs over the detection ranks, and every step handles all
+    groups, area ranges and IoU thresholds together.
+
+    Args:
+        dt_boxes: (n, 4) detected boxes in LTRB format
+        dt_scores: (n,) confidences of the detections
+        dt_keys: (n,) integer keys of the (image, category) groups of the detections
+        gt_boxes: (m, 4) ground truth boxes in LTRB format
+        gt_areas: (m,) areas of the ground truths, used for the area ranges
+        gt_crowds: (m,) whether the ground truths are crowd regions
+        gt_keys: (m,) integer keys of the (image, category) groups of the ground truths
+        iou_thresholds: (t,) IoU thresholds
+        area_ranges: (a, 2) area ranges
+        max_det: max number of detections of every group
+    Returns:
+        dt_indices: (k,) indices of the top `max_det` detections of every group
+        dt_ranks: (k,) ranks of them in their groups
+        dt_matched: (k, a, t) whether they are matched
+        dt_ignored: (k, a, t) whether they are ignored
+        gt_ignored: (m, a) whether the ground truths are ignored
+    """
+    thresholds = np.minimum(np.asarray(iou_thresholds, dtype=np.float64), 1 - 1e-10)
+    area_ranges = np.asarray(area_ranges, dtype=np.float64)
+    gt_crowds = np.asarray(gt_crowds, dtype=np.bool_)
+    gt_ignored = gt_crowds[:, None] | (gt_areas[:, None] < area_ranges[:, 0]) | (gt_areas[:, None] > area_ranges[:, 1])
+
+    keys = np.unique(np.concatenate([dt_keys, gt_keys]))
+    dt_indices = np.lexsort((-dt_scores, dt_keys))
+    dt_groups = np.searchsorted(keys, dt_keys[dt_indices])
+    dt_ranks = _ranks(dt_groups)
+    top = dt_ranks < max_det
+    dt_indices, dt_groups, dt_ranks = dt_indices[top], dt_groups[top], dt_ranks[top]
+    gt_indices = np.argsort(gt_keys, kind='stable')
+    gt_groups = np.searchsorted(keys, gt_keys[gt_indices])
+    gt_ranks = _ranks(gt_groups)
+
+    # Pad the groups to (num_groups, max_dets, 4) and (num_groups, max_gts, 4)
+    num_groups, a, t = len(keys), len(area_ranges), len(thresholds)
+    d = dt_ranks.max(initial=-1) + 1
+    g = gt_ranks.max(initial=-1) + 1
+    dts = np.zeros((num_groups, d, 4))
+    dts[dt_groups, dt_ranks] = dt_boxes[dt_indices]
+    gts = np.zeros((num_groups, g, 4))
+    gts[gt_groups, gt_ranks] = gt_boxes[gt_indices]
+    gt_valid = np.zeros((num_groups, g), dtype=np.bool_)
+    gt_valid[gt_groups, gt_ranks] = True
+    crowds = np.zeros((num_groups, g), dtype=np.bool_)
+    crowds[gt_groups, gt_ranks] = gt_crowds[gt_indices]
+    ignored = np.ones((num_groups, a, g), dtype=np.bool_)
+    ignored[gt_groups, :, gt_ranks] = gt_ignored[gt_indices]
+
+    # IoU of crowd regions is the intersection over the area of the detection
+    lt = np.maximum(dts[:, :, None, :2], gts[:, None, :, :2])
+    rb = np.minimum(dts[:, :, None, 2:], gts[:, None, :, 2:])
+    wh = np.maximum(rb - lt, 0)
+    inter = wh[..., 0] * wh[..., 1]
+    dt_areas = (dts[..., 2] - dts[..., 0]) * (dts[..., 3] - dts[..., 1])
+    gt_areas_ = (gts[..., 2] - gts[..., 0]) * (gts[..., 3] - gts[..., 1])
+    union = np.where(crowds[:, None, :], dt_areas[:, :, None], dt_areas[:, :, None] + gt_areas_[:, None, :] - inter)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ious = np.where(gt_valid[:, None, :], inter / union, -1)
+
+    matched = np.zeros((num_groups, d, a, t), dtype=np.bool_)
+    dt_ignored = np.zeros((num_groups, d, a, t), dtype=np.bool_)
+    if g > 0:
+        gt_matched = np.zeros((num_groups, a, t, g), dtype=np.bool_)
+        ignored4 = ignored[:, :, None, :]
+        for r in range(d):
+            # Only the groups where the detection overlaps enough can match
+            active = np.flatnonzero((ious[:, r] >= thresholds.min()).any(axis=1))
+            if len(active) == 0:
+                continue
+            iou = ious[active, r, None, None, :]
+            ig = ignored4[active]
+            candidate = (iou >= thresholds[:, None]) & (~gt_matched[active] | crowds[active, None, None, :])
+            # The ground truth with the max IoU, the last one on ties, and the
+            # ignored ones only if no other ground truth matches.
+            s1 = np.where(candidate & ~ig, iou, -1)
+            s2 = np.where(candidate & ig, iou, -1)
+            m1 = g - 1 - s1[..., ::-1].argmax(axis=-1)
+            m2 = g - 1 - s2[..., ::-1].argmax(axis=-1)
+            f1 = s1.max(axis=-1) >= 0
+            m = np.where(f1, m1, m2)
+            hit = f1 | (s2.max(axis=-1) >= 0)
+            matched[active, r] = hit
+            dt_ignored[active, r] = hit & np.take_along_axis(
+                np.broadcast_to(ig, candidate.shape), m[..., None], axis=-1)[..., 0]
+            ng, na, nt = np.nonzero(hit)
+            gt_matched[active[ng], na, nt, m[ng, na, nt]] = True
+
+    dt_matched = matched[dt_groups, dt_ranks]
+    dt_ignored = dt_ignored[dt_groups, dt_ranks]
+    dt_areas = dt_areas[dt_groups, dt_ranks]
+    out_of_range = (dt_areas[:, None] < area_ranges[:, 0]) | (dt_areas[:, None] > area_ranges[:, 1])
+    dt_ignored |= ~dt_matched & out_of_range[:, :, None]
+    return dt_indices, dt_ranks, dt_matched, dt_ignored, gt_ignored
+
+
+def coco_accumulate(dt_categories, dt_scores, dt_ranks, dt_matched, dt_ignored, n_positive,
+                    max_dets=COCO_MAX_DETS, rec_thresholds=COCO_REC_THRESHOLDS):
+    r"""
+    Precision and recall of COCOeval's `accumulate` from the matched detections.
+    The detections must be in image order, and in rank order inside every image.
+
+    Args:
+        dt_categories: (n,) category indices of the detections
+        dt_scores: (n,) confidences of the detections
+        dt_ranks: (n,) ranks of the detections in their (image, category) groups
+        dt_matched: (n, a, t) whether the detections are matched
+        dt_ignored: (n, a, t) whether the detections are ignored
+        n_positive: (k, a) number of ground truths which are not ignored
+        max_dets: (m,) max numbers of detections of every image
+        rec_thresholds: (r,) recall thresholds
+    Returns:
+        precision: (t, r, k, a, m), -1 for no ground truths
+        recall: (t, k, a, m), -1 for no ground truths
+    """
+    k, a = n_positive.shape
+    t = dt_matched.shape[2]
+    r = len(rec_thresholds)
+    precision = -np.ones((t, r, k, a, len(max_dets)))
+    recall = -np.ones((t, k, a, len(max_dets)))
+
+    order = np.lexsort((np.argsort(-dt_scores, kind='mergesort').argsort(), dt_categories))
+    categories = dt_categories[order]
+    starts = np.searchsorted(categories, np.arange(k + 1))
+    for ki in range(k):
+        inds = order[starts[ki]:starts[ki + 1]]
+        for mi, max_det in enumerate(max_dets):
+            sel = inds[dt_ranks[inds] < max_det]
+            nd = len(sel)
+            matched = dt_matched[sel].transpose(1, 2, 0)
+            ignored = dt_ignored[sel].transpose(1, 2, 0)
+            tps = np.cumsum(matched & ~ignored, axis=2, dtype=np.float64)
+            fps = np.cumsum(~matched & ~ignored, axis=2, dtype=np.float64)
+            for ai in range(a):
+                npig = n_positive[ki, ai]
+                if npig == 0:
+                    continue
+                rc = tps[ai] / npig
+                pr = tps[ai] / (fps[ai] + tps[ai] + np.spacing(1))
+                recall[:, ki, ai, mi] = rc[:, -1] if nd else 0
+
+                q = np.zeros((t, r))
+                if nd:
+                    pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+                    for ti in range(t):
+                        ri = np.searchsorted(rc[ti], rec_thresholds, side='left')
+                        valid = ri < nd
+                        q[ti, valid] = pr[ti, ri[valid]]
+                precision[:, :, ki, ai, mi] = q
+    return precision, recall
+
+
+def coco_summarize(precision, recall, iou_thresholds=COCO_IOU_THRESHOLDS, max_dets=COCO_MAX_DETS):
+    r"""
+    The 12 numbers of COCOeval's `summarize` for bounding boxes, with the area
+    ranges all, small, medium and large.
+    """
+    def mean(s):
+        s = s[s > -1]
+        return np.mean(s) if len(s) else -1
+
+    def ap(area=0, iou=None):
+        s = precision[..., area, -1]
+        if iou is not None:
+            s = s[np.isclose(iou_thresholds, iou)]
+        return mean(s)
+
+    def ar(area=0, m=-1):
+        return mean(recall[:, :, area, m])
+
+    return np.array([
+        ap(), ap(iou=.5), ap(iou=.75), ap(1), ap(2), ap(3),
+        ar(m=0), ar(m=1), ar(m=2), ar(1), ar(2), ar(3),
+    ])
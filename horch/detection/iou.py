@@ -1,6 +1,7 @@
 import torch
 from horch.detection.bbox import BBox, transform_bboxes
-from horch import _C
+from horch._backend import _C
+from horch._fallback import _C as _fallback
 
 
 def iou_1m(box, boxes, format=BBox.LTRB):
@@ -125,3 +126,144 @@ def iou_mn(boxes1, boxes2):
         ious: (m, n)
     """
     return IoUMN.apply(boxes1, boxes2)
+
+
+IOU_KINDS = {
+    'iou': 0,
+    'giou': 1,
+    'diou': 2,
+    'ciou': 3,
+}
+
+
+class IoUB11(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, boxes1, boxes2, kind):
+        ious = _C.iou_b11_forward(boxes1, boxes2, kind)
+        ctx.save_for_backward(boxes1, boxes2)
+        ctx.kind = kind
+        return ious
+
+    @staticmethod
+    def backward(ctx, dious):
+        dboxes1, dboxes2 = _C.iou_b11_backward(
+            dious.contiguous(), *ctx.saved_tensors, ctx.kind)
+        return dboxes1, dboxes2, None
+
+
+def _native_on(tensor):
+    # Whether the native ops can run on the device of the tensor.
+    return tensor.device.type == 'cpu' or (tensor.is_cuda and getattr(_C, 'with_cuda', False))
+
+
+def iou_b11_fused(boxes1, boxes2, kind='iou'):
+    r"""
+    Calculates batch one-to-one ious or their generalized variants by corners([xmin, ymin, xmax, ymax])
+    in a single native kernel, or with PyTorch ops if the extension is not built for the device.
+
+    Parameters
+    ----------
+    boxes1: torch.Tensor
+        Tensor of shape (..., 4)
+    boxes2: torch.Tensor
+        Tensor of shape (..., 4)
+    kind: str
+        `iou`, `giou`, `diou` or `ciou`.
+
+    Returns
+    -------
+    ious : torch.Tensor
+        Tensor of same shape as `boxes` eliminating the last dim.
+    """
+    if kind not in IOU_KINDS:
+        raise ValueError("kind must be one of %s" % list(IOU_KINDS))
+    boxes1, boxes2 = torch.broadcast_tensors(boxes1, boxes2)
+    size = boxes1.size()[:-1]
+    boxes1, boxes2 = boxes1.reshape(-1, 4).contiguous(), boxes2.reshape(-1, 4).contiguous()
+    if _native_on(boxes1):
+        ious = IoUB11.apply(boxes1, boxes2, IOU_KINDS[kind])
+    else:
+        ious = _fallback.iou_b11_forward(boxes1, boxes2, IOU_KINDS[kind])
+    return ious.view(size)
+
+
+def giou_b11(boxes1, boxes2):
+    r"""
+    Calculates batch one-to-one generalized ious by corners([xmin, ymin, xmax, ymax]).
+
+    Parameters
+    ----------
+    boxes1: torch.Tensor
+        Tensor of shape (..., 4)
+    boxes2: torch.Tensor
+        Tensor of shape (..., 4)
+
+    Returns
+    -------
+    gious : torch.Tensor
+        Tensor of same shape as `boxes` eliminating the last dim.
+    """
+    return iou_b11_fused(boxes1, boxes2, 'giou')
+
+
+def diou_b11(boxes1, boxes2):
+    r"""
+    Calculates batch one-to-one distance ious by corners([xmin, ymin, xmax, ymax]).
+
+    Parameters
+    ----------
+    boxes1: torch.Tensor
+        Tensor of shape (..., 4)
+    boxes2: torch.Tensor
+        Tensor of shape (..., 4)
+
+    Returns
+    -------
+    dious : torch.Tensor
+        Tensor of same shape as `boxes` eliminating the last dim.
+    """
+    return iou_b11_fused(boxes1, boxes2, 'diou')
+
+
+def ciou_b11(boxes1, boxes2):
+    r"""
+    Calculates batch one-to-one complete ious by corners([xmin, ymin, xmax, ymax]).
+
+    Parameters
+    ----------
+    boxes1: torch.Tensor
+        Tensor of shape (..., 4)
+    boxes2: torch.Tensor
+        Tensor of shape (..., 4)
+
+    Returns
+    -------
+    cious : torch.Tensor
+        Tensor of same shape as `boxes` eliminating the last dim.
+    """
+    return iou_b11_fused(boxes1, boxes2, 'ciou')
+
+
+# Matchers switch to `iou_mn_reduce` when the IoU matrix would have more elements.
+MAX_DENSE_IOU_SIZE = 1 << 24
+
+
+def iou_mn_reduce(boxes1, boxes2, threshold=0.5, tile_size=4096):
+    r"""
+    Calculates the reductions of IoU between boxes1 of size m and boxes2 of size n
+    used by matchers tile by tile, without materializing the (m, n) IoU matrix.
+
+    Args:
+        boxes1: (m, 4)
+        boxes2: (n, 4)
+        threshold: IoU threshold for `counts`.
+        tile_size: number of boxes in boxes2 processed at a time.
+    Returns:
+        max_ious: (n,) max IoU of every box in boxes2 with boxes1.
+        indices: (n,) index of the box in boxes1 with max IoU for every box in boxes2.
+        gt_indices: (m,) index of the box in boxes2 with max IoU for every box in boxes1.
+        counts: (n,) number of boxes in boxes1 with IoU >= threshold for every box in boxes2.
+    """
+    if boxes1.device.type == 'cpu':
+        return _C.iou_mn_reduce(boxes1.contiguous(), boxes2.contiguous(), threshold, tile_size)
+    return _fallback.iou_mn_reduce(boxes1, boxes2, threshold, tile_size)
@@ -1,4 +1,6 @@
-from horch import _C
+import torch
+
+from horch._backend import _C
 
 
 def nms(boxes, scores, iou_threshold=0.5):
@@ -13,7 +15,64 @@ def nms(boxes, scores, iou_threshold=0.5):
     return _C.nms(boxes, scores, iou_threshold)
 
 
-def soft_nms_cpu(boxes, scores, iou_threshold=0.5, topk=100, min_score=0.01):
+def batched_nms(boxes, scores, idxs=None, iou_threshold=0.5):
+    r"""
+    Performs nms independently for every group of boxes in a single call,
+    e.g. boxes of different images in a batch.
+
+    Args:
+        boxes (tensor of shape `(N, 4)` or `(B, N, 4)`): [xmin, ymin, xmax, ymax]
+        scores: Same length as boxes, (N,) or (B, N)
+        idxs: Group indices of shape (N,) for flat boxes (all boxes are in one group if
+            not provided), or mask of valid boxes of shape (B, N) for padded boxes (all
+            boxes are valid if not provided).
+        iou_threshold (float): Default value is 0.5
+    Returns:
+        indices: (K,) for flat boxes, grouped by `idxs` and sorted by scores in every group.
+            For padded boxes, list of B tensors of indices into every image.
+    """
+    if boxes.dim() == 2:
+        if idxs is None:
+            idxs = scores.new_zeros(scores.size(), dtype=torch.long)
+        return _C.batched_nms(boxes, scores, idxs, iou_threshold)
+
+    batch_size = boxes.size(0)
+    if idxs is None:
+        idxs = torch.ones_like(scores, dtype=torch.uint8)
+    batch_idxs, indices = torch.nonzero(idxs).t()
+    keep = _C.batched_nms(boxes[batch_idxs, indices], scores[batch_idxs, indices], batch_idxs, iou_threshold)
+    counts = torch.bincount(batch_idxs[keep], minlength=batch_size)
+    return list(indices[keep].split(counts.tolist()))
+
+
+def multiclass_nms(boxes, scores, labels, iou_threshold=0.5, max_per_class=None, max_total=100):
+    r"""
+    Performs nms for every class in a single pass over all (box, class) candidates.
+
+    Args:
+        boxes (tensor of shape `(N, 4)`): [xmin, ymin, xmax, ymax]
+        scores: Same length as boxes
+        labels: Class indices of boxes
+        iou_threshold (float): Default value is 0.5
+        max_per_class (int): Keep at most `max_per_class` boxes for every class
+        max_total (int): Keep at most `max_total` boxes for all classes
+    Returns:
+        indices: sorted by scores in descending order
+    """
+    keep = batched_nms(boxes, scores, labels, iou_threshold)
+    if max_per_class:
+        kept_labels = labels[keep]
+        counts = torch.bincount(kept_labels)
+        starts = torch.cumsum(counts, dim=0) - counts
+        ranks = torch.arange(len(keep), device=keep.device) - starts[kept_labels]
+        keep = keep[ranks < max_per_class]
+    keep = keep[scores[keep].argsort(descending=True)]
+    if max_total:
+        keep = keep[:max_total]
+    return keep
+
+
+def soft_nms_cpu(boxes, scores, iou_threshold=0.5, topk=100, min_score=0.01, algorithm='linear'):
     r"""
     Args:
         boxes (tensor of shape `(N, 4)`): [xmin, ymin, xmax, ymax]
@@ -21,14 +80,20 @@ def soft_nms_cpu(boxes, scores, iou_threshold=0.5, topk=100, min_score=0.01):
         iou_threshold (float): Default value is 0.5
         topk (int): Topk to remain
         min_score (float): Filter bboxes whose score is less than it to speed up
+        algorithm (str): `linear` scans all boxes for every pick, `heap` keeps
+            boxes in a max-heap and only visits boxes overlapping the picked one,
+            which is much faster for many boxes. Both give the same result.
     Returns:
         indices:
     """
     topk = min(len(boxes), topk)
+    if algorithm == 'heap':
+        return _C.soft_nms_heap(boxes, scores, iou_threshold, topk, min_score)
     return _C.soft_nms(boxes, scores, iou_threshold, topk, min_score)
 
 
-def softer_nms_cpu(boxes, scores, vars, iou_threshold=0.5, topk=100, sigma=0.01, min_score=0.01):
+def softer_nms_cpu(boxes, scores, vars, iou_threshold=0.5, topk=100, sigma=0.01, min_score=0.01,
+                   algorithm='linear'):
     r"""
     Args:
         boxes (tensor of shape `(N, 4)`): [xmin, ymin, xmax, ymax]
@@ -36,8 +101,124 @@ def softer_nms_cpu(boxes, scores, vars, iou_threshold=0.5, topk=100, sigma=0.01,
         iou_threshold (float): Default value is 0.5
         topk (int): Topk to remain
         min_score (float): Filter bboxes whose score is less than it to speed up
+        algorithm (str): `linear` or `heap`, see `soft_nms_cpu`.
     Returns:
         indices:
     """
     topk = min(len(boxes), topk)
+    if algorithm == 'heap':
+        return _C.softer_nms_heap(boxes, scores, vars, iou_threshold, topk, sigma, min_score)
     return _C.softer_nms(boxes, scores, vars, iou_threshold, topk, sigma, min_score)
+
+
+def decode_and_nms(loc_p, cls_p, anchors, conf_threshold=0.01, iou_threshold=0.5, topk=100,
+                   conf_strategy='softmax', nms_method='soft', min_score=0.01, max_per_class=None):
+    r"""
+    Scores, thresholds and decodes the predictions of one image and runs nms in a single
+    native call, without intermediate tensors of all anchors.
+
+    Args:
+        loc_p (tensor of shape `(A, 4)`): Predicted targets
+        cls_p (tensor of shape `(A, C)`): Class logits (with background)
+        anchors (tensor of shape `(A, 4)`): Anchors in XYWH format
+        conf_threshold (float): Boxes with confidence not higher than it are dropped
+        iou_threshold (float): Default value is 0.5
+        topk (int): Maximum number of detections
+        conf_strategy (str): `softmax` or `sigmoid`
+        nms_method (str): `nms`, `multiclass` or `soft`
+        min_score (float): Minimal score of soft nms
+        max_per_class (int): Maximum number of detections of every class for `multiclass` nms
+    Returns:
+        boxes: [xmin, ymin, xmax, ymax] of shape (K, 4)
+        scores: (K,), sorted in descending order except for soft nms
+        labels: Class indices (without background) of shape (K,)
+    """
+    return _C.decode_and_nms(loc_p, cls_p, anchors, conf_strategy, conf_threshold, nms_method,
+                             iou_threshold, topk or 0, min_score or 0, max_per_class or 0)
+
+
+def _sorted_ious(boxes, scores, mask):
+    # Pairwise IoU of the valid boxes of every image sorted by scores in descending order,
+    # only above the diagonal, i.e. between every box and the lower scoring ones.
+    order = scores.masked_fill(~mask, float('-inf')).argsort(dim=1, descending=True)
+    boxes = boxes.gather(1, order[..., None].expand(-1, -1, 4))
+    mask = mask.gather(1, order)
+    x1, y1, x2, y2 = boxes.unbind(dim=2)
+    w = torch.min(x2[:, :, None], x2[:, None, :]).sub_(torch.max(x1[:, :, None], x1[:, None, :])).clamp_(min=0)
+    h = torch.min(y2[:, :, None], y2[:, None, :]).sub_(torch.max(y1[:, :, None], y1[:, None, :])).clamp_(min=0)
+    inter = w.mul_(h)
+    areas = (x2 - x1) * (y2 - y1)
+    ious = inter / (areas[:, :, None] + areas[:, None, :] - inter)
+    ious = ious.masked_fill_(~(mask[:, :, None] & mask[:, None, :]), 0).triu_(1)
+    return ious, order, mask
+
+
+def _padded(boxes, scores, mask):
+    if boxes.dim() == 2:
+        boxes, scores = boxes[None], scores[None]
+        mask = mask[None] if mask is not None else None
+    if mask is None:
+        mask = torch.ones_like(scores, dtype=torch.bool)
+    return boxes, scores, mask
+
+
+def matrix_nms(boxes, scores, mask=None, kernel='gaussian', sigma=2.0):
+    r"""
+    Matrix nms of SOLOv2. Instead of removing boxes one by one, decays the score of every box
+    by its IoU with the higher scoring boxes, computed for all boxes (and images) at once.
+
+    Args:
+        boxes (tensor of shape `(N, 4)` or `(B, N, 4)`): [xmin, ymin, xmax, ymax]
+        scores: Same length as boxes, (N,) or (B, N)
+        mask: Mask of valid boxes of shape (B, N) for padded boxes (all boxes are valid if not provided).
+        kernel (str): `gaussian` or `linear`
+        sigma (float): Sigma of the gaussian kernel
+    Returns:
+        scores: Decayed scores of the same shape as `scores`, 0 for invalid boxes.
+    """
+    assert kernel in ['gaussian', 'linear'], "kernel must be gaussian or linear"
+    squeeze = boxes.dim() == 2
+    boxes, scores, mask = _padded(boxes, scores, mask)
+    decayed = torch.zeros_like(scores)
+    if scores.size(1) != 0:
+        ious, order, sorted_mask = _sorted_ious(boxes, scores, mask)
+        # Max IoU of every box with the higher scoring ones, i.e. how much it is suppressed itself
+        max_ious = ious.max(dim=1)[0][:, :, None]
+        if kernel == 'gaussian':
+            decay = torch.exp(-sigma * (ious ** 2 - max_ious ** 2))
+        else:
+            decay = (1 - ious) / (1 - max_ious).clamp_(min=1e-6)
+        decay = decay.min(dim=1)[0]
+        decayed.scatter_(1, order, (scores.gather(1, order) * decay).masked_fill_(~sorted_mask, 0))
+    return decayed[0] if squeeze else decayed
+
+
+def cluster_nms(boxes, scores, mask=None, iou_threshold=0.5):
+    r"""
+    Cluster nms. Suppresses boxes with the IoU matrix of the boxes kept so far until the kept
+    boxes do not change, computed for all boxes (and images) at once. The result is the same
+    as `nms`, in a few iterations instead of one step for every box.
+
+    Args:
+        boxes (tensor of shape `(N, 4)` or `(B, N, 4)`): [xmin, ymin, xmax, ymax]
+        scores: Same length as boxes, (N,) or (B, N)
+        mask: Mask of valid boxes of shape (B, N) for padded boxes (all boxes are valid if not provided).
+        iou_threshold (float): Default value is 0.5
+    Returns:
+        keep: Mask of kept boxes of the same shape as `scores`.
+    """
+    squeeze = boxes.dim() == 2
+    boxes, scores, mask = _padded(boxes, scores, mask)
+    keep = torch.zeros_like(mask)
+    if scores.size(1) != 0:
+        ious, order, sorted_mask = _sorted_ious(boxes, scores, mask)
+        overlaps = (ious >= iou_threshold).to(ious.dtype)
+        sorted_keep = torch.ones_like(sorted_mask)
+        for _ in range(scores.size(1)):
+            # Boxes not overlapping with any kept box with higher score are kept
+            new_keep = torch.bmm(sorted_keep[:, None, :].to(ious.dtype), overlaps)[:, 0] == 0
+            if torch.equal(new_keep, sorted_keep):
+                break
+            sorted_keep = new_keep
+        keep.scatter_(1, order, sorted_keep & sorted_mask)
+    return keep[0] if squeeze else keep
@@ -11,8 +11,11 @@ from horch import one_hot
 from horch.nn.loss import focal_loss2, loc_kl_loss
 
 from horch.detection.bbox import BBox
-from horch.detection.iou import iou_mn
-from horch.detection.nms import nms, soft_nms_cpu, softer_nms_cpu
+from horch.detection.anchor_cache import is_grid, image_size
+from horch.detection.iou import iou_mn, iou_mn_reduce, MAX_DENSE_IOU_SIZE
+from horch.detection.nms import decode_and_nms
+from horch.detection.detections import Detections
+from horch.detection.postprocess import select_candidates, batched_detections
 
 
 def coords_to_target(gt_box, anchors):
@@ -27,42 +30,159 @@ def target_to_coords(loc_t, anchors):
     return loc_t
 
 
-@curry
-def match_anchors_flat(anns, a_xywh, a_ltrb, pos_thresh=0.5, neg_thresh=None,
-                       get_label=lambda x: x['category_id'], debug=False):
-    num_anchors = len(a_xywh)
-    loc_t = a_xywh.new_zeros(num_anchors, 4)
-    cls_t = loc_t.new_zeros(num_anchors, dtype=torch.long)
+def pad_gts(image_gts, get_label=lambda x: x['category_id'], dtype=torch.float32, device='cpu'):
+    r"""
+    Pad ground truths of a batch of images to the same number of boxes.
 
-    if len(anns) == 0:
-        target = [loc_t, cls_t]
-        if neg_thresh:
-            target.append(loc_t.new_zeros(num_anchors, dtype=torch.uint8))
-        return target
+    Parameters
+    ----------
+    image_gts : List[List[dict]]
+        Annotations of every image with `bbox` in LTWH format.
+    get_label : function
+        Function to extract label from annotations.
 
-    bboxes = loc_t.new_tensor([ann['bbox'] for ann in anns])
-    bboxes = BBox.convert(bboxes, format=BBox.LTWH, to=BBox.XYWH, inplace=True)
-    labels = loc_t.new_tensor([get_label(ann) for ann in anns], dtype=torch.long)
+    Returns
+    -------
+    gt_boxes : torch.Tensor
+        Boxes in XYWH format of shape `(B, G_max, 4)`, zero for padding.
+    gt_labels : torch.Tensor
+        Labels of shape `(B, G_max)`, zero for padding.
+    gt_mask : torch.Tensor
+        Bool tensor of shape `(B, G_max)`, true for real boxes.
+    """
+    batch_size = len(image_gts)
+    num_gts = [len(anns) for anns in image_gts]
+    max_gts = max(num_gts, default=0)
+    gt_boxes = torch.zeros(batch_size, max_gts, 4, dtype=dtype)
+    gt_labels = torch.zeros(batch_size, max_gts, dtype=torch.long)
+    gt_mask = torch.arange(max_gts)[None, :] < torch.tensor(num_gts, dtype=torch.long)[:, None]
+    anns = [ann for anns in image_gts for ann in anns]
+    if anns:
+        gt_boxes[gt_mask] = torch.tensor([ann['bbox'] for ann in anns], dtype=dtype)
+        gt_labels[gt_mask] = torch.tensor([get_label(ann) for ann in anns], dtype=torch.long)
+        BBox.convert(gt_boxes, format=BBox.LTWH, to=BBox.XYWH, inplace=True)
+    return gt_boxes.to(device), gt_labels.to(device), gt_mask.to(device)
+
+
+def _reduce_ious(gt_boxes_ltrb, gt_mask, a_ltrb, threshold, max_dense_size, tiled=None):
+    # Per anchor max IoU and its ground truth, per ground truth best anchor.
+    batch_size, max_gts = gt_mask.size()
+    num_anchors = a_ltrb.size(0)
+    max_ious = a_ltrb.new_empty(batch_size, num_anchors)
+    assign = gt_mask.new_zeros(batch_size, num_anchors, dtype=torch.long)
+    best = gt_mask.new_zeros(batch_size, max_gts, dtype=torch.long)
+    chunk_size = max_dense_size // max(max_gts * num_anchors, 1)
+    if tiled is None:
+        tiled = a_ltrb.device.type == 'cpu'
+    if chunk_size == 0 or tiled:
+        # The native kernel reduces ious tile by tile in one pass, which beats materializing
+        # them on CPU and is required when a single image is too large.
+        for i in range(batch_size):
+            n = int(gt_mask[i].sum())
+            if n == 0:
+                max_ious[i] = -1
+                continue
+            max_ious[i], assign[i], best[i, :n], _ = iou_mn_reduce(
+                gt_boxes_ltrb[i, :n], a_ltrb, threshold)
+        return max_ious, assign, best
+    for start in range(0, batch_size, chunk_size):
+        end = start + chunk_size
+        boxes = gt_boxes_ltrb[start:end]
+        ious = iou_mn(boxes.reshape(-1, 4), a_ltrb).view(boxes.size(0), max_gts, num_anchors)
+        ious.masked_fill_(~gt_mask[start:end, :, None], -1)
+        max_ious[start:end], assign[start:end] = ious.max(dim=1)
+        best[start:end] = ious.argmax(dim=2)
+    return max_ious, assign, best
+
+
+def match_anchors_batch(gt_boxes, gt_labels, gt_mask, a_xywh, a_ltrb, pos_thresh=0.5, neg_thresh=None,
+                        force_last=True, max_dense_size=MAX_DENSE_IOU_SIZE):
+    r"""
+    Match anchors with padded ground truths of a whole batch at once.
 
-    bboxes_ltrb = BBox.convert(bboxes, BBox.XYWH, BBox.LTRB)
-    ious = iou_mn(bboxes_ltrb, a_ltrb)
+    Every anchor with max IoU over `pos_thresh` is assigned to the ground truth with max IoU,
+    and the best anchor of every ground truth is always positive. If several ground truths
+    share a best anchor, the last one wins.
 
-    max_ious, indices = ious.max(dim=1)
-    if debug:
-        print(max_ious.tolist())
-    loc_t[indices] = coords_to_target(bboxes, a_xywh[indices])
-    cls_t[indices] = labels
+    Parameters
+    ----------
+    gt_boxes : torch.Tensor
+        Ground truth boxes in XYWH format of shape `(B, G_max, 4)`.
+    gt_labels : torch.Tensor
+        Labels of shape `(B, G_max)`.
+    gt_mask : torch.Tensor
+        Bool tensor of shape `(B, G_max)`, false for padding.
+    a_xywh : torch.Tensor
+        Anchors in XYWH format of shape `(N, 4)`.
+    a_ltrb : torch.Tensor
+        Anchors in LTRB format of shape `(N, 4)`.
+    pos_thresh : float
+        IOU threshold of positive anchors.
+    neg_thresh : float
+        If provided, non-positive anchors whose max IoU is at least neg_thresh are ignored.
+    force_last : bool
+        Whether the best anchor of a ground truth overrides the assignment by threshold.
+        Otherwise it only applies to anchors not positive by threshold.
+    max_dense_size : int
+        Maximum number of elements of the IoU tensor of a chunk of images.
+
+    Returns
+    -------
+    loc_t : torch.Tensor
+        Location targets of shape `(B, N, 4)`.
+    cls_t : torch.Tensor
+        Class targets of shape `(B, N)`, 0 for background.
+    ignore : torch.Tensor or None
+        Bool tensor of shape `(B, N)` if `neg_thresh` is provided.
+    """
+    batch_size, max_gts = gt_mask.size()
+    num_anchors = a_xywh.size(0)
+    loc_t = a_xywh.new_zeros(batch_size, num_anchors, 4)
+    cls_t = gt_labels.new_zeros(batch_size, num_anchors)
+    ignore = None
+    if neg_thresh:
+        ignore = gt_mask.new_zeros(batch_size, num_anchors)
+    if max_gts == 0:
+        return loc_t, cls_t, ignore
+
+    gt_boxes_ltrb = BBox.convert(gt_boxes, BBox.XYWH, BBox.LTRB)
+    max_ious, assign, best = _reduce_ious(
+        gt_boxes_ltrb, gt_mask, a_ltrb, neg_thresh or pos_thresh, max_dense_size)
+    pos = max_ious > pos_thresh
+
+    gt_indices = torch.arange(max_gts, device=gt_mask.device).expand(batch_size, max_gts)
+    gt_indices = gt_indices.masked_fill(~gt_mask, -1)
+    forced = gt_indices.new_full((batch_size, num_anchors), -1)
+    forced.scatter_reduce_(1, best, gt_indices, reduce='amax')
+    forced_pos = forced >= 0
+    override = forced_pos if force_last else forced_pos & ~pos
+    assign = torch.where(override, forced, assign)
+    pos |= forced_pos
+
+    b, i = pos.nonzero(as_tuple=True)
+    g = assign[b, i]
+    loc_t[b, i] = coords_to_target(gt_boxes[b, g], a_xywh[i])
+    cls_t[b, i] = gt_labels[b, g]
 
-    pos = ious > pos_thresh
-    for ipos, bbox, label in zip(pos, bboxes, labels):
-        loc_t[ipos] = coords_to_target(bbox, a_xywh[ipos])
-        cls_t[ipos] = label
+    if neg_thresh:
+        ignore = ~pos & (max_ious >= neg_thresh)
+    return loc_t, cls_t, ignore
 
-    target = [loc_t, cls_t]
 
+@curry
+def match_anchors_flat(anns, a_xywh, a_ltrb, pos_thresh=0.5, neg_thresh=None,
+                       get_label=lambda x: x['category_id'], debug=False,
+                       max_dense_size=MAX_DENSE_IOU_SIZE):
+    gt_boxes, gt_labels, gt_mask = pad_gts([anns], get_label, a_xywh.dtype, a_xywh.device)
+    if debug and len(anns) != 0:
+        ious = iou_mn(BBox.convert(gt_boxes[0], BBox.XYWH, BBox.LTRB), a_ltrb)
+        print(ious.max(dim=1)[0].tolist())
+    loc_t, cls_t, ignore = match_anchors_batch(
+        gt_boxes, gt_labels, gt_mask, a_xywh, a_ltrb, pos_thresh, neg_thresh,
+        force_last=False, max_dense_size=max_dense_size)
+    target = [loc_t[0], cls_t[0]]
     if neg_thresh:
-        ignore = (cls_t == 0) & ((ious >= neg_thresh).sum(dim=0) != 0)
-        target.append(ignore)
+        target.append(ignore[0])
     return target
 
 
@@ -78,8 +198,9 @@ class MatchAnchors:
 
     Parameters
     ----------
-    anchors : torch.Tensor or List[torch.Tensor]
-        List of anchor boxes of shape `(lx, ly, #anchors, 4)`.
+    anchors : torch.Tensor or List[torch.Tensor] or MlvlAnchors or MlvlPriors
+        List of anchor boxes of shape `(lx, ly, #anchors, 4)`, or an anchor grid from
+        `horch.detection.anchor_cache` to look anchors up by the size of every image.
     pos_thresh : float
         IOU threshold of positive anchors.
     neg_thresh : float
@@ -87,23 +208,64 @@ class MatchAnchors:
         lower than neg_thresh will be considered negative. Other non-positive anchors will be ignored.
     get_label : function
         Function to extract label from annotations.
+    max_dense_size : int
+        If #ground truth boxes * #anchors exceeds it, ious are reduced tile by tile
+        instead of materializing the full iou matrix.
+
+    Called as a transform `(img, anns)` it matches one image. `batch(image_gts)` matches a
+    whole batch at once and returns stacked targets of shape `(B, #anchors, ...)`.
     """
 
     def __init__(self, anchors, pos_thresh=0.5, neg_thresh=None,
-                 get_label=get('category_id'), debug=False):
-        self.anchors_xywh = flatten(anchors)
-        self.anchors_ltrb = BBox.convert(self.anchors_xywh, BBox.XYWH, BBox.LTRB)
+                 get_label=get('category_id'), debug=False, max_dense_size=MAX_DENSE_IOU_SIZE):
+        if is_grid(anchors):
+            self.anchors = anchors
+        else:
+            self.anchors = None
+            self.anchors_xywh = flatten(anchors)
+            self.anchors_ltrb = BBox.convert(self.anchors_xywh, BBox.XYWH, BBox.LTRB)
         self.pos_thresh = pos_thresh
         self.neg_thresh = neg_thresh
         self.get_label = get_label
         self.debug = debug
+        self.max_dense_size = max_dense_size
+
+    def _get_anchors(self, size, device='cpu'):
+        if self.anchors is None:
+            return self.anchors_xywh, self.anchors_ltrb
+        return (self.anchors(size, device=device, format=BBox.XYWH),
+                self.anchors(size, device=device, format=BBox.LTRB))
 
     def __call__(self, img, anns):
+        a_xywh, a_ltrb = self._get_anchors(image_size(img) if self.anchors is not None else None)
         target = match_anchors_flat(
-            anns, self.anchors_xywh, self.anchors_ltrb,
-            self.pos_thresh, self.neg_thresh, self.get_label, self.debug)
+            anns, a_xywh, a_ltrb,
+            self.pos_thresh, self.neg_thresh, self.get_label, self.debug, self.max_dense_size)
         return img, target
 
+    def batch(self, image_gts, size=None, device='cpu'):
+        r"""
+        Match a batch of images of the same size.
+
+        Parameters
+        ----------
+        image_gts : List[List[dict]]
+            Annotations of every image.
+        size : tuple of int
+            (width, height) of the inputs, required if `anchors` is an anchor grid.
+        device : torch.device or str
+            Device of the targets when `anchors` is an anchor grid.
+        """
+        a_xywh, a_ltrb = self._get_anchors(size, device)
+        gt_boxes, gt_labels, gt_mask = pad_gts(image_gts, self.get_label, a_xywh.dtype, a_xywh.device)
+        loc_t, cls_t, ignore = match_anchors_batch(
+            gt_boxes, gt_labels, gt_mask, a_xywh, a_ltrb, self.pos_thresh, self.neg_thresh,
+            force_last=False, max_dense_size=self.max_dense_size)
+        target = [loc_t, cls_t]
+        if self.neg_thresh:
+            target.append(ignore)
+        return target
+
 
 class MultiBoxLoss(nn.Module):
 
@@ -226,66 +388,123 @@ class KLFocalLoss(nn.Module):
         return loss
 
 
-@curry
-def anchor_based_inference(
+def _fused_batch_inference(loc_p, cls_p, anchors, conf_threshold, iou_threshold, topk,
+                           conf_strategy, nms_method, min_score, max_per_class, mask):
+    dets = []
+    for i in range(loc_p.size(0)):
+        i_loc_p, i_cls_p = loc_p[i], cls_p[i]
+        i_anchors = anchors[i] if anchors.dim() == 3 else anchors
+        if mask is not None:
+            indices = torch.nonzero(mask[i]).squeeze(1)
+            i_loc_p, i_cls_p, i_anchors = i_loc_p[indices], i_cls_p[indices], i_anchors[indices]
+        boxes, scores, labels = decode_and_nms(
+            i_loc_p.cpu(), i_cls_p.cpu(), i_anchors.cpu(), conf_threshold, iou_threshold, topk,
+            conf_strategy, nms_method, min_score, max_per_class)
+        boxes = BBox.convert(boxes, format=BBox.LTRB, to=BBox.LTWH, inplace=True)
+        dets.append(Detections.single(boxes, scores, labels + 1))
+    return Detections.cat(dets)
+
+
+def anchor_based_batch_inference(
         loc_p, cls_p, anchors, conf_threshold=0.01,
         iou_threshold=0.5, topk=100,
-        conf_strategy='softmax', nms_method='soft', min_score=None):
-    bboxes = loc_p
-    if conf_strategy == 'softmax':
-        scores = torch.softmax(cls_p, dim=1)
-    else:
-        scores = torch.sigmoid_(cls_p)
-    scores, labels = torch.max(scores[:, 1:], dim=1)
-
-    if conf_threshold > 0:
-        pos = scores > conf_threshold
-        scores = scores[pos]
-        labels = labels[pos]
-        bboxes = bboxes[pos]
-        anchors = anchors[pos]
-
-    bboxes = target_to_coords(bboxes, anchors)
-
-    bboxes = BBox.convert(
-        bboxes, format=BBox.XYWH, to=BBox.LTRB, inplace=True).cpu()
-    scores = scores.cpu()
+        conf_strategy='softmax', nms_method='soft', min_score=None, max_per_class=None, mask=None,
+        fused=False):
+    r"""
+    Decode, score and filter the predictions of a batch of images at once, and run nms over
+    the candidates of all images.
 
-    if nms_method == 'soft':
+    Parameters
+    ----------
+    loc_p : torch.Tensor
+        Predicted targets of shape `(B, A, 4)`.
+    cls_p : torch.Tensor
+        Class logits (with background) of shape `(B, A, C)`.
+    anchors : torch.Tensor
+        Anchors in XYWH format of shape `(A, 4)`, or `(B, A, 4)` for anchors of every image.
+    mask : torch.Tensor
+        Optional mask of valid predictions of shape `(B, A)`.
+    fused : bool
+        Whether to decode and run nms image by image with the native `decode_and_nms` op,
+        which avoids the intermediate tensors of all anchors. Faster on CPU for small batches.
+        Only `nms`, `multiclass` and `soft` nms are fused.
+
+    Returns
+    -------
+    Detections
+    """
+    multiclass = nms_method == 'multiclass'
+    if nms_method in ['soft', 'matrix']:
         min_score = min_score or conf_threshold
-        indices = soft_nms_cpu(
-            bboxes, scores, iou_threshold, topk, min_score=min_score)
+    elif nms_method not in ['multiclass', 'cluster']:
+        nms_method = 'nms'
+    if fused:
+        return _fused_batch_inference(
+            loc_p, cls_p, anchors, conf_threshold, iou_threshold, topk,
+            conf_strategy, nms_method, min_score, max_per_class, mask)
+
+    if conf_strategy == 'softmax':
+        scores = torch.softmax(cls_p, dim=-1)
     else:
-        indices = nms(bboxes, scores, iou_threshold)
-        scores = scores[indices]
-        labels = labels[indices]
-        bboxes = bboxes[indices]
-        if scores.size(0) > topk:
-            indices = scores.topk(topk)[1]
-        else:
-            indices = range(scores.size(0))
+        scores = torch.sigmoid(cls_p)
+    batch_idxs, indices, scores, labels = select_candidates(
+        scores[..., 1:], conf_threshold, multiclass, mask)
 
-    bboxes = BBox.convert(
-        bboxes, format=BBox.LTRB, to=BBox.LTWH, inplace=True)
+    anchors = anchors[batch_idxs, indices] if anchors.dim() == 3 else anchors[indices]
+    bboxes = target_to_coords(loc_p[batch_idxs, indices], anchors)
+    bboxes = BBox.convert(bboxes, format=BBox.XYWH, to=BBox.LTRB, inplace=True)
+    return batched_detections(
+        bboxes, scores, labels, batch_idxs, loc_p.size(0), nms_method,
+        iou_threshold, topk, min_score, max_per_class)
 
-    dets = []
-    for ind in indices:
-        det = {
-            'image_id': -1,
-            'category_id': labels[ind].item() + 1,
-            'bbox': bboxes[ind].tolist(),
-            'score': scores[ind].item(),
-        }
-        dets.append(det)
-    return dets
+
+@curry
+def anchor_based_inference(
+        loc_p, cls_p, anchors, conf_threshold=0.01,
+        iou_threshold=0.5, topk=100,
+        conf_strategy='softmax', nms_method='soft', min_score=None, max_per_class=None, fused=False):
+    return anchor_based_batch_inference(
+        loc_p[None], cls_p[None], anchors, conf_threshold, iou_threshold, topk,
+        conf_strategy, nms_method, min_score, max_per_class, fused=fused)
 
 
 class AnchorBasedInference:
+    r"""
+
+    Parameters
+    ----------
+    anchors : torch.Tensor or List[torch.Tensor] or MlvlAnchors or MlvlPriors
+        List of anchor boxes of shape `(lx, ly, #anchors, 4)`, or an anchor grid from
+        `horch.detection.anchor_cache` to look anchors up by input size.
+    conf_threshold : float
+        Boxes with confidence lower than it will be ignored.
+    iou_threshold : float
+        IoU threshold for nms.
+    topk : int
+        Maximum number of detections of every image.
+    conf_strategy : str
+        `softmax` or `sigmoid`.
+    nms : str
+        `soft`, `nms`, `multiclass`, `matrix` or `cluster`. `multiclass` performs nms for every class
+        instead of the class with maximal confidence of every box. `matrix` and `cluster` suppress
+        all boxes in parallel, see `matrix_nms` and `cluster_nms`.
+    min_score : float
+        Minimal score of soft and matrix nms. Default: conf_threshold
+    max_per_class : int
+        Maximum number of detections of every class for `multiclass` nms.
+    size : tuple of int
+        Default (width, height) of inputs, used to look up anchors when `anchors` is an anchor grid
+        and no size is passed at call time.
+    fused : bool
+        Whether to use the native `decode_and_nms` op, see `anchor_based_batch_inference`.
+    """
 
     def __init__(self, anchors, conf_threshold=0.01,
                  iou_threshold=0.5, topk=100,
-                 conf_strategy='softmax', nms='soft', min_score=None):
-        self.anchors = flatten(anchors)
+                 conf_strategy='softmax', nms='soft', min_score=None, max_per_class=None, size=None,
+                 fused=False):
+        self.anchors = anchors if is_grid(anchors) else flatten(anchors)
+        self.size = size
         self.conf_threshold = conf_threshold
         self.iou_threshold = iou_threshold
         self.topk = topk
@@ -294,15 +513,18 @@ class AnchorBasedInference:
         self.conf_strategy = conf_strategy
         self.nms = nms
         self.min_score = min_score
-
-    def __call__(self, loc_p, cls_p):
-        image_dets = []
-        batch_size = loc_p.size(0)
-        for i in range(batch_size):
-            dets = anchor_based_inference(
-                loc_p[i], cls_p[i], self.anchors,
-                self.conf_threshold, self.iou_threshold,
-                self.topk, self.conf_strategy, self.nms, self.min_score
-            )
-            image_dets.append(dets)
-        return image_dets
+        self.max_per_class = max_per_class
+        self.fused = fused
+
+    def __call__(self, loc_p, cls_p, size=None):
+        anchors = self.anchors
+        if is_grid(anchors):
+            size = size or self.size
+            assert size is not None, "Input size is required to look up anchors"
+            anchors = anchors(size, loc_p.dtype, loc_p.device)
+        return anchor_based_batch_inference(
+            loc_p, cls_p, anchors,
+            self.conf_threshold, self.iou_threshold,
+            self.topk, self.conf_strategy, self.nms, self.min_score, self.max_per_class,
+            fused=self.fused
+        )
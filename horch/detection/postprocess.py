@@ -0,0 +1,229 @@
+import torch
+
+from horch.detection.bbox import BBox
+from horch.detection.detections import Detections
+from horch.detection.nms import batched_nms, soft_nms_cpu, softer_nms_cpu, matrix_nms, cluster_nms
+
+__all__ = ["select_candidates", "topk_per_image", "batched_detections", "parallel_nms"]
+
+NMS_METHODS = ['nms', 'multiclass', 'soft', 'softer', 'matrix', 'cluster']
+PARALLEL_NMS_METHODS = ['matrix', 'cluster']
+
+
+def select_candidates(scores, conf_threshold, multiclass=False, mask=None):
+    r"""
+    Threshold the class scores of a batch of images at once.
+
+    Parameters
+    ----------
+    scores : torch.Tensor
+        Class scores (without background) of shape `(B, A, C)`.
+    conf_threshold : float
+        Candidates with score lower than it are dropped. Nothing is dropped if it is
+        not positive, unless `multiclass`.
+    multiclass : bool
+        Whether every (anchor, class) pair above the threshold is a candidate, instead of
+        the class with maximal score of every anchor.
+    mask : torch.Tensor
+        Optional mask of valid anchors of shape `(B, A)`.
+
+    Returns
+    -------
+    batch_idxs, indices, scores, labels : torch.Tensor
+        Image index, anchor index, score and class index of every candidate, of shape `(N,)`.
+    """
+    if multiclass:
+        keep = scores > conf_threshold
+        if mask is not None:
+            keep &= mask[..., None]
+        batch_idxs, indices, labels = torch.nonzero(keep).t()
+        return batch_idxs, indices, scores[batch_idxs, indices, labels], labels
+
+    scores, labels = scores.max(dim=-1)
+    if conf_threshold > 0:
+        keep = scores > conf_threshold
+    else:
+        keep = torch.ones_like(scores, dtype=torch.bool)
+    if mask is not None:
+        keep &= mask
+    batch_idxs, indices = torch.nonzero(keep).t()
+    return batch_idxs, indices, scores[batch_idxs, indices], labels[batch_idxs, indices]
+
+
+def _ranks(batch_idxs, batch_size):
+    # Position of every candidate in its image, for candidates grouped by image.
+    counts = torch.bincount(batch_idxs, minlength=batch_size)
+    starts = torch.cumsum(counts, dim=0) - counts
+    return torch.arange(len(batch_idxs), device=batch_idxs.device) - starts[batch_idxs]
+
+
+def _sort_by_image(scores, batch_idxs, indices=None):
+    # Indices grouped by image and sorted by scores in descending order in every image.
+    if indices is None:
+        indices = torch.arange(len(scores), device=scores.device)
+    indices = indices[scores[indices].argsort(descending=True)]
+    return indices[torch.sort(batch_idxs[indices], stable=True)[1]]
+
+
+def topk_per_image(scores, batch_idxs, k, batch_size=None):
+    r"""
+    Indices of the `k` highest scoring candidates of every image, grouped by image.
+
+    Parameters
+    ----------
+    scores : torch.Tensor
+        Scores of shape `(N,)`.
+    batch_idxs : torch.Tensor
+        Image index of every candidate, of shape `(N,)`.
+    k : int
+    batch_size : int
+        Number of images. Default: `batch_idxs.max() + 1`
+    """
+    if batch_size is None:
+        batch_size = int(batch_idxs.max()) + 1 if len(batch_idxs) else 0
+    indices = _sort_by_image(scores, batch_idxs)
+    return indices[_ranks(batch_idxs[indices], batch_size) < k]
+
+
+def parallel_nms(bboxes, scores, nms_method, iou_threshold=0.5, topk=100, min_score=0.01,
+                 max_candidates=1000):
+    r"""
+    Matrix or cluster nms over the candidates of one image.
+
+    Parameters
+    ----------
+    bboxes : torch.Tensor
+        Boxes in LTRB format of shape `(N, 4)`.
+    scores : torch.Tensor
+        Scores of shape `(N,)`.
+    nms_method : str
+        `matrix` or `cluster`.
+    max_candidates : int
+        Only the `max_candidates` highest scoring candidates are suppressed and kept, as both
+        methods compute the IoU of all pairs of candidates.
+
+    Returns
+    -------
+    indices, scores : torch.Tensor
+        Indices of the kept candidates sorted by scores in descending order, and the scores of
+        all candidates, decayed by matrix nms.
+    """
+    assert nms_method in PARALLEL_NMS_METHODS, "nms_method must be one of %s" % PARALLEL_NMS_METHODS
+    indices = scores.argsort(descending=True)[:max_candidates]
+    if nms_method == 'matrix':
+        scores = scores.clone()
+        scores[indices] = matrix_nms(bboxes[indices], scores[indices])
+        indices = indices[scores[indices] >= min_score]
+        indices = indices[scores[indices].argsort(descending=True)]
+    else:
+        indices = indices[cluster_nms(bboxes[indices], scores[indices], iou_threshold=iou_threshold)]
+    if topk:
+        indices = indices[:topk]
+    return indices, scores
+
+
+def _pad_by_image(bboxes, scores, batch_idxs, batch_size):
+    # Candidates grouped by image to padded tensors of shape `(batch_size, k, ...)`, with the mask
+    # of valid candidates and the flat index of every candidate in them.
+    ranks = _ranks(batch_idxs, batch_size)
+    k = int(ranks.max()) + 1 if len(ranks) else 0
+    slots = batch_idxs * k + ranks
+    p_bboxes = bboxes.new_zeros(batch_size * k, 4).index_copy_(0, slots, bboxes)
+    p_scores = scores.new_zeros(batch_size * k).index_copy_(0, slots, scores)
+    mask = torch.zeros(batch_size * k, dtype=torch.bool).index_fill_(0, slots, True)
+    return p_bboxes.view(batch_size, k, 4), p_scores.view(batch_size, k), mask.view(batch_size, k), slots
+
+
+def batched_detections(bboxes, scores, labels, batch_idxs, batch_size, nms_method='nms',
+                       iou_threshold=0.5, topk=100, min_score=0.01, max_per_class=None, vars=None,
+                       max_candidates=1000):
+    r"""
+    NMS over the flat candidates of a batch of images.
+
+    `nms` and `multiclass` suppress the candidates of all images in a single `batched_nms` call.
+    `matrix` and `cluster` pad the candidates of every image and suppress all images with batched
+    tensor ops. Soft nms has no batched kernel and runs image by image on the candidates of the image.
+
+    Parameters
+    ----------
+    bboxes : torch.Tensor
+        Decoded boxes in LTRB format of shape `(N, 4)`.
+    scores : torch.Tensor
+        Scores of shape `(N,)`.
+    labels : torch.Tensor
+        Class indices (without background) of shape `(N,)`.
+    batch_idxs : torch.Tensor
+        Image index of every candidate, of shape `(N,)`.
+    batch_size : int
+        Number of images.
+    nms_method : str
+        `nms`, `multiclass`, `soft`, `softer`, `matrix` or `cluster`.
+    iou_threshold : float
+        IoU threshold for nms. Not used by `matrix` nms, which decays scores instead.
+    topk : int
+        Maximum number of detections of every image.
+    min_score : float
+        Minimal score of soft and matrix nms.
+    max_per_class : int
+        Maximum number of detections of every class for `multiclass` nms.
+    vars : torch.Tensor
+        Variances of the box coordinates of shape `(N, 4)` for `softer` nms.
+    max_candidates : int
+        Maximum number of candidates of every image for `matrix` and `cluster` nms, see `parallel_nms`.
+
+    Returns
+    -------
+    Detections
+        Detections of the `batch_size` images with 1-based category ids.
+    """
+    assert nms_method in NMS_METHODS, "nms_method must be one of %s" % NMS_METHODS
+    bboxes = bboxes.cpu()
+    scores = scores.cpu()
+    labels = labels.cpu()
+    batch_idxs = batch_idxs.cpu()
+
+    if nms_method in ['nms', 'multiclass'] + PARALLEL_NMS_METHODS:
+        if nms_method in PARALLEL_NMS_METHODS:
+            keep = topk_per_image(scores, batch_idxs, max_candidates, batch_size)
+            p_bboxes, p_scores, mask, slots = _pad_by_image(
+                bboxes[keep], scores[keep], batch_idxs[keep], batch_size)
+            if nms_method == 'matrix':
+                scores = scores.clone()
+                scores[keep] = matrix_nms(p_bboxes, p_scores, mask).view(-1)[slots]
+                keep = _sort_by_image(scores, batch_idxs, keep[scores[keep] >= min_score])
+            else:
+                keep = keep[cluster_nms(p_bboxes, p_scores, mask, iou_threshold).view(-1)[slots]]
+        elif nms_method == 'multiclass':
+            num_classes = int(labels.max()) + 1 if len(labels) else 1
+            keep = batched_nms(bboxes, scores, batch_idxs * num_classes + labels, iou_threshold)
+            if max_per_class:
+                keep = keep[_ranks(batch_idxs[keep] * num_classes + labels[keep],
+                                   batch_size * num_classes) < max_per_class]
+            keep = _sort_by_image(scores, batch_idxs, keep)
+        else:
+            keep = batched_nms(bboxes, scores, batch_idxs, iou_threshold)
+        if topk:
+            keep = keep[_ranks(batch_idxs[keep], batch_size) < topk]
+    else:
+        counts = torch.bincount(batch_idxs, minlength=batch_size).tolist()
+        order = torch.argsort(batch_idxs, stable=True)
+        keep = []
+        for indices in order.split(counts):
+            if len(indices) == 0:
+                continue
+            # Soft nms decays the scores (and softer nms moves the boxes) in place.
+            i_bboxes, i_scores = bboxes[indices], scores[indices]
+            if nms_method == 'softer':
+                i_keep = softer_nms_cpu(
+                    i_bboxes, i_scores, vars[indices].cpu(), iou_threshold, topk, 0.01, min_score)
+            else:
+                i_keep = soft_nms_cpu(i_bboxes, i_scores, iou_threshold, topk, min_score)
+            bboxes[indices] = i_bboxes
+            scores[indices] = i_scores
+            keep.append(indices[torch.as_tensor(i_keep, dtype=torch.long)])
+        keep = torch.cat(keep) if keep else batch_idxs.new_zeros(0)
+
+    counts = torch.bincount(batch_idxs[keep], minlength=batch_size)
+    offsets = torch.cat([counts.new_zeros(1), counts.cumsum(0)])
+    bboxes = BBox.convert(bboxes[keep], format=BBox.LTRB, to=BBox.LTWH, inplace=True)
+    return Detections(bboxes, scores[keep], labels[keep] + 1, offsets)
@@ -8,11 +8,13 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from horch.common import select, sample, _concat, one_hot, expand_last_dim
-from horch.detection.one import MultiBoxLoss, AnchorBasedInference
+from horch.common import sample, _concat, one_hot, expand_last_dim
+from horch.detection.one import MultiBoxLoss, AnchorBasedInference, pad_gts, match_anchors_batch
 from horch.detection.bbox import BBox
-from horch.detection.iou import iou_mn
-from horch.detection.nms import nms, soft_nms_cpu, softer_nms_cpu
+from horch.detection.detections import Detections
+from horch.detection.iou import iou_mn, iou_mn_reduce, MAX_DENSE_IOU_SIZE
+from horch.detection.nms import nms, batched_nms, multiclass_nms, soft_nms_cpu, softer_nms_cpu
+from horch.detection.postprocess import parallel_nms
 
 
 def coords_to_target(gt_box, anchors):
@@ -43,40 +45,32 @@ def target_to_coords(loc_t, anchors):
     return loc_t
 
 
-def match_anchors2(anns, a_xywh, a_ltrb, pos_thresh=0.7, neg_thresh=0.3,
-                   get_label=lambda x: x['category_id'], debug=False):
-    num_anchors = len(a_xywh)
-    if len(anns) == 0:
-        loc_t = a_xywh.new_zeros(num_anchors, 4)
-        cls_t = loc_t.new_zeros(num_anchors, dtype=torch.long)
-        ignore = loc_t.new_zeros(num_anchors, dtype=torch.uint8)
-        return loc_t, cls_t, ignore
-
-    bboxes = a_xywh.new_tensor([ann['bbox'] for ann in anns])
-    bboxes = BBox.convert(bboxes, format=BBox.LTWH, to=BBox.XYWH, inplace=True)
-    labels = a_xywh.new_tensor([get_label(ann) for ann in anns], dtype=torch.long)
-
-    bboxes_ltrb = BBox.convert(bboxes, BBox.XYWH, BBox.LTRB)
-    ious = iou_mn(bboxes_ltrb, a_ltrb)
-
-    pos = ious > pos_thresh
-    cls_t, indices = (pos.long() * labels[:, None]).max(dim=0)
-    loc_t_all = coords_to_target2(bboxes, a_xywh)
-    loc_t = select(loc_t_all, 0, indices)
-
-    max_ious, max_indices = ious.max(dim=1)
+def _reduce_ious(bboxes_ltrb, boxes, threshold, max_dense_size, debug=False):
+    r"""
+    Per box max IoU with the ground truths and its ground truth, per ground truth best
+    box, and per box number of ground truths with IoU at least `threshold`, like
+    `iou_mn_reduce`. The IoU matrix is only computed if it has at most `max_dense_size`
+    elements, so that the targets don't depend on the size.
+    """
+    if len(bboxes_ltrb) * len(boxes) > max_dense_size:
+        return iou_mn_reduce(bboxes_ltrb, boxes, threshold)
+    ious = iou_mn(bboxes_ltrb, boxes)
     if debug:
-        print(max_ious.tolist())
-    loc_t[max_indices] = select(loc_t_all, 1, max_indices)
-    cls_t[max_indices] = labels
+        print(ious.max(dim=1)[0].tolist())
+    max_ious, ann_indices = ious.max(dim=0)
+    return max_ious, ann_indices, ious.argmax(dim=1), (ious >= threshold).sum(dim=0)
 
-    ignore = (cls_t == 0) & ((ious >= neg_thresh).sum(dim=0) != 0)
-    return loc_t, cls_t, ignore
+
+def match_anchors2(anns, a_xywh, a_ltrb, pos_thresh=0.7, neg_thresh=0.3,
+                   get_label=lambda x: x['category_id'], debug=False,
+                   max_dense_size=MAX_DENSE_IOU_SIZE):
+    return match_anchors(anns, a_xywh, a_ltrb, pos_thresh, neg_thresh, get_label, debug, max_dense_size)
 
 
 @curry
 def match_anchors(anns, a_xywh, a_ltrb, pos_thresh=0.7, neg_thresh=0.3,
-                  get_label=lambda x: x['category_id'], debug=False):
+                  get_label=lambda x: x['category_id'], debug=False,
+                  max_dense_size=MAX_DENSE_IOU_SIZE):
     num_anchors = len(a_xywh)
     loc_t = a_xywh.new_zeros(num_anchors, 4)
     cls_t = loc_t.new_zeros(num_anchors, dtype=torch.long)
@@ -90,24 +84,25 @@ def match_anchors(anns, a_xywh, a_ltrb, pos_thresh=0.7, neg_thresh=0.3,
     labels = loc_t.new_tensor([get_label(ann) for ann in anns], dtype=torch.long)
 
     bboxes_ltrb = BBox.convert(bboxes, BBox.XYWH, BBox.LTRB)
-    ious = iou_mn(bboxes_ltrb, a_ltrb)
 
-    pos = ious > pos_thresh
-    for ipos, bbox, label in zip(pos, bboxes, labels):
-        loc_t[ipos] = coords_to_target(bbox, a_xywh[ipos])
-        cls_t[ipos] = label
+    # Positive anchors are assigned to the ground truth box with max IoU.
+    max_ious, ann_indices, indices, counts = _reduce_ious(
+        bboxes_ltrb, a_ltrb, neg_thresh, max_dense_size, debug)
+
+    pos = max_ious > pos_thresh
+    ann_indices = ann_indices[pos]
+    loc_t[pos] = coords_to_target(bboxes[ann_indices], a_xywh[pos])
+    cls_t[pos] = labels[ann_indices]
 
-    max_ious, indices = ious.max(dim=1)
-    if debug:
-        print(max_ious.tolist())
     loc_t[indices] = coords_to_target(bboxes, a_xywh[indices])
     cls_t[indices] = labels
 
-    ignore = (cls_t == 0) & ((ious >= neg_thresh).sum(dim=0) != 0)
+    ignore = (cls_t == 0) & (counts != 0)
     return loc_t, cls_t, ignore
 
 
-def match_rois(anns, rois, pos_thresh=0.5, n_samples=64, pos_neg_ratio=1 / 3):
+def match_rois(anns, rois, pos_thresh=0.5, n_samples=64, pos_neg_ratio=1 / 3,
+               max_dense_size=MAX_DENSE_IOU_SIZE):
     rois_xywh = BBox.convert(rois, BBox.LTRB, BBox.XYWH)
     num_anns = len(anns)
     num_rois = len(rois)
@@ -122,16 +117,16 @@ def match_rois(anns, rois, pos_thresh=0.5, n_samples=64, pos_neg_ratio=1 / 3):
     labels = loc_t.new_tensor([ann['category_id'] for ann in anns], dtype=torch.long)
 
     bboxes_ltrb = BBox.convert(bboxes, BBox.XYWH, BBox.LTRB)
-    ious = iou_mn(bboxes_ltrb, rois)
 
-    max_ious, indices = ious.max(dim=1)
+    max_ious, ann_indices, indices, _ = _reduce_ious(bboxes_ltrb, rois, pos_thresh, max_dense_size)
     loc_t[indices] = coords_to_target(bboxes, rois_xywh[indices])
     cls_t[indices] = labels
 
-    pos = ious > pos_thresh
-    for ann_id, ipos, bbox, label in zip(range(num_rois), pos, bboxes, labels):
-        loc_t[ipos] = coords_to_target(bbox, rois_xywh[ipos])
-        cls_t[ipos] = label
+    # Positive RoIs are assigned to the ground truth box with max IoU.
+    pos = max_ious > pos_thresh
+    ann_indices = ann_indices[pos]
+    loc_t[pos] = coords_to_target(bboxes[ann_indices], rois_xywh[pos])
+    cls_t[pos] = labels[ann_indices]
 
     pos = cls_t != 0
     n_pos = int(n_samples * pos_neg_ratio / (pos_neg_ratio + 1))
@@ -145,7 +140,8 @@ def match_rois(anns, rois, pos_thresh=0.5, n_samples=64, pos_neg_ratio=1 / 3):
     return loc_t, cls_t, indices
 
 
-def match_rois2(anns, rois, pos_thresh=0.5, n_samples=64, pos_neg_ratio=1 / 3):
+def match_rois2(anns, rois, pos_thresh=0.5, n_samples=64, pos_neg_ratio=1 / 3,
+                max_dense_size=MAX_DENSE_IOU_SIZE):
     num_rois = len(rois)
     if len(anns) == 0:
         loc_t = rois.new_zeros(num_rois, 4)
@@ -159,15 +155,18 @@ def match_rois2(anns, rois, pos_thresh=0.5, n_samples=64, pos_neg_ratio=1 / 3):
     labels = rois.new_tensor([ann['category_id'] for ann in anns], dtype=torch.long)
 
     bboxes_ltrb = BBox.convert(bboxes, BBox.XYWH, BBox.LTRB)
-    ious = iou_mn(bboxes_ltrb, rois)
 
-    pos = ious > pos_thresh
-    cls_t, ann_indices = (pos.long() * labels[:, None]).max(dim=0)
-    loc_t_all = coords_to_target2(bboxes, rois_xywh)
-    loc_t = select(loc_t_all, 0, ann_indices)
+    max_ious, ann_indices, max_indices, _ = _reduce_ious(bboxes_ltrb, rois, pos_thresh, max_dense_size)
+    loc_t = rois.new_zeros(num_rois, 4)
+    cls_t = loc_t.new_zeros(num_rois, dtype=torch.long)
+
+    # Positive RoIs are assigned to the ground truth box with max IoU.
+    pos = max_ious > pos_thresh
+    ann_indices = ann_indices[pos]
+    loc_t[pos] = coords_to_target(bboxes[ann_indices], rois_xywh[pos])
+    cls_t[pos] = labels[ann_indices]
 
-    max_ious, max_indices = ious.max(dim=1)
-    loc_t[max_indices] = select(loc_t_all, 1, max_indices)
+    loc_t[max_indices] = coords_to_target(bboxes, rois_xywh[max_indices])
     cls_t[max_indices] = labels
 
     pos = cls_t != 0
@@ -182,7 +181,6 @@ def match_rois2(anns, rois, pos_thresh=0.5, n_samples=64, pos_neg_ratio=1 / 3):
     return loc_t, cls_t, indices
 
 
-
 @curry
 def inference_rois(loc_p, cls_p, anchors, iou_threshold=0.5, topk=100, conf_strategy='softmax'):
     if conf_strategy == 'softmax':
@@ -197,13 +195,11 @@ def inference_rois(loc_p, cls_p, anchors, iou_threshold=0.5, topk=100, conf_stra
     bboxes = BBox.convert(
         loc_p, format=BBox.XYWH, to=BBox.LTRB, inplace=True)
 
+    image_indices = batched_nms(bboxes, scores, iou_threshold=iou_threshold)
     rois = []
-    for i in range(len(loc_p)):
-        ibboxes = bboxes[i]
-        iscores = scores[i]
-        indices = nms(ibboxes, iscores, iou_threshold)
-        ibboxes = ibboxes[indices]
-        iscores = iscores[indices]
+    for i, indices in enumerate(image_indices):
+        ibboxes = bboxes[i][indices]
+        iscores = scores[i][indices]
         if len(indices) > topk:
             indices = iscores.topk(topk)[1]
             ibboxes = ibboxes[indices]
@@ -234,15 +230,23 @@ class MatchAnchors:
     neg_thresh : float
         If provided, only non-positive anchors whose ious with all ground truth boxes are
         lower than neg_thresh will be considered negative. Other non-positive anchors will be ignored.
+    max_dense_size : int
+        Maximum number of elements of the IoU tensor computed at once. Larger batches are
+        matched in chunks, and a single image exceeding it is reduced tile by tile.
+
+    Called as a transform `(img, anns)` it matches one image, called with a batch of annotations
+    it matches all images at once. Targets of the batch are concatenated along the first dim.
     """
 
-    def __init__(self, anchors, pos_thresh=0.7, neg_thresh=0.3, get_label=lambda x: 1, debug=False):
+    def __init__(self, anchors, pos_thresh=0.7, neg_thresh=0.3, get_label=lambda x: 1, debug=False,
+                 max_dense_size=MAX_DENSE_IOU_SIZE):
         self.a_xywh = flatten(anchors)
         self.a_ltrb = BBox.convert(self.a_xywh, BBox.XYWH, BBox.LTRB)
         self.pos_thresh = pos_thresh
         self.neg_thresh = neg_thresh
         self.get_label = get_label
         self.debug = debug
+        self.max_dense_size = max_dense_size
 
     def __call__(self, x, image_gts=None):
         is_transform = image_gts is not None
@@ -251,23 +255,19 @@ class MatchAnchors:
         else:
             image_gts = x
 
-        is_cpu = self.a_xywh.device.type == 'cpu'
-        match_func = match_anchors if is_cpu else match_anchors2
-        batch_size = len(image_gts)
-
-        loc_targets = []
-        cls_targets = []
-        ignores = []
-        for i in range(batch_size):
-            loc_t, cls_t, ignore = match_func(
-                image_gts[i], self.a_xywh, self.a_ltrb,
-                self.pos_thresh, self.neg_thresh, self.get_label, self.debug)
-            loc_targets.append(loc_t)
-            cls_targets.append(cls_t)
-            ignores.append(ignore)
-        loc_t = _concat(loc_targets, dim=0)
-        cls_t = _concat(cls_targets, dim=0)
-        ignore = _concat(ignores, dim=0)
+        gt_boxes, gt_labels, gt_mask = pad_gts(
+            image_gts, self.get_label, self.a_xywh.dtype, self.a_xywh.device)
+        if self.debug:
+            gt_ltrb = BBox.convert(gt_boxes, BBox.XYWH, BBox.LTRB)
+            for boxes, mask in zip(gt_ltrb, gt_mask):
+                if mask.any():
+                    print(iou_mn(boxes[mask], self.a_ltrb).max(dim=1)[0].tolist())
+        loc_t, cls_t, ignore = match_anchors_batch(
+            gt_boxes, gt_labels, gt_mask, self.a_xywh, self.a_ltrb,
+            self.pos_thresh, self.neg_thresh, max_dense_size=self.max_dense_size)
+        loc_t = loc_t.view(-1, 4)
+        cls_t = cls_t.view(-1)
+        ignore = ignore.view(-1)
 
         if is_transform:
             return x, [loc_t, cls_t, ignore]
@@ -294,11 +294,13 @@ class InferenceRoIs:
 
 
 class MatchRoIs:
-    def __init__(self, pos_thresh=0.5, n_samples=None, pos_neg_ratio=1 / 3):
+    def __init__(self, pos_thresh=0.5, n_samples=None, pos_neg_ratio=1 / 3,
+                 max_dense_size=MAX_DENSE_IOU_SIZE):
         super().__init__()
         self.pos_thresh = pos_thresh
         self.n_samples = n_samples
         self.pos_neg_ratio = pos_neg_ratio
+        self.max_dense_size = max_dense_size
 
     def __call__(self, rois, image_gts):
         is_cpu = rois.device.type == 'cpu'
@@ -310,7 +312,8 @@ class MatchRoIs:
         sampled_rois = []
         for i in range(len(rois)):
             loc_t, cls_t, indices = match_func(
-                image_gts[i], rois_ltrb[i], self.pos_thresh, self.n_samples, self.pos_neg_ratio)
+                image_gts[i], rois_ltrb[i], self.pos_thresh, self.n_samples, self.pos_neg_ratio,
+                self.max_dense_size)
             loc_targets.append(loc_t)
             cls_targets.append(cls_t)
             sampled_rois.append(rois[i][indices])
@@ -419,20 +422,28 @@ class RCNNKLLoss(nn.Module):
 @curry
 def roi_based_inference(
         rois, loc_p, cls_p, conf_threshold=0.01,
-        iou_threshold=0.5, topk=100, nms_method='soft'):
+        iou_threshold=0.5, topk=100, nms_method='soft', max_per_class=None):
 
-    scores, labels = torch.softmax(cls_p, dim=1)[:, 1:].max(dim=1)
     # num_classes = cls_p.size(1) - 1
     # loc_p = expand_last_dim(loc_p, num_classes, 4)
     # loc_p = select(loc_p, 1, labels)
     bboxes = loc_p
 
-    if conf_threshold:
-        pos = scores > conf_threshold
+    if nms_method == 'multiclass':
+        scores = torch.softmax(cls_p, dim=1)[:, 1:]
+        pos, labels = torch.nonzero(scores > conf_threshold).t()
         bboxes = bboxes[pos]
         rois = rois[pos]
-        scores = scores[pos]
-        labels = labels[pos]
+        scores = scores[pos, labels]
+    else:
+        scores, labels = torch.softmax(cls_p, dim=1)[:, 1:].max(dim=1)
+
+        if conf_threshold:
+            pos = scores > conf_threshold
+            bboxes = bboxes[pos]
+            rois = rois[pos]
+            scores = scores[pos]
+            labels = labels[pos]
 
     bboxes[..., :2].mul_(rois[:, 2:]).add_(rois[:, :2])
     bboxes[..., 2:].exp_().mul_(rois[:, 2:])
@@ -444,6 +455,12 @@ def roi_based_inference(
     if nms_method == 'soft':
         indices = soft_nms_cpu(
             bboxes, scores, iou_threshold, topk)
+    elif nms_method == 'multiclass':
+        labels = labels.cpu()
+        indices = multiclass_nms(
+            bboxes, scores, labels, iou_threshold, max_per_class, topk)
+    elif nms_method in ['matrix', 'cluster']:
+        indices, scores = parallel_nms(bboxes, scores, nms_method, iou_threshold, topk)
     else:
         indices = nms(bboxes, scores, iou_threshold)
         if len(indices) > topk:
@@ -453,16 +470,7 @@ def roi_based_inference(
     bboxes = BBox.convert(
         bboxes, format=BBox.LTRB, to=BBox.LTWH, inplace=True)
 
-    dets = []
-    for i, ind in enumerate(indices):
-        det = {
-            'image_id': -1,
-            'category_id': labels[ind].item() + 1,
-            'bbox': bboxes[ind].tolist(),
-            'score': scores[ind].item(),
-        }
-        dets.append(det)
-    return dets
+    return Detections.single(bboxes, scores, labels + 1, indices)
 
 
 @curry
@@ -484,25 +492,17 @@ def softer_roi_based_inference(
     bboxes = BBox.convert(
         bboxes, format=BBox.LTRB, to=BBox.LTWH, inplace=True)
 
-    dets = []
-    for i, ind in enumerate(indices):
-        det = {
-            'image_id': -1,
-            'category_id': labels[ind].item() + 1,
-            'bbox': bboxes[ind].tolist(),
-            'score': scores[ind].item(),
-        }
-        dets.append(det)
-    return dets
+    return Detections.single(bboxes, scores, labels + 1, indices)
 
 
 class RoIBasedInference:
 
-    def __init__(self, iou_threshold=0.5, conf_threshold=0.01, topk=100, nms='soft'):
+    def __init__(self, iou_threshold=0.5, conf_threshold=0.01, topk=100, nms='soft', max_per_class=None):
         self.iou_threshold = iou_threshold
         self.conf_threshold = conf_threshold
         self.topk = topk
         self.nms = nms
+        self.max_per_class = max_per_class
 
     def __call__(self, rois, loc_p, cls_p, log_var_p=None):
         image_dets = []
@@ -520,6 +520,6 @@ class RoIBasedInference:
             else:
                 dets = roi_based_inference(
                     rois[i], loc_p[i], cls_p[i],
-                    self.iou_threshold, self.conf_threshold, self.topk, self.nms)
+                    self.conf_threshold, self.iou_threshold, self.topk, self.nms, self.max_per_class)
             image_dets.append(dets)
-        return image_dets
+        return Detections.cat(image_dets)
@@ -3,79 +3,212 @@ import random
 
 from toolz import curry
 
+import numpy as np
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.modules.utils import _pair
 
 from horch.common import select, sample, _concat, expand_last_dim
 from horch.detection.one import MultiBoxLoss
 from horch.detection.bbox import BBox
+from horch.detection.detections import Detections
 from horch.detection.iou import iou_mn
-from horch.detection.nms import nms, soft_nms_cpu
+from horch.detection.nms import nms, batched_nms, soft_nms_cpu
+from horch.detection.postprocess import parallel_nms
 from horch.detection.two import MatchAnchors, coords_to_target2, coords_to_target
+from horch.nn.roi_align import roi_align
+
+
+def _rle_string_to_counts(s):
+    # Counts of a compressed COCO RLE string, as `rleFrString` of the COCO API.
+    if isinstance(s, str):
+        s = s.encode('ascii')
+    c = np.frombuffer(s, dtype=np.uint8).astype(np.int64) - 48
+    if len(c) == 0:
+        return np.zeros(0, dtype=np.int64)
+    # Every count is 5 bits per char, least significant first, until a char without 0x20
+    ends = (c & 0x20) == 0
+    starts = np.flatnonzero(np.concatenate([[True], ends[:-1]]))
+    tokens = np.cumsum(ends) - ends
+    k = np.arange(len(c)) - starts[tokens]
+    x = np.add.reduceat((c & 0x1f) << (5 * k), starts)
+    # Sign extension from the last char of every count
+    negative = (c[ends] & 0x10) != 0
+    x[negative] |= np.left_shift(-1, 5 * (k[ends][negative] + 1))
+    # Counts after the third are deltas to the count two before
+    counts = x.copy()
+    counts[1::2] = np.cumsum(x[1::2])
+    counts[2::2] = np.cumsum(x[2::2])
+    return counts
+
+
+def _is_rle(segm):
+    return isinstance(segm, dict) and 'counts' in segm
+
+
+def _decode_masks(segms):
+    # Masks as uint8 tensors of shape (H, W), decoding all RLEs at once.
+    rles = [i for i, segm in enumerate(segms) if _is_rle(segm)]
+    masks = [None] * len(segms)
+    for i, segm in enumerate(segms):
+        if not _is_rle(segm):
+            m = segm if torch.is_tensor(segm) else torch.from_numpy(np.asarray(segm))
+            masks[i] = m.to(torch.uint8)
+    if rles:
+        counts = []
+        for i in rles:
+            c = segms[i]['counts']
+            counts.append(np.asarray(_rle_string_to_counts(c) if isinstance(c, (str, bytes)) else c, dtype=np.int64))
+        sizes = [segms[i]['size'] for i in rles]
+        # Runs alternate between 0 and 1, starting with 0
+        values = np.concatenate([np.arange(len(c)) % 2 for c in counts]).astype(np.uint8)
+        pixels = np.repeat(values, np.concatenate(counts))
+        # RLEs may differ in size and are column major
+        pixels = np.split(pixels, np.cumsum([h * w for h, w in sizes])[:-1])
+        for i, p, (h, w) in zip(rles, pixels, sizes):
+            masks[i] = torch.from_numpy(p.reshape(w, h)).t()
+    return masks
+
+
+def stack_masks(segms):
+    r"""
+    Stack binary masks of the same size.
+
+    Parameters
+    ----------
+    segms : Sequence
+        Masks as tensors, arrays or PIL images of shape `(H, W)`, or COCO RLE dicts with
+        `size` and `counts` (compressed or not). All RLEs are decoded by a single `np.repeat`.
+
+    Returns
+    -------
+    torch.Tensor
+        Uint8 tensor of shape `(#masks, H, W)`.
+    """
+    masks = _decode_masks(segms)
+    return torch.stack(masks) if masks else torch.zeros(0, 0, 0, dtype=torch.uint8)
+
+
+def mask_targets(segms, segm_indices, rois, mask_size=(14, 14), sampling_ratio=2):
+    r"""
+    Crop and resize the masks of all RoIs with one RoIAlign.
+
+    Parameters
+    ----------
+    segms : Sequence
+        Masks of the ground truths involved, see `stack_masks`. They may differ in size.
+    segm_indices : torch.Tensor
+        Index of the mask of every RoI, of shape `(n,)`.
+    rois : torch.Tensor
+        Normalized RoIs in LTRB format of shape `(n, 4)`, relative to the size of their masks.
+    mask_size : tuple of int
+        (height, width) of the targets.
+    sampling_ratio : int
+        Sampling points of every bin along each axis.
+
+    Returns
+    -------
+    torch.Tensor
+        Binary targets of shape `(n, *mask_size)`, on the device of `rois`.
+    """
+    if len(rois) == 0:
+        return rois.new_zeros(0, *mask_size)
+    device = rois.device
+    # Only the masks of the RoIs are decoded
+    used, segm_indices = torch.unique(segm_indices.cpu(), return_inverse=True)
+    masks = _decode_masks([segms[i] for i in used.tolist()])
+    sizes = torch.tensor([m.size() for m in masks])
+    scales = sizes.flip(1).repeat(1, 2).float()
+    # Pixel i covers [i, i + 1) while RoIAlign samples pixel centers at integers
+    boxes = rois.detach().float().cpu() * scales[segm_indices] - 0.5
+
+    # Only the window around the RoIs of every mask is converted to float. The windows have a
+    # pixel of replicated border on each side, as RoIAlign clamps samples to the border, and
+    # are stacked vertically in one image, so the padding on the right is never sampled.
+    n = len(masks)
+    index = segm_indices[:, None].expand(-1, 2)
+    lo = boxes.new_full((n, 2), float('inf')).scatter_reduce_(0, index, boxes[:, :2], 'amin')
+    hi = boxes.new_full((n, 2), -float('inf')).scatter_reduce_(0, index, boxes[:, 2:], 'amax')
+    lo = lo.floor().long() - 1
+    hi = hi.floor().long() + 2
+    heights = hi[:, 1] - lo[:, 1]
+    tops = torch.cumsum(heights, dim=0) - heights
+    inputs = torch.empty(1, 1, int(heights.sum()), int((hi[:, 0] - lo[:, 0]).max()))
+    for m, (x0, y0), (x1, y1), top in zip(masks, lo.tolist(), hi.tolist(), tops.tolist()):
+        height, width = m.size()
+        t, b, l, r = max(y0, 0), min(y1, height), max(x0, 0), min(x1, width)
+        window = inputs[0, 0, top:top + y1 - y0, :x1 - x0]
+        window[t - y0:b - y0, l - x0:r - x0] = m[t:b, l:r]
+        if t != y0:
+            window[:t - y0] = window[t - y0]
+        if b != y1:
+            window[b - y0:] = window[b - y0 - 1]
+        if l != x0:
+            window[:, :l - x0] = window[:, l - x0:l - x0 + 1]
+        if r != x1:
+            window[:, r - x0:] = window[:, r - x0 - 1:r - x0]
+    boxes -= lo[segm_indices].repeat(1, 2).float()
+    boxes[:, 1::2] += tops[segm_indices, None].float()
+
+    rois = torch.cat([boxes.new_zeros(len(boxes), 1), boxes], dim=1)
+    with torch.no_grad():
+        m = roi_align(inputs, rois, _pair(mask_size), (1.0, 1.0), sampling_ratio)
+    return (m[:, 0] >= 0.5).float().to(device)
+
+
+def _sample_rois(loc_t, cls_t, ann_indices, n_samples, pos_neg_ratio):
+    pos = cls_t != 0
+    n_pos = int(n_samples * pos_neg_ratio / (pos_neg_ratio + 1))
+    n_neg = n_samples - n_pos
+    pos_indices = torch.nonzero(pos).squeeze(1)
+    if len(pos_indices) != 0:
+        pos_indices = sample(pos_indices, n_pos)
+    neg_indices = sample(torch.nonzero(~pos).squeeze(1), n_neg)
+    loc_t = loc_t[pos_indices]
+    indices = torch.cat([pos_indices, neg_indices], dim=0)
+    cls_t = cls_t[indices]
+    return loc_t, cls_t, indices, ann_indices[pos_indices]
 
 
-def match_rois(anns, rois, pos_thresh=0.5, mask_size=(14, 14), n_samples=64, pos_neg_ratio=1 / 3):
+def _match_rois(anns, rois, pos_thresh=0.5, n_samples=64, pos_neg_ratio=1 / 3):
     rois_xywh = BBox.convert(rois, BBox.LTRB, BBox.XYWH)
     num_anns = len(anns)
     num_rois = len(rois)
     loc_t = rois.new_zeros(num_rois, 4)
     cls_t = loc_t.new_zeros(num_rois, dtype=torch.long)
+    ann_indices = torch.zeros(num_rois, dtype=torch.long, device=rois.device)
 
-    if num_anns == 0:
-        return loc_t, cls_t
+    if num_anns != 0:
+        bboxes = loc_t.new_tensor([ann['bbox'] for ann in anns])
+        bboxes = BBox.convert(bboxes, format=BBox.LTWH, to=BBox.XYWH, inplace=True)
+        labels = loc_t.new_tensor([ann['category_id'] for ann in anns], dtype=torch.long)
 
-    bboxes = loc_t.new_tensor([ann['bbox'] for ann in anns])
-    bboxes = BBox.convert(bboxes, format=BBox.LTWH, to=BBox.XYWH, inplace=True)
-    labels = loc_t.new_tensor([ann['category_id'] for ann in anns], dtype=torch.long)
+        bboxes_ltrb = BBox.convert(bboxes, BBox.XYWH, BBox.LTRB)
+        ious = iou_mn(bboxes_ltrb, rois)
 
-    bboxes_ltrb = BBox.convert(bboxes, BBox.XYWH, BBox.LTRB)
-    ious = iou_mn(bboxes_ltrb, rois)
+        max_ious, indices = ious.max(dim=1)
+        loc_t[indices] = coords_to_target(bboxes, rois_xywh[indices])
+        cls_t[indices] = labels
+        ann_indices[indices] = torch.arange(num_anns, device=rois.device)
 
-    ann_indices = torch.zeros(num_rois, dtype=torch.long)
-    max_ious, indices = ious.max(dim=1)
-    loc_t[indices] = coords_to_target(bboxes, rois_xywh[indices])
-    cls_t[indices] = labels
-    ann_indices[indices] = torch.arange(num_anns)
+        pos = ious > pos_thresh
+        for ann_id, ipos, bbox, label in zip(range(num_rois), pos, bboxes, labels):
+            loc_t[ipos] = coords_to_target(bbox, rois_xywh[ipos])
+            cls_t[ipos] = label
+            ann_indices[ipos] = ann_id
 
-    pos = ious > pos_thresh
-    for ann_id, ipos, bbox, label in zip(range(num_rois), pos, bboxes, labels):
-        loc_t[ipos] = coords_to_target(bbox, rois_xywh[ipos])
-        cls_t[ipos] = label
-        ann_indices[ipos] = ann_id
+    return _sample_rois(loc_t, cls_t, ann_indices, n_samples, pos_neg_ratio)
 
-    pos = cls_t != 0
-    n_pos = int(n_samples * pos_neg_ratio / (pos_neg_ratio + 1))
-    n_neg = n_samples - n_pos
-    pos_indices = sample(torch.nonzero(pos).squeeze(1), n_pos)
-    neg_indices = sample(torch.nonzero(~pos).squeeze(1), n_neg)
-    loc_t = loc_t[pos_indices]
-    indices = torch.cat([pos_indices, neg_indices], dim=0)
-    cls_t = cls_t[indices]
-
-    mask_t = loc_t.new_zeros(n_pos, *mask_size)
-    for i in range(n_pos):
-        ind = pos_indices[i]
-        mask = anns[ann_indices[ind]]['segmentation']
-        height, width = mask.shape
-        l, t, r, b = rois[ind]
-        l = max(0, int(l * width))
-        t = max(0, int(t * height))
-        r = int(r * width)
-        b = int(b * height)
-        m = mask[t:b, l:r].float()
-        m = m.view(1, 1, *m.size())
-        m = F.interpolate(m, size=mask_size).squeeze()
-        mask_t[i] = m
-    return loc_t, cls_t, mask_t, indices
 
-
-def match_rois2(anns, rois, pos_thresh=0.5, mask_size=(14, 14), n_samples=64, pos_neg_ratio=1 / 3):
+def _match_rois2(anns, rois, pos_thresh=0.5, n_samples=64, pos_neg_ratio=1 / 3):
     num_rois = len(rois)
     if len(anns) == 0:
         loc_t = rois.new_zeros(num_rois, 4)
         cls_t = loc_t.new_zeros(num_rois, dtype=torch.long)
-        return loc_t, cls_t
+        ann_indices = torch.zeros(num_rois, dtype=torch.long, device=rois.device)
+        return _sample_rois(loc_t, cls_t, ann_indices, n_samples, pos_neg_ratio)
 
     rois_xywh = BBox.convert(rois, BBox.LTRB, BBox.XYWH)
 
@@ -96,33 +229,22 @@ def match_rois2(anns, rois, pos_thresh=0.5, mask_size=(14, 14), n_samples=64, po
     cls_t[max_indices] = labels
 
     ann_indices[max_indices] = torch.arange(len(anns), device=rois.device)
+    return _sample_rois(loc_t, cls_t, ann_indices, n_samples, pos_neg_ratio)
 
-    pos = cls_t != 0
-    n_pos = int(n_samples * pos_neg_ratio / (pos_neg_ratio + 1))
-    n_neg = n_samples - n_pos
-    pos_indices = sample(torch.nonzero(pos).squeeze(1), n_pos)
-    neg_indices = sample(torch.nonzero(~pos).squeeze(1), n_neg)
-    loc_t = loc_t[pos_indices]
-    indices = torch.cat([pos_indices, neg_indices], dim=0)
-    cls_t = cls_t[indices]
 
-    mask_t = loc_t.new_zeros(n_pos, *mask_size)
-    for i in range(n_pos):
-        ind = pos_indices[i]
-        mask = anns[ann_indices[ind]]['segmentation']
-        height, width = mask.shape
-        l, t, r, b = rois[ind]
-        l = max(0, int(l * width))
-        t = max(0, int(t * height))
-        r = int(r * width)
-        b = int(b * height)
-        m = mask[t:b, l:r].float()
-        m = m.view(1, 1, *m.size())
-        m = F.interpolate(m, size=mask_size).squeeze()
-        mask_t[i] = m
+def match_rois(anns, rois, pos_thresh=0.5, mask_size=(14, 14), n_samples=64, pos_neg_ratio=1 / 3):
+    loc_t, cls_t, indices, pos_ann_indices = _match_rois(anns, rois, pos_thresh, n_samples, pos_neg_ratio)
+    mask_t = mask_targets(
+        [ann['segmentation'] for ann in anns], pos_ann_indices, rois[indices[:len(loc_t)]], mask_size)
     return loc_t, cls_t, mask_t, indices
 
 
+def match_rois2(anns, rois, pos_thresh=0.5, mask_size=(14, 14), n_samples=64, pos_neg_ratio=1 / 3):
+    loc_t, cls_t, indices, pos_ann_indices = _match_rois2(anns, rois, pos_thresh, n_samples, pos_neg_ratio)
+    mask_t = mask_targets(
+        [ann['segmentation'] for ann in anns], pos_ann_indices, rois[indices[:len(loc_t)]], mask_size)
+    return loc_t, cls_t, mask_t, indices
+
 
 @curry
 def inference_rois(loc_p, cls_p, anchors, iou_threshold=0.5, topk=100, conf_strategy='softmax'):
@@ -139,13 +261,11 @@ def inference_rois(loc_p, cls_p, anchors, iou_threshold=0.5, topk=100, conf_stra
     bboxes = BBox.convert(
         loc_p, format=BBox.XYWH, to=BBox.LTRB, inplace=True)
 
+    image_indices = batched_nms(bboxes, scores, iou_threshold=iou_threshold)
     rois = []
-    for i in range(len(loc_p)):
-        ibboxes = bboxes[i]
-        iscores = scores[i]
-        indices = nms(ibboxes, iscores, iou_threshold)
-        ibboxes = ibboxes[indices]
-        iscores = iscores[indices]
+    for i, indices in enumerate(image_indices):
+        ibboxes = bboxes[i][indices]
+        iscores = scores[i][indices]
         if len(indices) > topk:
             indices = iscores.topk(topk)[1]
             ibboxes = ibboxes[indices]
@@ -192,25 +312,35 @@ class MatchRoIs:
 
     def __call__(self, rois, image_gts):
         is_cpu = rois.device.type != 'cpu'
-        match_func = match_rois if is_cpu else match_rois2
+        match_func = _match_rois if is_cpu else _match_rois2
         rois_ltrb = rois[..., 1:]
 
         loc_targets = []
         cls_targets = []
-        mask_targets = []
         sampled_rois = []
+        segms = []
+        segm_indices = []
+        pos_rois = []
         for i in range(len(rois)):
-            loc_t, cls_t, mask_t, indices = match_func(
-                image_gts[i], rois_ltrb[i], self.pos_thresh, self.mask_size, self.n_samples, self.pos_neg_ratio)
+            anns = image_gts[i]
+            loc_t, cls_t, indices, pos_ann_indices = match_func(
+                anns, rois_ltrb[i], self.pos_thresh, self.n_samples, self.pos_neg_ratio)
             loc_targets.append(loc_t)
             cls_targets.append(cls_t)
-            mask_targets.append(mask_t)
             sampled_rois.append(rois[i][indices])
+            segm_indices.append(pos_ann_indices + len(segms))
+            pos_rois.append(rois_ltrb[i][indices[:len(loc_t)]])
+            segms.extend(ann['segmentation'] for ann in anns)
         loc_t = torch.cat(loc_targets, dim=0)
         cls_t = torch.cat(cls_targets, dim=0)
-        mask_t = torch.cat(mask_targets, dim=0)
         rois = torch.cat(sampled_rois, dim=0)
 
+        # Mask targets of all images in one RoIAlign
+        segm_indices = torch.cat(segm_indices, dim=0)
+        used, segm_indices = torch.unique(segm_indices, return_inverse=True)
+        mask_t = mask_targets(
+            [segms[j] for j in used.tolist()], segm_indices, torch.cat(pos_rois, dim=0), self.mask_size)
+
         return loc_t, cls_t, mask_t, rois
 
 
@@ -276,28 +406,20 @@ def roi_based_inference(
             indices = indices[scores[indices].topk(topk)[1]]
         else:
             warnings.warn("Only %d RoIs left after nms rather than top %d" % (len(scores), topk))
+    elif nms_method in ['matrix', 'cluster']:
+        indices, scores = parallel_nms(bboxes, scores, nms_method, iou_threshold, topk)
     else:
         indices = soft_nms_cpu(
             bboxes, scores, iou_threshold, topk)
     bboxes = BBox.convert(
         bboxes, format=BBox.LTRB, to=BBox.LTWH, inplace=True)
 
+    masks = None
     if predict_mask is not None:
         mask_p = predict_mask(indices)
-        masks = (select(mask_p, 1, labels[indices]).sigmoid_() > 0.5).cpu().numpy()
-
-    dets = []
-    for i, ind in enumerate(indices):
-        det = {
-            'image_id': -1,
-            'category_id': labels[ind].item() + 1,
-            'bbox': bboxes[ind].tolist(),
-            'score': scores[ind].item(),
-        }
-        if predict_mask:
-            det['segmentation'] = masks[i]
-        dets.append(det)
-    return dets
+        masks = list((select(mask_p, 1, labels[indices]).sigmoid_() > 0.5).cpu().numpy())
+
+    return Detections.single(bboxes, scores, labels + 1, indices, masks)
 
 
 class RoIBasedInference:
@@ -318,4 +440,4 @@ class RoIBasedInference:
                 rois[i], loc_p[i], cls_p[i], lambda indices: predict_mask(i, indices),
                 self.iou_threshold, self.topk, self.nms_method)
             image_dets.append(dets)
-        return image_dets
+        return Detections.cat(image_dets)
@@ -6,9 +6,11 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from horch.common import one_hot, _tuple, _concat
-from horch.detection import soft_nms_cpu, BBox, nms
+from horch.detection import soft_nms_cpu, BBox, nms, multiclass_nms
+from horch.detection.anchor_cache import is_grid, image_size
+from horch.detection.detections import Detections
+from horch.detection.postprocess import parallel_nms
 from horch.models.detection.head import RetinaHead, to_pred
-from horch.transforms.detection.functional import to_percent_coords
 from horch.nn.loss import focal_loss2, iou_loss
 from horch.models.detection import OneStageDetector
 from torch import nn as nn
@@ -45,11 +47,9 @@ def get_mlvl_centers(locations, strides):
     for location, stride in zip(locations, strides):
         lx, ly = _tuple(location, 2)
         sw, sh = _tuple(stride, 2)
-        centers = torch.zeros(lx, ly, 2)
-        centers[..., 0] = (torch.arange(
-            lx, dtype=torch.float).view(lx, 1).expand(lx, ly) * sw + sw // 2)
-        centers[..., 1] = (torch.arange(
-            ly, dtype=torch.float).view(1, ly).expand(lx, ly) * sh + sh // 2)
+        cx = torch.arange(lx, dtype=torch.float).mul_(sw).add_(sw // 2)
+        cy = torch.arange(ly, dtype=torch.float).mul_(sh).add_(sh // 2)
+        centers = torch.stack((cx.view(lx, 1).expand(lx, ly), cy.view(1, ly).expand(lx, ly)), dim=-1)
         mlvl_centers.append(centers)
     return mlvl_centers
 
@@ -65,55 +65,104 @@ def centerness(loc_t):
     return c
 
 
-class FCOSTransform:
+def assign_targets(centers, ranges, boxes, labels, ambiguity='last'):
+    r"""
+    Assign ground truths to the locations of all levels in one pass.
+
+    Parameters
+    ----------
+    centers : torch.Tensor
+        Centers of the locations of all levels of shape `(P, 2)`.
+    ranges : torch.Tensor
+        Range `[lo, hi)` of the maximal regression target of the level of every location,
+        of shape `(P, 2)`.
+    boxes : torch.Tensor
+        Ground truth boxes in LTRB format of shape `(G, 4)`.
+    labels : torch.Tensor
+        Labels of the ground truths of shape `(G,)`.
+    ambiguity : str
+        How to assign a location inside several boxes. `last` takes the last box in
+        `boxes`, `area` takes the box with minimal area as in the paper.
+
+    Returns
+    -------
+    loc_t, cls_t, ctn_t : torch.Tensor
+        Targets of shape `(P, 4)`, `(P,)` and `(P,)`.
+    """
+    cx, cy = centers[:, None, 0], centers[:, None, 1]
+    l, t, r, b = boxes.t()
+    # (P, G)
+    mask = (l < cx) & (cx < r) & (t < cy) & (cy < b)
+    max_t = torch.max(torch.max(cx - l, cy - t), torch.max(r - cx, b - cy))
+    mask &= (max_t >= ranges[:, :1]) & (max_t < ranges[:, 1:])
+
+    pos = mask.any(dim=1)
+    if ambiguity == 'area':
+        areas = (r - l) * (b - t)
+        indices = areas.expand_as(max_t).masked_fill(~mask, inf).argmin(dim=1)
+    else:
+        order = torch.arange(1, len(boxes) + 1, device=boxes.device)
+        indices = (mask * order).argmax(dim=1)
+
+    # Targets of the assigned boxes only, instead of a (P, G, 4) tensor
+    cx, cy = centers[:, 0], centers[:, 1]
+    l, t, r, b = boxes[indices].t()
+    loc_t = torch.stack([cx - l, cy - t, r - cx, b - cy], dim=-1).masked_fill_(~pos[:, None], 0)
+    cls_t = labels[indices].masked_fill_(~pos, 0)
+    ctn_t = centers.new_zeros(len(centers))
+    ctn_t[pos] = centerness(loc_t[pos])
+    return loc_t, cls_t, ctn_t
+
 
-    def __init__(self, mlvl_centers, thresholds=(0, 64, 128, 256, 512, inf), get_label=lambda x: x["category_id"]):
+class FCOSTransform:
+    r"""
+    Parameters
+    ----------
+    mlvl_centers : List[torch.Tensor] or MlvlCenters
+        Centers of every level of shape `(lx, ly, 2)`, or `MlvlCenters` to look them up by image size.
+    thresholds : Sequence[float]
+        Bounds of the ranges of the maximal regression target of consecutive levels.
+    get_label : callable
+        Label of an annotation.
+    ambiguity : str
+        `last` or `area`, see `assign_targets`.
+    """
+
+    def __init__(self, mlvl_centers, thresholds=(0, 64, 128, 256, 512, inf), get_label=lambda x: x["category_id"],
+                 ambiguity='last'):
+        assert ambiguity in ['last', 'area'], "ambiguity must be last or area"
         self.mlvl_centers = mlvl_centers
         self.thresholds = list(zip(thresholds[:-1], thresholds[1:]))
         self.get_label = get_label
+        self.ambiguity = ambiguity
 
     def __call__(self, img, anns):
-        loc_targets = []
-        cls_targets = []
-        ctn_targets = []
-        for centers in self.mlvl_centers:
-            lx, ly = centers.size()[:2]
-            loc_targets.append(torch.zeros(lx, ly, 4))
-            cls_targets.append(torch.zeros(lx, ly, dtype=torch.long))
-            ctn_targets.append(torch.zeros(lx, ly))
-
-        for ann in anns:
-            label = self.get_label(ann)
-            l, t, w, h = ann['bbox']
-            r = l + w
-            b = t + h
-            for centers, threshold, loc_t, cls_t, ctn_t in zip(self.mlvl_centers, self.thresholds, loc_targets,
-                                                               cls_targets, ctn_targets):
-                lo, hi = threshold
-                cx = centers[..., 0]
-                cy = centers[..., 1]
-                mask = (l < cx) & (cx < r) & (t < cy) & (cy < b)
-                ts = torch.stack([cx - l, cy - t, r - cx, b - cy], dim=-1)
-                max_t = ts.max(dim=-1)[0]
-                mask &= (max_t >= lo) & (max_t < hi)
-                if not mask.any():
-                    continue
-                loc_t[mask] = ts[mask]
-                cls_t[mask] = label
-                ctn_t[mask] = centerness(loc_t[mask])
-
-        loc_t = torch.cat([t.view(-1, 4) for t in loc_targets], dim=0)
-        cls_t = torch.cat([t.view(-1) for t in cls_targets], dim=0)
-        ctn_t = torch.cat([t.view(-1) for t in ctn_targets], dim=0)
-
+        mlvl_centers = self.mlvl_centers
+        if is_grid(mlvl_centers):
+            mlvl_centers = mlvl_centers.mlvl(image_size(img))
+        centers = torch.cat([c.reshape(-1, 2) for c in mlvl_centers], dim=0)
+        ranges = torch.cat([
+            centers.new_tensor(threshold).expand(c.size(0) * c.size(1), 2)
+            for c, threshold in zip(mlvl_centers, self.thresholds)
+        ], dim=0)
+
+        if len(anns) == 0:
+            return img, [torch.zeros(len(centers), 4), torch.zeros(len(centers), dtype=torch.long),
+                         torch.zeros(len(centers))]
+
+        boxes = torch.tensor(
+            [[l, t, l + w, t + h] for l, t, w, h in (ann['bbox'] for ann in anns)], dtype=centers.dtype)
+        labels = torch.tensor([self.get_label(ann) for ann in anns], dtype=torch.long)
+        loc_t, cls_t, ctn_t = assign_targets(centers, ranges, boxes, labels, self.ambiguity)
         return img, [loc_t, cls_t, ctn_t]
 
 
 class FCOSLoss(nn.Module):
-    def __init__(self, use_ctn=True, p=0.1):
+    def __init__(self, use_ctn=True, p=0.1, iou_kind='iou'):
         super().__init__()
         self.use_ctn = use_ctn
         self.p = p
+        self.iou_kind = iou_kind
 
     def forward(self, loc_p, cls_p, ctn_p, loc_t, cls_t, ctn_t):
         loc_p = loc_p.exp()
@@ -121,7 +170,7 @@ class FCOSLoss(nn.Module):
         num_pos = pos.sum().item()
         if num_pos == 0:
             return loc_p.new_tensor(0, requires_grad=True)
-        loc_loss = iou_loss(loc_p[pos], loc_t[pos], reduction='sum') / num_pos
+        loc_loss = iou_loss(loc_p[pos], loc_t[pos], reduction='sum', kind=self.iou_kind) / num_pos
         cls_t = one_hot(cls_t, C=cls_p.size(-1))
         cls_loss = focal_loss2(cls_p, cls_t, reduction='sum') / num_pos
         if self.use_ctn:
@@ -140,21 +189,30 @@ class FCOSLoss(nn.Module):
 
 def center_based_inference(
         size, loc_p, cls_p, ctn_p, centers, conf_threshold=0.01,
-        iou_threshold=0.5, topk=100, nms_method='soft_nms', use_ctn=True):
-    dets = []
+        iou_threshold=0.5, topk=100, nms_method='soft_nms', use_ctn=True, max_per_class=None):
     bboxes = loc_p.exp_()
-    scores, labels = cls_p[:, 1:].max(dim=-1)
-    scores = scores.sigmoid_()
-    if use_ctn:
-        centerness = ctn_p.sigmoid_()
-        scores = scores.mul_(centerness)
-
-    if conf_threshold > 0:
-        mask = scores > conf_threshold
-        scores = scores[mask]
-        labels = labels[mask]
+    if nms_method == 'multiclass':
+        scores = cls_p[:, 1:].sigmoid()
+        if use_ctn:
+            centerness = ctn_p.sigmoid_()
+            scores = scores.mul_(centerness[:, None])
+        mask, labels = torch.nonzero(scores > conf_threshold).t()
+        scores = scores[mask, labels]
         bboxes = bboxes[mask]
         centers = centers[mask]
+    else:
+        scores, labels = cls_p[:, 1:].max(dim=-1)
+        scores = scores.sigmoid_()
+        if use_ctn:
+            centerness = ctn_p.sigmoid_()
+            scores = scores.mul_(centerness)
+
+        if conf_threshold > 0:
+            mask = scores > conf_threshold
+            scores = scores[mask]
+            labels = labels[mask]
+            bboxes = bboxes[mask]
+            centers = centers[mask]
 
     cx = centers[:, 0]
     cy = centers[:, 1]
@@ -176,22 +234,20 @@ def center_based_inference(
             indices = scores.topk(topk)[1]
         else:
             indices = range(scores.size(0))
+    elif nms_method == 'multiclass':
+        labels = labels.cpu()
+        indices = multiclass_nms(
+            bboxes, scores, labels, iou_threshold, max_per_class, topk)
+    elif nms_method in ['matrix', 'cluster']:
+        indices, scores = parallel_nms(
+            bboxes, scores, nms_method, iou_threshold, topk, min_score=conf_threshold)
     else:
         indices = soft_nms_cpu(
             bboxes, scores, iou_threshold, topk, min_score=conf_threshold)
     bboxes = BBox.convert(
         bboxes, format=BBox.LTRB, to=BBox.LTWH, inplace=True)
-    for ind in indices:
-        det = {
-            'image_id': -1,
-            'category_id': labels[ind].item() + 1,
-            'bbox': bboxes[ind].tolist(),
-            'score': scores[ind].item(),
-            'absolute': True,
-        }
-        dets.append(det)
-    dets = to_percent_coords(dets, size)
-    return dets
+    bboxes = BBox.to_percent(bboxes, size)
+    return Detections.single(bboxes, scores, labels + 1, indices)
 
 
 def flatten(xs):
@@ -204,27 +260,32 @@ def flatten(xs):
 class FCOSInference:
 
     def __init__(self, size, mlvl_centers, conf_threshold=0.05, iou_threshold=0.5, topk=100, nms='nms',
-                 soft_nms_threshold=None, use_ctn=True):
+                 soft_nms_threshold=None, use_ctn=True, max_per_class=None):
         self.size = size
-        self.centers = flatten(mlvl_centers)
+        self.centers = mlvl_centers if is_grid(mlvl_centers) else flatten(mlvl_centers)
         self.conf_threshold = conf_threshold
         self.iou_threshold = iou_threshold
         self.topk = topk
         self.nms = nms
         self.soft_nms_threshold = soft_nms_threshold
         self.use_ctn = use_ctn
+        self.max_per_class = max_per_class
 
-    def __call__(self, loc_p, cls_p, ctn_p):
+    def __call__(self, loc_p, cls_p, ctn_p, size=None):
+        size = size or self.size
+        centers = self.centers
+        if is_grid(centers):
+            centers = centers(size, loc_p.dtype, loc_p.device)
         image_dets = []
         batch_size = loc_p.size(0)
         for i in range(batch_size):
             dets = center_based_inference(
-                self.size, loc_p[i], cls_p[i], ctn_p[i], self.centers,
+                size, loc_p[i], cls_p[i], ctn_p[i], centers,
                 self.conf_threshold, self.iou_threshold,
-                self.topk, self.nms, self.use_ctn
+                self.topk, self.nms, self.use_ctn, self.max_per_class
             )
             image_dets.append(dets)
-        return image_dets
+        return Detections.cat(image_dets)
 
 
 class FCOS(OneStageDetector):
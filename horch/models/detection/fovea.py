@@ -5,7 +5,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from horch.common import one_hot, _tuple, _concat
-from horch.detection import soft_nms_cpu, BBox, nms
+from horch.detection.anchor_cache import is_grid, image_size
+from horch.detection.postprocess import select_candidates, topk_per_image, batched_detections
 from horch.nn.loss import focal_loss2
 
 
@@ -13,11 +14,9 @@ def get_mlvl_centers(locations):
     mlvl_centers = []
     for location in locations:
         lx, ly = _tuple(location, 2)
-        centers = torch.zeros(lx, ly, 2)
-        centers[..., 0] = torch.arange(
-            lx, dtype=torch.float).view(lx, 1).expand(lx, ly) + 0.5
-        centers[..., 1] = torch.arange(
-            ly, dtype=torch.float).view(1, ly).expand(lx, ly) + 0.5
+        cx = torch.arange(lx, dtype=torch.float).add_(0.5)
+        cy = torch.arange(ly, dtype=torch.float).add_(0.5)
+        centers = torch.stack((cx.view(lx, 1).expand(lx, ly), cy.view(1, ly).expand(lx, ly)), dim=-1)
         mlvl_centers.append(centers)
     return mlvl_centers
 
@@ -37,63 +36,157 @@ DEFAULT_AREA_THRESHOLDS = tuple(
 )
 
 
+def assign_targets(mlvl_centers, boxes, labels, levels, thresholds,
+                   shrunk_pos=0.3, shrunk_neg=0.4, ambiguity='last'):
+    r"""
+    Assign ground truths to the locations of all levels in one pass.
+
+    Only the cells around the fovea region of every valid (box, level) pair are visited, so the
+    cost scales with the area of the regions instead of #locations x #boxes.
+
+    Parameters
+    ----------
+    mlvl_centers : List[torch.Tensor]
+        Centers `(i + 0.5, j + 0.5)` of the locations of every level, of shape `(lx, ly, 2)`.
+    boxes : torch.Tensor
+        Ground truth boxes in LTWH format of shape `(G, 4)`. Float64 keeps the rounding of the
+        per-annotation computation.
+    labels : torch.Tensor
+        Labels of the ground truths of shape `(G,)`.
+    levels : Sequence[int]
+        Level of every feature map, whose stride is `2 ** level`.
+    thresholds : Sequence[tuple]
+        Range `(lo, hi)` of box areas of every level.
+    shrunk_pos, shrunk_neg : float
+        Scale of the positive and ignored fovea regions.
+    ambiguity : str
+        How to assign a location inside the positive regions of several boxes. `last` takes
+        the last box in `boxes`, `area` takes the box with minimal area.
+
+    Returns
+    -------
+    loc_t, cls_t, ignore : torch.Tensor
+        Targets of the concatenated locations of shape `(P, 4)`, `(P,)` and `(P,)`.
+    """
+    centers = torch.cat([c.reshape(-1, 2) for c in mlvl_centers], dim=0)
+    dtype = centers.dtype
+    num_locations = len(centers)
+    sizes = torch.tensor([c.size()[:2] for c in mlvl_centers])
+    counts = sizes[:, 0] * sizes[:, 1]
+    starts = counts.cumsum(0) - counts
+
+    l, t, w, h = boxes[:, :, None].unbind(dim=1)
+    area = w * h
+    lo, hi = boxes.new_tensor(thresholds).t()
+    scales = boxes.new_tensor([2 ** level for level in levels])
+    # (G, L)
+    l_, t_, w_, h_ = l / scales, t / scales, w / scales, h / scales
+    r_, b_ = (l + w) / scales, (t + h) / scales
+    cx_ = l_ + 0.5 * w_
+    cy_ = t_ + 0.5 * h_
+
+    # Valid (box, level) pairs and the cells covering their ignored region, which contains
+    # the positive one.
+    gs, ls = torch.nonzero((area > lo) & (area < hi)).t()
+    l_neg, t_neg, r_neg, b_neg = [c[gs, ls] for c in get_fovea(cx_, cy_, w_, h_, shrunk_neg)]
+    lx, ly = sizes[ls].t()
+    x0 = (l_neg - 0.5).floor_().long().clamp_(min=0)
+    y0 = (t_neg - 0.5).floor_().long().clamp_(min=0)
+    x1 = torch.min((r_neg - 0.5).ceil_().long(), lx - 1)
+    y1 = torch.min((b_neg - 0.5).ceil_().long(), ly - 1)
+    nx = (x1 - x0 + 1).clamp_(min=0)
+    ny = (y1 - y0 + 1).clamp_(min=0)
+
+    # (M,) candidate (pair, cell)
+    pairs = torch.arange(len(gs)).repeat_interleave(nx * ny)
+    cell_starts = (nx * ny).cumsum(0) - nx * ny
+    k = torch.arange(len(pairs)) - cell_starts[pairs]
+    ix = x0[pairs] + k // ny[pairs]
+    iy = y0[pairs] + k % ny[pairs]
+    gs, ls = gs[pairs], ls[pairs]
+    points = starts[ls] + ix * sizes[ls, 1] + iy
+    cx, cy = centers[points].t()
+
+    def inside(shrunk):
+        l_f, t_f, r_f, b_f = [c[gs, ls].to(dtype) for c in get_fovea(cx_, cy_, w_, h_, shrunk)]
+        return (l_f < cx) & (cx < r_f) & (t_f < cy) & (cy < b_f)
+
+    ignore = torch.zeros(num_locations, dtype=torch.bool)
+    ignore[points[inside(shrunk_neg)]] = True
+
+    pos = inside(shrunk_pos)
+    points, gs = points[pos], gs[pos]
+    if ambiguity == 'area':
+        # Rank of every box by (area, index), the minimal rank wins
+        order = torch.sort(area[:, 0], stable=True)[1]
+        ranks = torch.empty_like(order)
+        ranks[order] = torch.arange(len(order))
+        keys = ranks[gs]
+    else:
+        keys = -gs
+    winner = torch.full((num_locations,), len(boxes), dtype=torch.long).scatter_reduce_(
+        0, points, keys, 'amin')
+    assigned = winner != len(boxes)
+    indices = winner[assigned]
+    indices = order[indices] if ambiguity == 'area' else -indices
+
+    points = torch.nonzero(assigned)[:, 0]
+    level_idxs = torch.arange(len(levels)).repeat_interleave(counts)[points]
+    l_, t_, r_, b_ = [c[indices, level_idxs].to(dtype) for c in (l_, t_, r_, b_)]
+    cx, cy = centers[points].t()
+    loc_t = centers.new_zeros(num_locations, 4)
+    loc_t[points] = (torch.stack([cx - l_, cy - t_, r_ - cx, b_ - cy], dim=-1) / 4).log_()
+    cls_t = torch.zeros(num_locations, dtype=torch.long)
+    cls_t[points] = labels[indices]
+    return loc_t, cls_t, ignore & ~assigned
+
+
 class FoveaTransform:
+    r"""
+    Parameters
+    ----------
+    mlvl_centers : List[torch.Tensor] or MlvlCenters
+        Centers of every level of shape `(lx, ly, 2)`, or `MlvlCenters` with unit `grid` to look
+        them up by image size.
+    levels : Sequence[int]
+        Level of every feature map, whose stride is `2 ** level`.
+    thresholds : Sequence[tuple]
+        Range `(lo, hi)` of box areas of every level.
+    shrunk_pos, shrunk_neg : float
+        Scale of the positive and ignored fovea regions.
+    get_label : callable
+        Label of an annotation.
+    ambiguity : str
+        `last` or `area`, see `assign_targets`.
+    """
 
     def __init__(self, mlvl_centers, levels=(3, 4, 5, 6, 7),
                  thresholds=DEFAULT_AREA_THRESHOLDS,
-                 shrunk_pos=0.3, shrunk_neg=0.4, get_label=lambda x: x["category_id"]):
+                 shrunk_pos=0.3, shrunk_neg=0.4, get_label=lambda x: x["category_id"], ambiguity='last'):
+        assert ambiguity in ['last', 'area'], "ambiguity must be last or area"
         self.mlvl_centers = mlvl_centers
         self.levels = levels
         self.thresholds = thresholds
         self.shrunk_pos = shrunk_pos
         self.shrunk_neg = shrunk_neg
         self.get_label = get_label
+        self.ambiguity = ambiguity
 
     def __call__(self, img, anns):
-        loc_targets = []
-        cls_targets = []
-        ignores = []
-        for centers in self.mlvl_centers:
-            lx, ly = centers.size()[:2]
-            loc_targets.append(torch.zeros(lx, ly, 4))
-            cls_targets.append(torch.zeros(lx, ly, dtype=torch.long))
-            ignores.append(torch.zeros(lx, ly, dtype=torch.uint8))
-
-        for ann in anns:
-            label = self.get_label(ann)
-            l, t, w, h = ann['bbox']
-            area = w * h
-            r = l + w
-            b = t + h
-            for level, centers, threshold, loc_t, cls_t, ignore in zip(
-                    self.levels, self.mlvl_centers, self.thresholds, loc_targets, cls_targets, ignores):
-                lo, hi = threshold
-                if area <= lo or area >= hi:
-                    continue
-
-                l_, t_, r_, b_, w_, h_ = [c / (2 ** level) for c in [l, t, r, b, w, h]]
-                cx_ = l_ + 0.5 * w_
-                cy_ = t_ + 0.5 * h_
-
-                l_pos, t_pos, r_pos, b_pos = get_fovea(cx_, cy_, w_, h_, self.shrunk_pos)
-                l_neg, t_neg, r_neg, b_neg = get_fovea(cx_, cy_, w_, h_, self.shrunk_neg)
-
-                cx = centers[..., 0]
-                cy = centers[..., 1]
-                pos = (l_pos < cx) & (cx < r_pos) & (t_pos < cy) & (cy < b_pos)
-                ignore |= (l_neg < cx) & (cx < r_neg) & (t_neg < cy) & (cy < b_neg)
-                if not pos.any():
-                    continue
-                ts = (torch.stack([cx - l_, cy - t_, r_ - cx, b_ - cy], dim=-1) / 4).log_()
-                loc_t[pos] = ts[pos]
-                cls_t[pos] = label
-
-        loc_t = torch.cat([t.view(-1, 4) for t in loc_targets], dim=0)
-        cls_t = torch.cat([t.view(-1) for t in cls_targets], dim=0)
-        ignore = torch.cat([t.view(-1) for t in ignores], dim=0)
-        ignore = ignore & (cls_t == 0)
-
-        return img, [loc_t, cls_t, ignore]
+        mlvl_centers = self.mlvl_centers
+        if is_grid(mlvl_centers):
+            mlvl_centers = mlvl_centers.mlvl(image_size(img))
+        if len(anns) == 0:
+            num_locations = sum(c.size(0) * c.size(1) for c in mlvl_centers)
+            return img, [torch.zeros(num_locations, 4), torch.zeros(num_locations, dtype=torch.long),
+                         torch.zeros(num_locations, dtype=torch.uint8)]
+
+        boxes = torch.tensor([ann['bbox'] for ann in anns], dtype=torch.float64)
+        labels = torch.tensor([self.get_label(ann) for ann in anns], dtype=torch.long)
+        loc_t, cls_t, ignore = assign_targets(
+            mlvl_centers, boxes, labels, self.levels, self.thresholds,
+            self.shrunk_pos, self.shrunk_neg, self.ambiguity)
+        return img, [loc_t, cls_t, ignore.to(torch.uint8)]
 
 
 class FoveaLoss(nn.Module):
@@ -122,100 +215,84 @@ class FoveaLoss(nn.Module):
         return loss
 
 
+def fovea_batch_inference(
+        loc_preds, cls_preds, mlvl_centers, conf_threshold=0.05, iou_threshold=0.5,
+        topk1=1000, nms_method='soft_nms', topk2=100, max_per_class=None):
+    r"""
+    Decode, score and filter the predictions of all levels of a batch of images at once, and
+    run nms over the candidates of all images.
+
+    Parameters
+    ----------
+    loc_preds : Sequence[torch.Tensor]
+        Predicted targets of every level, each of shape `(B, lx * ly, 4)`.
+    cls_preds : Sequence[torch.Tensor]
+        Class logits (with background) of every level, each of shape `(B, lx * ly, C)`.
+    mlvl_centers : Sequence[torch.Tensor]
+        Centers of every level, each of shape `(lx, ly, 2)`.
+
+    Returns
+    -------
+    Detections
+    """
+    loc_p = torch.cat(list(loc_preds), dim=1)
+    cls_p = torch.cat(list(cls_preds), dim=1)
+    centers = torch.cat([c.view(-1, 2) for c in mlvl_centers], dim=0)
+    # (lx, ly) of the level of every location
+    scales = torch.cat([
+        centers.new_tensor(c.size()[:2]).expand(c.size(0) * c.size(1), 2)
+        for c in mlvl_centers
+    ], dim=0)
+
+    scores = torch.sigmoid(cls_p[..., 1:])
+    batch_idxs, indices, scores, labels = select_candidates(
+        scores, conf_threshold, nms_method == 'multiclass')
+
+    bboxes = loc_p[batch_idxs, indices].exp_().mul_(4)
+    centers = centers[indices]
+    bboxes[:, :2] = centers - bboxes[:, :2]
+    bboxes[:, 2:] += centers
+    bboxes.div_(scales[indices].repeat(1, 2))
+
+    indices = topk_per_image(scores, batch_idxs, topk1, loc_p.size(0))
+    bboxes, scores, labels, batch_idxs = bboxes[indices], scores[indices], labels[indices], batch_idxs[indices]
+
+    if nms_method not in ['nms', 'multiclass', 'matrix', 'cluster']:
+        nms_method = 'soft'
+    return batched_detections(
+        bboxes, scores, labels, batch_idxs, loc_p.size(0), nms_method,
+        iou_threshold, topk2, conf_threshold, max_per_class)
+
+
 def fovea_inference(
         loc_preds, cls_preds, mlvl_centers, conf_threshold=0.05, iou_threshold=0.5,
-        topk1=1000, nms_method='soft_nms', topk2=100):
-    dets = []
-    mlvl_scores = []
-    mlvl_labels = []
-    mlvl_bboxes = []
-    for loc_p, cls_p, centers in zip(loc_preds, cls_preds, mlvl_centers):
-        lx, ly = centers.size()[:2]
-        centers = centers.view(-1, 2)
-        bboxes = loc_p
-        scores, labels = cls_p[:, 1:].max(dim=-1)
-        scores = scores.sigmoid_()
-        pos = scores > conf_threshold
-        scores = scores[pos]
-        if len(scores) == 0:
-            continue
-        labels = labels[pos]
-        bboxes = bboxes[pos]
-        centers = centers[pos]
-
-        bboxes.exp_().mul_(4)
-
-        bboxes[:, :2] = centers - bboxes[:, :2]
-        bboxes[:, 2:] += centers
-
-        bboxes[:, [0, 2]] /= lx
-        bboxes[:, [1, 3]] /= ly
-
-        mlvl_scores.append(scores)
-        mlvl_labels.append(labels)
-        mlvl_bboxes.append(bboxes)
-
-    if len(mlvl_scores) == 0:
-        return []
-
-    scores = torch.cat(mlvl_scores, dim=0)
-    labels = torch.cat(mlvl_labels, dim=0)
-    bboxes = torch.cat(mlvl_bboxes, dim=0)
-
-    if len(scores) > topk1:
-        scores, indices = scores.topk(topk1)
-        labels = labels[indices]
-        bboxes = bboxes[indices]
-
-    scores = scores.cpu()
-    bboxes = bboxes.cpu()
-
-    if nms_method == 'nms':
-        indices = nms(bboxes, scores, iou_threshold)
-        scores = scores[indices]
-        labels = labels[indices]
-        bboxes = bboxes[indices]
-        if scores.size(0) > topk2:
-            indices = scores.topk(topk2)[1]
-        else:
-            indices = range(scores.size(0))
-    else:
-        indices = soft_nms_cpu(
-            bboxes, scores, iou_threshold, topk2, min_score=conf_threshold)
-    bboxes = BBox.convert(
-        bboxes, format=BBox.LTRB, to=BBox.LTWH, inplace=True)
-    for ind in indices:
-        det = {
-            'image_id': -1,
-            'category_id': labels[ind].item() + 1,
-            'bbox': bboxes[ind].tolist(),
-            'score': scores[ind].item(),
-        }
-        dets.append(det)
-    return dets
+        topk1=1000, nms_method='soft_nms', topk2=100, max_per_class=None):
+    return fovea_batch_inference(
+        [p[None] for p in loc_preds], [p[None] for p in cls_preds], mlvl_centers,
+        conf_threshold, iou_threshold, topk1, nms_method, topk2, max_per_class)
 
 
 class FoveaInference:
 
     def __init__(self, mlvl_centers, conf_threshold=0.05, iou_threshold=0.5,
-                 topk1=1000, nms_method='soft_nms', topk2=100):
+                 topk1=1000, nms_method='soft_nms', topk2=100, max_per_class=None, size=None):
         self.mlvl_centers = mlvl_centers
+        self.size = size
         self.conf_threshold = conf_threshold
         self.iou_threshold = iou_threshold
         self.topk1 = topk1
         self.nms_method = nms_method
         self.topk2 = topk2
-
-    def __call__(self, loc_preds, cls_preds):
-        image_dets = []
-        batch_size = loc_preds[0].size(0)
-        for i in range(batch_size):
-            dets = fovea_inference(
-                [p[i] for p in loc_preds],
-                [p[i] for p in cls_preds],
-                self.mlvl_centers,
-                self.conf_threshold, self.iou_threshold,
-                self.topk1, self.nms_method, self.topk2,
-            )
-            image_dets.append(dets)
-        return image_dets
+        self.max_per_class = max_per_class
+
+    def __call__(self, loc_preds, cls_preds, size=None):
+        mlvl_centers = self.mlvl_centers
+        if is_grid(mlvl_centers):
+            size = size or self.size
+            assert size is not None, "Input size is required to look up centers"
+            mlvl_centers = mlvl_centers.mlvl(size, loc_preds[0].dtype, loc_preds[0].device)
+        return fovea_batch_inference(
+            loc_preds, cls_preds, mlvl_centers,
+            self.conf_threshold, self.iou_threshold,
+            self.topk1, self.nms_method, self.topk2, self.max_per_class,
+        )
@@ -8,7 +8,7 @@ from horch.common import _tuple, inverse_sigmoid
 from horch.models.detection.head import SSDHead
 from horch.models.modules import Conv2d, get_norm_layer, get_activation, get_attention
 
-from horch.detection.one import MultiBoxLoss, anchor_based_inference, flatten
+from horch.detection.one import MultiBoxLoss, anchor_based_batch_inference, flatten
 
 
 class RefineLoss:
@@ -48,46 +48,74 @@ class RefineLoss:
         return loss
 
 
-def anchor_refine_inference(
+def anchor_refine_batch_inference(
         r_loc_p, r_cls_p, d_loc_p, d_cls_p, anchors,
         neg_threshold=0.01, iou_threshold=0.5, r_topk=400, d_topk=200,
-        detect_conf_strategy='softmax', detect_conf_threshold=0.01, detect_nms='soft', reg='refine'):
+        detect_conf_strategy='softmax', detect_conf_threshold=0.01, detect_nms='soft', reg='refine',
+        fused=False):
+    r"""
+    Refine the anchors of a batch of images at once, keeping the `r_topk` anchors of every
+    image that are not negative, and detect with the refined anchors.
+
+    Parameters
+    ----------
+    r_loc_p, d_loc_p : torch.Tensor
+        Predicted targets of the refine and detect heads of shape `(B, A, 4)`.
+    r_cls_p : torch.Tensor
+        Objectness logits of the refine head of shape `(B, A)`.
+    d_cls_p : torch.Tensor
+        Class logits (with background) of the detect head of shape `(B, A, C)`.
+    anchors : torch.Tensor
+        Anchors in XYWH format of shape `(A, 4)`.
+    fused : bool
+        Whether to detect with the native `decode_and_nms` op, see `anchor_based_batch_inference`.
+
+    Returns
+    -------
+    Detections
+    """
     pos = r_cls_p > inverse_sigmoid(neg_threshold)
-    r_loc_p = r_loc_p[pos]
-    r_cls_p = r_cls_p[pos]
-    anchors = anchors[pos]
-    d_loc_p = d_loc_p[pos]
-    d_cls_p = d_cls_p[pos]
+    k = min(r_topk, r_cls_p.size(1))
+    indices = r_cls_p.masked_fill(~pos, float('-inf')).topk(k, dim=1)[1]
+    pos = pos.gather(1, indices)
+    anchors = anchors[indices]
+    r_loc_p = r_loc_p.gather(1, indices[..., None].expand(-1, -1, 4))
+    d_loc_p = d_loc_p.gather(1, indices[..., None].expand(-1, -1, 4))
+    d_cls_p = d_cls_p.gather(1, indices[..., None].expand(-1, -1, d_cls_p.size(-1)))
 
     if reg == 'refine':
-        r_loc_p[:, :2].mul_(anchors[:, 2:]).add_(anchors[:, :2])
-        r_loc_p[:, 2:].exp_().mul_(anchors[:, 2:])
-
-    if len(r_cls_p) > r_topk:
-        indices = r_cls_p.topk(r_topk)[1]
-        r_loc_p = r_loc_p[indices]
-        d_loc_p = d_loc_p[indices]
-        d_cls_p = d_cls_p[indices]
-        if reg == 'residual':
-            anchors = anchors[indices]
-
-    if reg == 'refine':
-        return anchor_based_inference(
+        r_loc_p[..., :2].mul_(anchors[..., 2:]).add_(anchors[..., :2])
+        r_loc_p[..., 2:].exp_().mul_(anchors[..., 2:])
+        return anchor_based_batch_inference(
             d_loc_p, d_cls_p, r_loc_p,
             conf_threshold=detect_conf_threshold, iou_threshold=iou_threshold,
-            topk=d_topk, conf_strategy=detect_conf_strategy, nms_method=detect_nms)
+            topk=d_topk, conf_strategy=detect_conf_strategy, nms_method=detect_nms, mask=pos,
+            fused=fused)
     else:  # residual
-        return anchor_based_inference(
+        return anchor_based_batch_inference(
             d_loc_p + r_loc_p, d_cls_p, anchors,
             conf_threshold=detect_conf_threshold, iou_threshold=iou_threshold,
-            topk=d_topk, conf_strategy=detect_conf_strategy, nms_method=detect_nms)
+            topk=d_topk, conf_strategy=detect_conf_strategy, nms_method=detect_nms, mask=pos,
+            fused=fused)
+
+
+def anchor_refine_inference(
+        r_loc_p, r_cls_p, d_loc_p, d_cls_p, anchors,
+        neg_threshold=0.01, iou_threshold=0.5, r_topk=400, d_topk=200,
+        detect_conf_strategy='softmax', detect_conf_threshold=0.01, detect_nms='soft', reg='refine',
+        fused=False):
+    return anchor_refine_batch_inference(
+        r_loc_p[None], r_cls_p[None], d_loc_p[None], d_cls_p[None], anchors,
+        neg_threshold, iou_threshold, r_topk, d_topk,
+        detect_conf_strategy, detect_conf_threshold, detect_nms, reg, fused)
 
 
 class AnchorRefineInference:
 
     def __init__(self, anchors, neg_threshold=0.01,
                  iou_threshold=0.5, r_topk=400, d_topk=200,
-                 detect_conf_strategy='softmax', detect_conf_threshold=0.01, detect_nms='soft', reg='refine'):
+                 detect_conf_strategy='softmax', detect_conf_threshold=0.01, detect_nms='soft', reg='refine',
+                 fused=False):
         self.neg_threshold = neg_threshold
         self.anchors = flatten(anchors)
         self.iou_threshold = iou_threshold
@@ -97,18 +125,15 @@ class AnchorRefineInference:
         self.detect_conf_threshold = detect_conf_threshold
         self.detect_nms = detect_nms
         self.reg = reg
+        self.fused = fused
 
     def __call__(self, r_loc_p, r_cls_p, d_loc_p, d_cls_p, *args):
-        image_dets = []
-        batch_size = r_loc_p.size(0)
-        for i in range(batch_size):
-            dets = anchor_refine_inference(
-                r_loc_p[i], r_cls_p[i], d_loc_p[i], d_cls_p[i], self.anchors,
-                self.neg_threshold, self.iou_threshold, self.r_topk, self.d_topk,
-                self.detect_conf_strategy, self.detect_conf_threshold, self.detect_nms, self.reg
-            )
-            image_dets.append(dets)
-        return image_dets
+        return anchor_refine_batch_inference(
+            r_loc_p, r_cls_p, d_loc_p, d_cls_p, self.anchors,
+            self.neg_threshold, self.iou_threshold, self.r_topk, self.d_topk,
+            self.detect_conf_strategy, self.detect_conf_threshold, self.detect_nms, self.reg,
+            self.fused
+        )
 
 
 class Bottleneck(nn.Module):
@@ -8,6 +8,24 @@ from horch.common import detach, _tuple, _concat, inverse_sigmoid
 from horch.models.utils import bias_init_constant, weight_init_normal
 from horch.models.modules import Sequential, Conv2d
 from horch.models.detection.head import to_pred
+from horch.nn.roi_align import MultiScaleRoIAlign
+
+
+def pool_rois(roi_pool, ps, rois):
+    r"""
+    Pool the RoIs from the levels `ps`.
+
+    A `MultiScaleRoIAlign` pools from all levels at once, any other `roi_pool` pools every RoI
+    from every level.
+
+    Returns
+    -------
+    list of torch.Tensor
+        Pooled features to be reduced by the heads.
+    """
+    if isinstance(roi_pool, MultiScaleRoIAlign):
+        return roi_pool(ps, rois)
+    return [roi_pool(p, rois) for p in ps]
 
 
 class RPNHead(nn.Module):
@@ -165,7 +183,7 @@ class FasterRCNN(nn.Module):
 
         loc_t, cls_t, rois = self.roi_match(rois, image_gts)
 
-        ps = [self.roi_pool(p, rois) for p in ps]
+        ps = pool_rois(self.roi_pool, ps, rois)
         # if self._position_sensitive:
         #     ps = [p.view(p.size(0), -1, 1, 1) for p in ps]
         preds = self.box_head(*ps)
@@ -175,7 +193,7 @@ class FasterRCNN(nn.Module):
         self.eval()
         with torch.no_grad():
             ps, rois = self.rpn.region_proposal(x)
-            ps = [self.roi_pool(p, rois) for p in ps]
+            ps = pool_rois(self.roi_pool, ps, rois)
             # if self._position_sensitive:
             #     ps = [p.view(p.size(0), -1, 1, 1) for p in ps]
             preds = self.box_head(*ps)
@@ -237,7 +255,7 @@ class MaskRCNN(nn.Module):
 
         loc_t, cls_t, mask_t, rois = self.roi_match(rois, image_gts)
 
-        ps = [self.roi_pool(p, rois) for p in ps]
+        ps = pool_rois(self.roi_pool, ps, rois)
         if self._position_sensitive:
             ps = [p.view(p.size(0), -1, 1, 1) for p in ps]
         loc_p, cls_p = self.box_head(ps)
@@ -252,7 +270,7 @@ class MaskRCNN(nn.Module):
         self.eval()
         with torch.no_grad():
             ps, rois = self.rpn.region_proposal(x)
-            ps = [self.roi_pool(p, rois) for p in ps]
+            ps = pool_rois(self.roi_pool, ps, rois)
             if self._position_sensitive:
                 ps = [p.view(p.size(0), -1, 1, 1) for p in ps]
             loc_p, cls_p = self.box_head(ps)
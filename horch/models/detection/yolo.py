@@ -1,4 +1,3 @@
-from math import log
 import random
 
 import torch
@@ -10,7 +9,10 @@ from horch.models.modules import upsample_concat, Conv2d
 from horch.models.utils import get_last_conv, bias_init_constant
 from horch.nn.loss import focal_loss2, loc_kl_loss
 
-from horch.detection import BBox, soft_nms_cpu, nms, softer_nms_cpu
+from horch.detection import BBox
+from horch.detection.anchor_cache import is_grid, image_size
+from horch.detection.one import pad_gts
+from horch.detection.postprocess import select_candidates, batched_detections
 
 
 class BasicBlock(nn.Module):
@@ -219,72 +221,171 @@ def iou_1m_with_size(box, boxes):
     return ious
 
 
-def match_anchors(anns, mlvl_priors, locations, ignore_thresh=None,
-                  get_label=lambda x: x['category_id'], debug=False):
-    loc_targets = []
-    cls_targets = []
-    ignores = []
+def iou_mn_with_size(sizes1, sizes2):
+    r"""
+    IoU of boxes with the same center, given sizes of shape `(m, 2)` and `(n, 2)`.
+    """
+    inter_sizes = torch.min(sizes1[:, None, :], sizes2[None, :, :])
+    inter_areas = inter_sizes[..., 0] * inter_sizes[..., 1]
+    areas1 = sizes1[:, 0] * sizes1[:, 1]
+    areas2 = sizes2[:, 0] * sizes2[:, 1]
+    union_areas = areas1[:, None] + areas2[None, :] - inter_areas
+    return inter_areas / union_areas
+
+
+def match_anchors_batch(gt_boxes, gt_labels, gt_mask, mlvl_priors, locations, ignore_thresh=None, debug=False):
+    r"""
+    Match the ground truths of a batch of images to the priors of all levels at once.
+
+    Every ground truth is assigned to the prior with maximal size-only IoU, in the cell of its
+    center on the level of the prior. A later ground truth in the same cell and prior overwrites
+    an earlier one. Every (level, prior) with IoU larger than `ignore_thresh` is ignored in the
+    cell of the center on that level.
+
+    Parameters
+    ----------
+    gt_boxes : torch.Tensor
+        Normalized boxes in XYWH format of shape `(B, G, 4)`, see `horch.detection.one.pad_gts`.
+        Float64 keeps the rounding of the per-annotation computation.
+    gt_labels : torch.Tensor
+        Labels of shape `(B, G)`.
+    gt_mask : torch.Tensor
+        Bool tensor of shape `(B, G)`, true for real boxes.
+    mlvl_priors : torch.Tensor
+        Normalized prior sizes of shape `(#levels, #priors, 2)`.
+    locations : Sequence[tuple]
+        (lx, ly) of every level.
+    ignore_thresh : float
+        IoU threshold for ignored predictions. No prediction is ignored if not provided.
+
+    Returns
+    -------
+    loc_t : torch.Tensor
+        Targets of shape `(B, #anchors, 4)`.
+    cls_t : torch.Tensor
+        Labels of shape `(B, #anchors)`, zero for background.
+    ignore : torch.Tensor
+        Uint8 tensor of shape `(B, #anchors)`.
+    """
+    batch_size = gt_mask.size(0)
     num_levels, priors_per_level = mlvl_priors.size()[:2]
-    for (lx, ly), priors in zip(locations, mlvl_priors):
-        loc_targets.append(
-            priors.new_zeros((lx, ly, priors_per_level, 4)))
-        cls_targets.append(
-            priors.new_zeros((lx, ly, priors_per_level), dtype=torch.long))
-        ignores.append(
-            priors.new_zeros((lx, ly, priors_per_level), dtype=torch.uint8))
-
-    for ann in anns:
-        l, t, w, h = ann['bbox']
-        x = l + w / 2
-        y = t + h / 2
-        size = torch.tensor([w, h])
-        ious = iou_1m_with_size(size, mlvl_priors)
-        max_iou, max_ind = ious.view(-1).max(dim=0)
-        level, i = divmod(max_ind.item(), priors_per_level)
-        if debug:
-            print("[%d,%d]: %.4f" % (level, i, max_iou.item()))
-        lx, ly = locations[level]
-        pw, ph = mlvl_priors[level, i]
-        cx, offset_x = divmod(x * lx, 1)
-        cx = int(cx)
-        cy, offset_y = divmod(y * ly, 1)
-        cy = int(cy)
-        tx = inverse_sigmoid(offset_x)
-        ty = inverse_sigmoid(offset_y)
-        tw = log(w / pw)
-        th = log(h / ph)
-        loc_targets[level][cx, cy, i] = torch.tensor([tx, ty, tw, th])
-        cls_targets[level][cx, cy, i] = get_label(ann)
-        ignore = ious > ignore_thresh
-        for level, i in torch.nonzero(ignore):
-            lx, ly = locations[level]
-            cx, offset_x = divmod(x * lx, 1)
-            cx = int(cx)
-            cy, offset_y = divmod(y * ly, 1)
-            cy = int(cy)
-            ignores[level][cx, cy, i] = 1
-
-    loc_t = torch.cat([t.view(-1, 4) for t in loc_targets], dim=0)
-    cls_t = torch.cat([t.view(-1) for t in cls_targets], dim=0)
-    ignore = torch.cat([t.view(-1) for t in ignores], dim=0)
+    device = mlvl_priors.device
+    lxly = torch.tensor(locations, dtype=torch.long, device=device)
+    counts = lxly[:, 0] * lxly[:, 1] * priors_per_level
+    starts = counts.cumsum(0) - counts
+    num_anchors = int(counts.sum())
+
+    loc_t = mlvl_priors.new_zeros((batch_size, num_anchors, 4))
+    cls_t = torch.zeros((batch_size, num_anchors), dtype=torch.long, device=device)
+    ignore = torch.zeros((batch_size, num_anchors), dtype=torch.uint8, device=device)
+
+    batch_idxs, gt_idxs = torch.nonzero(gt_mask).t()
+    boxes = gt_boxes[batch_idxs, gt_idxs]
+    labels = gt_labels[batch_idxs, gt_idxs]
+    x, y, w, h = boxes.t()
+    sizes = boxes[:, 2:].to(mlvl_priors.dtype)
+    priors = mlvl_priors.view(-1, 2)
+
+    # (N, #levels * #priors)
+    ious = iou_mn_with_size(sizes, priors)
+    max_ious, best = ious.max(dim=1) if len(boxes) else (ious.new_zeros(0), ious.new_zeros(0, dtype=torch.long))
+    if debug:
+        for max_iou, ind in zip(max_ious.tolist(), best.tolist()):
+            print("[%d,%d]: %.4f" % (*divmod(ind, priors_per_level), max_iou))
+
+    # Cell and offset of the center of every ground truth on every level, (N, #levels)
+    px = x[:, None] * lxly[:, 0].to(x.dtype)
+    py = y[:, None] * lxly[:, 1].to(y.dtype)
+    # A center on the right or bottom edge of the image is in the last cell
+    cx = torch.min(px.floor(), (lxly[:, 0] - 1).to(px.dtype))
+    cy = torch.min(py.floor(), (lxly[:, 1] - 1).to(py.dtype))
+    offset_x, offset_y = px - cx, py - cy
+    cx, cy = cx.long(), cy.long()
+
+    def anchor_indices(n, level, i):
+        return batch_idxs[n] * num_anchors + starts[level] + \
+            (cx[n, level] * lxly[level, 1] + cy[n, level]) * priors_per_level + i
+
+    n = torch.arange(len(boxes), device=device)
+    level, i = best // priors_per_level, best % priors_per_level
+    indices = anchor_indices(n, level, i)
+    # The last ground truth of an anchor wins
+    winner = torch.full((batch_size * num_anchors,), -1, dtype=torch.long, device=device).scatter_reduce_(
+        0, indices, n, 'amax')
+    keep = winner[indices] == n
+    n, level, i, indices = n[keep], level[keep], i[keep], indices[keep]
+
+    pw, ph = priors[best[keep]].t()
+    tx = inverse_sigmoid(offset_x[n, level])
+    ty = inverse_sigmoid(offset_y[n, level])
+    # `w / pw` of a float and a tensor is `pw.reciprocal() * w`
+    tw = (pw.reciprocal() * w[n].to(pw.dtype)).to(w.dtype).log_()
+    th = (ph.reciprocal() * h[n].to(ph.dtype)).to(h.dtype).log_()
+    loc_t.view(-1, 4)[indices] = torch.stack([tx, ty, tw, th], dim=-1).to(loc_t.dtype)
+    cls_t.view(-1)[indices] = labels[n]
+
+    if ignore_thresh is not None:
+        n, j = torch.nonzero(ious > ignore_thresh).t()
+        ignore.view(-1)[anchor_indices(n, j // priors_per_level, j % priors_per_level)] = 1
     return loc_t, cls_t, ignore
 
 
+def match_anchors(anns, mlvl_priors, locations, ignore_thresh=None,
+                  get_label=lambda x: x['category_id'], debug=False):
+    gt_boxes, gt_labels, gt_mask = pad_gts([anns], get_label, torch.float64, mlvl_priors.device)
+    loc_t, cls_t, ignore = match_anchors_batch(
+        gt_boxes, gt_labels, gt_mask, mlvl_priors, locations, ignore_thresh, debug)
+    return loc_t[0], cls_t[0], ignore[0]
+
+
 class YOLOTransform:
 
     def __init__(self, mlvl_anchors, ignore_thresh=0.5, get_label=lambda x: x["category_id"], debug=False):
-        self.mlvl_priors = torch.stack([a[0, 0, :, 2:] for a in mlvl_anchors])
-        self.locations = [tuple(a.size()[:2]) for a in mlvl_anchors]
+        if is_grid(mlvl_anchors):
+            self.anchors = mlvl_anchors
+            self.mlvl_priors = torch.stack(mlvl_anchors.priors)
+            self.locations = None
+        else:
+            self.anchors = None
+            self.mlvl_priors = torch.stack([a[0, 0, :, 2:] for a in mlvl_anchors])
+            self.locations = [tuple(a.size()[:2]) for a in mlvl_anchors]
         self.ignore_thresh = ignore_thresh
         self.get_label = get_label
         self.debug = debug
 
+    def _get_locations(self, size):
+        if self.locations is not None:
+            return self.locations
+        assert size is not None, "Input size is required to look up anchors"
+        return self.anchors.locations(size)
+
     def __call__(self, img, anns):
         target = match_anchors(
-            anns, self.mlvl_priors, self.locations,
+            anns, self.mlvl_priors, self._get_locations(image_size(img)),
             self.ignore_thresh, self.get_label, self.debug)
         return img, target
 
+    def batch(self, image_gts, size=None):
+        r"""
+        Match a batch of images of the same size.
+
+        Parameters
+        ----------
+        image_gts : List[List[dict]]
+            Annotations of every image.
+        size : tuple of int
+            (width, height) of the inputs, required if `mlvl_anchors` is an anchor grid.
+
+        Returns
+        -------
+        loc_t, cls_t, ignore : torch.Tensor
+            Targets of shape `(B, #anchors, 4)`, `(B, #anchors)` and `(B, #anchors)`.
+        """
+        gt_boxes, gt_labels, gt_mask = pad_gts(image_gts, self.get_label, torch.float64)
+        return list(match_anchors_batch(
+            gt_boxes, gt_labels, gt_mask, self.mlvl_priors, self._get_locations(size),
+            self.ignore_thresh, self.debug))
+
 
 class YOLOLoss(nn.Module):
     def __init__(self, p=0.01, obj_loss='sigmoid', neg_gain=1, loc_gain=0.5):
@@ -366,84 +467,94 @@ class YOLOKLLoss(nn.Module):
         return loss
 
 
-def yolo_inference(
+def yolo_batch_inference(
         loc_p, obj_p, cls_p, anchors, locations, conf_threshold=0.01,
-        iou_threshold=0.5, topk=100, nms_method='soft'):
-    if nms_method == 'softer':
-        bboxes, log_vars = loc_p
-        vars = log_vars.exp_()
-    else:
-        bboxes = loc_p
-    scores, labels = torch.sigmoid_(cls_p).max(dim=1)
-    scores *= torch.sigmoid_(obj_p)
-
-    if conf_threshold > 0:
-        pos = scores > conf_threshold
-        scores = scores[pos]
-        labels = labels[pos]
-        bboxes = bboxes[pos]
-        anchors = anchors[pos]
-        locations = locations[pos]
-        if nms_method == 'softer':
-            vars = vars[pos]
-
-    bboxes[..., :2].sigmoid_().sub_(0.5).div_(locations).add_(anchors[:, :2])
+        iou_threshold=0.5, topk=100, nms_method='soft', max_per_class=None, log_var_p=None):
+    r"""
+    Decode, score and filter the predictions of a batch of images at once, and run nms over
+    the candidates of all images.
+
+    Parameters
+    ----------
+    loc_p : torch.Tensor
+        Predicted targets of shape `(B, A, 4)`.
+    obj_p : torch.Tensor
+        Objectness logits of shape `(B, A)`.
+    cls_p : torch.Tensor
+        Class logits of shape `(B, A, C)`.
+    anchors : torch.Tensor
+        Anchors in XYWH format of shape `(A, 4)`.
+    locations : torch.Tensor
+        (lx, ly) of the level of every anchor, of shape `(A, 2)`.
+    log_var_p : torch.Tensor
+        Predicted log variances of shape `(B, A, 4)`, required by `softer` nms.
+
+    Returns
+    -------
+    Detections
+    """
+    scores = torch.sigmoid(cls_p) * torch.sigmoid(obj_p)[..., None]
+    batch_idxs, indices, scores, labels = select_candidates(
+        scores, conf_threshold, nms_method == 'multiclass')
+
+    bboxes = loc_p[batch_idxs, indices]
+    anchors = anchors[indices]
+    bboxes[..., :2].sigmoid_().sub_(0.5).div_(locations[indices]).add_(anchors[:, :2])
     bboxes[..., 2:].exp_().mul_(anchors[:, 2:])
+    bboxes = BBox.convert(bboxes, format=BBox.XYWH, to=BBox.LTRB, inplace=True)
 
-    bboxes = BBox.convert(
-        bboxes, format=BBox.XYWH, to=BBox.LTRB, inplace=True).cpu()
-    scores = scores.cpu()
-
-    if nms_method == 'nms':
-        indices = nms(bboxes, scores, iou_threshold)
-        scores = scores[indices]
-        labels = labels[indices]
-        bboxes = bboxes[indices]
-        if scores.size(0) > topk:
-            indices = scores.topk(topk)[1]
-        else:
-            indices = range(scores.size(0))
-    elif nms_method == 'softer':
-        indices = softer_nms_cpu(
-            bboxes, scores, vars.cpu(), iou_threshold, topk, 0.01, min_score=conf_threshold)
-    else:
-        indices = soft_nms_cpu(
-            bboxes, scores, iou_threshold, topk, min_score=0.01)
-    bboxes = BBox.convert(
-        bboxes, format=BBox.LTRB, to=BBox.LTWH, inplace=True)
-    dets = []
-    for ind in indices:
-        det = {
-            'image_id': -1,
-            'category_id': labels[ind].item() + 1,
-            'bbox': bboxes[ind].tolist(),
-            'score': scores[ind].item(),
-        }
-        dets.append(det)
-    return dets
+    vars = None
+    min_score = 0.01
+    if nms_method == 'softer':
+        vars = log_var_p[batch_idxs, indices].exp_()
+        min_score = conf_threshold
+    elif nms_method not in ['nms', 'multiclass', 'matrix', 'cluster']:
+        nms_method = 'soft'
+    return batched_detections(
+        bboxes, scores, labels, batch_idxs, loc_p.size(0), nms_method,
+        iou_threshold, topk, min_score, max_per_class, vars)
+
+
+def yolo_inference(
+        loc_p, obj_p, cls_p, anchors, locations, conf_threshold=0.01,
+        iou_threshold=0.5, topk=100, nms_method='soft', max_per_class=None):
+    log_var_p = None
+    if nms_method == 'softer':
+        loc_p, log_var_p = loc_p
+        log_var_p = log_var_p[None]
+    return yolo_batch_inference(
+        loc_p[None], obj_p[None], cls_p[None], anchors, locations, conf_threshold,
+        iou_threshold, topk, nms_method, max_per_class, log_var_p)
 
 
 class YOLOInference:
 
     def __init__(self, mlvl_anchors, conf_threshold=0.5,
-                 iou_threshold=0.5, topk=100, nms='soft'):
-        self.locations = get_locations(mlvl_anchors)
-        self.anchors = flatten(mlvl_anchors)
+                 iou_threshold=0.5, topk=100, nms='soft', max_per_class=None, size=None):
+        if is_grid(mlvl_anchors):
+            self.locations = None
+            self.anchors = mlvl_anchors
+        else:
+            self.locations = get_locations(mlvl_anchors)
+            self.anchors = flatten(mlvl_anchors)
+        self.size = size
         self.conf_threshold = conf_threshold
         self.iou_threshold = iou_threshold
         self.topk = topk
         self.nms = nms
-
-    def __call__(self, loc_p, obj_p, cls_p, log_var_p=None):
-        image_dets = []
-        batch_size = loc_p.size(0)
-        softer_nms = log_var_p is not None and self.nms == 'softer'
-        for i in range(batch_size):
-            i_loc_p = (loc_p[i], log_var_p[i]) if softer_nms else loc_p[i]
-            dets = yolo_inference(
-                i_loc_p, obj_p[i], cls_p[i], self.anchors, self.locations,
-                self.conf_threshold, self.iou_threshold,
-                self.topk, self.nms,
-            )
-            image_dets.append(dets)
-        return image_dets
+        self.max_per_class = max_per_class
+
+    def __call__(self, loc_p, obj_p, cls_p, log_var_p=None, size=None):
+        anchors, locations = self.anchors, self.locations
+        if locations is None:
+            size = size or self.size
+            assert size is not None, "Input size is required to look up anchors"
+            locations = anchors.grid_sizes(size, loc_p.dtype, loc_p.device)
+            anchors = anchors(size, loc_p.dtype, loc_p.device)
+        if self.nms == 'softer':
+            assert log_var_p is not None, "log_var_p is required by softer nms"
+        return yolo_batch_inference(
+            loc_p, obj_p, cls_p, anchors, locations,
+            self.conf_threshold, self.iou_threshold,
+            self.topk, self.nms, self.max_per_class, log_var_p,
+        )
@@ -1,2 +1,2 @@
 from horch.nn.psroi_align import PSRoIAlign, psroi_align
-from horch.nn.roi_align import RoIAlign, roi_align
+from horch.nn.roi_align import RoIAlign, MultiScaleRoIAlign, roi_align
@@ -28,23 +28,29 @@ def focal_loss2(input, target, gamma=2, beta=1, alpha=0.25, eps=1e-6, reduction=
         pos_weight=input.new_tensor(alpha)) / gamma
 
 
-def iou_loss(prediction, ground_truth, reduction='mean'):
-    l_p = prediction[..., 0]
-    t_p = prediction[..., 1]
-    r_p = prediction[..., 2]
-    b_p = prediction[..., 3]
-    l_t = ground_truth[..., 0]
-    t_t = ground_truth[..., 1]
-    r_t = ground_truth[..., 2]
-    b_t = ground_truth[..., 3]
+def iou_loss(prediction, ground_truth, reduction='mean', kind='iou'):
+    r"""
+    Parameters
+    ----------
+    prediction : torch.Tensor
+        (N, 4) distances from the locations to the left, top, right and bottom of the predicted boxes.
+    ground_truth : torch.Tensor
+        (N, 4) distances from the locations to the left, top, right and bottom of the ground truth boxes.
+    reduction : str
+        `sum` or `mean`
+    kind : str
+        `iou` for -log(IoU), or `giou`, `diou` and `ciou` for 1 - GIoU, 1 - DIoU and 1 - CIoU.
+    """
+    from horch.detection.iou import iou_b11_fused
 
-    area_p = (t_p + b_p) * (l_p + r_p)
-    area_t = (t_t + b_t) * (l_t + r_t)
-    inter_h = torch.min(t_p, t_t) + torch.min(b_p, b_t)
-    inter_w = torch.min(l_p, l_t) + torch.min(r_p, r_t)
-    inter = inter_h * inter_w
-    iou = inter / (area_p + area_t - inter)
-    loss = -torch.log(iou)
+    # Boxes relative to the locations
+    boxes_p = torch.cat([-prediction[..., :2], prediction[..., 2:]], dim=-1)
+    boxes_t = torch.cat([-ground_truth[..., :2], ground_truth[..., 2:]], dim=-1)
+    ious = iou_b11_fused(boxes_p, boxes_t, kind)
+    if kind == 'iou':
+        loss = -torch.log(ious)
+    else:
+        loss = 1 - ious
     if reduction == 'sum':
         return loss.sum()
     elif reduction == 'mean':
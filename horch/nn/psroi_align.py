@@ -6,7 +6,7 @@ from torch.autograd.function import once_differentiable
 
 from torch.nn.modules.utils import _pair
 
-from horch import _C
+from horch._backend import _C
 
 
 class _PSROIAlign(Function):
@@ -6,7 +6,7 @@ from torch.autograd.function import once_differentiable
 
 from torch.nn.modules.utils import _pair
 
-from horch import _C
+from horch._backend import _C
 
 
 class _ROIAlign(Function):
@@ -62,4 +62,97 @@ class RoIAlign(nn.Module):
         tmpstr += ', sampling_ratio=' + str(self.sampling_ratio)
         tmpstr += ', adaptive=' + str(self.adaptive)
         tmpstr += ')'
-        return tmpstr
\ No newline at end of file
+        return tmpstr
+
+
+class MultiScaleRoIAlign(nn.Module):
+    r"""
+    RoIAlign over the levels of a feature pyramid.
+
+    Every RoI is assigned to one level by the heuristic of FPN,
+    `floor(canonical_level + log2(sqrt(wh) / canonical_size))`, and the RoIs of each level
+    are pooled by one `roi_align` call.
+
+    Parameters
+    ----------
+    output_size : int or tuple of ints
+        (height, width) of the output.
+    levels : sequence of ints
+        Levels of the features, the stride of level `l` is `2 ** l`.
+        Default: (2, 3, 4, 5)
+    sampling_ratio : int
+        Sampling points of every bin along each axis.
+    canonical_size : int
+        Size of RoIs of `canonical_level` in pixels of the image. Default: 224
+    canonical_level : int
+        Default: 4
+    all_levels : bool
+        Whether to pool every RoI from every level instead, as a list of outputs of all levels.
+        Default: False
+    """
+
+    def __init__(self, output_size, levels=(2, 3, 4, 5), sampling_ratio=2,
+                 canonical_size=224, canonical_level=4, all_levels=False):
+        super().__init__()
+        self.output_size = _pair(output_size)
+        self.levels = tuple(levels)
+        self.sampling_ratio = sampling_ratio
+        self.canonical_size = canonical_size
+        self.canonical_level = canonical_level
+        self.all_levels = all_levels
+
+    def assign_levels(self, ps, rois):
+        r"""
+        Index in `ps` of the level of every RoI.
+        """
+        stride = 2 ** self.levels[0]
+        height, width = ps[0].size(2) * stride, ps[0].size(3) * stride
+        wh = (rois[:, 3:5] - rois[:, 1:3]) * rois.new_tensor([width, height])
+        sizes = wh.clamp(min=0).prod(dim=1).clamp(min=1e-6).sqrt()
+        levels = torch.floor(self.canonical_level + torch.log2(sizes / self.canonical_size) + 1e-6)
+        levels = levels.clamp(self.levels[0], self.levels[-1]) - self.levels[0]
+        return levels.long()
+
+    def forward(self, ps, rois):
+        r"""
+        Parameters
+        ----------
+        ps : sequence of torch.Tensor
+            Features of `levels`.
+        rois : torch.Tensor
+            Normalized RoIs with batch indices of shape `(..., 5)`.
+
+        Returns
+        -------
+        list of torch.Tensor
+            Pooled features of the RoIs in order, of shape `(n, C, *output_size)`. One tensor for
+            every level if `all_levels`, else a single one.
+        """
+        assert len(ps) == len(self.levels), "Features of %d levels are expected." % len(self.levels)
+        assert rois.size(-1) == 5, "Batch indices must be provided."
+        rois = rois.view(-1, 5)
+        if self.all_levels:
+            return [roi_align(p, rois, self.output_size, tuple(p.size()[2:4]), self.sampling_ratio)
+                    for p in ps]
+
+        levels = self.assign_levels(ps, rois)
+        output = ps[0].new_zeros(len(rois), ps[0].size(1), *self.output_size)
+        for i, p in enumerate(ps):
+            indices = torch.nonzero(levels == i).squeeze(1)
+            if len(indices) == 0:
+                continue
+            output = output.index_copy(
+                0, indices,
+                roi_align(p, rois[indices], self.output_size, tuple(p.size()[2:4]), self.sampling_ratio))
+        return [output]
+
+    def __repr__(self):
+        tmpstr = self.__class__.__name__ + '('
+        tmpstr += 'output_size=' + str(self.output_size)
+        tmpstr += ', levels=' + str(self.levels)
+        tmpstr += ', sampling_ratio=' + str(self.sampling_ratio)
+        tmpstr += ', canonical_size=' + str(self.canonical_size)
+        tmpstr += ', canonical_level=' + str(self.canonical_level)
+        tmpstr += ', all_levels=' + str(self.all_levels)
+        tmpstr += ')'
+        return tmpstr
@@ -16,7 +16,9 @@ from nltk.translate.bleu_score import corpus_bleu
 from nltk.translate.bleu_score import SmoothingFunction
 
 from horch.functools import lmap
-from horch.detection import mAP, BBox
+from horch.detection.detections import Detections, as_detections
+from horch.detection.eval import compute_map, compute_dataset_map, coco_match, coco_accumulate, coco_summarize, \
+    COCO_IOU_THRESHOLDS, COCO_AREA_RANGES
 
 
 class Average(Metric):
@@ -178,12 +180,89 @@ class LossG(Average):
         return lossG, batch_size
 
 
+def _all_gather(obj):
+    # Objects of all ranks when torch.distributed is initialized, else [obj].
+    import torch.distributed as dist
+    if dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+        objs = [None] * dist.get_world_size()
+        dist.all_gather_object(objs, obj)
+        return objs
+    return [obj]
+
+
+def _known_images(image_gts, dets):
+    r"""
+    Image ids of the images from their first ground truth, or from their detections if they
+    have none, and the detections of these images. Images without both are skipped, as they
+    don't change the evaluation.
+    """
+    offsets = dets.offsets.tolist()
+    det_image_ids = dets.image_ids.tolist()
+    image_ids, keep = [], []
+    for i, gts in enumerate(image_gts):
+        if len(gts) != 0:
+            image_id = gts[0]['image_id']
+        elif offsets[i] == offsets[i + 1]:
+            continue
+        elif det_image_ids[offsets[i]] != -1:
+            image_id = det_image_ids[offsets[i]]
+        else:
+            raise ValueError("Image %d has neither ground truths nor detections with `image_id`" % i)
+        image_ids.append(image_id)
+        keep.append(i)
+    if len(keep) != len(image_gts):
+        dets = Detections.cat(dets[i:i + 1] for i in keep)
+    return image_ids, dets
+
+
+_shard_state = None
+
+
+def _map_shards(fn, state, shards, num_workers):
+    r"""
+    Maps `fn` over `shards` in a pool of `num_workers` forked processes, in which
+    `state` is available as `_shard_state` without being pickled. The shards are
+    mapped serially on platforms without the 'fork' start method.
+    """
+    global _shard_state
+    import multiprocessing
+    _shard_state = state
+    try:
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            return [fn(shard) for shard in shards]
+        with multiprocessing.get_context('fork').Pool(num_workers) as pool:
+            return pool.map(fn, shards)
+    finally:
+        _shard_state = None
+
+
+def _streaming_coco_match(shard):
+    # The detections are inherited by the forked workers, only the range is sent.
+    start, end = shard
+    return _shard_state._match(_shard_state._image_ids[start:end], _shard_state._all_dets[start:end])
+
+
 class COCOEval(Metric):
+    r"""
+    COCO evaluation with hpycocotools.
+
+    Args:
+        annotations: COCO style annotations
+        iou_type: `bbox` or `segm`
+        percent_area_ranges: area ranges relative to the image size
+        num_workers: number of processes to rasterize the segmentations and to
+            run `evaluate` with, which is sharded by images. The per-image results
+            are merged for one `accumulate` and `summarize`.
+
+    When torch.distributed is initialized, the detections of all ranks are merged
+    in `compute`.
+    """
 
-    def __init__(self, annotations, iou_type='bbox', percent_area_ranges=None):
+    def __init__(self, annotations, iou_type='bbox', percent_area_ranges=None, num_workers=0):
         self.annotations = annotations
         self.iou_type = iou_type
         self.percent_area_ranges = percent_area_ranges
+        self.num_workers = num_workers
         super().__init__()
 
     def reset(self):
@@ -194,16 +273,18 @@ class COCOEval(Metric):
     def update(self, output):
         target, image_dets, batch_size = get(
             ["target", "preds", "batch_size"], output)
-        image_gts = target[0]
-        for dets, gts in zip(image_dets, image_gts):
-            image_id = gts[0]['image_id']
-            for d in dets:
-                d = {**d, 'image_id': image_id}
-                self.res.append(d)
+        image_ids, dets = _known_images(target[0], as_detections(image_dets))
+        if not image_ids:
+            return
+        dets = dets.with_image_ids(image_ids)
+        sizes = [(img['width'], img['height']) for img in self.coco_gt.loadImgs(image_ids)]
+        self.res.append(_to_absolute(dets, sizes))
 
     def compute(self):
         from hpycocotools.coco import COCO
-        img_ids = list(set([ d['image_id'] for d in self.res ]))
+        dets = Detections.cat(d for r in _all_gather(self.res) for d in r)
+        res = [d for ds in dets.to_coco_dicts() for d in ds]
+        img_ids = list(set([d['image_id'] for d in res]))
         imgs = self.coco_gt.loadImgs(img_ids)
         ann_ids = self.coco_gt.getAnnIds(imgIds=img_ids)
         anns = self.coco_gt.loadAnns(ann_ids)
@@ -215,40 +296,214 @@ class COCOEval(Metric):
         coco_gt = COCO(annotations, verbose=False, use_percent=bool(self.percent_area_ranges))
 
         from hpycocotools.cocoeval import COCOeval
-        from hpycocotools.mask import encode
-        for dt in self.res:
-            img = self.coco_gt.imgs[dt['image_id']]
-            width = img['width']
-            height = img['height']
-            l, t, w, h = dt['bbox']
-            l *= width
-            t *= height
-            w *= width
-            h *= height
-            dt['bbox'] = [l, t, w, h]
-            if 'segmentation' in dt and self.iou_type == 'segm':
-                r = int(l + w)
-                b = int(t + h)
-                l = max(0, int(l))
-                t = max(0, int(t))
-                r = min(r, width)
-                b = min(b, height)
-                w = r - l
-                h = b - t
-                m = np.zeros((height, width), dtype=np.uint8)
-                segm = cv2.resize(dt['segmentation'], (w, h), interpolation=cv2.INTER_NEAREST)
-                m[t:b, l:r] = segm
-                dt['segmentation'] = encode(np.asfortranarray(m))
-
-        coco_dt = coco_gt.loadRes(self.res)
+        if self.num_workers > 0 and res:
+            n = -(-len(res) // (self.num_workers * 4))
+            shards = [res[i:i + n] for i in range(0, len(res), n)]
+            res = [d for r in _map_shards(_coco_to_res, self, shards, self.num_workers) for d in r]
+        else:
+            res = _coco_to_res(res, self)
+
+        coco_dt = coco_gt.loadRes(res)
         ev = COCOeval(coco_gt, coco_dt,
                       iouType=self.iou_type, pAreaRng=self.percent_area_ranges, verbose=False)
-        ev.evaluate()
+        if self.num_workers > 0:
+            _coco_evaluate_sharded(ev, self.num_workers)
+        else:
+            ev.evaluate()
         ev.accumulate()
         ev.summarize()
         return ev.stats[0]
 
 
+def _to_absolute(dets, sizes):
+    # Boxes relative to the image size of the images of `dets` to absolute ones in float64.
+    boxes, scores, image_ids, labels = dets.numpy()
+    sizes = np.tile(np.asarray(sizes, dtype=np.float64).reshape(-1, 2), 2)
+    boxes *= np.repeat(sizes, dets.counts.numpy(), axis=0)
+    return Detections(torch.from_numpy(boxes), dets.scores, dets.labels, dets.offsets, dets.image_ids, dets.masks)
+
+
+def _coco_to_res(dts, metric=None):
+    # The segmentations inside the boxes to RLE of the whole image.
+    from hpycocotools.mask import encode
+    metric = metric or _shard_state
+    res = []
+    for dt in dts:
+        dt = dict(dt)
+        img = metric.coco_gt.imgs[dt['image_id']]
+        width = img['width']
+        height = img['height']
+        l, t, w, h = dt['bbox']
+        if 'segmentation' in dt and metric.iou_type == 'segm':
+            r = int(l + w)
+            b = int(t + h)
+            l = max(0, int(l))
+            t = max(0, int(t))
+            r = min(r, width)
+            b = min(b, height)
+            w = r - l
+            h = b - t
+            m = np.zeros((height, width), dtype=np.uint8)
+            segm = cv2.resize(dt['segmentation'], (w, h), interpolation=cv2.INTER_NEAREST)
+            m[t:b, l:r] = segm
+            dt['segmentation'] = encode(np.asfortranarray(m))
+        res.append(dt)
+    return res
+
+
+def _coco_evaluate_shard(img_ids):
+    ev = _shard_state
+    ev.params.imgIds = img_ids
+    ev.evaluate()
+    return ev.evalImgs
+
+
+def _coco_evaluate_sharded(ev, num_workers):
+    r"""
+    COCOeval.evaluate over shards of the images in a process pool. `evalImgs` is
+    ordered by category, area range and image, so the shards are interleaved
+    back into that order.
+    """
+    p = ev.params
+    img_ids = list(np.unique(p.imgIds))
+    if not img_ids:
+        ev.evaluate()
+        return
+    shards = [list(s) for s in np.array_split(img_ids, min(num_workers, len(img_ids))) if len(s)]
+    results = _map_shards(_coco_evaluate_shard, ev, shards, num_workers)
+
+    num_categories = len(p.catIds) if p.useCats else 1
+    eval_imgs = []
+    for i in range(num_categories * len(p.areaRng)):
+        for shard, result in zip(shards, results):
+            eval_imgs.extend(result[i * len(shard):(i + 1) * len(shard)])
+    p.imgIds = img_ids
+    ev.evalImgs = eval_imgs
+    ev._paramsEval = deepcopy(p)
+
+
+class StreamingCOCOEvaluator(Metric):
+    r"""
+    COCO bounding box evaluation without hpycocotools. The ground truths are
+    indexed once into arrays, detections are matched in `update` like COCOeval's
+    `evaluateImg`, and `compute` only accumulates precision and recall.
+
+    With `num_workers > 0`, `update` only collects the detections, and `compute`
+    matches the images in shards over a pool of processes. When torch.distributed
+    is initialized, the match tables of all ranks are merged in `compute`, so every
+    rank only needs to see its own images.
+
+    Args:
+        annotations: COCO style annotations with `images`, `annotations` and `categories`
+        iou_thresholds: IoU thresholds, default to COCO's 0.5:0.05:0.95
+        area_ranges: area ranges of all, small, medium and large objects
+        num_workers: number of processes to match the images with in `compute`
+        shard_size: number of images of every shard
+
+    Inputs:
+        target (list of list of annotations): ground truth annotations of every image,
+            only used for the `image_id`. Images without annotations take it from their
+            detections, and are skipped if they have none.
+        preds (Detections or list of list of annotations): detections of every image with LTWH
+            `bbox` relative to the image size, `category_id` and `score`
+
+    Returns the AP at IoU=0.50:0.95, and the 12 numbers of COCOeval's summary are
+    stored in `stats`.
+    """
+
+    def __init__(self, annotations, iou_thresholds=COCO_IOU_THRESHOLDS, area_ranges=COCO_AREA_RANGES,
+                 num_workers=0, shard_size=256):
+        self.iou_thresholds = np.asarray(iou_thresholds)
+        self.area_ranges = np.asarray(area_ranges, dtype=np.float64)
+        self.num_workers = num_workers
+        self.shard_size = shard_size
+        self.category_ids = np.array(sorted(c['id'] for c in annotations['categories']))
+        self.image_sizes = {img['id']: (img['width'], img['height']) for img in annotations['images']}
+
+        anns = [ann for ann in annotations['annotations'] if ann['category_id'] in set(self.category_ids)]
+        image_ids = np.array([ann['image_id'] for ann in anns])
+        order = np.argsort(image_ids, kind='stable')
+        image_ids = image_ids[order]
+        boxes = np.array([anns[i]['bbox'] for i in order], dtype=np.float64).reshape(-1, 4)
+        boxes[:, 2:] += boxes[:, :2]
+        self._gt_boxes = boxes
+        self._gt_areas = np.array([anns[i]['area'] for i in order], dtype=np.float64)
+        self._gt_crowds = np.array([anns[i].get('iscrowd', 0) for i in order], dtype=np.bool_)
+        self._gt_categories = np.searchsorted(
+            self.category_ids, np.array([anns[i]['category_id'] for i in order], dtype=np.int64))
+        ids, starts, counts = np.unique(image_ids, return_index=True, return_counts=True)
+        self._gt_slices = {i: slice(s, s + c) for i, s, c in zip(ids.tolist(), starts.tolist(), counts.tolist())}
+        super().__init__()
+
+    def reset(self):
+        self._tables = []
+        self._image_ids = []
+        self._image_dets = []
+
+    def update(self, output):
+        target, image_dets = get(["target", "preds"], output)
+        image_ids, dets = _known_images(target[0], as_detections(image_dets))
+        if not image_ids:
+            return
+        if self.num_workers > 0:
+            self._image_ids.extend(image_ids)
+            self._image_dets.append(dets)
+        else:
+            self._tables.append(self._match(image_ids, dets))
+
+    def _match(self, image_ids, dets):
+        r"""
+        Match table of the images: category indices, scores, ranks, matched and
+        ignored flags of the detections, and the number of ground truths which are
+        not ignored of every category and area range.
+        """
+        num_categories = len(self.category_ids)
+        gt_indices, gt_keys = [], []
+        for i, image_id in enumerate(image_ids):
+            gt_slice = self._gt_slices.get(image_id, slice(0, 0))
+            gt_indices.append(np.arange(gt_slice.start, gt_slice.stop))
+            gt_keys.append(i * num_categories + self._gt_categories[gt_slice])
+        gt_indices = np.concatenate(gt_indices)
+        gt_keys = np.concatenate(gt_keys)
+
+        dets = _to_absolute(dets, [self.image_sizes[image_id] for image_id in image_ids])
+        dt_boxes, dt_scores, _, categories = dets.numpy()
+        keep = np.isin(categories, self.category_ids)
+        dt_boxes = dt_boxes[keep]
+        dt_boxes[:, 2:] += dt_boxes[:, :2]
+        dt_scores = dt_scores[keep]
+        dt_keys = dets.image_indices.numpy()[keep] * num_categories + \
+            np.searchsorted(self.category_ids, categories[keep])
+        dt_indices, dt_ranks, dt_matched, dt_ignored, gt_ignored = coco_match(
+            dt_boxes, dt_scores, dt_keys,
+            self._gt_boxes[gt_indices], self._gt_areas[gt_indices], self._gt_crowds[gt_indices], gt_keys,
+            self.iou_thresholds, self.area_ranges)
+
+        gt_categories = gt_keys % num_categories
+        n_positive = np.stack([
+            np.bincount(gt_categories[~gt_ignored[:, a]], minlength=num_categories)
+            for a in range(len(self.area_ranges))], axis=1)
+        return (dt_keys[dt_indices] % num_categories, dt_scores[dt_indices],
+                dt_ranks, dt_matched, dt_ignored, n_positive)
+
+    def compute(self):
+        tables = self._tables
+        if self._image_ids:
+            self._all_dets = Detections.cat(self._image_dets)
+            shards = [(i, i + self.shard_size) for i in range(0, len(self._image_ids), self.shard_size)]
+            tables = tables + _map_shards(_streaming_coco_match, self, shards, self.num_workers)
+        tables = [t for ts in _all_gather(tables) for t in ts]
+        if not tables:
+            raise NotComputableError(
+                'Metric must have at least one example before it can be computed')
+        dt_categories, dt_scores, dt_ranks, dt_matched, dt_ignored, n_positive = zip(*tables)
+        precision, recall = coco_accumulate(
+            *map(np.concatenate, (dt_categories, dt_scores, dt_ranks, dt_matched, dt_ignored)),
+            sum(n_positive))
+        self.stats = coco_summarize(precision, recall, self.iou_thresholds)
+        return self.stats[0]
+
+
 def get_ap(values):
     values = np.array([np.mean(values), values[0], values[5]])
     return values
@@ -346,14 +601,18 @@ class PixelAccuracy(Average):
         return acc, batch_size
 
 
-class CocoAveragePrecision(Average):
+class CocoAveragePrecision(Metric):
     r"""
+    Dataset level AP at the IoU thresholds. Detections and ground truths are
+    accumulated in arrays over batches, and all thresholds are evaluated together
+    in `compute`.
+
     Args:
 
     Inputs:
-        target (list of list of horch.Detection.BBox): ground truth bounding boxes
-        preds: (batch_size, h, w, c)
-        predict: preds -> detected bounding boxes like `target` with additional `confidence`
+        target (list of list of annotations): ground truth annotations of every image
+        preds (Detections or list of list of annotations): detected annotations like `target`
+            with additional `score`
     """
 
     def __init__(self, iou_threshold=np.arange(0.5, 1, 0.05), get_value=get_ap):
@@ -361,29 +620,43 @@ class CocoAveragePrecision(Average):
         self.get_value = get_value
         super().__init__(self.output_transform)
 
+    def reset(self):
+        self._num_images = 0
+        self._dts = []
+        self._gts = []
+
     def output_transform(self, output):
-        target, image_dets, batch_size = get(
-            ["target", "preds", "batch_size"], output)
-        image_gts = target[0]
-        for dets, gts in zip(image_dets, image_gts):
-            image_id = gts[0]['image_id']
-            for d in dets:
-                d['image_id'] = image_id
+        target, image_dets = get(["target", "preds"], output)
+        return image_dets, target[0]
+
+    def update(self, output):
+        image_dets, image_gts = output
+        dets = as_detections(image_dets)
+        boxes, scores, _, labels = dets.numpy()
+        boxes[:, 2:] += boxes[:, :2]
+        image_indices = self._num_images + dets.image_indices.numpy()
+        self._dts.append([boxes, scores, image_indices, labels])
+        for gts in image_gts:
+            self._gts.append(_columns(gts, self._num_images))
+            self._num_images += 1
+
+    def compute(self):
+        if self._num_images == 0:
+            raise NotComputableError(
+                'Metric must have at least one example before it can be computed')
+        dt_boxes, dt_scores, dt_image_ids, dt_category_ids = map(np.concatenate, zip(*self._dts))
+        gt_boxes, gt_image_ids, gt_category_ids = map(np.concatenate, zip(*self._gts))
+        values = compute_dataset_map(
+            dt_boxes, dt_scores, dt_image_ids, dt_category_ids,
+            gt_boxes, gt_image_ids, gt_category_ids, self.iou_threshold)
+        return self.get_value(values)
 
-        image_dets = [
-            [BBox(**ann, format=BBox.LTWH) for ann in idets]
-            for idets in image_dets
-        ]
-        image_gts = [
-            [BBox(**ann, format=BBox.LTWH) for ann in igts]
-            for igts in image_gts
-        ]
 
-        values = np.array([np.mean([mAP(image_dets[i], image_gts[i],
-                                        threshold) for i in range(batch_size)])
-                           for threshold in self.iou_threshold])
-        values = self.get_value(values)
-        return values, batch_size
+def _columns(anns, image_id):
+    # LTWH annotations of one image to LTRB box, image id and category id arrays.
+    boxes = np.array([ann['bbox'] for ann in anns], dtype=np.float64).reshape(-1, 4)
+    boxes[:, 2:] += boxes[:, :2]
+    return [boxes, np.full(len(anns), image_id), np.array([ann['category_id'] for ann in anns], dtype=np.int64)]
 
 
 class MeanAveragePrecision(Average):
@@ -391,8 +664,8 @@ class MeanAveragePrecision(Average):
     Args:
 
     Inputs:
-        target (list of list of horch.Detection.BBox): ground truth bounding boxes
-        preds: (batch_size, h, w, c)
+        target (list of list of annotations): ground truth annotations of every image
+        preds (Detections or list of list of annotations): detections of every image
     """
 
     def __init__(self, iou_threshold=0.5):
@@ -404,22 +677,18 @@ class MeanAveragePrecision(Average):
             ["target", "preds", "batch_size"], output)
         image_gts = target[0]
 
-        for dets, gts in zip(image_dets, image_gts):
-            image_id = gts[0]['image_id']
-            for d in dets:
-                d['image_id'] = image_id
-
-        image_dets = [
-            [BBox(**ann, format=BBox.LTWH) for ann in idets]
-            for idets in image_dets
-        ]
-        image_gts = [
-            [BBox(**ann, format=BBox.LTWH) for ann in igts]
-            for igts in image_gts
-        ]
-        values = np.mean([mAP(image_dets[i], image_gts[i],
-                              self.iou_threshold) for i in range(batch_size)])
-        return values, batch_size
+        dets = as_detections(image_dets)
+        boxes, scores, _, labels = dets.numpy()
+        boxes[:, 2:] += boxes[:, :2]
+        offsets = dets.offsets.tolist()
+        values = []
+        for i in range(batch_size):
+            s, e = offsets[i], offsets[i + 1]
+            gt_boxes, gt_image_ids, gt_labels = _columns(image_gts[i], 0)
+            values.append(compute_map(
+                boxes[s:e], scores[s:e], np.zeros(e - s, dtype=np.int64), labels[s:e],
+                gt_boxes, gt_image_ids, gt_labels, self.iou_threshold))
+        return np.mean(values), batch_size
 
 
 
@@ -97,6 +97,10 @@ def get_torch_extensions():
 
     is_windows = sys.platform == 'win32' or sys.platform == 'cygwin'
 
+    if not is_windows:
+        # Needed for the auto-vectorization of the SoA loops in the CPU kernels
+        extra_compile_args['cxx'] += ['-O3']
+
     if torch.cuda.is_available() and CUDA_HOME is not None and (not is_windows):
         extension = CUDAExtension
         sources += source_cuda
@@ -0,0 +1,40 @@
+import random
+
+import torch
+
+SIZES = [(320, 256), (97, 131)]
+
+
+def random_anns(size, n, max_ratio):
+    anns = []
+    for _ in range(n):
+        w, h = random.uniform(4, size[0] * max_ratio), random.uniform(4, size[1] * max_ratio)
+        l, t = random.uniform(0, size[0] - w), random.uniform(0, size[1] - h)
+        anns.append({'bbox': [l, t, w, h], 'category_id': random.randint(1, 80)})
+    return anns
+
+
+def overwrite_order(anns, ambiguity):
+    # The order in which a loop that overwrites earlier boxes resolves ambiguous locations
+    # like `ambiguity`. For `area`, the box with minimal area is written last, and of boxes
+    # with equal areas the first one.
+    if ambiguity == 'last':
+        return anns
+    order = sorted(range(len(anns)), key=lambda i: (-anns[i]['bbox'][2] * anns[i]['bbox'][3], -i))
+    return [anns[i] for i in order]
+
+
+def assert_transform_matches_loop(make_transform, targets_loop, max_ratio, counts=(0, 1, 10, 50)):
+    r"""
+    Compares the targets of `make_transform(size)` with `targets_loop(transform, anns)` on
+    random annotations of images of every size in `SIZES`.
+    """
+    random.seed(0)
+    for size in SIZES:
+        transform = make_transform(size)
+        img = torch.zeros(3, size[1], size[0])
+        for n in counts:
+            anns = random_anns(size, n, max_ratio)
+            for t1, t2 in zip(transform(img, anns)[1], targets_loop(transform, anns)):
+                assert t1.dtype == t2.dtype
+                assert torch.equal(t1, t2)
@@ -0,0 +1,33 @@
+import numpy as np
+
+from horch.detection.anchor import find_priors_kmeans, kmeans_minibatch, iou_wh
+
+
+def random_sizes(n, rng):
+    true_centers = np.array([[0.05, 0.08], [0.2, 0.1], [0.3, 0.5], [0.7, 0.6]])
+    sizes = true_centers[rng.randint(len(true_centers), size=n)]
+    return sizes * rng.uniform(0.9, 1.1, size=(n, 2)), true_centers
+
+
+def test_kmeans_minibatch():
+    rng = np.random.RandomState(0)
+    sizes, true_centers = random_sizes(50000, rng)
+    centers = kmeans_minibatch(sizes, 4, batch_size=1024, max_iter=200, seed=0, verbose=False)
+    assert iou_wh(true_centers, centers).max(axis=1).min() > 0.95
+
+    # Streams of chunks are consumed in one pass
+    chunks = (sizes[i:i + 3000] for i in range(0, len(sizes), 3000))
+    centers = kmeans_minibatch(chunks, 4, batch_size=1024, seed=0, verbose=False)
+    assert iou_wh(true_centers, centers).max(axis=1).min() > 0.95
+
+
+def test_find_priors_kmeans():
+    rng = np.random.RandomState(1)
+    sizes, true_centers = random_sizes(5000, rng)
+    np.random.seed(0)
+    priors = find_priors_kmeans(sizes, 4, verbose=False).numpy()
+    assert priors.shape == (4, 2)
+    # k-means++ seeding finds all the clusters
+    priors = find_priors_kmeans(sizes, 4, verbose=False, method='minibatch', seed=0).numpy()
+    assert priors.shape == (4, 2)
+    assert iou_wh(sizes, priors).max(axis=1).mean() > 0.9
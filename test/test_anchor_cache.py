@@ -0,0 +1,135 @@
+import torch
+
+from horch.detection import BBox, get_locations, generate_mlvl_anchors, generate_anchors_with_priors
+from horch.detection.anchor_cache import (
+    LRUCache, MlvlAnchors, MlvlPriors, MlvlCenters, clear_cache, get_cache
+)
+from horch.detection.one import MatchAnchors, AnchorBasedInference, flatten
+from horch.models.detection import fcos, fovea
+from horch.models.detection.yolo import YOLOTransform, YOLOInference
+
+
+STRIDES = [8, 16, 32]
+ANCHOR_SIZES = [
+    torch.tensor([[16., 16.], [24., 12.]]),
+    torch.tensor([[32., 32.], [48., 24.]]),
+    torch.tensor([[64., 64.], [96., 48.]]),
+]
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    assert cache.get('a', lambda: 1) == 1
+    assert cache.get('b', lambda: 2) == 2
+    assert cache.get('a', lambda: 0) == 1
+    cache.get('c', lambda: 3)
+    assert 'b' not in cache and 'a' in cache and 'c' in cache
+    assert (cache.hits, cache.misses) == (1, 3)
+    cache.resize(1)
+    assert len(cache) == 1 and 'c' in cache
+
+
+def test_anchor_grids_match_generators():
+    clear_cache()
+    for size in [(320, 320), (300, 220), (97, 131)]:
+        locations = get_locations(size, STRIDES)
+        anchors = MlvlAnchors(STRIDES, ANCHOR_SIZES)
+        expected = generate_mlvl_anchors(size, STRIDES, ANCHOR_SIZES)
+        assert torch.allclose(anchors(size), flatten(expected))
+        assert torch.allclose(
+            anchors(size, format=BBox.LTRB), BBox.convert(flatten(expected), BBox.XYWH, BBox.LTRB))
+
+        priors = torch.rand(3, 3, 2)
+        expected = [generate_anchors_with_priors(size, s, p) for s, p in zip(STRIDES, priors)]
+        assert torch.allclose(MlvlPriors(STRIDES, priors)(size), flatten(expected))
+
+        for centers, expected in [
+            (MlvlCenters(STRIDES), fcos.get_mlvl_centers(locations, STRIDES)),
+            (MlvlCenters(STRIDES, unit='grid'), fovea.get_mlvl_centers(locations)),
+        ]:
+            for c, e in zip(centers.mlvl(size), expected):
+                assert torch.equal(c, e)
+
+
+def test_anchor_grid_cached():
+    clear_cache()
+    anchors = MlvlAnchors(STRIDES, ANCHOR_SIZES)
+    a = anchors((320, 320))
+    assert MlvlAnchors(STRIDES, ANCHOR_SIZES)((320, 320)) is a
+    assert anchors((320, 320), dtype=torch.float64) is not a
+    assert anchors((256, 256)).size(0) != a.size(0)
+    assert get_cache().hits == 1
+
+
+def random_anns(size, n=5):
+    w, h = size
+    anns = []
+    for i in range(n):
+        l, t = torch.rand(2).tolist()
+        bw, bh = (torch.rand(2) * 0.4 + 0.1).tolist()
+        anns.append({
+            'bbox': [l * 0.5 * w, t * 0.5 * h, bw * w, bh * h],
+            'category_id': i % 3 + 1,
+        })
+    return anns
+
+
+def normalized(anns, size):
+    w, h = size
+    return [{**ann, 'bbox': [x / s for x, s in zip(ann['bbox'], (w, h, w, h))]} for ann in anns]
+
+
+def test_transforms_look_up_by_image_size():
+    torch.manual_seed(0)
+    for size in [(320, 256), (192, 224)]:
+        img = torch.zeros(3, size[1], size[0])
+        anns = normalized(random_anns(size), size)
+
+        fixed = MatchAnchors(generate_mlvl_anchors(size, STRIDES, ANCHOR_SIZES), 0.5, 0.4)
+        cached = MatchAnchors(MlvlAnchors(STRIDES, ANCHOR_SIZES), 0.5, 0.4)
+        for t1, t2 in zip(fixed(img, anns)[1], cached(img, anns)[1]):
+            assert torch.equal(t1, t2)
+
+        priors = torch.rand(3, 3, 2) * 0.5
+        mlvl_anchors = [generate_anchors_with_priors(size, s, p) for s, p in zip(STRIDES, priors)]
+        fixed = YOLOTransform(mlvl_anchors)
+        cached = YOLOTransform(MlvlPriors(STRIDES, priors))
+        for t1, t2 in zip(fixed(img, anns)[1], cached(img, anns)[1]):
+            assert torch.equal(t1, t2)
+
+        anns = random_anns(size)
+        locations = get_locations(size, STRIDES)
+        fixed = fcos.FCOSTransform(fcos.get_mlvl_centers(locations, STRIDES), thresholds=(0, 64, 128, 1e8))
+        cached = fcos.FCOSTransform(MlvlCenters(STRIDES), thresholds=(0, 64, 128, 1e8))
+        for t1, t2 in zip(fixed(img, anns)[1], cached(img, anns)[1]):
+            assert torch.equal(t1, t2)
+
+        thresholds = ((0, 64 ** 2), (32 ** 2, 128 ** 2), (64 ** 2, 1e8))
+        fixed = fovea.FoveaTransform(fovea.get_mlvl_centers(locations), levels=(3, 4, 5), thresholds=thresholds)
+        cached = fovea.FoveaTransform(MlvlCenters(STRIDES, unit='grid'), levels=(3, 4, 5), thresholds=thresholds)
+        for t1, t2 in zip(fixed(img, anns)[1], cached(img, anns)[1]):
+            assert torch.equal(t1, t2)
+
+
+def test_inference_looks_up_by_size():
+    torch.manual_seed(0)
+    size = (256, 192)
+    n = flatten(generate_mlvl_anchors(size, STRIDES, ANCHOR_SIZES)).size(0)
+    loc_p = torch.randn(2, n, 4) * 0.1
+    cls_p = torch.randn(2, n, 4)
+
+    fixed = AnchorBasedInference(generate_mlvl_anchors(size, STRIDES, ANCHOR_SIZES), nms='nms')
+    cached = AnchorBasedInference(MlvlAnchors(STRIDES, ANCHOR_SIZES), nms='nms')
+    assert fixed(loc_p.clone(), cls_p.clone()).to_coco_dicts() == \
+        cached(loc_p.clone(), cls_p.clone(), size=size).to_coco_dicts()
+
+    priors = torch.rand(3, 2, 2) * 0.5
+    mlvl_anchors = [generate_anchors_with_priors(size, s, p) for s, p in zip(STRIDES, priors)]
+    n = flatten(mlvl_anchors).size(0)
+    loc_p = torch.randn(2, n, 4) * 0.1
+    obj_p = torch.randn(2, n)
+    cls_p = torch.randn(2, n, 3)
+    fixed = YOLOInference(mlvl_anchors, nms='nms')
+    cached = YOLOInference(MlvlPriors(STRIDES, priors), nms='nms', size=size)
+    assert fixed(loc_p.clone(), obj_p.clone(), cls_p.clone()).to_coco_dicts() == \
+        cached(loc_p.clone(), obj_p.clone(), cls_p.clone()).to_coco_dicts()
@@ -0,0 +1,138 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import torch
+
+from horch.detection import BBox
+from horch._fallback import _C as _fallback
+
+try:
+    from horch import _C as _native, _numpy as _native_numpy
+except ImportError:
+    _native = None
+
+pytestmark = pytest.mark.skipif(_native is None, reason="horch._C is not built")
+
+
+def random_boxes(*size):
+    boxes = torch.rand(*size, 4)
+    boxes[..., 2:] = boxes[..., 2:] * 0.3 + 0.05
+    return BBox.convert(boxes, BBox.XYWH, BBox.LTRB, inplace=True)
+
+
+def test_nms():
+    boxes = random_boxes(500)
+    scores = torch.rand(500)
+    idxs = torch.randint(5, (500,))
+    assert _fallback.nms(boxes, scores, 0.5).tolist() == _native.nms(boxes, scores, 0.5).tolist()
+    assert _fallback.batched_nms(boxes, scores, idxs, 0.5).tolist() == \
+        _native.batched_nms(boxes, scores, idxs, 0.5).tolist()
+
+
+def test_soft_nms():
+    boxes = random_boxes(500)
+    scores = torch.rand(500)
+    vars = torch.rand(500, 4) * 0.1 + 0.01
+    scores1, scores2 = scores.clone(), scores.clone()
+    assert _fallback.soft_nms(boxes, scores1, 0.5, 100, 0.01).tolist() == \
+        _native.soft_nms(boxes, scores2, 0.5, 100, 0.01).tolist()
+    assert torch.allclose(scores1, scores2)
+
+    boxes1, boxes2 = boxes.clone(), boxes.clone()
+    assert _fallback.softer_nms(boxes1, scores.clone(), vars, 0.5, 100, 0.01, 0.01).tolist() == \
+        _native.softer_nms(boxes2, scores.clone(), vars, 0.5, 100, 0.01, 0.01).tolist()
+    assert torch.allclose(boxes1, boxes2, atol=1e-6)
+
+
+@pytest.mark.parametrize("conf_strategy", ['softmax', 'sigmoid'])
+@pytest.mark.parametrize("nms_method", ['nms', 'multiclass', 'soft'])
+def test_decode_and_nms(conf_strategy, nms_method):
+    torch.manual_seed(0)
+    anchors = BBox.convert(random_boxes(1000), BBox.LTRB, BBox.XYWH)
+    loc_p = torch.randn(1000, 4) * 0.2
+    cls_p = torch.randn(1000, 5) - 1
+    args = (loc_p, cls_p, anchors, conf_strategy, 0.3, nms_method, 0.5, 50, 0.01, 3)
+    for t1, t2 in zip(_fallback.decode_and_nms(*args), _native.decode_and_nms(*args)):
+        assert torch.allclose(t1, t2)
+
+
+def test_iou_mn():
+    boxes1 = random_boxes(20)
+    boxes2 = random_boxes(300)
+    ious = _native.iou_mn_forward(boxes1, boxes2)
+    assert torch.allclose(_fallback.iou_mn_forward(boxes1, boxes2), ious)
+    dious = torch.randn_like(ious)
+    for g1, g2 in zip(_fallback.iou_mn_backward(dious, boxes1, boxes2, ious),
+                      _native.iou_mn_backward(dious, boxes1, boxes2, ious)):
+        assert torch.allclose(g1, g2, atol=1e-5)
+    for kind in range(4):
+        boxes3 = random_boxes(300)
+        ious = _native.iou_b11_forward(boxes2, boxes3, kind)
+        assert torch.allclose(_fallback.iou_b11_forward(boxes2, boxes3, kind), ious, atol=1e-6)
+        dious = torch.randn_like(ious)
+        for g1, g2 in zip(_fallback.iou_b11_backward(dious, boxes2, boxes3, kind),
+                          _native.iou_b11_backward(dious, boxes2, boxes3, kind)):
+            assert torch.allclose(g1, g2, atol=1e-4)
+
+
+@pytest.mark.parametrize("sampling_ratio", [2, 0])
+def test_roi_align(sampling_ratio):
+    input = torch.randn(2, 12, 16, 20)
+    rois = torch.cat([torch.randint(2, (30, 1)).float(), random_boxes(30)], dim=1)
+    args = (rois, 16.0, 20.0, 3, 2, sampling_ratio)
+    output = _native.roi_align_forward(input, *args)
+    assert torch.allclose(_fallback.roi_align_forward(input, *args), output, atol=1e-5)
+    grad = torch.randn_like(output)
+    args = (rois, 16.0, 20.0, 3, 2, 2, 12, 16, 20, sampling_ratio)
+    assert torch.allclose(_fallback.roi_align_backward(grad, *args),
+                          _native.roi_align_backward(grad, *args), atol=1e-5)
+
+    args = (rois, 16.0, 20.0, 2, 3, 2, sampling_ratio)
+    output = _native.psroi_align_forward(input, *args)
+    assert torch.allclose(_fallback.psroi_align_forward(input, *args), output, atol=1e-5)
+    grad = torch.randn_like(output)
+    args = (rois, 16.0, 20.0, 2, 3, 2, 2, 12, 16, 20, sampling_ratio)
+    assert torch.allclose(_fallback.psroi_align_backward(grad, *args),
+                          _native.psroi_align_backward(grad, *args), atol=1e-5)
+
+
+def test_roi_align_threads():
+    input = torch.randn(2, 18, 16, 20)
+    rois = torch.cat([torch.randint(2, (50, 1)).float(), random_boxes(50)], dim=1)
+    num_threads = torch.get_num_threads()
+    results = []
+    for t in [1, 4]:
+        torch.set_num_threads(t)
+        output = _native.roi_align_forward(input, rois, 16.0, 20.0, 3, 3, 2)
+        grad = torch.ones_like(output)
+        ps_output = _native.psroi_align_forward(input, rois, 16.0, 20.0, 2, 3, 3, 2)
+        results.append([
+            output, _native.roi_align_backward(grad, rois, 16.0, 20.0, 3, 3, 2, 18, 16, 20, 2),
+            ps_output, _native.psroi_align_backward(torch.ones_like(ps_output), rois, 16.0, 20.0, 2, 3, 3,
+                                                    2, 18, 16, 20, 2),
+        ])
+    torch.set_num_threads(num_threads)
+    for t1, t4 in zip(*results):
+        assert torch.equal(t1, t4)
+
+
+def test_concurrent_calls():
+    # The ops release the GIL and must give the same results when called from several threads
+    boxes = random_boxes(1000)
+    scores = torch.rand(1000)
+    boxes2 = random_boxes(300)
+    np_boxes = boxes.double().numpy()
+    cases = [
+        lambda: [_native.nms(boxes, scores, 0.5)],
+        lambda: [_native.soft_nms(boxes, scores.clone(), 0.5, 100, 0.01)],
+        lambda: [_native.iou_mn_forward(boxes, boxes2)],
+        lambda: [torch.from_numpy(_native_numpy.iou_mn(np_boxes, np_boxes[:100])),
+                 torch.from_numpy(_native_numpy.iou_mm(np_boxes[:200]))],
+    ]
+    for f in cases:
+        expected = f()
+        with ThreadPoolExecutor(4) as pool:
+            for results in pool.map(lambda _: f(), range(16)):
+                for t1, t2 in zip(results, expected):
+                    assert torch.equal(t1, t2)
@@ -0,0 +1,260 @@
+import multiprocessing
+from copy import deepcopy
+
+import numpy as np
+import pytest
+
+from horch.train.metrics import StreamingCOCOEvaluator, COCOEval, _coco_evaluate_sharded
+
+
+def coco_reference(gts, dts, cat_ids, img_ids):
+    # A direct port of the bbox path of pycocotools' COCOeval.evaluate, accumulate and summarize.
+    iou_thrs = np.linspace(.5, 0.95, 10)
+    rec_thrs = np.linspace(.0, 1.00, 101)
+    max_dets = [1, 10, 100]
+    area_rngs = [[0 ** 2, 1e5 ** 2], [0 ** 2, 32 ** 2], [32 ** 2, 96 ** 2], [96 ** 2, 1e5 ** 2]]
+
+    def iou(d, g, crowd):
+        ious = np.zeros((len(d), len(g)))
+        for i, a in enumerate(d):
+            for j, b in enumerate(g):
+                w = max(0, min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0]))
+                h = max(0, min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1]))
+                inter = w * h
+                union = a[2] * a[3] if crowd[j] else a[2] * a[3] + b[2] * b[3] - inter
+                ious[i, j] = inter / union
+        return ious
+
+    def evaluate_img(img_id, cat_id, a_rng, max_det):
+        gt = [g for g in gts if g['image_id'] == img_id and g['category_id'] == cat_id]
+        dt = [d for d in dts if d['image_id'] == img_id and d['category_id'] == cat_id]
+        if len(gt) == 0 and len(dt) == 0:
+            return None
+        for g in gt:
+            g['_ignore'] = 1 if g['iscrowd'] or g['area'] < a_rng[0] or g['area'] > a_rng[1] else 0
+        gtind = np.argsort([g['_ignore'] for g in gt], kind='mergesort')
+        gt = [gt[i] for i in gtind]
+        dtind = np.argsort([-d['score'] for d in dt], kind='mergesort')
+        dt = [dt[i] for i in dtind[0:max_det]]
+        iscrowd = [int(o['iscrowd']) for o in gt]
+        ious = iou([d['bbox'] for d in dt], [g['bbox'] for g in gt], iscrowd)
+        T, G, D = len(iou_thrs), len(gt), len(dt)
+        gtm = np.zeros((T, G))
+        dtm = np.zeros((T, D))
+        gt_ig = np.array([g['_ignore'] for g in gt])
+        dt_ig = np.zeros((T, D))
+        for tind, t in enumerate(iou_thrs):
+            for dind, d in enumerate(dt):
+                thr = min([t, 1 - 1e-10])
+                m = -1
+                for gind, g in enumerate(gt):
+                    if gtm[tind, gind] > 0 and not iscrowd[gind]:
+                        continue
+                    if m > -1 and gt_ig[m] == 0 and gt_ig[gind] == 1:
+                        break
+                    if ious[dind, gind] < thr:
+                        continue
+                    thr = ious[dind, gind]
+                    m = gind
+                if m == -1:
+                    continue
+                dt_ig[tind, dind] = gt_ig[m]
+                dtm[tind, dind] = 1
+                gtm[tind, m] = 1
+        a = np.array([d['bbox'][2] * d['bbox'][3] < a_rng[0] or d['bbox'][2] * d['bbox'][3] > a_rng[1]
+                      for d in dt]).reshape((1, len(dt)))
+        dt_ig = np.logical_or(dt_ig, np.logical_and(dtm == 0, np.repeat(a, T, 0)))
+        return {'dtMatches': dtm, 'dtScores': [d['score'] for d in dt],
+                'gtIgnore': gt_ig, 'dtIgnore': dt_ig}
+
+    T, R, K, A, M = len(iou_thrs), len(rec_thrs), len(cat_ids), len(area_rngs), len(max_dets)
+    precision = -np.ones((T, R, K, A, M))
+    recall = -np.ones((T, K, A, M))
+    for k, cat_id in enumerate(cat_ids):
+        for a, a_rng in enumerate(area_rngs):
+            E = [evaluate_img(i, cat_id, a_rng, max_dets[-1]) for i in img_ids]
+            E = [e for e in E if e is not None]
+            if len(E) == 0:
+                continue
+            for m, max_det in enumerate(max_dets):
+                dt_scores = np.concatenate([e['dtScores'][0:max_det] for e in E])
+                inds = np.argsort(-dt_scores, kind='mergesort')
+                dtm = np.concatenate([e['dtMatches'][:, 0:max_det] for e in E], axis=1)[:, inds]
+                dt_ig = np.concatenate([e['dtIgnore'][:, 0:max_det] for e in E], axis=1)[:, inds]
+                gt_ig = np.concatenate([e['gtIgnore'] for e in E])
+                npig = np.count_nonzero(gt_ig == 0)
+                if npig == 0:
+                    continue
+                tps = np.logical_and(dtm, np.logical_not(dt_ig))
+                fps = np.logical_and(np.logical_not(dtm), np.logical_not(dt_ig))
+                tp_sum = np.cumsum(tps, axis=1).astype(dtype=float)
+                fp_sum = np.cumsum(fps, axis=1).astype(dtype=float)
+                for t, (tp, fp) in enumerate(zip(tp_sum, fp_sum)):
+                    nd = len(tp)
+                    rc = tp / npig
+                    pr = tp / (fp + tp + np.spacing(1))
+                    q = np.zeros((R,))
+                    recall[t, k, a, m] = rc[-1] if nd else 0
+                    pr = pr.tolist()
+                    q = q.tolist()
+                    for i in range(nd - 1, 0, -1):
+                        if pr[i] > pr[i - 1]:
+                            pr[i - 1] = pr[i]
+                    inds = np.searchsorted(rc, rec_thrs, side='left')
+                    try:
+                        for ri, pi in enumerate(inds):
+                            q[ri] = pr[pi]
+                    except IndexError:
+                        pass
+                    precision[t, :, k, a, m] = np.array(q)
+
+    def summarize(ap, iou_thr=None, area=0, max_det=100):
+        m = max_dets.index(max_det)
+        if ap:
+            s = precision
+            if iou_thr is not None:
+                s = s[np.where(np.isclose(iou_thr, iou_thrs))[0]]
+            s = s[:, :, :, area, m]
+        else:
+            s = recall[:, :, area, m]
+        s = s[s > -1]
+        return -1 if len(s) == 0 else np.mean(s)
+
+    return np.array([
+        summarize(1), summarize(1, iou_thr=.5), summarize(1, iou_thr=.75),
+        summarize(1, area=1), summarize(1, area=2), summarize(1, area=3),
+        summarize(0, max_det=1), summarize(0, max_det=10), summarize(0),
+        summarize(0, area=1), summarize(0, area=2), summarize(0, area=3),
+    ])
+
+
+def random_coco(seed=0, num_images=12, cat_ids=(1, 3, 7)):
+    rng = np.random.RandomState(seed)
+    cat_ids = list(cat_ids)
+    images = [{'id': i + 10, 'width': 200, 'height': 160} for i in range(num_images)]
+    gts, image_dets = [], []
+    for img in images:
+        image_gts = []
+        for _ in range(rng.randint(0, 8)):
+            wh = rng.choice([8, 20, 50, 120]) * rng.uniform(0.6, 1.4, size=2)
+            lt = rng.uniform(0, 60, size=2)
+            image_gts.append({
+                'id': len(gts) + 1, 'image_id': img['id'], 'category_id': int(rng.choice(cat_ids)),
+                'bbox': [*lt, *wh], 'area': float(wh.prod() * rng.uniform(0.7, 1)),
+                'iscrowd': int(rng.uniform() < 0.1)})
+            gts.append(image_gts[-1])
+        dets = []
+        for g in image_gts:
+            for _ in range(rng.randint(0, 3)):
+                dets.append({'category_id': g['category_id'], 'score': float(rng.uniform()),
+                             'bbox': list(np.array(g['bbox']) + rng.normal(0, 3, size=4))})
+        for _ in range(rng.randint(0, 6)):
+            dets.append({'category_id': int(rng.choice(cat_ids + [5])), 'score': float(rng.uniform()),
+                         'bbox': [*rng.uniform(0, 60, size=2), *rng.uniform(5, 80, size=2)]})
+        image_dets.append(dets)
+    # Make sure every image has an annotation to take the image id from
+    targets = [[g for g in gts if g['image_id'] == img['id']] or [{'image_id': img['id']}] for img in images]
+
+    annotations = {'images': images, 'annotations': gts,
+                   'categories': [{'id': c} for c in cat_ids]}
+    return annotations, targets, image_dets
+
+
+def evaluate(metric, targets, image_dets, batch_size=5):
+    metric.reset()
+    for start in range(0, len(targets), batch_size):
+        preds = [[{**d, 'bbox': [d['bbox'][0] / 200, d['bbox'][1] / 160, d['bbox'][2] / 200, d['bbox'][3] / 160]}
+                  for d in dets] for dets in image_dets[start:start + batch_size]]
+        metric.update({'target': [targets[start:start + batch_size]], 'preds': preds})
+    metric.compute()
+    return metric.stats
+
+
+def test_streaming_coco_evaluator():
+    annotations, targets, image_dets = random_coco()
+    images, gts, cat_ids = annotations['images'], annotations['annotations'], [1, 3, 7]
+    stats = evaluate(StreamingCOCOEvaluator(annotations), targets, image_dets)
+
+    dts = [{**d, 'image_id': img['id']} for img, dets in zip(images, image_dets)
+           for d in dets if d['category_id'] in cat_ids]
+    expected = coco_reference(gts, dts, cat_ids, [img['id'] for img in images])
+    np.testing.assert_allclose(stats, expected)
+
+
+def test_streaming_coco_evaluator_images_without_gts():
+    annotations, targets, image_dets = random_coco(3, num_images=20)
+    stats = evaluate(StreamingCOCOEvaluator(annotations), targets, image_dets)
+    # Images without annotations take the image id of their detections, or are skipped
+    image_dets = [[{**d, 'image_id': img['id']} for d in dets]
+                  for img, dets in zip(annotations['images'], image_dets)]
+    targets = [[g for g in gts if 'id' in g] for gts in targets]
+    assert any(len(gts) == 0 and dets for gts, dets in zip(targets, image_dets))
+    assert any(len(gts) == 0 and not dets for gts, dets in zip(targets, image_dets))
+    for num_workers in [0, 2]:
+        np.testing.assert_allclose(
+            evaluate(StreamingCOCOEvaluator(annotations, num_workers=num_workers, shard_size=4),
+                     targets, image_dets), stats)
+
+
+def test_streaming_coco_evaluator_sharded():
+    annotations, targets, image_dets = random_coco(1, num_images=30)
+    stats = evaluate(StreamingCOCOEvaluator(annotations), targets, image_dets)
+    sharded = evaluate(StreamingCOCOEvaluator(annotations, num_workers=2, shard_size=4), targets, image_dets)
+    np.testing.assert_allclose(sharded, stats)
+
+
+def test_streaming_coco_evaluator_sharded_without_fork(monkeypatch):
+    annotations, targets, image_dets = random_coco(2, num_images=20)
+    stats = evaluate(StreamingCOCOEvaluator(annotations), targets, image_dets)
+    monkeypatch.setattr(multiprocessing, 'get_all_start_methods', lambda: ['spawn'])
+    sharded = evaluate(StreamingCOCOEvaluator(annotations, num_workers=2, shard_size=4), targets, image_dets)
+    np.testing.assert_allclose(sharded, stats)
+
+
+def test_coco_eval_sharded():
+    pytest.importorskip('hpycocotools')
+    annotations, targets, image_dets = random_coco(1, num_images=30)
+    preds = [[{**d, 'bbox': [d['bbox'][0] / 200, d['bbox'][1] / 160, d['bbox'][2] / 200, d['bbox'][3] / 160]}
+              for d in dets] for dets in image_dets]
+    results = []
+    for num_workers in [0, 2]:
+        metric = COCOEval(annotations, num_workers=num_workers)
+        metric.reset()
+        for start in range(0, len(targets), 5):
+            metric.update({'target': [targets[start:start + 5]], 'preds': preds[start:start + 5], 'batch_size': 5})
+        results.append(metric.compute())
+    np.testing.assert_allclose(results[1], results[0])
+
+
+class FakeParams:
+    def __init__(self, img_ids, cat_ids, use_cats=1):
+        self.imgIds = img_ids
+        self.catIds = cat_ids
+        self.areaRng = [[0, 1e10], [0, 1024], [1024, 9216], [9216, 1e10]]
+        self.useCats = use_cats
+
+
+class FakeCOCOeval:
+    # evalImgs in the order of COCOeval.evaluate, by category, area range and image
+    def __init__(self, params):
+        self.params = params
+
+    def evaluate(self):
+        p = self.params
+        cat_ids = p.catIds if p.useCats else [-1]
+        self.evalImgs = [(c, tuple(a), i) for c in cat_ids for a in p.areaRng for i in np.unique(p.imgIds)]
+        self._paramsEval = deepcopy(p)
+
+
+@pytest.mark.parametrize("fork", [True, False])
+def test_coco_evaluate_sharded(monkeypatch, fork):
+    if not fork:
+        monkeypatch.setattr(multiprocessing, 'get_all_start_methods', lambda: ['spawn'])
+    for img_ids, use_cats, num_workers in [([5, 3, 9, 1, 7, 2, 8], 1, 3), ([4, 1, 6, 2], 0, 2),
+                                           ([3], 1, 4), ([], 1, 2)]:
+        expected = FakeCOCOeval(FakeParams(img_ids, [1, 3, 7], use_cats))
+        expected.evaluate()
+        ev = FakeCOCOeval(FakeParams(img_ids, [1, 3, 7], use_cats))
+        _coco_evaluate_sharded(ev, num_workers)
+        assert ev.evalImgs == expected.evalImgs
+        assert list(ev._paramsEval.imgIds) == sorted(img_ids)
@@ -0,0 +1,83 @@
+import numpy as np
+import torch
+
+from horch.detection import Detections, BBox, mAP
+from horch.train.metrics import CocoAveragePrecision, MeanAveragePrecision, StreamingCOCOEvaluator
+
+
+def random_image_dets(rng, num_images=5):
+    image_dets = []
+    for i in range(num_images):
+        image_dets.append([
+            {'image_id': -1, 'category_id': int(rng.randint(1, 4)),
+             'bbox': list(rng.uniform(0, 0.5, size=4)), 'score': float(rng.uniform())}
+            for _ in range(rng.randint(0, 6))
+        ])
+    return image_dets
+
+
+def test_detections():
+    rng = np.random.RandomState(0)
+    image_dets = random_image_dets(rng)
+    image_dets[1] = []
+    dets = Detections.from_dicts(image_dets)
+    assert len(dets) == len(image_dets)
+    assert dets.to_coco_dicts() == image_dets
+    assert list(dets) == image_dets
+    assert dets[1] == [] and dets[-1] == image_dets[-1]
+    assert dets[1:4].to_coco_dicts() == image_dets[1:4]
+    assert Detections.cat([dets[:2], dets[2:]]).to_coco_dicts() == image_dets
+
+    image_ids = [10, 11, 12, 13, 14]
+    for ds, image_id in zip(dets.with_image_ids(image_ids), image_ids):
+        assert all(d['image_id'] == image_id for d in ds)
+
+    single = Detections.single(
+        torch.rand(6, 4), torch.rand(6), torch.arange(6), indices=torch.tensor([4, 1]))
+    assert len(single) == 1 and single[0][0]['category_id'] == 4
+    assert len(Detections.empty(3)) == 3 and Detections.empty(3)[2] == []
+
+
+def coco_annotations(rng, num_images):
+    images = [{'id': i, 'width': 200, 'height': 100} for i in range(num_images)]
+    annotations = []
+    for i in range(num_images):
+        for _ in range(rng.randint(1, 5)):
+            bbox = list(rng.uniform(0, 0.5, size=4) * [200, 100, 200, 100])
+            annotations.append({'id': len(annotations), 'image_id': i, 'category_id': int(rng.randint(1, 4)),
+                                'bbox': bbox, 'area': bbox[2] * bbox[3], 'iscrowd': 0})
+    categories = [{'id': i} for i in range(1, 4)]
+    return {'images': images, 'annotations': annotations, 'categories': categories}
+
+
+def test_metrics_consume_detections():
+    rng = np.random.RandomState(1)
+    num_images = 8
+    annotations = coco_annotations(rng, num_images)
+    image_gts = [[ann for ann in annotations['annotations'] if ann['image_id'] == i] for i in range(num_images)]
+    image_dets = []
+    for gts in image_gts:
+        dets = [{'category_id': g['category_id'], 'score': float(rng.uniform()),
+                 'bbox': list(np.array(g['bbox']) / [200, 100, 200, 100] + rng.normal(0, 0.01, size=4))}
+                for g in gts]
+        dets += random_image_dets(rng, 1)[0]
+        image_dets.append(dets)
+
+    def run(metric, preds):
+        metric.reset()
+        for b in range(0, num_images, 4):
+            output = {'target': [image_gts[b:b + 4]], 'preds': preds[b:b + 4], 'batch_size': 4}
+            metric.update(metric._output_transform(output))
+        return metric.compute()
+
+    columns = Detections.from_dicts(image_dets)
+    for metric in [CocoAveragePrecision(), StreamingCOCOEvaluator(annotations)]:
+        np.testing.assert_allclose(run(metric, image_dets), run(metric, columns))
+
+    expected = np.mean([
+        np.mean([mAP([BBox(**{**d, 'image_id': 0}, format=BBox.LTWH) for d in image_dets[i]],
+                     [BBox(**{**g, 'image_id': 0}, format=BBox.LTWH) for g in image_gts[i]])
+                 for i in range(b, b + 4)])
+        for b in range(0, num_images, 4)])
+    metric = MeanAveragePrecision()
+    np.testing.assert_allclose(run(metric, columns), expected)
@@ -0,0 +1,120 @@
+import numpy as np
+
+from horch.detection import BBox
+from horch.detection.iou import iou_11
+from horch.detection.eval import mAP, compute_ap, compute_map, compute_dataset_map, average_precision
+
+
+def random_boxes(n, rng):
+    lt = rng.uniform(0, 80, size=(n, 2))
+    wh = rng.uniform(5, 40, size=(n, 2))
+    return np.concatenate([lt, lt + wh], axis=1)
+
+
+def reference_ap(dt_boxes, dt_scores, gt_boxes, iou_threshold):
+    dt_boxes = dt_boxes[np.argsort(-dt_scores, kind='stable')]
+    TP = np.zeros(len(dt_boxes))
+    seen = np.zeros(len(gt_boxes))
+    for i, dt in enumerate(dt_boxes):
+        ious = [iou_11(dt, gt) for gt in gt_boxes]
+        j_max, iou_max = max(enumerate(ious), key=lambda x: x[1])
+        if iou_max > iou_threshold and not seen[j_max]:
+            TP[i] = 1
+            seen[j_max] = 1
+    acc_tp = np.cumsum(TP)
+    acc_fp = np.cumsum(1 - TP)
+    mrec = [0, *(acc_tp / len(gt_boxes)), 1]
+    mpre = [0, *(acc_tp / (acc_fp + acc_tp)), 0]
+    for i in range(len(mpre) - 1, 0, -1):
+        mpre[i - 1] = max(mpre[i - 1], mpre[i])
+    return sum((mrec[i] - mrec[i - 1]) * mpre[i]
+               for i in range(1, len(mrec)) if mrec[i] != mrec[i - 1])
+
+
+def test_compute_ap():
+    rng = np.random.RandomState(0)
+    for _ in range(20):
+        gt_boxes = random_boxes(rng.randint(1, 10), rng)
+        dt_boxes = np.concatenate([
+            gt_boxes + rng.normal(0, 3, size=gt_boxes.shape),
+            random_boxes(rng.randint(1, 20), rng)])
+        dt_scores = rng.uniform(size=len(dt_boxes))
+        for iou_threshold in [0.3, 0.5, 0.75]:
+            np.testing.assert_allclose(
+                compute_ap(dt_boxes, dt_scores, gt_boxes, iou_threshold),
+                reference_ap(dt_boxes, dt_scores, gt_boxes, iou_threshold))
+
+
+def test_compute_map():
+    rng = np.random.RandomState(1)
+    gt_boxes = random_boxes(60, rng)
+    gt_image_ids = rng.randint(0, 8, size=60)
+    gt_category_ids = rng.randint(0, 3, size=60)
+    dt_boxes = np.concatenate([gt_boxes + rng.normal(0, 3, size=gt_boxes.shape), random_boxes(100, rng)])
+    dt_scores = rng.uniform(size=160)
+    dt_image_ids = np.concatenate([gt_image_ids, rng.randint(0, 10, size=100)])
+    dt_category_ids = np.concatenate([gt_category_ids, rng.randint(0, 4, size=100)])
+
+    expected = []
+    for i in np.unique(gt_image_ids):
+        aps = []
+        for c in np.unique(gt_category_ids[gt_image_ids == i]):
+            gm = (gt_image_ids == i) & (gt_category_ids == c)
+            dm = (dt_image_ids == i) & (dt_category_ids == c)
+            aps.append(reference_ap(dt_boxes[dm], dt_scores[dm], gt_boxes[gm], 0.5) if dm.any() else 0)
+        expected.append(np.mean(aps))
+
+    result = compute_map(dt_boxes, dt_scores, dt_image_ids, dt_category_ids,
+                         gt_boxes, gt_image_ids, gt_category_ids, 0.5)
+    np.testing.assert_allclose(result, np.mean(expected))
+
+    detections = [BBox(i, c, list(b), s) for b, s, i, c in
+                  zip(dt_boxes, dt_scores, dt_image_ids, dt_category_ids)]
+    ground_truths = [BBox(i, c, list(b)) for b, i, c in
+                     zip(gt_boxes, gt_image_ids, gt_category_ids)]
+    np.testing.assert_allclose(mAP(detections, ground_truths, 0.5), result)
+
+
+def test_compute_dataset_map():
+    rng = np.random.RandomState(2)
+    gt_boxes = random_boxes(60, rng)
+    gt_image_ids = rng.randint(0, 8, size=60)
+    gt_category_ids = rng.randint(0, 3, size=60)
+    dt_boxes = np.concatenate([gt_boxes + rng.normal(0, 3, size=gt_boxes.shape), random_boxes(100, rng)])
+    dt_scores = rng.uniform(size=160)
+    dt_image_ids = np.concatenate([gt_image_ids, rng.randint(0, 10, size=100)])
+    dt_category_ids = np.concatenate([gt_category_ids, rng.randint(0, 4, size=100)])
+    iou_thresholds = np.arange(0.5, 1, 0.05)
+
+    expected = []
+    for iou_threshold in iou_thresholds:
+        aps = []
+        for c in np.unique(gt_category_ids):
+            dm = np.flatnonzero(dt_category_ids == c)
+            dm = dm[np.argsort(-dt_scores[dm], kind='stable')]
+            TP = np.zeros(len(dm))
+            seen = set()
+            for k, i in enumerate(dm):
+                gm = np.flatnonzero((gt_image_ids == dt_image_ids[i]) & (gt_category_ids == c))
+                if len(gm) == 0:
+                    continue
+                ious = [iou_11(dt_boxes[i], gt_boxes[j]) for j in gm]
+                j = gm[int(np.argmax(ious))]
+                if max(ious) > iou_threshold and j not in seen:
+                    TP[k] = 1
+                    seen.add(j)
+            acc_tp = np.cumsum(TP)
+            recall = acc_tp / (gt_category_ids == c).sum()
+            precision = acc_tp / np.arange(1, len(TP) + 1)
+            aps.append(average_precision(recall, precision)[0])
+        expected.append(np.mean(aps))
+
+    result = compute_dataset_map(dt_boxes, dt_scores, dt_image_ids, dt_category_ids,
+                                 gt_boxes, gt_image_ids, gt_category_ids, iou_thresholds)
+    np.testing.assert_allclose(result, expected)
+
+    result = compute_map(dt_boxes, dt_scores, dt_image_ids, dt_category_ids,
+                         gt_boxes, gt_image_ids, gt_category_ids, iou_thresholds)
+    expected = [compute_map(dt_boxes, dt_scores, dt_image_ids, dt_category_ids,
+                            gt_boxes, gt_image_ids, gt_category_ids, t) for t in iou_thresholds]
+    np.testing.assert_allclose(result, expected)
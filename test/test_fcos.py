@@ -0,0 +1,72 @@
+import pytest
+import torch
+
+from horch.detection import get_locations
+from horch.models.detection.fcos import FCOSTransform, get_mlvl_centers, centerness
+
+from helpers import assert_transform_matches_loop, overwrite_order
+
+STRIDES = [8, 16, 32, 64, 128]
+
+
+def fcos_targets_loop(mlvl_centers, thresholds, anns):
+    loc_targets, cls_targets, ctn_targets = [], [], []
+    for centers in mlvl_centers:
+        lx, ly = centers.size()[:2]
+        loc_targets.append(torch.zeros(lx, ly, 4))
+        cls_targets.append(torch.zeros(lx, ly, dtype=torch.long))
+        ctn_targets.append(torch.zeros(lx, ly))
+    for ann in anns:
+        l, t, w, h = ann['bbox']
+        r, b = l + w, t + h
+        for centers, (lo, hi), loc_t, cls_t, ctn_t in zip(
+                mlvl_centers, thresholds, loc_targets, cls_targets, ctn_targets):
+            cx, cy = centers[..., 0], centers[..., 1]
+            mask = (l < cx) & (cx < r) & (t < cy) & (cy < b)
+            ts = torch.stack([cx - l, cy - t, r - cx, b - cy], dim=-1)
+            max_t = ts.max(dim=-1)[0]
+            mask &= (max_t >= lo) & (max_t < hi)
+            loc_t[mask] = ts[mask]
+            cls_t[mask] = ann['category_id']
+            ctn_t[mask] = centerness(loc_t[mask])
+    return [torch.cat([t.reshape(-1, *t.shape[2:]) for t in ts])
+            for ts in (loc_targets, cls_targets, ctn_targets)]
+
+
+@pytest.mark.parametrize('ambiguity', ['last', 'area'])
+def test_fcos_transform_matches_loop(ambiguity):
+    def make_transform(size):
+        return FCOSTransform(get_mlvl_centers(get_locations(size, STRIDES), STRIDES), ambiguity=ambiguity)
+
+    def targets_loop(transform, anns):
+        return fcos_targets_loop(transform.mlvl_centers, transform.thresholds, overwrite_order(anns, ambiguity))
+
+    assert_transform_matches_loop(make_transform, targets_loop, 0.7)
+
+
+def test_fcos_transform_min_area():
+    size = (64, 64)
+    mlvl_centers = get_mlvl_centers(get_locations(size, [8]), [8])
+    small = {'bbox': [8, 8, 24, 24], 'category_id': 1}
+    large = {'bbox': [0, 0, 48, 48], 'category_id': 2}
+    img = torch.zeros(3, 64, 64)
+    transform = FCOSTransform(mlvl_centers, thresholds=(0, 1e8), ambiguity='area')
+    for anns in [[small, large], [large, small]]:
+        cls_t = transform(img, anns)[1][1].view(8, 8)
+        assert cls_t[2, 2] == 1 and cls_t[0, 0] == 2
+    cls_t = FCOSTransform(mlvl_centers, thresholds=(0, 1e8))(img, [small, large])[1][1].view(8, 8)
+    assert cls_t[2, 2] == 2
+
+
+def test_fcos_transform_equal_areas():
+    size = (64, 64)
+    mlvl_centers = get_mlvl_centers(get_locations(size, [8]), [8])
+    # The location (20, 20) is inside both boxes, which have the same area
+    a = {'bbox': [0, 0, 32, 32], 'category_id': 1}
+    b = {'bbox': [16, 16, 32, 32], 'category_id': 2}
+    img = torch.zeros(3, 64, 64)
+    for ambiguity, winner in [('area', 0), ('last', -1)]:
+        transform = FCOSTransform(mlvl_centers, thresholds=(0, 1e8), ambiguity=ambiguity)
+        for anns in [[a, b], [b, a]]:
+            cls_t = transform(img, anns)[1][1].view(8, 8)
+            assert cls_t[2, 2] == anns[winner]['category_id']
@@ -0,0 +1,77 @@
+import pytest
+import torch
+
+from horch.detection import get_locations
+from horch.models.detection.fovea import FoveaTransform, get_mlvl_centers, get_fovea
+
+from helpers import assert_transform_matches_loop, overwrite_order
+
+STRIDES = [8, 16, 32, 64, 128]
+
+
+def fovea_targets_loop(transform, mlvl_centers, anns):
+    loc_targets, cls_targets, ignores = [], [], []
+    for centers in mlvl_centers:
+        lx, ly = centers.size()[:2]
+        loc_targets.append(torch.zeros(lx, ly, 4))
+        cls_targets.append(torch.zeros(lx, ly, dtype=torch.long))
+        ignores.append(torch.zeros(lx, ly, dtype=torch.uint8))
+    for ann in anns:
+        l, t, w, h = ann['bbox']
+        for level, centers, (lo, hi), loc_t, cls_t, ignore in zip(
+                transform.levels, mlvl_centers, transform.thresholds, loc_targets, cls_targets, ignores):
+            if w * h <= lo or w * h >= hi:
+                continue
+            l_, t_, r_, b_, w_, h_ = [c / (2 ** level) for c in [l, t, l + w, t + h, w, h]]
+            cx_, cy_ = l_ + 0.5 * w_, t_ + 0.5 * h_
+            l_pos, t_pos, r_pos, b_pos = get_fovea(cx_, cy_, w_, h_, transform.shrunk_pos)
+            l_neg, t_neg, r_neg, b_neg = get_fovea(cx_, cy_, w_, h_, transform.shrunk_neg)
+            cx, cy = centers[..., 0], centers[..., 1]
+            pos = (l_pos < cx) & (cx < r_pos) & (t_pos < cy) & (cy < b_pos)
+            ignore |= (l_neg < cx) & (cx < r_neg) & (t_neg < cy) & (cy < b_neg)
+            ts = (torch.stack([cx - l_, cy - t_, r_ - cx, b_ - cy], dim=-1) / 4).log_()
+            loc_t[pos] = ts[pos]
+            cls_t[pos] = ann['category_id']
+    loc_t = torch.cat([t.view(-1, 4) for t in loc_targets])
+    cls_t = torch.cat([t.view(-1) for t in cls_targets])
+    ignore = torch.cat([t.view(-1) for t in ignores]) & (cls_t == 0)
+    return loc_t, cls_t, ignore
+
+
+@pytest.mark.parametrize('ambiguity', ['last', 'area'])
+def test_fovea_transform_matches_loop(ambiguity):
+    def make_transform(size):
+        return FoveaTransform(get_mlvl_centers(get_locations(size, STRIDES)), ambiguity=ambiguity)
+
+    def targets_loop(transform, anns):
+        return fovea_targets_loop(transform, transform.mlvl_centers, overwrite_order(anns, ambiguity))
+
+    assert_transform_matches_loop(make_transform, targets_loop, 0.9)
+
+
+def test_fovea_transform_min_area():
+    size = (128, 128)
+    mlvl_centers = get_mlvl_centers(get_locations(size, [8]))
+    small = {'bbox': [32, 32, 64, 64], 'category_id': 1}
+    large = {'bbox': [0, 0, 128, 128], 'category_id': 2}
+    img = torch.zeros(3, 128, 128)
+    transform = FoveaTransform(mlvl_centers, levels=(3,), thresholds=((0, 1e8),), ambiguity='area')
+    for anns in [[small, large], [large, small]]:
+        cls_t = transform(img, anns)[1][1].view(16, 16)
+        assert cls_t[7, 7] == 1
+    cls_t = FoveaTransform(mlvl_centers, levels=(3,), thresholds=((0, 1e8),))(img, [small, large])[1][1].view(16, 16)
+    assert cls_t[7, 7] == 2
+
+
+def test_fovea_transform_equal_areas():
+    size = (128, 128)
+    mlvl_centers = get_mlvl_centers(get_locations(size, [8]))
+    # The location (7, 7) is in the positive regions of both boxes, which have the same area
+    a = {'bbox': [0, 0, 96, 96], 'category_id': 1}
+    b = {'bbox': [16, 16, 96, 96], 'category_id': 2}
+    img = torch.zeros(3, 128, 128)
+    for ambiguity, winner in [('area', 0), ('last', -1)]:
+        transform = FoveaTransform(mlvl_centers, levels=(3,), thresholds=((0, 1e8),), ambiguity=ambiguity)
+        for anns in [[a, b], [b, a]]:
+            cls_t = transform(img, anns)[1][1].view(16, 16)
+            assert cls_t[7, 7] == anns[winner]['category_id']
@@ -0,0 +1,200 @@
+import torch
+
+from horch.detection import BBox
+from horch.detection import iou
+from horch.detection.iou import iou_mn, iou_mn_reduce, iou_b11, iou_b11_fused, IOU_KINDS
+from horch.nn.loss import iou_loss
+from horch.detection.one import match_anchors_flat, match_anchors_batch, pad_gts, _reduce_ious, coords_to_target
+from horch.detection.two import match_anchors, match_anchors2, match_rois, match_rois2
+
+
+def random_boxes(*size):
+    boxes = torch.rand(*size, 4)
+    boxes[..., 2:] = boxes[..., 2:] * 0.3 + 0.05
+    return BBox.convert(boxes, BBox.XYWH, BBox.LTRB, inplace=True)
+
+
+def test_iou_mn_reduce():
+    boxes1 = random_boxes(30)
+    boxes2 = random_boxes(10000)
+    ious = iou_mn(boxes1, boxes2)
+    max_ious, indices, gt_indices, counts = iou_mn_reduce(boxes1, boxes2, 0.3, tile_size=1000)
+    expected_max_ious, expected_indices = ious.max(dim=0)
+    assert torch.allclose(max_ious, expected_max_ious)
+    assert indices.tolist() == expected_indices.tolist()
+    assert gt_indices.tolist() == ious.max(dim=1)[1].tolist()
+    assert counts.tolist() == (ious >= 0.3).sum(dim=0).tolist()
+
+
+def test_match_anchors_tiled():
+    a_ltrb = random_boxes(5000)
+    a_xywh = BBox.convert(a_ltrb, BBox.LTRB, BBox.XYWH)
+    anns = [
+        {'bbox': [0.1, 0.1, 0.2, 0.2], 'category_id': 1},
+        {'bbox': [0.6, 0.5, 0.3, 0.2], 'category_id': 2},
+    ]
+    loc_t, cls_t, ignore = match_anchors_flat(anns, a_xywh, a_ltrb, 0.5, 0.4)
+    loc_t2, cls_t2, ignore2 = match_anchors_flat(anns, a_xywh, a_ltrb, 0.5, 0.4, max_dense_size=0)
+    assert cls_t.tolist() == cls_t2.tolist()
+    assert torch.allclose(loc_t, loc_t2)
+    assert ignore.tolist() == ignore2.tolist()
+
+
+def random_anns(n):
+    anns = []
+    for i in range(n):
+        # Disjoint cells of a 4x4 grid, so that no anchor overlaps two boxes.
+        cx, cy = divmod(i, 4)
+        w, h = (torch.rand(2) * 0.15 + 0.05).tolist()
+        anns.append({'bbox': [cx / 4 + 0.02, cy / 4 + 0.02, w, h], 'category_id': i % 5 + 1})
+    return anns
+
+
+def overlapping_anns(n):
+    # Boxes around the center of the image, which compete for the same anchors.
+    anns = []
+    for i in range(n):
+        l, t = (torch.rand(2) * 0.3 + 0.3).tolist()
+        w, h = (torch.rand(2) * 0.1 + 0.15).tolist()
+        anns.append({'bbox': [l, t, w, h], 'category_id': i % 5 + 1})
+    return anns
+
+
+def match_anchors_loop(anns, a_xywh, a_ltrb, pos_thresh, neg_thresh, force_last):
+    # Anchors over `pos_thresh` take the box with max IoU, then the boxes take their best
+    # anchors one by one, so that the last box wins a shared best anchor.
+    loc_t = a_xywh.new_zeros(len(a_xywh), 4)
+    cls_t = torch.zeros(len(a_xywh), dtype=torch.long)
+    if not anns:
+        return loc_t, cls_t, torch.zeros(len(a_xywh), dtype=torch.bool)
+    boxes = BBox.convert(torch.tensor([ann['bbox'] for ann in anns]), BBox.LTWH, BBox.XYWH, inplace=True)
+    ious = iou_mn(BBox.convert(boxes, BBox.XYWH, BBox.LTRB), a_ltrb)
+    max_ious, assign = ious.max(dim=0)
+    pos = max_ious > pos_thresh
+    threshold_pos = pos.clone()
+    for g, a in enumerate(ious.argmax(dim=1).tolist()):
+        if force_last or not threshold_pos[a]:
+            assign[a] = g
+        pos[a] = True
+    for a in torch.nonzero(pos).squeeze(1).tolist():
+        ann = anns[assign[a]]
+        loc_t[a] = coords_to_target(boxes[assign[a]], a_xywh[a])
+        cls_t[a] = ann['category_id']
+    return loc_t, cls_t, ~pos & (max_ious >= neg_thresh)
+
+
+def test_match_anchors_batch():
+    torch.manual_seed(0)
+    a_ltrb = random_boxes(3000)
+    a_xywh = BBox.convert(a_ltrb, BBox.LTRB, BBox.XYWH)
+    image_gts = [random_anns(n) for n in [3, 0, 7, 1, 16]]
+    gt_boxes, gt_labels, gt_mask = pad_gts(image_gts)
+    assert gt_boxes.size() == (5, 16, 4)
+    assert gt_mask.sum(dim=1).tolist() == [3, 0, 7, 1, 16]
+
+    for max_dense_size in [1 << 24, 3000 * 16 * 2, 0]:
+        loc_t, cls_t, ignore = match_anchors_batch(
+            gt_boxes, gt_labels, gt_mask, a_xywh, a_ltrb, 0.5, 0.3, max_dense_size=max_dense_size)
+        for i, anns in enumerate(image_gts):
+            loc_e, cls_e, ignore_e = match_anchors(
+                anns, a_xywh, a_ltrb, 0.5, 0.3, max_dense_size=1 << 24)
+            assert cls_t[i].tolist() == cls_e.tolist()
+            assert torch.allclose(loc_t[i], loc_e, atol=1e-6)
+            assert ignore[i].tolist() == ignore_e.bool().tolist()
+
+            loc_e, cls_e, ignore_e = match_anchors_flat(anns, a_xywh, a_ltrb, 0.5, 0.3)
+            assert cls_t[i].tolist() == cls_e.tolist()
+
+    gt_ltrb = BBox.convert(gt_boxes, BBox.XYWH, BBox.LTRB)
+    tiled = _reduce_ious(gt_ltrb, gt_mask, a_ltrb, 0.3, 1 << 24, tiled=True)
+    for max_dense_size in [1 << 24, 3000 * 16 * 2]:
+        dense = _reduce_ious(gt_ltrb, gt_mask, a_ltrb, 0.3, max_dense_size, tiled=False)
+        nonempty = gt_mask.any(dim=1)
+        assert torch.allclose(tiled[0][nonempty], dense[0][nonempty])
+        assert torch.equal(tiled[1][nonempty], dense[1][nonempty])
+        assert torch.equal(tiled[2][gt_mask], dense[2][gt_mask])
+
+
+def test_match_anchors_batch_overlapping():
+    torch.manual_seed(0)
+    a_ltrb = random_boxes(3000)
+    a_xywh = BBox.convert(a_ltrb, BBox.LTRB, BBox.XYWH)
+    image_gts = [overlapping_anns(n) for n in [2, 5, 0, 12]]
+    gt_boxes, gt_labels, gt_mask = pad_gts(image_gts)
+    for force_last in [True, False]:
+        for max_dense_size in [1 << 24, 0]:
+            loc_t, cls_t, ignore = match_anchors_batch(
+                gt_boxes, gt_labels, gt_mask, a_xywh, a_ltrb, 0.5, 0.3,
+                force_last=force_last, max_dense_size=max_dense_size)
+            for i, anns in enumerate(image_gts):
+                loc_e, cls_e, ignore_e = match_anchors_loop(anns, a_xywh, a_ltrb, 0.5, 0.3, force_last)
+                assert cls_t[i].tolist() == cls_e.tolist()
+                assert torch.allclose(loc_t[i], loc_e, atol=1e-6)
+                assert ignore[i].tolist() == ignore_e.tolist()
+
+    # Both boxes have their max IoU with the last anchor, which the first box matches exactly
+    a_ltrb = torch.cat([a_ltrb, torch.tensor([[0.4, 0.4, 0.6, 0.6]])])
+    a_xywh = BBox.convert(a_ltrb, BBox.LTRB, BBox.XYWH)
+    exact = {'bbox': [0.4, 0.4, 0.2, 0.2], 'category_id': 1}
+    shifted = {'bbox': [0.402, 0.4, 0.2, 0.2], 'category_id': 2}
+    for anns in [[exact, shifted], [shifted, exact]]:
+        gt_boxes, gt_labels, gt_mask = pad_gts([anns])
+        ious = iou_mn(BBox.convert(gt_boxes[0], BBox.XYWH, BBox.LTRB), a_ltrb)
+        assert ious.argmax(dim=1).tolist() == [3000, 3000]
+        cls_t = match_anchors_batch(gt_boxes, gt_labels, gt_mask, a_xywh, a_ltrb, 0.5, force_last=True)[1]
+        assert cls_t[0, 3000] == anns[-1]['category_id']
+        # Without force_last, the anchor is positive by threshold and keeps the box with max IoU
+        cls_t = match_anchors_batch(gt_boxes, gt_labels, gt_mask, a_xywh, a_ltrb, 0.5, force_last=False)[1]
+        assert cls_t[0, 3000] == exact['category_id']
+
+
+def test_two_stage_match_dense_and_tiled():
+    torch.manual_seed(0)
+    a_ltrb = random_boxes(500)
+    a_xywh = BBox.convert(a_ltrb, BBox.LTRB, BBox.XYWH)
+    # Two overlapping boxes for which some anchors clear pos_thresh, with the higher
+    # label on the box with the lower IoU
+    image_gts = [[{'bbox': [0.1, 0.1, 0.4, 0.4], 'category_id': 3},
+                  {'bbox': [0.15, 0.1, 0.4, 0.4], 'category_id': 1}]]
+    image_gts += [overlapping_anns(n) for n in [0, 1, 8]]
+    for anns in image_gts:
+        for f in [match_anchors, match_anchors2]:
+            dense = f(anns, a_xywh, a_ltrb, 0.5, 0.3)
+            tiled = f(anns, a_xywh, a_ltrb, 0.5, 0.3, max_dense_size=0)
+            for t1, t2 in zip(dense, tiled):
+                assert torch.equal(t1, t2)
+        for f in [match_rois, match_rois2]:
+            torch.manual_seed(1)
+            dense = f(anns, a_ltrb, 0.5, n_samples=64)
+            torch.manual_seed(1)
+            tiled = f(anns, a_ltrb, 0.5, n_samples=64, max_dense_size=0)
+            for t1, t2 in zip(dense, tiled):
+                assert torch.equal(t1, t2)
+
+
+def test_iou_b11_fused():
+    boxes1 = random_boxes(100).double()
+    boxes2 = (boxes1 + torch.randn_like(boxes1) * 0.05).double()
+    boxes2[:, 2:] = torch.max(boxes2[:, 2:], boxes2[:, :2] + 0.01)
+    assert torch.allclose(iou_b11_fused(boxes1, boxes2), iou_b11(boxes1, boxes2), atol=1e-5)
+    # alpha of CIoU is treated as a constant, so its gradient is not exact.
+    for kind in ['iou', 'giou', 'diou']:
+        assert torch.autograd.gradcheck(
+            lambda x, y: iou_b11_fused(x, y, kind),
+            (boxes1.requires_grad_(), boxes2.requires_grad_()))
+
+
+def test_iou_b11_fused_fallback(monkeypatch):
+    # Devices the extension is not built for use PyTorch ops, with the same values and gradients
+    boxes1 = random_boxes(100).double().requires_grad_()
+    boxes2 = random_boxes(100).double().requires_grad_()
+    native = [iou_b11_fused(boxes1, boxes2, kind) for kind in IOU_KINDS]
+    native_grads = torch.autograd.grad(sum(x.sum() for x in native), (boxes1, boxes2))
+    monkeypatch.setattr(iou, '_native_on', lambda tensor: False)
+    fallback = [iou_b11_fused(boxes1, boxes2, kind) for kind in IOU_KINDS]
+    fallback_grads = torch.autograd.grad(sum(x.sum() for x in fallback), (boxes1, boxes2))
+    for t1, t2 in zip(native + list(native_grads), fallback + list(fallback_grads)):
+        assert torch.allclose(t1, t2)
+
+    loss = iou_loss(torch.rand(10, 4, device='meta'), torch.rand(10, 4, device='meta'), kind='giou')
+    assert loss.device.type == 'meta'
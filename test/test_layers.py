@@ -2,6 +2,7 @@ import torch
 
 from horch import cuda
 from horch.nn.psroi_align import PSRoIAlign
+from horch.nn.roi_align import MultiScaleRoIAlign, roi_align
 from horch.detection import BBox
 
 
@@ -86,3 +87,28 @@ def test_psroi_align_cuda():
     res_cuda = l(cuda(x), cuda(roi))
     diff = res - res_cuda.cpu()
     assert diff.mean() < 1e-8
+
+
+def test_multi_scale_roi_align():
+    torch.manual_seed(0)
+    levels = (3, 4, 5)
+    ps = [torch.randn(2, 4, 64 // 2 ** l, 96 // 2 ** l, requires_grad=True) for l in levels]
+    rois = BBox.convert(torch.rand(20, 4) * 0.5 + 0.02, BBox.XYWH, BBox.LTRB)
+    rois[:3] = torch.tensor([[0.1, 0.1, 0.12, 0.12], [0.0, 0.0, 1.0, 1.0], [0.2, 0.2, 0.7, 0.7]])
+    rois = torch.cat([torch.randint(2, (20, 1)).float(), rois], dim=1)
+    pool = MultiScaleRoIAlign(3, levels, canonical_size=32)
+    assigned = pool.assign_levels(ps, rois)
+    assert assigned[:3].tolist() == [0, 2, 1]
+    assert assigned.unique().tolist() == [0, 1, 2]
+
+    out, = pool(ps, rois)
+    for i, l in enumerate(assigned.tolist()):
+        p = ps[l]
+        assert torch.allclose(out[i], roi_align(p, rois[i:i + 1], (3, 3), tuple(p.size()[2:4]), 2)[0])
+    out.sum().backward()
+    assert all(p.grad is not None for p in ps)
+
+    outs = MultiScaleRoIAlign(3, levels, all_levels=True)(ps, rois)
+    assert len(outs) == 3
+    for p, o in zip(ps, outs):
+        assert torch.equal(o, roi_align(p, rois, (3, 3), tuple(p.size()[2:4]), 2))
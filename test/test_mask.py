@@ -0,0 +1,121 @@
+import random
+
+import numpy as np
+import torch
+
+from horch.detection.two.mask import stack_masks, mask_targets, match_rois2, MatchRoIs, _decode_masks
+from horch.nn.roi_align import roi_align
+
+
+def rle_counts(mask):
+    pixels = mask.T.reshape(-1)
+    bounds = np.concatenate([[0], np.nonzero(pixels[1:] != pixels[:-1])[0] + 1, [len(pixels)]])
+    counts = np.diff(bounds).tolist()
+    return [0] + counts if pixels[0] == 1 else counts
+
+
+def rle_to_string(counts):
+    # `rleToString` of the COCO API
+    s = []
+    for i, x in enumerate(counts):
+        if i > 2:
+            x -= counts[i - 2]
+        more = True
+        while more:
+            c = x & 0x1f
+            x >>= 5
+            more = x != -1 if c & 0x10 else x != 0
+            if more:
+                c |= 0x20
+            s.append(chr(c + 48))
+    return ''.join(s)
+
+
+def test_stack_masks_rle():
+    rng = np.random.RandomState(0)
+    masks = [(rng.rand(13, 17) > 0.6).astype(np.uint8) for _ in range(3)]
+    masks[1][:] = 1
+    counts = [rle_counts(m) for m in masks]
+    for m, c in zip(masks, counts):
+        assert sum(c) == m.size
+    segms = [
+        masks[0],
+        {'size': [13, 17], 'counts': counts[1]},
+        {'size': [13, 17], 'counts': rle_to_string(counts[2])},
+    ]
+    assert torch.equal(stack_masks(segms), torch.from_numpy(np.stack(masks)))
+
+
+def test_decode_rles_of_different_sizes():
+    rng = np.random.RandomState(0)
+    masks = [(rng.rand(*size) > 0.5).astype(np.uint8) for size in [(40, 60), (60, 40), (13, 17), (40, 60)]]
+    segms = [
+        {'size': list(m.shape), 'counts': rle_to_string(rle_counts(m)) if i % 2 else rle_counts(m)}
+        for i, m in enumerate(masks)
+    ]
+    decoded = _decode_masks(segms)
+    for m, d in zip(masks, decoded):
+        assert torch.equal(d, torch.from_numpy(m))
+
+    rois = torch.tensor([[0., 0., 1., 1.]]).expand(4, 4)
+    mask_t = mask_targets(segms, torch.arange(4), rois, (40, 60))
+    assert torch.equal(mask_t[0], torch.from_numpy(masks[0]).float())
+
+
+def test_mask_targets():
+    mask = torch.zeros(60, 80, dtype=torch.uint8)
+    mask[10:40, 20:60] = 1
+    rois = torch.tensor([[20 / 80, 10 / 60, 60 / 80, 40 / 60], [0, 0, 1, 1]])
+    mask_t = mask_targets([mask], torch.tensor([0, 0]), rois, (14, 14))
+    assert mask_t.size() == (2, 14, 14)
+    assert mask_t[0].eq(1).all()
+    assert mask_t[1].sum() > 0 and mask_t[1, 0].eq(0).all()
+
+    # Masks of different sizes, RoIs stay relative to their own mask
+    small = torch.ones(30, 40, dtype=torch.uint8)
+    mask_t = mask_targets([mask, small], torch.tensor([0, 1]), rois, (7, 7))
+    assert mask_t[0].eq(1).all() and mask_t[1].eq(1).all()
+
+
+def test_mask_targets_same_as_full_masks():
+    torch.manual_seed(0)
+    masks = (torch.rand(3, 40, 50) > 0.5).to(torch.uint8)
+    rois = torch.rand(20, 4) * 0.6
+    rois[:, 2:] += rois[:, :2] * 0.5 + 0.01
+    rois[:4] = torch.tensor([[0, 0, 1, 1], [0, 0, 0.05, 0.05], [0.95, 0.9, 1, 1], [0, 0.5, 0.02, 1]])
+    segm_indices = torch.randint(3, (20,))
+    scales = torch.tensor([50., 40., 50., 40.])
+    boxes = torch.cat([segm_indices[:, None].float(), rois * scales - 0.5], dim=1)
+    expected = roi_align(masks[:, None].float(), boxes, (14, 14), (1.0, 1.0), 2)[:, 0]
+    mask_t = mask_targets(list(masks), segm_indices, rois)
+    # Samples are shifted to the windows, which may round ties at the threshold differently
+    ties = (expected - 0.5).abs() < 1e-5
+    assert torch.equal(mask_t[~ties], (expected[~ties] >= 0.5).float())
+
+
+def random_image_gts(n, size=(48, 64)):
+    h, w = size
+    anns = []
+    for _ in range(n):
+        l, t = random.randint(0, w // 2), random.randint(0, h // 2)
+        r, b = random.randint(l + 4, w), random.randint(t + 4, h)
+        mask = np.zeros(size, dtype=np.uint8)
+        mask[t:b, l:r] = 1
+        anns.append({'bbox': [l / w, t / h, (r - l) / w, (b - t) / h], 'category_id': random.randint(1, 5),
+                     'segmentation': mask})
+    return anns
+
+
+def test_match_rois_batch_masks():
+    random.seed(0)
+    image_gts = [random_image_gts(n) for n in [3, 1, 5]]
+    rois = torch.rand(3, 50, 4) * 0.5
+    rois[..., 2:] += rois[..., :2] + 0.05
+    rois = torch.cat([torch.arange(3.)[:, None, None].expand(3, 50, 1), rois], dim=-1)
+    torch.manual_seed(0)
+    expected = [match_rois2(anns, rois[i, :, 1:], n_samples=16) for i, anns in enumerate(image_gts)]
+    torch.manual_seed(0)
+    loc_t, cls_t, mask_t, _ = MatchRoIs(n_samples=16)(rois, image_gts)
+    assert torch.equal(mask_t, torch.cat([e[2] for e in expected]))
+    assert torch.equal(cls_t, torch.cat([e[1] for e in expected]))
+    assert mask_t.size(0) == 3 * 4
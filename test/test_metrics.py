@@ -1,7 +1,6 @@
 import numpy as np
 
-from horch.detection import BBox
-from horch.train.metrics import mAP
+from horch.detection import BBox, mAP
 
 
 def test_mAP():
@@ -64,3 +63,35 @@ def test_mAP():
     ) for d in ground_truths]
     np.testing.assert_allclose(
         mAP(detections, ground_truths, iou_threshold=0.295), 0.2456867)
+
+
+def test_coco_average_precision():
+    from horch.detection.eval import compute_dataset_map
+    from horch.train.metrics import CocoAveragePrecision
+
+    rng = np.random.RandomState(0)
+    image_gts, image_dets = [], []
+    for i in range(6):
+        gts = [{'image_id': i, 'category_id': int(rng.randint(3)),
+                'bbox': list(rng.uniform(10, 50, size=4))} for _ in range(rng.randint(1, 5))]
+        dets = [{'category_id': g['category_id'], 'score': float(rng.uniform()),
+                 'bbox': list(np.array(g['bbox']) + rng.normal(0, 3, size=4))} for g in gts]
+        dets += [{'category_id': int(rng.randint(3)), 'score': float(rng.uniform()),
+                  'bbox': list(rng.uniform(10, 50, size=4))} for _ in range(rng.randint(0, 4))]
+        image_gts.append(gts)
+        image_dets.append(dets)
+
+    metric = CocoAveragePrecision()
+    metric.reset()
+    for b in range(0, 6, 4):
+        metric.update(metric.output_transform({
+            'target': [image_gts[b:b + 4]], 'preds': image_dets[b:b + 4], 'batch_size': 2}))
+
+    def ltrb(b):
+        return [b[0], b[1], b[0] + b[2], b[1] + b[3]]
+
+    dts = [(ltrb(d['bbox']), d['score'], i, d['category_id']) for i, ds in enumerate(image_dets) for d in ds]
+    gts = [(ltrb(g['bbox']), i, g['category_id']) for i, gs in enumerate(image_gts) for g in gs]
+    values = compute_dataset_map(*map(np.array, zip(*dts)), *map(np.array, zip(*gts)),
+                                 np.arange(0.5, 1, 0.05))
+    np.testing.assert_allclose(metric.compute(), [np.mean(values), values[0], values[5]])
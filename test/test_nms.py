@@ -0,0 +1,101 @@
+import torch
+
+from horch.detection import BBox
+from horch.detection.nms import (
+    nms, batched_nms, multiclass_nms, soft_nms_cpu, softer_nms_cpu, matrix_nms, cluster_nms
+)
+
+
+def random_boxes(*size):
+    boxes = torch.rand(*size, 4)
+    boxes[..., 2:] = boxes[..., 2:] * 0.3 + 0.05
+    return BBox.convert(boxes, BBox.XYWH, BBox.LTRB, inplace=True)
+
+
+def test_batched_nms():
+    batch_size, num_boxes = 4, 200
+    boxes = random_boxes(batch_size, num_boxes)
+    scores = torch.rand(batch_size, num_boxes)
+    mask = torch.rand(batch_size, num_boxes) > 0.3
+
+    image_indices = batched_nms(boxes, scores, mask, iou_threshold=0.5)
+    assert len(image_indices) == batch_size
+    for i in range(batch_size):
+        valid = torch.nonzero(mask[i]).squeeze(1)
+        expected = valid[nms(boxes[i][valid], scores[i][valid], 0.5)]
+        assert image_indices[i].tolist() == expected.tolist()
+
+    flat_boxes = boxes.view(-1, 4)
+    flat_scores = scores.view(-1)
+    idxs = torch.arange(batch_size).repeat_interleave(num_boxes)
+    keep = batched_nms(flat_boxes, flat_scores, idxs, iou_threshold=0.5)
+    expected = torch.cat([
+        nms(boxes[i], scores[i], 0.5) + i * num_boxes for i in range(batch_size)])
+    assert keep.tolist() == expected.tolist()
+
+    # Flat boxes without idxs are one group
+    assert batched_nms(flat_boxes, flat_scores, iou_threshold=0.5).tolist() == \
+        nms(flat_boxes, flat_scores, 0.5).tolist()
+
+
+def test_multiclass_nms():
+    num_boxes, num_classes = 300, 5
+    boxes = random_boxes(num_boxes)
+    scores = torch.rand(num_boxes)
+    labels = torch.randint(num_classes, (num_boxes,))
+
+    keep = multiclass_nms(boxes, scores, labels, 0.5, max_per_class=10, max_total=30)
+    expected = []
+    for c in range(num_classes):
+        indices = torch.nonzero(labels == c).squeeze(1)
+        expected.append(indices[nms(boxes[indices], scores[indices], 0.5)][:10])
+    expected = torch.cat(expected)
+    expected = expected[scores[expected].argsort(descending=True)][:30]
+    assert keep.tolist() == expected.tolist()
+
+
+def test_soft_nms_heap():
+    boxes = random_boxes(2000)
+    scores = torch.rand(2000)
+    indices = soft_nms_cpu(boxes, scores.clone(), 0.3, 200, 0.01)
+    heap_indices = soft_nms_cpu(boxes, scores.clone(), 0.3, 200, 0.01, algorithm='heap')
+    assert indices.tolist() == heap_indices.tolist()
+
+    vars = torch.rand(2000, 4) * 0.1 + 0.01
+    indices = softer_nms_cpu(boxes.clone(), scores.clone(), vars, 0.3, 200)
+    heap_indices = softer_nms_cpu(boxes.clone(), scores.clone(), vars, 0.3, 200, algorithm='heap')
+    assert indices.tolist() == heap_indices.tolist()
+
+
+def test_cluster_nms():
+    batch_size, num_boxes = 4, 200
+    boxes = random_boxes(batch_size, num_boxes)
+    scores = torch.rand(batch_size, num_boxes)
+    mask = torch.rand(batch_size, num_boxes) > 0.3
+
+    keep = cluster_nms(boxes, scores, mask, iou_threshold=0.5)
+    for i, indices in enumerate(batched_nms(boxes, scores, mask, iou_threshold=0.5)):
+        assert torch.nonzero(keep[i]).squeeze(1).tolist() == sorted(indices.tolist())
+    assert cluster_nms(boxes[0, :0], scores[0, :0]).tolist() == []
+
+
+def test_matrix_nms():
+    batch_size, num_boxes = 4, 200
+    boxes = random_boxes(batch_size, num_boxes)
+    scores = torch.rand(batch_size, num_boxes)
+    mask = torch.rand(batch_size, num_boxes) > 0.3
+
+    for kernel in ['gaussian', 'linear']:
+        decayed = matrix_nms(boxes, scores, mask, kernel=kernel)
+        assert (decayed[~mask] == 0).all()
+        for i in range(batch_size):
+            valid = torch.nonzero(mask[i]).squeeze(1)
+            expected = matrix_nms(boxes[i][valid], scores[i][valid], kernel=kernel)
+            assert torch.allclose(decayed[i][valid], expected)
+            assert (expected <= scores[i][valid]).all()
+            assert expected.max() == scores[i][valid].max()
+
+    # A duplicate is decayed, a disjoint box is not
+    boxes = torch.tensor([[0., 0., 1., 1.], [0., 0., 1., 1.], [2., 2., 3., 3.]])
+    decayed = matrix_nms(boxes, torch.tensor([0.9, 0.8, 0.7]), kernel='linear')
+    assert decayed.tolist() == [0.8999999761581421, 0., 0.699999988079071]
@@ -0,0 +1,207 @@
+import torch
+
+from horch.detection import BBox, get_locations, generate_mlvl_anchors, generate_anchors_with_priors
+from horch.detection.detections import Detections
+from horch.detection.nms import nms, soft_nms_cpu, multiclass_nms
+from horch.detection.postprocess import topk_per_image, batched_detections, parallel_nms
+from horch.detection.one import AnchorBasedInference, flatten, target_to_coords
+from horch.models.detection import fovea
+from horch.models.detection.refinedet import AnchorRefineInference
+from horch.models.detection.yolo import YOLOInference, get_locations as yolo_locations
+
+STRIDES = [8, 16, 32]
+ANCHOR_SIZES = [
+    torch.tensor([[16., 16.], [24., 12.]]),
+    torch.tensor([[32., 32.], [48., 24.]]),
+    torch.tensor([[64., 64.], [96., 48.]]),
+]
+SIZE = (256, 192)
+
+
+def test_topk_per_image():
+    scores = torch.tensor([0.1, 0.9, 0.5, 0.3, 0.8, 0.7])
+    batch_idxs = torch.tensor([1, 0, 1, 0, 1, 0])
+    assert topk_per_image(scores, batch_idxs, 2).tolist() == [1, 5, 4, 2]
+    assert topk_per_image(scores, batch_idxs, 2, batch_size=3).tolist() == [1, 5, 4, 2]
+
+
+def test_batched_detections_keeps_images_apart():
+    bboxes = torch.tensor([[0., 0., 1., 1.], [0., 0., 1., 1.], [0., 0., 0.5, 0.5]])
+    scores = torch.tensor([0.9, 0.8, 0.7])
+    labels = torch.tensor([0, 0, 1])
+    batch_idxs = torch.tensor([0, 2, 0])
+    for nms_method in ['nms', 'multiclass', 'soft', 'cluster']:
+        dets = batched_detections(bboxes.clone(), scores.clone(), labels, batch_idxs, 3, nms_method)
+        assert dets.counts.tolist() == [2, 0, 1]
+        assert dets.labels.tolist() == [1, 2, 1]
+
+
+def assert_same(batch, singles, atol=1e-8):
+    expected = Detections.cat(singles)
+    assert torch.equal(batch.offsets, expected.offsets)
+    assert torch.allclose(batch.boxes, expected.boxes, atol=atol)
+    assert torch.allclose(batch.scores, expected.scores)
+    assert torch.equal(batch.labels, expected.labels)
+
+
+def per_image_nms(bboxes, scores, labels, nms_method, iou_threshold, topk, min_score):
+    # The per-image nms step of the inference functions before they were batched
+    if nms_method in ['soft', 'soft_nms']:
+        indices = soft_nms_cpu(bboxes, scores, iou_threshold, topk, min_score=min_score)
+    elif nms_method == 'multiclass':
+        indices = multiclass_nms(bboxes, scores, labels, iou_threshold, None, topk)
+    else:
+        indices = nms(bboxes, scores, iou_threshold)
+        scores = scores[indices]
+        labels = labels[indices]
+        bboxes = bboxes[indices]
+        if scores.size(0) > topk:
+            indices = scores.topk(topk)[1]
+        else:
+            indices = range(scores.size(0))
+    bboxes = BBox.convert(bboxes, format=BBox.LTRB, to=BBox.LTWH, inplace=True)
+    return Detections.single(bboxes, scores, labels + 1, indices)
+
+
+def select(scores, conf_threshold, nms_method):
+    if nms_method == 'multiclass':
+        pos, labels = torch.nonzero(scores > conf_threshold).t()
+        return pos, scores[pos, labels], labels
+    scores, labels = scores.max(dim=1)
+    pos = torch.nonzero(scores > conf_threshold).squeeze(1)
+    return pos, scores[pos], labels[pos]
+
+
+def reference_anchor_based(loc_p, cls_p, anchors, conf_threshold, iou_threshold, topk, nms_method):
+    pos, scores, labels = select(torch.sigmoid(cls_p)[:, 1:], conf_threshold, nms_method)
+    bboxes = BBox.convert(target_to_coords(loc_p[pos], anchors[pos]), format=BBox.XYWH, to=BBox.LTRB)
+    return per_image_nms(bboxes, scores, labels, nms_method, iou_threshold, topk, conf_threshold)
+
+
+def reference_yolo(loc_p, obj_p, cls_p, anchors, locations, conf_threshold, iou_threshold, topk, nms_method):
+    pos, scores, labels = select(torch.sigmoid(cls_p) * torch.sigmoid(obj_p)[:, None], conf_threshold, nms_method)
+    bboxes, anchors = loc_p[pos], anchors[pos]
+    bboxes[:, :2].sigmoid_().sub_(0.5).div_(locations[pos]).add_(anchors[:, :2])
+    bboxes[:, 2:].exp_().mul_(anchors[:, 2:])
+    bboxes = BBox.convert(bboxes, format=BBox.XYWH, to=BBox.LTRB)
+    return per_image_nms(bboxes, scores, labels, nms_method, iou_threshold, topk, 0.01)
+
+
+def reference_fovea(loc_preds, cls_preds, mlvl_centers, conf_threshold, iou_threshold, topk1, nms_method, topk2):
+    mlvl_scores, mlvl_labels, mlvl_bboxes = [], [], []
+    for loc_p, cls_p, centers in zip(loc_preds, cls_preds, mlvl_centers):
+        lx, ly = centers.size()[:2]
+        pos, scores, labels = select(cls_p[:, 1:].sigmoid(), conf_threshold, nms_method)
+        centers = centers.view(-1, 2)[pos]
+        bboxes = loc_p[pos].exp() * 4
+        bboxes = torch.cat([centers - bboxes[:, :2], centers + bboxes[:, 2:]], dim=1)
+        bboxes[:, [0, 2]] /= lx
+        bboxes[:, [1, 3]] /= ly
+        mlvl_scores.append(scores)
+        mlvl_labels.append(labels)
+        mlvl_bboxes.append(bboxes)
+    scores = torch.cat(mlvl_scores)
+    labels = torch.cat(mlvl_labels)
+    bboxes = torch.cat(mlvl_bboxes)
+    if len(scores) == 0:
+        return Detections.empty()
+    if len(scores) > topk1:
+        scores, indices = scores.topk(topk1)
+        labels = labels[indices]
+        bboxes = bboxes[indices]
+    return per_image_nms(bboxes, scores, labels, nms_method, iou_threshold, topk2, conf_threshold)
+
+
+def test_batch_inference_matches_per_image():
+    # The references follow the per-image inference loops that the batched ones replaced
+    torch.manual_seed(0)
+    mlvl_anchors = generate_mlvl_anchors(SIZE, STRIDES, ANCHOR_SIZES)
+    anchors = flatten(mlvl_anchors)
+    loc_p = torch.randn(3, len(anchors), 4) * 0.2
+    cls_p = torch.randn(3, len(anchors), 5) - 1
+    cls_p[1] = -20
+    for nms_method in ['soft', 'nms', 'multiclass']:
+        inference = AnchorBasedInference(mlvl_anchors, 0.3, nms=nms_method, conf_strategy='sigmoid', topk=20)
+        assert_same(inference(loc_p.clone(), cls_p.clone()), [
+            reference_anchor_based(loc_p[i], cls_p[i], anchors, 0.3, 0.5, 20, nms_method)
+            for i in range(3)
+        ])
+
+    priors = torch.rand(3, 2, 2) * 0.5
+    mlvl_anchors = [generate_anchors_with_priors(SIZE, s, p) for s, p in zip(STRIDES, priors)]
+    anchors, locations = flatten(mlvl_anchors), yolo_locations(mlvl_anchors)
+    loc_p = torch.randn(3, len(anchors), 4) * 0.2
+    obj_p = torch.randn(3, len(anchors))
+    cls_p = torch.randn(3, len(anchors), 4)
+    for nms_method in ['soft', 'nms', 'multiclass']:
+        inference = YOLOInference(mlvl_anchors, 0.2, nms=nms_method, topk=20)
+        assert_same(inference(loc_p.clone(), obj_p.clone(), cls_p.clone()), [
+            reference_yolo(loc_p[i], obj_p[i], cls_p[i], anchors, locations, 0.2, 0.5, 20, nms_method)
+            for i in range(3)
+        ], atol=1e-6)
+
+    locations = get_locations(SIZE, STRIDES)
+    mlvl_centers = fovea.get_mlvl_centers(locations)
+    loc_preds = [torch.randn(3, lx * ly, 4) * 0.3 for lx, ly in locations]
+    cls_preds = [torch.randn(3, lx * ly, 5) - 1 for lx, ly in locations]
+    cls_preds[0][1] = -20
+    for nms_method in ['soft_nms', 'nms', 'multiclass']:
+        inference = fovea.FoveaInference(mlvl_centers, 0.3, topk1=50, nms_method=nms_method, topk2=20)
+        assert_same(inference(loc_preds, cls_preds), [
+            reference_fovea([p[i] for p in loc_preds], [p[i] for p in cls_preds], mlvl_centers,
+                            0.3, 0.5, 50, nms_method, 20)
+            for i in range(3)
+        ])
+
+
+def test_fused_inference_matches():
+    torch.manual_seed(0)
+    mlvl_anchors = generate_mlvl_anchors(SIZE, STRIDES, ANCHOR_SIZES)
+    n = len(flatten(mlvl_anchors))
+    loc_p = torch.randn(3, n, 4) * 0.2
+    cls_p = torch.randn(3, n, 5) - 1
+    cls_p[1] = -20
+    for conf_strategy in ['softmax', 'sigmoid']:
+        for nms in ['soft', 'nms', 'multiclass']:
+            kwargs = dict(conf_strategy=conf_strategy, nms=nms, topk=20, max_per_class=5)
+            inference = AnchorBasedInference(mlvl_anchors, 0.3, **kwargs)
+            fused = AnchorBasedInference(mlvl_anchors, 0.3, fused=True, **kwargs)
+            assert_same(fused(loc_p.clone(), cls_p.clone()), [inference(loc_p.clone(), cls_p.clone())])
+
+    r_loc_p = torch.randn(3, n, 4) * 0.2
+    r_cls_p = torch.randn(3, n)
+    for reg in ['refine', 'residual']:
+        for nms in ['soft', 'nms', 'multiclass']:
+            kwargs = dict(r_topk=200, d_topk=20, detect_conf_threshold=0.3, detect_nms=nms, reg=reg)
+            inference = AnchorRefineInference(mlvl_anchors, **kwargs)
+            fused = AnchorRefineInference(mlvl_anchors, fused=True, **kwargs)
+            assert_same(fused(r_loc_p, r_cls_p, loc_p, cls_p), [inference(r_loc_p, r_cls_p, loc_p, cls_p)])
+
+
+def test_parallel_nms_inference():
+    torch.manual_seed(0)
+    mlvl_anchors = generate_mlvl_anchors(SIZE, STRIDES, ANCHOR_SIZES)
+    anchors = flatten(mlvl_anchors)
+    loc_p = torch.randn(3, len(anchors), 4) * 0.2
+    cls_p = torch.randn(3, len(anchors), 5) - 1
+    cls_p[1] = -20
+
+    # Cluster nms keeps the same boxes as greedy nms
+    expected = AnchorBasedInference(mlvl_anchors, 0.3, nms='nms', conf_strategy='sigmoid', topk=20)
+    inference = AnchorBasedInference(mlvl_anchors, 0.3, nms='cluster', conf_strategy='sigmoid', topk=20)
+    assert_same(inference(loc_p.clone(), cls_p.clone()), [expected(loc_p.clone(), cls_p.clone())])
+
+    # Batched matrix nms is the same as matrix nms of every image
+    inference = AnchorBasedInference(mlvl_anchors, 0.3, nms='matrix', conf_strategy='sigmoid', topk=20)
+    singles = []
+    for i in range(3):
+        scores, labels = torch.sigmoid(cls_p[i, :, 1:]).max(dim=1)
+        indices = torch.nonzero(scores > 0.3).squeeze(1)
+        bboxes = BBox.convert(target_to_coords(loc_p[i][indices], anchors[indices]), BBox.XYWH, BBox.LTRB)
+        keep, scores = parallel_nms(bboxes, scores[indices], 'matrix', topk=20, min_score=0.3)
+        singles.append(Detections.single(bboxes, scores, labels[indices] + 1, keep))
+    dets = inference(loc_p.clone(), cls_p.clone())
+    singles = Detections.cat(singles)
+    assert torch.equal(dets.offsets, singles.offsets)
+    assert torch.allclose(dets.scores, singles.scores)
+    assert torch.equal(dets.labels, singles.labels)
@@ -0,0 +1,102 @@
+import random
+from math import log
+
+import torch
+
+from horch.common import inverse_sigmoid
+from horch.detection import generate_anchors_with_priors
+from horch.detection.anchor_cache import MlvlPriors
+from horch.models.detection.yolo import YOLOTransform, iou_1m_with_size
+
+STRIDES = [8, 16, 32]
+
+
+def match_anchors_loop(anns, mlvl_priors, locations, ignore_thresh):
+    loc_targets, cls_targets, ignores = [], [], []
+    priors_per_level = mlvl_priors.size(1)
+    for (lx, ly), priors in zip(locations, mlvl_priors):
+        loc_targets.append(priors.new_zeros((lx, ly, priors_per_level, 4)))
+        cls_targets.append(priors.new_zeros((lx, ly, priors_per_level), dtype=torch.long))
+        ignores.append(priors.new_zeros((lx, ly, priors_per_level), dtype=torch.uint8))
+    for ann in anns:
+        l, t, w, h = ann['bbox']
+        x, y = l + w / 2, t + h / 2
+        ious = iou_1m_with_size(torch.tensor([w, h]), mlvl_priors)
+        level, i = divmod(ious.view(-1).max(dim=0)[1].item(), priors_per_level)
+        lx, ly = locations[level]
+        pw, ph = mlvl_priors[level, i]
+        cx, offset_x = divmod(x * lx, 1)
+        cy, offset_y = divmod(y * ly, 1)
+        loc_targets[level][int(cx), int(cy), i] = torch.tensor(
+            [inverse_sigmoid(offset_x), inverse_sigmoid(offset_y), log(w / pw), log(h / ph)])
+        cls_targets[level][int(cx), int(cy), i] = ann['category_id']
+        for level, i in torch.nonzero(ious > ignore_thresh):
+            lx, ly = locations[level]
+            ignores[level][int(x * lx), int(y * ly), i] = 1
+    return [torch.cat([t.reshape(-1, *t.shape[3:]) for t in ts]) for ts in (loc_targets, cls_targets, ignores)]
+
+
+def random_anns(n):
+    anns = []
+    for _ in range(n):
+        w, h = random.uniform(0.01, 0.9), random.uniform(0.01, 0.9)
+        anns.append({'bbox': [random.uniform(0, 1 - w), random.uniform(0, 1 - h), w, h],
+                     'category_id': random.randint(1, 80)})
+    return anns
+
+
+def test_yolo_transform_matches_loop():
+    random.seed(0)
+    torch.manual_seed(0)
+    size = (320, 256)
+    priors = torch.rand(3, 3, 2) * 0.6 + 0.02
+    mlvl_anchors = [generate_anchors_with_priors(size, s, p) for s, p in zip(STRIDES, priors)]
+    transform = YOLOTransform(mlvl_anchors, ignore_thresh=0.5)
+    img = torch.zeros(3, size[1], size[0])
+    for n in [0, 1, 10, 50]:
+        anns = random_anns(n)
+        # Same cell and prior, the later one wins
+        anns += [dict(a, category_id=81) for a in anns[:1]]
+        expected = match_anchors_loop(anns, transform.mlvl_priors, transform.locations, 0.5)
+        for t1, t2 in zip(transform(img, anns)[1], expected):
+            assert t1.dtype == t2.dtype
+            assert torch.equal(t1, t2)
+
+
+def test_yolo_transform_batch():
+    random.seed(0)
+    torch.manual_seed(0)
+    size = (320, 256)
+    transform = YOLOTransform(MlvlPriors(STRIDES, torch.rand(3, 3, 2) * 0.6 + 0.02), ignore_thresh=0.5)
+    img = torch.zeros(3, size[1], size[0])
+    image_gts = [random_anns(n) for n in [3, 0, 20]]
+    targets = transform.batch(image_gts, size)
+    for i, anns in enumerate(image_gts):
+        for t1, t2 in zip(targets, transform(img, anns)[1]):
+            assert torch.equal(t1[i], t2)
+
+
+def test_yolo_transform_center_on_edge():
+    torch.manual_seed(0)
+    size = (320, 256)
+    transform = YOLOTransform(MlvlPriors(STRIDES, torch.rand(3, 3, 2) * 0.6 + 0.02), ignore_thresh=0.5)
+    # Centers on the right, bottom and bottom right edges of the image
+    image_gts = [[{'bbox': [0.8, 0.2, 0.4, 0.2], 'category_id': 1}],
+                 [{'bbox': [0.2, 0.9, 0.2, 0.2], 'category_id': 2}],
+                 [{'bbox': [0.9, 0.9, 0.2, 0.2], 'category_id': 3}]]
+    loc_t, cls_t, ignore = transform.batch(image_gts, size)
+    for i, anns in enumerate(image_gts):
+        assert cls_t[i].tolist().count(anns[0]['category_id']) == 1
+    assert torch.isfinite(loc_t).all()
+
+    locations = transform.anchors.locations(size)
+    priors_per_level = transform.mlvl_priors.size(1)
+    start = 0
+    for lx, ly in locations:
+        cells = cls_t[:, start:start + lx * ly * priors_per_level].view(3, lx, ly, priors_per_level)
+        ignores = ignore[:, start:start + lx * ly * priors_per_level].view(3, lx, ly, priors_per_level)
+        # Only the last column or row, nothing wrapped around to the next one or to the next image
+        assert not cells[0, :-1].any() and not ignores[0, :-1].any()
+        assert not cells[1, :, :-1].any() and not ignores[1, :, :-1].any()
+        assert not cells[2, :-1].any() and not cells[2, :, :-1].any()
+        start += lx * ly * priors_per_level